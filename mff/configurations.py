@@ -19,6 +19,201 @@ class MissingData(Exception):
     pass
 
 
+class PackedConfs(object):
+    """ Ragged collection of local atomic configurations stored in contiguous arrays.
+
+    The neighbours of configuration i are stored in the rows offsets[i]:offsets[i+1]
+    of ``positions`` and ``species``. Indexing with an integer returns the usual
+    M by 5 array, indexing with a slice or an array of indices returns a new
+    PackedConfs, so that the object can be used wherever a list of configurations is expected.
+
+    Args:
+        positions (array): K by 3 positions of all the neighbours w.r.t. their central atom
+        species (array): K atomic numbers of all the neighbours
+        offsets (array): N+1 CSR-style offsets of each configuration into positions and species
+        central (array): N atomic numbers of the central atoms
+
+    """
+
+    def __init__(self, positions, species, offsets, central):
+        self.positions = np.ascontiguousarray(positions, dtype=np.float64).reshape(-1, 3)
+        self.species = np.ascontiguousarray(species, dtype=np.int64)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        self.central = np.ascontiguousarray(central, dtype=np.int64)
+
+    @classmethod
+    def from_confs(cls, confs):
+        """ Pack a list of M by 5 configurations.
+
+        Args:
+            confs (list of arrays): List of M by 5 numpy arrays, where M is the number of atoms within
+                r_cut from the central one.
+
+        Returns:
+            packed (PackedConfs): the packed configurations
+
+        """
+
+        if isinstance(confs, cls):
+            return confs
+
+        confs = [np.asarray(c, dtype=np.float64).reshape(-1, 5) for c in confs]
+        sizes = np.array([len(c) for c in confs], dtype=np.int64)
+        offsets = np.zeros(len(confs) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+
+        if len(confs) and offsets[-1] > 0:
+            flat = np.concatenate(confs)
+        else:
+            flat = np.zeros((0, 5))
+
+        # The central species is repeated on every row, and unknown for empty confs
+        central = np.array([c[0, 3] if len(c) else 0 for c in confs], dtype=np.int64)
+
+        return cls(flat[:, :3], flat[:, 4], offsets, central)
+
+    @property
+    def sizes(self):
+        """ Number of neighbours of each configuration """
+        return np.diff(self.offsets)
+
+    @property
+    def conf_index(self):
+        """ Index of the configuration each neighbour belongs to """
+        return np.repeat(np.arange(len(self)), self.sizes)
+
+    def __len__(self):
+        return len(self.central)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('configuration index out of range')
+            start, stop = self.offsets[index], self.offsets[index + 1]
+            conf = np.empty((stop - start, 5))
+            conf[:, :3] = self.positions[start:stop]
+            conf[:, 3] = self.central[index]
+            conf[:, 4] = self.species[start:stop]
+            return conf
+
+        if isinstance(index, slice) and index.step in (None, 1):
+            start, stop, _ = index.indices(len(self))
+            stop = max(start, stop)
+            lo, hi = self.offsets[start], self.offsets[stop]
+            return PackedConfs(self.positions[lo:hi], self.species[lo:hi],
+                               self.offsets[start:stop + 1] - lo, self.central[start:stop])
+
+        index = np.arange(len(self))[index]
+        sizes = self.sizes[index]
+        offsets = np.zeros(len(index) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        rows = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - self.offsets[index], sizes)
+        return PackedConfs(self.positions[rows], self.species[rows], offsets, self.central[index])
+
+    def to_list(self):
+        """ Unpack into a list of M by 5 arrays """
+        return [conf for conf in self]
+
+    def padded(self):
+        """ Zero-padded dense view of the configurations.
+
+        Returns:
+            positions (array): N by Mmax by 3 positions
+            species (array): N by Mmax atomic numbers of the neighbours
+            mask (array): N by Mmax boolean array, False for padded entries
+
+        """
+
+        sizes = self.sizes
+        n, m = len(self), int(sizes.max()) if len(self) else 0
+        rows = self.conf_index
+        cols = np.arange(len(rows)) - self.offsets[rows]
+
+        positions = np.zeros((n, m, 3))
+        species = np.zeros((n, m), dtype=np.int64)
+        mask = np.zeros((n, m), dtype=bool)
+        positions[rows, cols] = self.positions
+        species[rows, cols] = self.species
+        mask[rows, cols] = True
+
+        return positions, species, mask
+
+
+class PackedGlobalConfs(object):
+    """ Packed configurations grouped by snapshot, replacing a list of lists of
+    M by 5 arrays. Indexing with an integer returns the PackedConfs of one snapshot.
+
+    Args:
+        confs (PackedConfs): configurations of all the snapshots, one after the other
+        offsets (array): S+1 offsets of each snapshot into confs
+
+    """
+
+    def __init__(self, confs, offsets):
+        self.confs = confs
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_global_confs(cls, global_confs):
+        """ Pack a list of lists of M by 5 configurations.
+
+        Args:
+            global_confs (list of lists of arrays): list containing lists of configurations, grouped together
+                so that local atomic environments taken from the same snapshot are in the same group.
+
+        Returns:
+            packed (PackedGlobalConfs): the packed snapshots
+
+        """
+
+        if isinstance(global_confs, cls):
+            return global_confs
+
+        sizes = np.array([len(g) for g in global_confs], dtype=np.int64)
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        confs = PackedConfs.from_confs([c for g in global_confs for c in g])
+
+        return cls(confs, offsets)
+
+    @property
+    def sizes(self):
+        """ Number of configurations in each snapshot """
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('snapshot index out of range')
+            return self.confs[self.offsets[index]:self.offsets[index + 1]]
+
+        index = np.arange(len(self))[index]
+        sizes = self.sizes[index]
+        offsets = np.zeros(len(index) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        rows = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - self.offsets[index], sizes)
+        return PackedGlobalConfs(self.confs[rows], offsets)
+
+    def to_list(self):
+        """ Unpack into a list of lists of M by 5 arrays """
+        return [snapshot.to_list() for snapshot in self]
+
+
 def carve_from_snapshot(atoms, r_cut, forces_label=None, energy_label=None, atoms_ind=None):
     """Extract atomic configurations, the forces acting on the central atoms
     os said configurations, and the local energy values associated to a single atoms object.
@@ -213,7 +408,7 @@ def load(path, r_cut):
     return data.item()
 
 
-def unpack(data):
+def unpack(data, packed=False):
     """ From a data dictionary, generate elements, configurations, forces, energies and
         global configurations to be used by the GP module.
 
@@ -221,6 +416,8 @@ def unpack(data):
         data (dict): Structure containing, for each snapshot in the trajectory, 
             the forces, energy, and local atomic configurations for that snapshot's atoms.
             Obtained from ``generate``
+        packed (bool): if True, confs and global_confs are returned as PackedConfs
+            and PackedGlobalConfs
 
     Returns:
         elements (list): Atomic numbers of all atomic species present in the dataset
@@ -248,22 +445,28 @@ def unpack(data):
         forces = np.array([item for sublist in forces for item in sublist])
     except:
         logger.warning("No forces in the data file")
-    confs = np.array([item for sublist in global_confs for item in sublist])
+    if not packed:
+        confs = np.array([item for sublist in global_confs for item in sublist])
     try:
         energies = np.array(energies)
     except:
         logger.warning("No energies in the data file")
-    global_confs = np.array(global_confs)
+    if packed:
+        global_confs = PackedGlobalConfs.from_global_confs(global_confs)
+        confs = global_confs.confs
+    else:
+        global_confs = np.array(global_confs)
 
     return elements, confs, forces, energies, global_confs
 
 
-def load_and_unpack(path, r_cut):
+def load_and_unpack(path, r_cut, packed=False):
     """ Load data saved with ``save`` and unpack it with ``unpak``
 
     Args:
         path (Path or string): Name and position of file to load data from
         r_cut (float): Cutoff used
+        packed (bool): if True, return PackedConfs and PackedGlobalConfs
 
     Returns:
         elements (list): Atomic numbers of all atomic species present in the dataset
@@ -278,6 +481,6 @@ def load_and_unpack(path, r_cut):
 
     """
     data = load(path, r_cut)
-    elements, confs, forces, energies, global_confs = unpack(data)
+    elements, confs, forces, energies, global_confs = unpack(data, packed)
 
     return elements, confs, forces, energies, global_confs
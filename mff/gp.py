@@ -7,6 +7,8 @@ from scipy.linalg import cho_solve, cholesky, solve_triangular
 from scipy.optimize import fmin_l_bfgs_b
 
 from mff import interpolation, kernels
+from mff.kernels.speciesblocks import block_rows, species_partition
+from mff.outofcore import GramFile
 
 logger = logging.getLogger(__name__)
 
@@ -18,31 +20,50 @@ class GaussianProcess(object):
     Args:
         kernel (obj): A kernel object (typically a two or three body)
         noise (float): The regularising noise level (typically named \sigma_n^2)
-        optimizer (str): The kind of optimization of marginal likelihood (not implemented yet)
+        optimizer (str): None, or "fmin_l_bfgs_b" to choose the hyperparameters of the kernel
+            by maximizing the log-marginal likelihood of the training forces in fit, using
+            the gradient of the gram matrix computed by the kernel
+        n_restarts_optimizer (int): number of additional optimizations started from
+            random hyperparameters within the bounds of the kernel
+        random_state (int): seed of the generator drawing the starting hyperparameters of
+            the restarts, default is None for a random seed
 
     Attributes:
         X_train_ (list): The configurations used for training
+        D_train_ (list): Descriptors of the training configurations, computed once by
+            the kernel and used in place of X_train_ in all the kernel calls
+        D_glob_train_ (list): Descriptors of the global training configurations
+        dtype_ (str): "float64" or "float32", precision of the kernel used in the last fit.
+            Models fitted with single-precision kernels are meant for screening
         alpha_ (array): The coefficients obtained during training
         L_ (array): The lower triangular matrix from cholesky decomposition of gram matrix
+        L_blocks_ (list): (rows, L) Cholesky factors of the independent species blocks of
+            the force gram matrix, when fit splits it, see ``mff.kernels.speciesblocks``.
+            L_ and K are then None
         K (array): The kernel gram matrix
     """
 
     # optimizers "fmin_l_bfgs_b"
 
     def __init__(self, kernel=None, noise=1e-10,
-                 optimizer=None, n_restarts_optimizer=0):
+                 optimizer=None, n_restarts_optimizer=0, random_state=None):
 
         self.kernel = kernel
         self.noise = noise
         self.optimizer = optimizer
         self.n_restarts_optimizer = n_restarts_optimizer
+        self.random_state = random_state
+        self._rng = np.random.RandomState(random_state)
         self.fitted = [None, None]
 
-    def calc_gram_ff(self, X):
+    def calc_gram_ff(self, X, ncores=1, gram_file=None):
         """Calculate the force-force kernel gram matrix
 
         Args:
             X (list): list of N training configurations, which are M x 5 matrices
+            ncores (int): number of CPU workers to use, default is 1
+            gram_file (str): optional path of a file the gram matrix is written into
+                tile by tile, resuming from the tiles already there, see ``GramFile``
 
         Returns:
             K (matrix): The force-force gram matrix, has dimensions 3N x 3N
@@ -50,7 +71,10 @@ class GaussianProcess(object):
 
         self.kernel_ = self.kernel
         self.X_train_ = X
-        K = self.kernel_.calc_gram(self.X_train_, self.ncores)
+        self.D_train_ = self.kernel_.describe(X)
+        if gram_file is not None:
+            return GramFile(gram_file, self.kernel_, self.D_train_).compute(ncores)
+        K = self.kernel_.calc_gram(self.D_train_, ncores)
         return K
 
     def calc_gram_ee(self, X):
@@ -65,68 +89,97 @@ class GaussianProcess(object):
 
         self.kernel_ = self.kernel
         self.X_train_ = X
-        K = self.kernel_.calc_gram_e(self.X_train_, self.ncores)
+        self.D_train_ = self.kernel_.describe(X, 'global')
+        K = self.kernel_.calc_gram_e(self.D_train_, self.ncores)
         return K
 
-    def fit(self, X, y, ncores=1):
+    def fit(self, X, y, ncores=1, gram_file=None):
         """Fit a Gaussian process regression model on training forces
 
         Args:
             X (list): training configurations
             y (np.ndarray): training forces
             ncores (int): number of CPU workers to use, default is 1
+            gram_file (str): optional path of a file the gram matrix is written into
+                tile by tile and factorized in place, for gram matrices that do not fit
+                in memory. An interrupted fit resumes from the tiles and Cholesky panels
+                already in the file, see ``GramFile``. K is then None, and the lower
+                triangle of L_ is read from the file.
+
+        With a many-species kernel whose gram matrix splits in independent species blocks,
+        the gram matrix of each block is computed and factorized on its own, and their
+        factors are stored in L_blocks_.
 
         """
         self.kernel_ = self.kernel
+        self.dtype_ = self.kernel_.dtype
         self.X_train_ = X
+        self.D_train_ = self.kernel_.describe(X)
         self.y_train_ = np.reshape(y, (y.shape[0] * 3, 1))
 
-        # if self.optimizer is not None:
-        #     # Choose hyperparameters based on maximizing the log-marginal
-        #     # likelihood (potentially starting from several initial values)
-        #     def obj_func(theta, eval_gradient=True):
-        #         if eval_gradient:
-        #             lml, grad = self.log_marginal_likelihood(
-        #                 theta, eval_gradient=True)
-        #             return -lml, -grad
-        #         else:
-        #             return -self.log_marginal_likelihood(theta)
-
-        #     # First optimize starting from theta specified in kernel_
-        #     optima = [(self._constrained_optimization(obj_func,
-        #                                               self.kernel_.theta,
-        #                                               self.kernel_.bounds))]
-
-        #     # Additional runs are performed from log-uniform chosen initial
-        #     # theta
-        #     if self.n_restarts_optimizer > 0:
-        #         if not np.isfinite(self.kernel_.bounds).all():
-        #             raise ValueError(
-        #                 "Multiple optimizer restarts (n_restarts_optimizer>0) "
-        #                 "requires that all bounds are finite.")
-        #         bounds = self.kernel_.bounds
-        #         for iteration in range(self.n_restarts_optimizer):
-        #             theta_initial = \
-        #                 self._rng.uniform(bounds[:, 0], bounds[:, 1])
-        #             optima.append(
-        #                 self._constrained_optimization(obj_func, theta_initial,
-        #                                                bounds))
-        #     # Select result from run with minimal (negative) log-marginal
-        #     # likelihood
-        #     lml_values = list(map(itemgetter(1), optima))
-        #     self.kernel_.theta = optima[np.argmin(lml_values)][0]
-        #     self.log_marginal_likelihood_value_ = -np.min(lml_values)
-        # else:
-        #     self.log_marginal_likelihood_value_ = \
-        #         self.log_marginal_likelihood(self.kernel_.theta)
+        if self.optimizer is not None:
+            # Choose hyperparameters based on maximizing the log-marginal
+            # likelihood (potentially starting from several initial values).
+            # Each step needs one evaluation of the gram matrix and its gradient
+            def obj_func(theta, eval_gradient=True):
+                if eval_gradient:
+                    lml, grad = self.log_marginal_likelihood(
+                        theta, eval_gradient=True, ncores=ncores)
+                    return -lml, -grad
+                else:
+                    return -self.log_marginal_likelihood(theta, ncores=ncores)
+
+            # First optimize starting from theta specified in kernel_
+            optima = [(self._constrained_optimization(obj_func,
+                                                      self.kernel_.theta,
+                                                      self.kernel_.bounds))]
+
+            # Additional runs are performed from uniformly chosen initial theta
+            if self.n_restarts_optimizer > 0:
+                bounds = np.asarray(self.kernel_.bounds, dtype=float)
+                if not np.isfinite(bounds).all():
+                    raise ValueError(
+                        "Multiple optimizer restarts (n_restarts_optimizer>0) "
+                        "requires that all bounds are finite.")
+                for iteration in range(self.n_restarts_optimizer):
+                    theta_initial = self._rng.uniform(bounds[:, 0], bounds[:, 1])
+                    optima.append(
+                        self._constrained_optimization(obj_func, theta_initial,
+                                                       bounds))
+            # Select result from run with minimal (negative) log-marginal
+            # likelihood
+            lml_values = [optimum[1] for optimum in optima]
+            self.kernel_.theta = optima[int(np.argmin(lml_values))][0]
+            self.log_marginal_likelihood_value_ = -np.min(lml_values)
+            logger.info("Optimized hyperparameters: %s" % (self.kernel_.theta,))
 
         # Precompute quantities required for predictions which are independent
         # of actual query points
-        K = self.kernel_.calc_gram(self.X_train_, ncores)
-        K[np.diag_indices_from(K)] += self.noise
+        blocks = []
+        if gram_file is None and getattr(self.kernel_, 'species_zeros', False):
+            blocks = species_partition(self.D_train_)
+        self.L_blocks_ = None
+        if len(blocks) > 1:
+            logger.info('Factorizing the gram matrix in %i species blocks' % len(blocks))
+            self.L_blocks_ = []
+            K = None
+        elif gram_file is None:
+            K = self.kernel_.calc_gram(self.D_train_, ncores)
+            K[np.diag_indices_from(K)] += self.noise
+        else:
+            gram = GramFile(gram_file, self.kernel_, self.D_train_)
+            gram.compute(ncores)
+            K = None
 
         try:  # Use Cholesky decomposition to build the lower triangular matrix
-            self.L_ = cholesky(K, lower=True)
+            if self.L_blocks_ is not None:
+                self.L_ = None
+                for indices in blocks:
+                    K_block = self.kernel_.calc_gram([self.D_train_[i] for i in indices], ncores)
+                    K_block[np.diag_indices_from(K_block)] += self.noise
+                    self.L_blocks_.append((block_rows(indices, 3), cholesky(K_block, lower=True)))
+            else:
+                self.L_ = cholesky(K, lower=True) if K is not None else gram.cholesky(self.noise)
         except np.linalg.LinAlgError as exc:
             exc.args = ("The kernel, %s, is not returning a "
                         "positive definite matrix. Try gradually "
@@ -136,11 +189,19 @@ class GaussianProcess(object):
             raise
 
         # Calculate the alpha weights using the Cholesky method
-        self.alpha_ = cho_solve((self.L_, True), self.y_train_)
+        if self.L_blocks_ is not None:
+            self.alpha_ = np.zeros(self.y_train_.shape)
+            for rows, L in self.L_blocks_:
+                self.alpha_[rows] = cho_solve((L, True), self.y_train_[rows])
+        elif K is not None:
+            self.alpha_ = cho_solve((self.L_, True), self.y_train_)
+        else:
+            self.alpha_ = gram.cho_solve(self.y_train_)
         self.K = K
         self.energy_alpha_ = None
         self.energy_K = None
         self.X_glob_train_ = None
+        self.D_glob_train_ = None
         self.fitted[0] = 'force'
         self.n_train = len(self.y_train_) // 3
 
@@ -158,8 +219,11 @@ class GaussianProcess(object):
 
         """
         self.kernel_ = self.kernel
+        self.dtype_ = self.kernel_.dtype
         self.X_train_ = X
         self.X_glob_train_ = X_glob
+        self.D_train_ = self.kernel_.describe(X)
+        self.D_glob_train_ = self.kernel_.describe(X_glob, 'global')
         self.y_train_ = np.reshape(y_force, (y_force.shape[0] * 3, 1))
         self.y_train_energy_ = np.reshape(y_energy, (y_energy.shape[0], 1))
 
@@ -212,14 +276,14 @@ class GaussianProcess(object):
 
         # Precompute quantities required for predictions which are independent
         # of actual query points
-        K_ff = self.kernel_.calc_gram(self.X_train_, ncores)
+        K_ff = self.kernel_.calc_gram(self.D_train_, ncores)
         K_ff[np.diag_indices_from(K_ff)] += self.noise
 
-        K_ee = self.kernel_.calc_gram_e(self.X_glob_train_, ncores)
+        K_ee = self.kernel_.calc_gram_e(self.D_glob_train_, ncores)
         K_ee[np.diag_indices_from(K_ee)] += self.noise
 
         K_ef = self.kernel_.calc_gram_ef(
-            self.X_train_, self.X_glob_train_, ncores)
+            self.D_train_, self.D_glob_train_, ncores)
 
         K = np.zeros((y_force.shape[0] * 3 + y_energy.shape[0],
                       y_force.shape[0] * 3 + y_energy.shape[0]))
@@ -228,6 +292,7 @@ class GaussianProcess(object):
         K[y_energy.shape[0]:, :y_energy.shape[0]] = K_ef.T
         K[y_energy.shape[0]:, y_energy.shape[0]:] = K_ff
 
+        self.L_blocks_ = None
         try:  # Use Cholesky decomposition to build the lower triangular matrix
             self.L_ = cholesky(K, lower=True)  # Line 2
         except np.linalg.LinAlgError as exc:
@@ -262,7 +327,9 @@ class GaussianProcess(object):
 
         """
         self.kernel_ = self.kernel
+        self.dtype_ = self.kernel_.dtype
         self.X_glob_train_ = X_glob
+        self.D_glob_train_ = self.kernel_.describe(X_glob, 'global')
         self.y_train_energy_ = np.reshape(y, (y.shape[0], 1))
 
         if self.optimizer is not None:  # TODO Debug
@@ -312,9 +379,10 @@ class GaussianProcess(object):
 
         # Precompute quantities required for predictions which are independent
         # of actual query points
-        self.energy_K = self.kernel_.calc_gram_e(self.X_glob_train_, ncores)
+        self.energy_K = self.kernel_.calc_gram_e(self.D_glob_train_, ncores)
         self.energy_K[np.diag_indices_from(self.energy_K)] += self.noise
 
+        self.L_blocks_ = None
         try:  # Use Cholesky decomposition to build the lower triangular matrix
             self.L_ = cholesky(self.energy_K, lower=True)
         except np.linalg.LinAlgError as exc:
@@ -332,6 +400,7 @@ class GaussianProcess(object):
         self.fitted[1] = 'energy'
         self.n_train = len(self.y_train_energy_)
         self.X_train_ = None
+        self.D_train_ = None
 
         return self
 
@@ -358,7 +427,7 @@ class GaussianProcess(object):
         # Unfitted; predict based on GP prior
         if not hasattr(self, "X_glob_train_") and not hasattr(self, "X_train_"):
             kernel = self.kernel
-            y_mean = np.zeros(X.shape[0])
+            y_mean = np.zeros(len(X))
             logger.warning("No training data, predicting based on prior")
             if return_std:
                 y_var = kernel.calc_diag(X)
@@ -367,32 +436,27 @@ class GaussianProcess(object):
                 return y_mean
 
         else:  # Predict based on GP posterior
+            X = self.kernel_.describe(X)
             if self.fitted == ['force', None]:  # Predict using force data
-                K_trans = self.kernel_.calc(X, self.X_train_, ncores)
+                K_trans = self.kernel_.calc(X, self.D_train_, ncores)
                 y_mean = K_trans.dot(self.alpha_[:, 0])
 
             elif self.fitted == [None, 'energy']:  # Predict using energy data
                 K_force_energy = self.kernel_.calc_ef(
-                    self.X_glob_train_, X, ncores).T
+                    self.D_glob_train_, X, ncores).T
                 y_mean = K_force_energy.dot(self.energy_alpha_[:, 0])
 
             else:  # Predict using both force and energy data
-                K_trans = self.kernel_.calc(X, self.X_train_, ncores)
+                K_trans = self.kernel_.calc(X, self.D_train_, ncores)
                 K_force_energy = self.kernel_.calc_ef(
-                    self.X_glob_train_, X, ncores).T
+                    self.D_glob_train_, X, ncores).T
                 K = np.hstack((K_force_energy, K_trans))
                 y_mean = K.dot(self.alpha_[:, 0])
 
             if return_std:  # TODO CHECK FOR ENERGY, FORCE and FORCE +ENERGY FIT
-                # compute inverse K_inv of K based on its Cholesky
-                # decomposition L and its inverse L_inv
-                L_inv = solve_triangular(self.L_.T, np.eye(self.L_.shape[0]))
-                K_inv = L_inv.dot(L_inv.T)
-
                 # Compute variance of predictive distribution
                 y_var = self.kernel_.calc_diag(X)
-                fit = np.einsum("ij,ij->i", np.dot(K_trans, K_inv), K_trans)
-                y_var -= fit
+                y_var -= self._variance_fit(K_trans)
 
                 # Check if any of the variances is negative because of
                 # numerical issues. If yes: set the variance to 0.
@@ -436,48 +500,40 @@ class GaussianProcess(object):
                 return e_mean
 
         else:  # Predict based on GP posterior
+            X = self.kernel_.describe(X, 'local' if mapping else 'global')
 
             if self.fitted == ['force', None]:  # Predict using force data
                 K_trans = self.kernel_.calc_ef(
-                    X, self.X_train_, ncores, mapping, **kwargs)
+                    X, self.D_train_, ncores, mapping, **kwargs)
                 # Line 4 (y_mean = f_star)
                 e_mean = K_trans.dot(self.alpha_[:, 0])
 
             elif self.fitted == [None, 'energy']:  # Predict using energy data
                 K_energy = self.kernel_.calc_ee(
-                    X, self.X_glob_train_, ncores, mapping, **kwargs)
+                    X, self.D_glob_train_, ncores, mapping, **kwargs)
                 e_mean = K_energy.dot(self.energy_alpha_[:, 0])
 
             else:  # Predict using both force and energy data
                 K_energy = self.kernel_.calc_ee(
-                    X, self.X_glob_train_, ncores, mapping, **kwargs)
+                    X, self.D_glob_train_, ncores, mapping, **kwargs)
                 K_energy_force = self.kernel_.calc_ef(
-                    X, self.X_train_, ncores, mapping, **kwargs)
+                    X, self.D_train_, ncores, mapping, **kwargs)
                 K = np.hstack((K_energy, K_energy_force))
                 e_mean = K.dot(self.alpha_[:, 0])
 
             if return_std:  # TODO CHECK FOR ENERGY, FORCE and FORCE +ENERGY FIT
-                # compute inverse K_inv of K based on its Cholesky
-                # decomposition L and its inverse L_inv
-                L_inv = solve_triangular(self.L_.T, np.eye(self.L_.shape[0]))
-                K_inv = L_inv.dot(L_inv.T)
                 # Compute variance of predictive distribution
                 if self.fitted == ['force', None]:  # Predict using force data
                     e_var = self.kernel_.calc_diag_e(X)
-                    fit = np.einsum(
-                        "ij,ij->i", np.dot(K_trans, K_inv), K_trans)
-                    e_var -= fit
+                    e_var -= self._variance_fit(K_trans)
 
                 elif self.fitted == [None, 'energy']:  # Predict using force data
                     e_var = self.kernel_.calc_diag_e(X)
-                    fit = np.einsum(
-                        "ij,ij->i", np.dot(K_energy, K_inv), K_energy)
-                    e_var -= fit
+                    e_var -= self._variance_fit(K_energy)
 
                 else:  # Predict using force data
                     e_var = self.kernel_.calc_diag_e(X)
-                    fit = np.einsum("ij,ij->i", np.dot(K, K_inv), K)
-                    e_var -= fit
+                    e_var -= self._variance_fit(K)
 
                 # Check if any of the variances is negative because of
                 # numerical issues. If yes: set the variance to 0.
@@ -492,7 +548,7 @@ class GaussianProcess(object):
                 return e_mean
 
     # TODO: debug for energy and energy-force fitting
-    def log_marginal_likelihood(self, theta=None, eval_gradient=False):
+    def log_marginal_likelihood(self, theta=None, eval_gradient=False, ncores=1):
         """Returns log-marginal likelihood of theta for training data.
 
         Args:
@@ -504,6 +560,7 @@ class GaussianProcess(object):
                 If True, the gradient of the log-marginal likelihood with respect
                 to the kernel hyperparameters at position theta is returned
                 additionally. If True, theta must not be None.
+            ncores (int): number of CPU workers to use, default is 1
 
         Returns:
             log_likelihood : float
@@ -524,9 +581,9 @@ class GaussianProcess(object):
         kernel.theta = theta
 
         if eval_gradient:
-            K, K_gradient = kernel.calc_gram(self.X_train_, eval_gradient=True)
+            K, K_gradient = kernel.calc_gram(self.D_train_, ncores, eval_gradient=True)
         else:
-            K = kernel.calc_gram(self.X_train_)
+            K = kernel.calc_gram(self.D_train_, ncores)
 
         K[np.diag_indices_from(K)] += self.noise
         try:
@@ -563,6 +620,49 @@ class GaussianProcess(object):
         else:
             return log_likelihood
 
+    def gram_inverse(self):
+        """Inverse of the training gram matrix plus noise, from its Cholesky factor L_,
+        or from the factors of its species blocks in L_blocks_
+
+        Returns:
+            K_inv (np.ndarray): the inverse of the gram matrix
+
+        """
+
+        if getattr(self, 'L_blocks_', None) is None:
+            # compute inverse K_inv of K based on its Cholesky
+            # decomposition L and its inverse L_inv
+            L_inv = solve_triangular(self.L_.T, np.eye(self.L_.shape[0]))
+            return L_inv.dot(L_inv.T)
+
+        K_inv = np.zeros((len(self.alpha_), len(self.alpha_)))
+        for rows, L in self.L_blocks_:
+            K_inv[np.ix_(rows, rows)] = cho_solve((L, True), np.eye(len(rows)))
+        return K_inv
+
+    def _variance_fit(self, K_trans):
+        """Part of the prior variance explained by the training data, the diagonal of
+        K_trans K^-1 K_trans^T. Models fitted by species blocks solve each block with its
+        own Cholesky factor, without building the inverse of the whole gram matrix
+
+        Args:
+            K_trans (np.ndarray): kernel between the target and the training configurations
+
+        Returns:
+            fit (np.ndarray): the variance to subtract from the prior variance of each target
+
+        """
+
+        if getattr(self, 'L_blocks_', None) is None:
+            K_inv = self.gram_inverse()
+            return np.einsum("ij,ij->i", np.dot(K_trans, K_inv), K_trans)
+
+        fit = np.zeros(len(K_trans))
+        for rows, L in self.L_blocks_:
+            K_block = K_trans[:, rows]
+            fit += np.einsum("ij,ji->i", K_block, cho_solve((L, True), K_block.T))
+        return fit
+
     def _constrained_optimization(self, obj_func, initial_theta,
                                   bounds):  # TODO: debug for energy and energy-force fitting
         if self.optimizer == "fmin_l_bfgs_b":
@@ -604,7 +704,7 @@ class GaussianProcess(object):
         kernel = self.kernel
         # kernel.theta = theta
 
-        K = kernel.calc_gram(self.X_train_)
+        K = kernel.calc_gram(self.D_train_)
 
         K[np.diag_indices_from(K)] += self.noise
 
@@ -627,6 +727,15 @@ class GaussianProcess(object):
 
         return pseudo_log_likelihood
 
+    def close_pool(self):
+        """Shut down the worker pool used by the kernel for parallel calculations.
+        The pool is otherwise kept alive between calls to fit and predict, and is
+        closed automatically when the interpreter exits.
+
+        """
+
+        self.kernel.close_pool()
+
     def save(self, filename):
         """Dump the current GP model for later use
 
@@ -635,21 +744,23 @@ class GaussianProcess(object):
 
         """
 
-        output = [self.kernel_.kernel_name,
-                  self.noise,
-                  self.optimizer,
-                  self.n_restarts_optimizer,
-                  self.fitted,
-                  self.alpha_,
-                  self.K,
-                  self.energy_alpha_,
-                  self.energy_K,
-                  self.X_train_,
-                  self.X_glob_train_,
-                  self.L_,
-                  self.n_train]
-
-        np.save(filename, output)
+        output = {'kernel_name': self.kernel_.kernel_name,
+                  'noise': self.noise,
+                  'optimizer': self.optimizer,
+                  'n_restarts_optimizer': self.n_restarts_optimizer,
+                  'fitted': self.fitted,
+                  'alpha_': self.alpha_,
+                  'K': self.K,
+                  'energy_alpha_': self.energy_alpha_,
+                  'energy_K': self.energy_K,
+                  'X_train_': self.X_train_,
+                  'X_glob_train_': self.X_glob_train_,
+                  'L_': self.L_,
+                  'L_blocks_': getattr(self, 'L_blocks_', None),
+                  'n_train': self.n_train,
+                  'dtype_': self.dtype_}
+
+        np.save(filename, np.array(output, dtype=object))
 
     def load(self, filename):
         """Load a saved GP model
@@ -658,21 +769,41 @@ class GaussianProcess(object):
             filename (str): name of the file where the GP is saved
 
         """
-        self.kernel.kernel_name, \
-            self.noise, \
-            self.optimizer, \
-            self.n_restarts_optimizer, \
-            self.fitted, \
-            self.alpha_, \
-            self.K, \
-            self.energy_alpha_, \
-            self.energy_K, \
-            self.X_train_, \
-            self.X_glob_train_, \
-            self.L_, \
-            self.n_train = np.load(filename, allow_pickle=True)
+        output = np.load(filename, allow_pickle=True)
+
+        if output.ndim == 0:
+            output = output.item()
+        else:
+            # Models saved as a list of fields, before the dtype option in double precision
+            keys = ('kernel_name', 'noise', 'optimizer', 'n_restarts_optimizer', 'fitted',
+                    'alpha_', 'K', 'energy_alpha_', 'energy_K', 'X_train_', 'X_glob_train_',
+                    'L_', 'n_train', 'dtype_')
+            output = dict(zip(keys, list(output) + ['float64']))
+            if isinstance(output['L_'], list):
+                output['L_blocks_'], output['L_'] = output['L_'], None
+
+        self.kernel.kernel_name = output['kernel_name']
+        self.noise = output['noise']
+        self.optimizer = output['optimizer']
+        self.n_restarts_optimizer = output['n_restarts_optimizer']
+        self.fitted = output['fitted']
+        self.alpha_ = output['alpha_']
+        self.K = output['K']
+        self.energy_alpha_ = output['energy_alpha_']
+        self.energy_K = output['energy_K']
+        self.X_train_ = output['X_train_']
+        self.X_glob_train_ = output['X_glob_train_']
+        self.L_ = output['L_']
+        self.L_blocks_ = output.get('L_blocks_')
+        self.n_train = output['n_train']
+        self.dtype_ = output['dtype_']
 
         self.kernel_ = self.kernel
+        self.D_train_ = self.kernel_.describe(self.X_train_)
+        self.D_glob_train_ = self.kernel_.describe(self.X_glob_train_, 'global')
+        if self.dtype_ != self.kernel_.dtype:
+            logger.warning("The GP was fitted with a %s kernel, the current kernel uses %s"
+                           % (self.dtype_, self.kernel_.dtype))
 
         print('Loaded GP from file')
 
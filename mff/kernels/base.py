@@ -1,13 +1,491 @@
+import atexit
+import hashlib
+import logging
+import multiprocessing as mp
 import os
+import pickle
+import sys
+import tempfile
+import weakref
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
 from pathlib import Path
 
+import numpy as np
+
+from mff.kernels import parallel
+from mff.kernels.blockcache import BlockCache
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, where the cache is not locked
+    fcntl = None
+
 path = Path(os.path.abspath(__file__))
-Mffpath = path.parent.parent / "cache/"
+
+logger = logging.getLogger(__name__)
+
+# Modules defining the theano graphs, their sources are part of the cache key
+KERNEL_MODULES = ('twobodykernel.py', 'threebodykernel.py', 'manybodykernel.py', 'eamkernel.py')
+
+# Compiled kernel functions already loaded by this process, by pickle path
+_functions = {}
+
+_cache_version = None
+
+# Kernels with a running worker pool, shut down on interpreter exit
+_pooled_kernels = weakref.WeakSet()
+
+# Suffix of the compiled functions of each precision, double precision keeps the plain names
+DTYPE_SUFFIXES = {'float64': '', 'float32': '_f32'}
+
+# Recursion limit needed to pickle and unpickle the compiled theano functions
+RECURSION_LIMIT = 100000
+
+
+def function_name(name, kertype=None, dtype='float64'):
+    """ Name of the compiled version of a kernel function, as stored in the cache folder
+
+    Args:
+        name (str): name of the function, e.g. "k2_ff"
+        kertype (str): "single" or "multi", selects the _s or _m version
+        dtype (str): "float64" or "float32", precision of the compiled function
+
+    Returns:
+        name (str): the name of the function, e.g. "k2_ff_s_f32"
+
+    """
+
+    if kertype is not None:
+        name = name + {"single": "_s", "multi": "_m"}[kertype]
+    return name + DTYPE_SUFFIXES[dtype]
+
+
+def cache_root():
+    """ Folder of the compiled kernel cache. It is given by the MFF_CACHE_DIR environment
+    variable if set, and is otherwise the mff folder of $XDG_CACHE_HOME, ~/.cache/mff
+    by default.
+
+    Returns:
+        root (Path): the cache folder, shared by all the versions of the kernels
+
+    """
+
+    root = os.environ.get('MFF_CACHE_DIR')
+    if not root:
+        root = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'mff'
+    return Path(root)
+
+
+def cache_version():
+    """ Key of the compiled kernels, a hash of the sources of the kernel modules
+    and of the versions of Python, NumPy and Theano. Compiled functions are only
+    reused by the installations with the same key.
+
+    Returns:
+        version (str): hexadecimal key
+
+    """
+
+    global _cache_version
+    if _cache_version is None:
+        try:
+            import theano
+            theano_version = theano.__version__
+        except ImportError:
+            theano_version = None
+        h = hashlib.sha1()
+        for name in KERNEL_MODULES:
+            h.update((path.parent / name).read_bytes())
+        h.update(repr((sys.version, np.__version__, theano_version)).encode())
+        _cache_version = h.hexdigest()[:16]
+
+    return _cache_version
+
+
+def cache_dir():
+    """ Folder of the compiled functions of the current version, created if needed """
+    folder = cache_root() / cache_version()
+    folder.mkdir(parents=True, exist_ok=True)
+    return folder
+
+
+def function_path(name, kertype=None, dtype='float64'):
+    """ Path of the pickle of a compiled kernel function, see ``function_name`` """
+    return cache_dir() / (function_name(name, kertype, dtype) + ".pickle")
+
+
+def raise_recursion_limit():
+    """ Raise the recursion limit of the interpreter, needed to pickle and unpickle
+    the deep graphs of the compiled theano functions. It is never lowered.
+    """
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), RECURSION_LIMIT))
+
+
+def save_function(fun, name, kertype=None, dtype='float64'):
+    """ Store a compiled kernel function in the cache folder. The pickle is written to
+    a temporary file that is then renamed, so that other processes never read a
+    partially written function.
+
+    Args:
+        fun (object): the compiled kernel function
+        name (str): name of the function, e.g. "k2_ff"
+        kertype (str): "single" or "multi", selects the _s or _m version
+        dtype (str): "float64" or "float32", precision of the compiled function
+
+    """
+
+    raise_recursion_limit()
+    target = function_path(name, kertype, dtype)
+    fd, tmp = tempfile.mkstemp(prefix=target.name, suffix='.tmp', dir=str(target.parent))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(fun, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, str(target))
+    except BaseException:
+        os.remove(tmp)
+        raise
+    _functions[str(target)] = fun
+
+
+@contextmanager
+def cache_lock(kernel_name, dtype='float64'):
+    """ Exclusive lock on the compiled functions of a kernel. It is held while the
+    functions are compiled or loaded, so that concurrent jobs starting with a cold
+    cache compile them once, and the others load the result.
+
+    Args:
+        kernel_name (str): name of the kernel, e.g. "TwoBodySingleSpecies"
+        dtype (str): "float64" or "float32", precision of the compiled functions
+
+    """
+
+    if fcntl is None:
+        yield
+        return
+
+    with open(str(cache_dir() / ('%s_%s.lock' % (kernel_name, dtype))), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def theano_precision(dtype):
+    """ Context in which the theano graphs are built with floatX set to dtype, so that
+    the inputs declared without an explicit type and the Python constants follow it.
+
+    Args:
+        dtype (str): "float64" or "float32"
+
+    """
+
+    from theano import change_flags
+    with change_flags(floatX=dtype):
+        yield
+
+
+def load_function(name, kertype=None, dtype='float64'):
+    """ Load a compiled kernel function from the cache folder, see ``cache_dir``.
+    Each function is unpickled only once per process, so that workers
+    of a persistent pool pay the loading cost a single time.
+
+    Args:
+        name (str): name of the function, e.g. "k2_ff"
+        kertype (str): "single" or "multi", selects the _s or _m version
+        dtype (str): "float64" or "float32", precision of the compiled function
+
+    Returns:
+        fun (object): the compiled kernel function
+
+    """
+
+    target = str(function_path(name, kertype, dtype))
+
+    if target not in _functions:
+        raise_recursion_limit()
+        with open(target, 'rb') as f:
+            _functions[target] = pickle.load(f)
+
+    return _functions[target]
+
+
+def init_worker(names):
+    """ Initializer of the worker processes, loads the compiled functions once.
+
+    Args:
+        names (list): names of the functions to load, as accepted by ``load_function``
+
+    """
+
+    raise_recursion_limit()
+    for name in names:
+        load_function(name)
+
+
+def flatten_segments(X_glob):
+    """ Flatten a list of global configurations into the list of their local ones
+
+    Args:
+        X_glob (list): N global configurations, lists of local configurations
+
+    Returns:
+        confs (list): all the local configurations, in order
+        offsets (array): N + 1 offsets, the local configurations of the i-th global one
+            being confs[offsets[i]:offsets[i + 1]]
+
+    """
+
+    confs = [conf for x in X_glob for conf in x]
+    offsets = np.concatenate(([0], np.cumsum([len(x) for x in X_glob]))).astype(int)
+
+    return confs, offsets
+
+
+def segment_sum(values, offsets, axis=0):
+    """ Sum the slices of values between consecutive offsets along an axis, with
+    ``np.add.reduceat``, see ``flatten_segments``. Empty segments sum to zero.
+
+    Args:
+        values (array): values of the local configurations along axis
+        offsets (array): N + 1 offsets of the segments
+        axis (int): axis to reduce
+
+    Returns:
+        sums (array): values with N sums along axis
+
+    """
+
+    starts, ends = offsets[:-1], offsets[1:]
+    shape = list(values.shape)
+    shape[axis] = len(starts)
+    if values.shape[axis] == 0:
+        return np.zeros(shape)
+
+    # reduceat returns the element at the start of empty segments, zeroed below
+    sums = np.add.reduceat(values, np.minimum(starts, values.shape[axis] - 1), axis=axis)
+    empty = starts == ends
+    if empty.any():
+        sums[(slice(None),) * (axis % values.ndim) + (empty,)] = 0
+
+    return sums
+
+
+@atexit.register
+def close_pools():
+    """ Shut down the worker pools of all the kernels """
+    for kernel in list(_pooled_kernels):
+        kernel.close_pool()
+
 
 class Kernel(metaclass=ABCMeta):
+    """ Base kernel class
+
+    Attributes:
+        schedule (str): "static" or "dynamic", how the tiles of the kernel matrices
+            are distributed to the workers when ncores > 1, see ``parallel.TileScheduler``
+        utilization (dict): fraction of the wall time each worker spent computing
+            during the last parallel calculation, by process id
+        block_cache (BlockCache): cache of the kernel blocks used by calc, calc_ef,
+            calc_ee and calc_gram, None if disabled, see ``use_block_cache``
+        diag_cache (BlockCache): cache of the self-kernels of the configurations used by
+            calc_diag and calc_diag_e, None if disabled, see ``use_diag_cache``
+        dtype (str): "float64" or "float32", precision in which the kernel functions
+            are evaluated. The kernel matrices are assembled in double precision.
+
+    """
+
+    # Names of the compiled functions used by the workers, without the _s/_m suffix
+    function_names = ()
+
+    # The cost of a kernel call scales as (M1*M2)**cost_power, M being the number of neighbours
+    cost_power = 1
+
+    # Whether the kernel between configurations without a common (central, neighbour)
+    # species pair is zero, so that calc and calc_gram skip those blocks, see ``speciesblocks``
+    species_zeros = False
 
     @abstractmethod
-    def __init__(self, kernel_name, *args, **kwargs):
+    def __init__(self, kernel_name, *args, dtype='float64', **kwargs):
         super().__init__(*args, **kwargs)
+        if dtype not in DTYPE_SUFFIXES:
+            raise ValueError("Unknown dtype %s, use 'float64' or 'float32'" % dtype)
         self.kernel_name = kernel_name
+        self.dtype = dtype
+        self._pool = None
+        self._pool_size = 0
+        self.schedule = 'static'
+        self.utilization = None
+        self.block_cache = None
+        self.diag_cache = None
+
+    def get_pool(self, ncores):
+        """ Return the persistent worker pool of the kernel, starting it if needed.
+        The pool is reused by every call with the same number of cores, and is shut down
+        by ``close_pool`` or when the interpreter exits.
+
+        Args:
+            ncores (int): number of worker processes
+
+        Returns:
+            pool (multiprocessing.Pool): the worker pool
+
+        """
+
+        if self._pool is None or self._pool_size != ncores:
+            self.close_pool()
+            raise_recursion_limit()
+            names = []
+            if getattr(self, 'engine', 'theano') == 'theano':
+                # The workers load the functions from the cache, make sure they are all there
+                self.compile_functions()
+                names = [function_name(name, self.type, self.dtype)
+                         for name in self.function_names]
+            logger.info('Starting a pool of %i workers for the %s kernel' % (ncores, self.kernel_name))
+            self._pool = mp.Pool(ncores, initializer=init_worker, initargs=(names,))
+            self._pool_size = ncores
+            _pooled_kernels.add(self)
+
+        return self._pool
+
+    def theano_function(self, name):
+        """ Compiled theano function of the kernel, loaded from the cache folder on first use.
+        A function missing from the cache is compiled alone and stored there, holding the
+        lock of the kernel so that concurrent jobs compile it once.
+
+        Args:
+            name (str): name of the function, e.g. "k2_ff", one of ``function_names``
+
+        Returns:
+            fun (object): the compiled kernel function
+
+        """
+
+        try:
+            return load_function(name, self.type, self.dtype)
+        except FileNotFoundError:
+            pass
+
+        with theano_precision(self.dtype), cache_lock(self.kernel_name, self.dtype):
+            if not function_path(name, self.type, self.dtype).exists():
+                logger.info('Compiling %s for the %s kernel in %s'
+                            % (name, self.kernel_name, self.dtype))
+                for key, fun in self.compile_theano((name,), self.dtype).items():
+                    save_function(fun, key, self.type, self.dtype)
+
+        return load_function(name, self.type, self.dtype)
+
+    def compile_functions(self):
+        """ Load or compile all the theano functions of the kernel, see ``theano_function``.
+        Called before starting the worker pool, and to fill the cache ahead of time.
+        """
+
+        for name in self.function_names:
+            self.theano_function(name)
+
+    @staticmethod
+    def compile_theano(names, dtype='float64'):
+        """ Build and compile the theano functions of the kernel.
+
+        Args:
+            names (list): names of the functions to compile, among ``function_names``
+            dtype (str): "float64" or "float32", precision of the compiled functions
+
+        Returns:
+            functions (dict): the compiled theano functions, by name
+
+        """
+
+        return {}
+
+    def describe(self, X, kind='local'):
+        """ Descriptors of a set of configurations, in the form taken by the kernel functions.
+        They are computed once, and can be passed to the kernel methods in place of
+        the configurations. Kernels working on raw configurations return X itself.
+
+        Args:
+            X (list): list of local configurations, or of global configurations
+            kind (str): "local" or "global", the kind of configurations in X
+
+        Returns:
+            D (list): the descriptors of the configurations
+
+        """
+
+        return X
+
+    def calc_parallel(self, fun, X1, X2, block, ncores, kinds=('local', 'local'), args=(),
+                      symmetric=False, order='C'):
+        """ Evaluate a kernel with the worker pool, sharing the configurations
+        with the workers and splitting the work in index tiles.
+        See ``mff.kernels.parallel.calc_parallel`` for the arguments.
+
+        Returns:
+            ker (array): the kernel matrix
+
+        """
+
+        scheduler = parallel.TileScheduler(ncores, self.schedule)
+        ker = parallel.calc_parallel(self.get_pool(ncores), scheduler, fun, X1, X2, block,
+                                     kinds, args, symmetric, self.cost_power, order)
+        self.utilization = scheduler.utilization
+
+        return ker
+
+    def use_block_cache(self, max_bytes=2**28):
+        """ Enable the cache of kernel blocks, so that the blocks between configurations
+        already seen with the same hyperparameters are not computed again.
+
+        Args:
+            max_bytes (int): memory budget of the cache in bytes, None or 0 disables it
+
+        Returns:
+            cache (BlockCache): the cache, whose hit and miss counters help sizing it
+
+        """
+
+        if max_bytes:
+            self.block_cache = BlockCache(max_bytes)
+        else:
+            self.block_cache = None
+
+        return self.block_cache
+
+    def use_diag_cache(self, max_bytes=2**24):
+        """ Enable the cache of the self-kernels of the configurations, so that the variance
+        of the predictions on configurations already seen is not computed again.
+
+        Args:
+            max_bytes (int): memory budget of the cache in bytes, None or 0 disables it
+
+        Returns:
+            cache (BlockCache): the cache
+
+        """
+
+        if max_bytes:
+            self.diag_cache = BlockCache(max_bytes)
+        else:
+            self.diag_cache = None
+
+        return self.diag_cache
+
+    def close_pool(self):
+        """ Shut down the worker pool of the kernel, if any """
+        if getattr(self, '_pool', None) is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._pool_size = 0
+        _pooled_kernels.discard(self)
+
+    def __getstate__(self):
+        # The worker pool cannot be pickled, a copy of the kernel starts its own
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_pool_size'] = 0
+        return state
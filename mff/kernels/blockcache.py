@@ -0,0 +1,276 @@
+import functools
+import hashlib
+import inspect
+import logging
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+from mff.kernels.parallel import mirror_lower
+
+logger = logging.getLogger(__name__)
+
+
+def conf_hash(conf):
+    """ Content hash of a configuration.
+
+    Args:
+        conf (array or list): a local configuration, a descriptor, a global configuration
+            given as a list of local configurations, or their ``Triplets``
+
+    Returns:
+        digest (bytes): a hash that only depends on the values of the configuration
+
+    """
+
+    h = hashlib.sha1()
+    stack = [conf]
+    while stack:
+        x = stack.pop()
+        x = getattr(x, 'conf', x)  # Descriptors are hashed as their configuration
+        if isinstance(x, np.ndarray) and x.dtype != object or np.isscalar(x):
+            x = np.ascontiguousarray(x, dtype=np.float64)
+            h.update(str(x.shape).encode())
+            h.update(x.tobytes())
+        else:
+            h.update(b'[%i]' % len(x))
+            stack.extend(reversed(list(x)))
+
+    return h.digest()
+
+
+class BlockCache(object):
+    """ Least recently used cache of kernel blocks between pairs of configurations.
+
+    Blocks are the 3x3, 1x3 and 1x1 kernels between two configurations, keyed by
+    the content hashes of the two configurations, the kernel name and precision, its
+    hyperparameters and the kind of block. When the stored blocks exceed ``max_bytes``
+    the least recently used ones are evicted.
+
+    Args:
+        max_bytes (int): memory budget of the cache, in bytes
+
+    Attributes:
+        hits (int): number of blocks found in the cache
+        misses (int): number of blocks that had to be computed
+        evictions (int): number of blocks removed to stay within the budget
+        nbytes (int): memory currently used by the stored blocks, in bytes
+
+    """
+
+    def __init__(self, max_bytes=2**28):
+        self.max_bytes = max_bytes
+        self._blocks = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def get(self, key):
+        """ Return the block stored under key, or None, updating the counters """
+        block = self._blocks.get(key)
+        if block is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._blocks.move_to_end(key)
+        return block
+
+    def put(self, key, block):
+        """ Store a copy of block under key, evicting the least recently used blocks """
+        block = np.array(block)
+        size = sys.getsizeof(block) + sys.getsizeof(key)
+        if size > self.max_bytes:
+            return
+        old = self._blocks.pop(key, None)
+        if old is not None:
+            self.nbytes -= sys.getsizeof(old) + sys.getsizeof(key)
+        self._blocks[key] = block
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            k, b = self._blocks.popitem(last=False)
+            self.nbytes -= sys.getsizeof(b) + sys.getsizeof(k)
+            self.evictions += 1
+
+    def clear(self):
+        """ Remove all the blocks and reset the counters """
+        self._blocks.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def info(self):
+        """ Summary of the cache usage
+
+        Returns:
+            info (dict): hits, misses, evictions, number of blocks, bytes used and budget
+
+        """
+
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'blocks': len(self._blocks), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+    def __getstate__(self):
+        # The stored blocks are not saved together with the kernel
+        state = self.__dict__.copy()
+        state['_blocks'] = OrderedDict()
+        state['nbytes'] = 0
+        return state
+
+
+def kernel_tag(kernel, mode):
+    """ Part of the cache keys that identifies the kernel function: its name, precision
+    and hyperparameters, and the approximation options that change its values.
+
+    Args:
+        kernel (Kernel): the kernel
+        mode (str): kind of kernel stored in the blocks, e.g. "ff" or "diag_ee"
+
+    Returns:
+        tag (tuple): hashable description of the kernel
+
+    """
+
+    return (kernel.kernel_name, kernel.dtype, mode, tuple(float(t) for t in kernel.theta),
+            getattr(kernel, 'window_tol', None), getattr(kernel, 'histogram_width', None))
+
+
+def cached_blocks(mode, block):
+    """ Decorator adding the block cache of the kernel to a kernel method.
+
+    The decorated method is only called on the configurations with missing blocks;
+    the other blocks are read from ``kernel.block_cache``. When the kernel has no
+    cache the method is called unchanged.
+
+    Args:
+        mode (str): "ff", "ef", "ee" or "gram", the kind of kernel the method computes
+        block (tuple): shape of the kernel block between two configurations
+
+    """
+
+    b1, b2 = block
+
+    def decorator(fun):
+        signature = inspect.signature(fun)
+
+        if mode == 'gram':
+            @functools.wraps(fun)
+            def wrapper(self, X, ncores=1, eval_gradient=False, order='C'):
+                cache = getattr(self, 'block_cache', None)
+                if cache is None or eval_gradient:
+                    return fun(self, X, ncores, eval_gradient, order)
+
+                # Same keys as the force-force blocks of calc, so that each fills the other
+                tag = kernel_tag(self, 'ff') + ((),)
+                h = [conf_hash(x) for x in X]
+                blocks = [cache.get((h[i], h[j]) + tag) for i in range(len(X)) for j in range(i + 1)]
+
+                if any(blk is None for blk in blocks):
+                    gram = fun(self, X, ncores, eval_gradient, order)
+                    for i in range(len(X)):
+                        for j in range(len(X)):
+                            cache.put((h[i], h[j]) + tag,
+                                      gram[b1 * i:b1 * i + b1, b2 * j:b2 * j + b2])
+                    return gram
+
+                gram = np.zeros((len(X) * b1, len(X) * b2), order=order)
+                blocks = iter(blocks)
+                for i in range(len(X)):
+                    for j in range(i + 1):
+                        gram[b1 * i:b1 * i + b1, b2 * j:b2 * j + b2] = next(blocks)
+                mirror_lower(gram, b1)
+                return gram
+
+            return wrapper
+
+        @functools.wraps(fun)
+        def wrapper(self, X1, X2, ncores=1, *args, **kwargs):
+            cache = getattr(self, 'block_cache', None)
+            if cache is None:
+                return fun(self, X1, X2, ncores, *args, **kwargs)
+
+            # Options such as mapping change the kernel, and are part of the key
+            options = signature.bind(self, X1, X2, ncores, *args, **kwargs)
+            options.apply_defaults()
+            options = tuple(options.arguments.items())[4:]
+            tag = kernel_tag(self, mode) + (options,)
+
+            h1 = [conf_hash(x) for x in X1]
+            h2 = [conf_hash(x) for x in X2]
+            ker = np.zeros((len(X1) * b1, len(X2) * b2))
+            missing = np.zeros((len(X1), len(X2)), dtype=bool)
+            for i, a in enumerate(h1):
+                for j, b in enumerate(h2):
+                    blk = cache.get((a, b) + tag)
+                    if blk is None:
+                        missing[i, j] = True
+                    else:
+                        ker[b1 * i:b1 * i + b1, b2 * j:b2 * j + b2] = blk
+
+            # Only the rows and columns with missing blocks are computed
+            rows = np.flatnonzero(missing.any(axis=1))
+            cols = np.flatnonzero(missing[rows].any(axis=0))
+            if len(rows):
+                logger.debug('Computing %i of %i kernel blocks' % (missing.sum(), missing.size))
+                sub = fun(self, [X1[i] for i in rows], [X2[j] for j in cols], ncores,
+                          *args, **kwargs)
+                for k, i in enumerate(rows):
+                    for l, j in enumerate(cols):
+                        blk = sub[b1 * k:b1 * k + b1, b2 * l:b2 * l + b2]
+                        ker[b1 * i:b1 * i + b1, b2 * j:b2 * j + b2] = blk
+                        cache.put((h1[i], h2[j]) + tag, blk)
+
+            return ker
+
+        return wrapper
+
+    return decorator
+
+
+def cached_diag(mode, size):
+    """ Decorator adding the cache of self-kernels to the calc_diag methods of a kernel.
+
+    The self-kernels of the configurations already seen with the same hyperparameters
+    are read from ``kernel.diag_cache``, and the decorated method is only called on
+    the others. When the kernel has no cache the method is called unchanged.
+
+    Args:
+        mode (str): "ff" or "ee", the kind of self-kernel the method computes
+        size (int): number of values of the diagonal for each configuration
+
+    """
+
+    def decorator(fun):
+        @functools.wraps(fun)
+        def wrapper(self, X, *args, **kwargs):
+            cache = getattr(self, 'diag_cache', None)
+            if cache is None:
+                return fun(self, X, *args, **kwargs)
+
+            tag = kernel_tag(self, 'diag_' + mode)
+            keys = [(conf_hash(x),) + tag for x in X]
+            diag = np.zeros(len(X) * size)
+            missing = []
+            for i, key in enumerate(keys):
+                values = cache.get(key)
+                if values is None:
+                    missing.append(i)
+                else:
+                    diag[size * i:size * i + size] = values
+
+            if missing:
+                values = fun(self, [X[i] for i in missing], *args, **kwargs)
+                for k, i in enumerate(missing):
+                    diag[size * i:size * i + size] = values[size * k:size * k + size]
+                    cache.put(keys[i], values[size * k:size * k + size])
+
+            return diag
+
+        return wrapper
+
+    return decorator
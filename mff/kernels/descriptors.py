@@ -0,0 +1,248 @@
+from collections import namedtuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Compact list of the triplets of a configuration that contribute to the kernel
+TripletList = namedtuple('TripletList', ['distances', 'species', 'jacobian', 'w', 'dw'])
+
+
+def cutoff(r, rc, step=True):
+    """ Cosine cutoff function and its derivative
+
+    Args:
+        r (array): distances
+        rc (float): cutoff radius
+        step (bool): if True the function is set to zero beyond rc, otherwise the
+            cosine is used as it is, as done by some of the theano kernels
+
+    Returns:
+        fc (array): values of the cutoff function
+        dfc (array): derivative of the cutoff function with respect to r
+
+    """
+
+    fc = 0.5 * (1 + np.cos(np.pi * r / rc))
+    dfc = -0.5 * np.pi / rc * np.sin(np.pi * r / rc)
+    if step:
+        s = (np.sign(rc - r) + 1) / 2
+        fc, dfc = fc * s, dfc * s
+    return fc, dfc
+
+
+def cutoff_rc(r, rc, step=True):
+    """ Derivatives with respect to the cutoff radius of the cosine cutoff function and of
+    its derivative, see ``cutoff``. The step beyond rc does not contribute.
+
+    Args:
+        r (array): distances
+        rc (float): cutoff radius
+        step (bool): if True the derivatives are set to zero beyond rc
+
+    Returns:
+        fc_rc (array): derivatives of the cutoff function with respect to rc
+        dfc_rc (array): derivatives of its derivative with respect to rc
+
+    """
+
+    x = np.pi * r / rc
+    fc_rc = 0.5 * np.sin(x) * x / rc
+    dfc_rc = 0.5 * np.pi / rc ** 2 * (np.sin(x) + x * np.cos(x))
+    if step:
+        s = (np.sign(rc - r) + 1) / 2
+        fc_rc, dfc_rc = fc_rc * s, dfc_rc * s
+    return fc_rc, dfc_rc
+
+
+class Triplets(object):
+    """ Descriptors of the triplets of a local configuration, computed once and shared
+    by all the kernel calls involving the configuration.
+
+    A triplet is made of the central atom and two neighbours j < k, and is described
+    by its three distances (r1j, r1k, rjk), the species of its three atoms, and
+    the derivatives of the distances with respect to the position of the central atom.
+
+    Args:
+        conf (array): Mx5 array containing xyz coordinates and atomic species
+
+    Attributes:
+        conf (array): the configuration the descriptors were computed from
+        distances (array): Tx3 array of the distances r1j, r1k and rjk
+        species (array): Tx3 array of the species of the central atom, j and k
+        jacobian (array): Tx3x3 derivatives of the distances with respect to the
+            position of the central atom
+
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        conf = np.asarray(conf, dtype=np.float64).reshape(-1, 5)
+        rho = conf[:, :3]
+        r = np.sqrt(np.sum(rho ** 2, axis=1))
+        u = rho / r[:, None]
+
+        j, k = np.triu_indices(len(conf), 1)
+        self.distances = np.stack(
+            (r[j], r[k], np.sqrt(np.sum((rho[j] - rho[k]) ** 2, axis=1))), axis=1).reshape(-1, 3)
+        self.species = np.stack(
+            (conf[j, 3], conf[j, 4], conf[k, 4]), axis=1).reshape(-1, 3)
+        self.jacobian = np.zeros((len(j), 3, 3))
+        self.jacobian[:, 0] = -u[j]
+        self.jacobian[:, 1] = -u[k]
+        self._weights = {}
+        self._valid = {}
+        self._groups = {}
+        self._trees = {}
+
+    def __len__(self):
+        return len(self.distances)
+
+    def weights(self, rc, steps=(True, True)):
+        """ Cutoff weights of the triplets and their gradients with respect to
+        the position of the central atom, cached for each cutoff radius.
+
+        Args:
+            rc (float): cutoff radius
+            steps (tuple): whether the cutoff is set to zero beyond rc for the
+                distances from the central atom and for the distance jk
+
+        Returns:
+            w (array): T cutoff weights
+            dw (array): Tx3 gradients of the weights
+
+        """
+
+        key = (float(rc), tuple(steps))
+        if key not in self._weights:
+            f1j, d1j = cutoff(self.distances[:, 0], rc, steps[0])
+            f1k, d1k = cutoff(self.distances[:, 1], rc, steps[0])
+            fjk, _ = cutoff(self.distances[:, 2], rc, steps[1])
+            w = f1j * f1k * fjk
+            dw = fjk[:, None] * ((d1j * f1k)[:, None] * self.jacobian[:, 0] +
+                                 (f1j * d1k)[:, None] * self.jacobian[:, 1])
+            self._weights[key] = w, dw
+
+        return self._weights[key]
+
+    def valid(self, rc, steps=(True, True)):
+        """ Compact list of the triplets with non-zero cutoff weight or gradient,
+        cached for each cutoff radius. The other triplets never contribute to
+        the kernel or to its derivatives.
+
+        Args:
+            rc (float): cutoff radius
+            steps (tuple): cutoff steps, see ``weights``
+
+        Returns:
+            triplets (TripletList): distances (Tx3), species (Tx3), jacobian (Tx3x3),
+                cutoff weights w (T) and their gradients dw (Tx3) of the valid triplets
+
+        """
+
+        key = (float(rc), tuple(steps))
+        if key not in self._valid:
+            w, dw = self.weights(rc, steps)
+            keep = (w != 0) | np.any(dw != 0, axis=1)
+            self._valid[key] = TripletList(self.distances[keep], self.species[keep],
+                                           self.jacobian[keep], w[keep], dw[keep])
+
+        return self._valid[key]
+
+    def species_groups(self, rc, steps=(True, True)):
+        """ Valid triplets sorted by the species of their three atoms, cached for each
+        cutoff radius, so that the many-species kernels only compare triplets whose
+        species can match.
+
+        Args:
+            rc (float): cutoff radius
+            steps (tuple): cutoff steps, see ``weights``
+
+        Returns:
+            groups (dict): TripletList of the valid triplets, by tuple of the species
+                of the central atom, j and k
+
+        """
+
+        key = (float(rc), tuple(steps))
+        if key not in self._groups:
+            l = self.valid(rc, steps)
+            species, inverse = np.unique(l.species, axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            self._groups[key] = {tuple(s): TripletList(*(x[inverse == i] for x in l))
+                                 for i, s in enumerate(species)}
+
+        return self._groups[key]
+
+    def tree(self, rc, steps=(True, True)):
+        """ KD-tree of the sorted distances of the valid triplets, cached for each cutoff
+        radius. Sorting makes the descriptors invariant to the permutations of the
+        neighbours, and the distance between the sorted distances of two triplets is
+        the smallest distance between their distances over all the permutations.
+
+        Args:
+            rc (float): cutoff radius
+            steps (tuple): cutoff steps, see ``weights``
+
+        Returns:
+            tree (cKDTree): tree of the T x 3 sorted distances, in the order of ``valid``
+
+        """
+
+        key = (float(rc), tuple(steps))
+        if key not in self._trees:
+            self._trees[key] = cKDTree(np.sort(self.valid(rc, steps).distances, axis=1))
+
+        return self._trees[key]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_weights'] = {}
+        state['_valid'] = {}
+        state['_groups'] = {}
+        state['_trees'] = {}
+        return state
+
+
+def triplets(conf):
+    """ Return the Triplets of a configuration, computing them if needed """
+    return conf if isinstance(conf, Triplets) else Triplets(conf)
+
+
+def describe(X, kind='local'):
+    """ Compute the triplet descriptors of a set of configurations.
+    Configurations that are already described are returned as they are.
+
+    Args:
+        X (list): list of local configurations, or of global configurations
+        kind (str): "local" or "global", the kind of configurations in X
+
+    Returns:
+        D (list): list of Triplets, or list of lists of Triplets for global configurations
+
+    """
+
+    if X is None:
+        return None
+    if kind == 'global':
+        return [describe(x) for x in X]
+    return [triplets(x) for x in X]
+
+
+def configurations(D, kind='local'):
+    """ Configurations of a set of descriptors, the inverse of ``describe``. Used to share
+    the configurations with the worker processes, which describe them again.
+
+    Args:
+        D (list): list of Triplets or of configurations, or of global configurations
+        kind (str): "local" or "global", the kind of configurations in D
+
+    Returns:
+        X (list): the Mx5 arrays of the configurations, or lists of them
+
+    """
+
+    if D is None:
+        return None
+    if kind == 'global':
+        return [configurations(d) for d in D]
+    return [getattr(d, 'conf', d) for d in D]
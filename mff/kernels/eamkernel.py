@@ -1,139 +1,245 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import os.path
-import pickle
 from abc import ABCMeta, abstractmethod
 
 import numpy as np
 
-from mff.kernels.base import Kernel, Mffpath
+from mff.kernels import numbaengine
+from mff.kernels.base import Kernel, flatten_segments, load_function, segment_sum
+from mff.kernels.blockcache import cached_blocks
+from mff.kernels.descriptors import cutoff_rc
+from mff.kernels.parallel import mirror_lower
+from mff.kernels.twobodykernel import pad_confs
 
 logger = logging.getLogger(__name__)
 
 
-def dummy_calc_ff(data):
-    """ Function used when multiprocessing.
+def dummy_calc_ff(conf1, conf2, theta, kertype, dtype='float64'):
+    """ Function used when multiprocessing, evaluates the force-force kernel
+    of a single pair.
+
     Args:
-        data (list of objects): contains all the information required
-            for the computation of the kernel values
-    
+        conf1 (array): Mx5 array of the first configuration
+        conf2 (array): Mx5 array of the second configuration
+        theta (list): hyperparameters of the kernel
+        kertype (str): "single" or "multi" species kernel
+        dtype (str): "float64" or "float32", precision of the compiled function
+
     Returns:
-        result (array): the computed kernel values
+        result (array): the computed kernel value
 
     """
-    array, theta0, theta1, theta2, kertype = data
-    if kertype == "single":
-        with open(Mffpath / "keam_ff_s.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    elif kertype == "multi":
-        with open(Mffpath / "keam_ff_m.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    result = np.zeros((len(array), 3, 3))
-    for i in np.arange(len(array)):
-        result[i] = fun(np.zeros(3), np.zeros(3), array[i][0],
-                        array[i][1],  theta0, theta1, theta2)
-    return result
+
+    fun = load_function("keam_ff", kertype, dtype)
+    return fun(np.zeros(3), np.zeros(3), conf1, conf2, theta[0], theta[1], theta[2])
 
 
-def dummy_calc_ee(data):
-    """ Function used when multiprocessing.
+def dummy_calc_ee(x1, x2, theta, kertype, mapping, alpha_1_descr, dtype='float64'):
+    """ Function used when multiprocessing, evaluates the energy-energy kernel
+    of a single pair.
+
     Args:
-        data (list of objects): contains all the information required
-            for the computation of the kernel values
-    
+        x1 (list): configurations of the first snapshot, or a descriptor value if mapping
+        x2 (list): configurations of the second snapshot
+        theta (list): hyperparameters of the kernel
+        kertype (str): "single" or "multi" species kernel
+        mapping (bool): if True the first argument is a descriptor value
+        alpha_1_descr (int): atomic number of the central atom of the descriptor, used
+            by the many-species kernel when mapping
+        dtype (str): "float64" or "float32", precision of the compiled function
+
     Returns:
-        result (array): the computed kernel values
+        result (float): the computed kernel value
 
     """
 
-    array, theta0, theta1, theta2, kertype, mapping, alpha_1_descr = data
-    if mapping:
-        if kertype == "single":
-            with open(Mffpath / "keam_eed_s.pickle", 'rb') as f:
-                fun = pickle.load(f)
-        elif kertype == "multi":
-            with open(Mffpath / "keam_eed_m.pickle", 'rb') as f:
-                fun = pickle.load(f)
-    else:
-        if kertype == "single":
-            with open(Mffpath / "keam_ee_s.pickle", 'rb') as f:
-                fun = pickle.load(f)
-        elif kertype == "multi":
-            with open(Mffpath / "keam_ee_m.pickle", 'rb') as f:
-                fun = pickle.load(f)
-    result = np.zeros(len(array))
-
+    result = 0
     if not mapping:
-        for i in np.arange(len(array)):
-            for conf1 in array[i][0]:
-                for conf2 in array[i][1]:
-                    result[i] += 0.25*fun(np.zeros(3), np.zeros(3), conf1,
-                                     conf2, theta0, theta1, theta2)
+        fun = load_function("keam_ee", kertype, dtype)
+        for conf1 in x1:
+            for conf2 in x2:
+                result += 0.25*fun(np.zeros(3), np.zeros(3), conf1,
+                                   conf2, theta[0], theta[1], theta[2])
     else:
+        fun = load_function("keam_eed", kertype, dtype)
         if kertype == "multi":
-            for i in np.arange(len(array)):
-                for conf2 in array[i][1]:
-                    result[i] += 0.5*fun(np.zeros(3), array[i]
-                                     [0], conf2, theta0, theta1, theta2, alpha_1_descr)
+            for conf2 in x2:
+                result += 0.5*fun(np.zeros(3), x1, conf2,
+                                  theta[0], theta[1], theta[2], alpha_1_descr)
         else:
-            for i in np.arange(len(array)):
-                for conf2 in array[i][1]:
-                    result[i] += fun(np.zeros(3), array[i]
-                                     [0], conf2, theta0, theta1, theta2)
+            for conf2 in x2:
+                result += fun(np.zeros(3), x1, conf2, theta[0], theta[1], theta[2])
     return result
 
 
-def dummy_calc_ef(data):
-    """ Function used when multiprocessing.
+def dummy_calc_ef(x1, conf2, theta, kertype, mapping, alpha_1_descr, dtype='float64'):
+    """ Function used when multiprocessing, evaluates the energy-force kernel
+    of a single pair.
+
     Args:
-        data (list of objects): contains all the information required
-            for the computation of the kernel values
-    
+        x1 (list): configurations of the first snapshot, or a descriptor value if mapping
+        conf2 (array): Mx5 array of the second configuration
+        theta (list): hyperparameters of the kernel
+        kertype (str): "single" or "multi" species kernel
+        mapping (bool): if True the first argument is a descriptor value
+        alpha_1_descr (int): atomic number of the central atom of the descriptor, used
+            by the many-species kernel when mapping
+        dtype (str): "float64" or "float32", precision of the compiled function
+
     Returns:
-        result (array): the computed kernel values
+        result (array): the computed kernel value
 
     """
-    
-    array, theta0, theta1, theta2, kertype, mapping, alpha_1_descr = data
-    if mapping:
-        if kertype == "single":
-            with open(Mffpath / "keam_efd_s.pickle", 'rb') as f:
-                fun = pickle.load(f)
-        elif kertype == "multi":
-            with open(Mffpath / "keam_efd_m.pickle", 'rb') as f:
-                fun = pickle.load(f)
-    else:
-        if kertype == "single":
-            with open(Mffpath / "keam_ef_s.pickle", 'rb') as f:
-                fun = pickle.load(f)
-        elif kertype == "multi":
-            with open(Mffpath / "keam_ef_m.pickle", 'rb') as f:
-                fun = pickle.load(f)
-    result = np.zeros((len(array), 3))
+
+    conf2 = np.array(conf2, dtype='float')
+    result = np.zeros(3)
     if not mapping:
-        for i in np.arange(len(array)):
-            conf2 = np.array(array[i][1], dtype='float')
-            for conf1 in array[i][0]:
-                conf1 = np.array(conf1, dtype='float')
-                result[i] += -0.5*fun(np.zeros(3), np.zeros(3), conf1,
-                                  conf2,  theta0, theta1, theta2)
+        fun = load_function("keam_ef", kertype, dtype)
+        for conf1 in x1:
+            conf1 = np.array(conf1, dtype='float')
+            result += -0.5*fun(np.zeros(3), np.zeros(3), conf1,
+                               conf2, theta[0], theta[1], theta[2])
     else:
+        fun = load_function("keam_efd", kertype, dtype)
+        conf1 = np.array(x1, dtype='float')
         if kertype == "multi":
-            for i in np.arange(len(array)):
-                conf2 = np.array(array[i][1], dtype='float')
-                conf1 = np.array(array[i][0], dtype='float')
-                result[i] += -fun(np.zeros(3), conf1,
-                                  conf2, theta0, theta1, theta2, alpha_1_descr)
+            result += -fun(np.zeros(3), conf1, conf2,
+                           theta[0], theta[1], theta[2], alpha_1_descr)
         else:
-            for i in np.arange(len(array)):
-                conf2 = np.array(array[i][1], dtype='float')
-                conf1 = np.array(array[i][0], dtype='float')
-                result[i] += -fun(np.zeros(3), conf1,
-                                  conf2, theta0, theta1, theta2)
+            result += -fun(np.zeros(3), conf1, conf2, theta[0], theta[1], theta[2])
     return result
 
 
+def eam_descriptors(X, rc, r0, dtype='float64', engine='numpy'):
+    """ EAM descriptors of a set of local configurations, the sums over the neighbours of
+    exp(1 - r / r0) times the cutoff function, with their gradients with respect to the
+    position of the central atom. They are computed once per configuration, so that the
+    kernels between two sets of configurations are functions of N1 + N2 descriptors.
+
+    Args:
+        X (list or PackedConfs): N Mx5 arrays containing xyz coordinates and atomic species
+        rc (float): cutoff radius theta[1]
+        r0 (float): radius in the exponent of the descriptor theta[2]
+        dtype (str): "float64" or "float32", precision of the computation
+        engine (str): "numpy" (default) or "numba", see ``numbaengine.eam_sums``
+
+    Returns:
+        q (array): N descriptors
+        dq (array): Nx3 gradients of the descriptors
+        alpha_1 (array): N atomic numbers of the central atoms
+
+    """
+
+    r, u, cut, dcut, alpha_1, _ = pad_confs(X, rc, dtype)
+    if engine == 'numba':
+        q, dq = numbaengine.eam_sums(r, u, cut, dcut, r0)
+        return q.astype(dtype, copy=False), dq.astype(dtype, copy=False), alpha_1
+
+    e = np.exp(1 - r / r0)
+    q = np.sum(e * cut, axis=1)
+    # the derivative of r with respect to the central atom is -u
+    dq = -np.einsum('nm,nmx->nx', e * (dcut - cut / r0), u)
+
+    return q, dq, alpha_1
+
+
+def descriptor_derivatives(X, rc, r0):
+    """ Derivatives of the EAM descriptors and of their gradients with respect to the
+    cutoff radius and to r0, see ``eam_descriptors``
+
+    Args:
+        X (list or PackedConfs): N Mx5 arrays containing xyz coordinates and atomic species
+        rc (float): cutoff radius theta[1]
+        r0 (float): radius in the exponent of the descriptor theta[2]
+
+    Returns:
+        q_rc (array): N derivatives of the descriptors with respect to rc
+        dq_rc (array): Nx3 derivatives of their gradients with respect to rc
+        q_r0 (array): N derivatives of the descriptors with respect to r0
+        dq_r0 (array): Nx3 derivatives of their gradients with respect to r0
+
+    """
+
+    r, u, cut, dcut, _, _ = pad_confs(X, rc)
+    # padded entries are the only ones at zero distance
+    step = (r > 0) * (np.sign(rc - r) + 1) / 2
+    cut_rc, dcut_rc = cutoff_rc(r, rc, step=False)
+    cut_rc, dcut_rc = cut_rc * step, dcut_rc * step
+    e = np.exp(1 - r / r0)
+    e_r0 = e * r / r0 ** 2
+
+    q_rc = np.sum(e * cut_rc, axis=1)
+    dq_rc = -np.einsum('nm,nmx->nx', e * (dcut_rc - cut_rc / r0), u)
+    q_r0 = np.sum(e_r0 * cut, axis=1)
+    dq_r0 = -np.einsum('nm,nmx->nx', e_r0 * (dcut - cut / r0) + e * cut / r0 ** 2, u)
+
+    return q_rc, dq_rc, q_r0, dq_r0
+
+
+def global_descriptors(X_glob, rc, r0, dtype='float64', engine='numpy'):
+    """ EAM descriptors of the local configurations of a set of global configurations,
+    see ``eam_descriptors``
+
+    Returns:
+        q (array): descriptors of all the local configurations
+        dq (array): their gradients
+        alpha_1 (array): atomic numbers of their central atoms
+        offsets (array): offsets of the local configurations of each global one,
+            see ``flatten_segments``
+
+    """
+
+    confs, offsets = flatten_segments(X_glob)
+
+    return eam_descriptors(confs, rc, r0, dtype, engine) + (offsets,)
+
+
+def eam_rbf(q1, alpha_1, q2, alpha_2, sig, multi):
+    """ Gaussian kernel between two sets of EAM descriptors
+
+    Args:
+        q1 (array): N1 descriptors
+        alpha_1 (array): N1 central atomic numbers
+        q2 (array): N2 descriptors
+        alpha_2 (array): N2 central atomic numbers
+        sig (float): lengthscale hyperparameter theta[0]
+        multi (bool): if True the kernel vanishes between different central species
+
+    Returns:
+        k (array): N1 x N2 energy-energy kernel
+        delta (array): N1 x N2 differences of the descriptors
+
+    """
+
+    delta = q1[:, None] - q2[None, :]
+    k = np.exp(-delta ** 2 / (2 * sig ** 2))
+    if multi:
+        k = k * (alpha_1[:, None] == alpha_2[None, :])
+
+    return k, delta
+
+
+def eam_ef(k, delta, dq2, sig):
+    """ N1 x N2 x 3 energy-force kernel, minus the derivative with respect to the second
+    central atom, from the results of ``eam_rbf``
+    """
+    return -(k * delta / sig ** 2)[:, :, None] * dq2[None, :, :]
+
+
+def outer_blocks(h, dq1, dq2):
+    """ 3*N1 x 3*N2 matrix whose 3x3 blocks are h[i, j] times the outer product
+    of dq1[i] and dq2[j]
+    """
+    ker = h[:, None, :, None] * dq1[:, :, None, None] * dq2[None, None, :, :]
+    return ker.reshape(3 * len(dq1), 3 * len(dq2))
+
+
+def eam_ff(k, delta, dq1, dq2, sig):
+    """ 3*N1 x 3*N2 force-force kernel from the results of ``eam_rbf`` """
+    return outer_blocks(k * (1 / sig ** 2 - delta ** 2 / sig ** 4), dq1, dq2)
+
+
 class BaseEam(Kernel, metaclass=ABCMeta):
     """ Eam kernel class
     Handles the functions common to the single-species and
@@ -145,6 +251,13 @@ class BaseEam(Kernel, metaclass=ABCMeta):
         theta[1] (float) : decay rate of the cutoff function
         theta[2] (float) : cutoff radius
         bounds (list) : bounds of the kernel function.
+        engine (str): "theano" (default) for the compiled kernels, "numpy" or "numba" to
+            compute the kernels in closed form from the descriptors of the configurations,
+            see ``eam_descriptors``. With both engines the kernel matrices are assembled
+            from the descriptors of each configuration, computed once; the numba engine
+            computes the descriptors and the matrices with the parallel loops of
+            ``numbaengine.eam_sums`` and ``numbaengine.eam_kernel``
+        dtype (str): "float64" or "float32", precision of the kernels
 
     Attributes:
         k2_ee (object): Energy-energy kernel function
@@ -153,13 +266,231 @@ class BaseEam(Kernel, metaclass=ABCMeta):
 
     """
 
+    function_names = ('keam_ee', 'keam_ef', 'keam_ff', 'keam_eed', 'keam_efd')
+
     @abstractmethod
-    def __init__(self, kernel_name, theta, bounds):
-        super().__init__(kernel_name)
+    def __init__(self, kernel_name, theta, bounds, engine='theano', dtype='float64'):
+        super().__init__(kernel_name, dtype=dtype)
         self.theta = theta
         self.bounds = bounds
-        self.k2_ee, self.k2_ef, self.k2_ff, self.k2_ee_d, self.k2_ef_d = self.compile_theano()
+        if engine not in ('theano', 'numpy', 'numba'):
+            raise ValueError("Unknown engine %s, use 'theano', 'numpy' or 'numba'" % engine)
+        if engine == 'numba':
+            numbaengine.require_numba()
+        self.engine = engine
+        if engine != 'theano':
+            self.k2_ee, self.k2_ef, self.k2_ff = self.numpy_ee, self.numpy_ef, self.numpy_ff
+            self.k2_ee_d, self.k2_ef_d = self.numpy_ee_d, self.numpy_ef_d
+        else:
+            self.k2_ee, self.k2_ef, self.k2_ff = self.theano_ee, self.theano_ef, self.theano_ff
+            self.k2_ee_d, self.k2_ef_d = self.theano_ee_d, self.theano_ef_d
+
+    def descriptors(self, X, rc, r0):
+        """ Descriptors of a set of configurations with the engine of the kernel,
+        see ``eam_descriptors``
+        """
+        return eam_descriptors(X, rc, r0, self.dtype, self.engine)
+
+    def descriptor_kernel(self, q1, dq1, alpha_1, q2, dq2, alpha_2, sig, mode):
+        """ Kernel matrix between two sets of descriptors with the engine of the kernel
+
+        Args:
+            q1 (array): N1 descriptors
+            dq1 (array): N1x3 gradients of the descriptors, only used if mode is "ff"
+            alpha_1 (array): N1 central atomic numbers
+            q2 (array): N2 descriptors
+            dq2 (array): N2x3 gradients of the descriptors, not used if mode is "ee"
+            alpha_2 (array): N2 central atomic numbers
+            sig (float): lengthscale hyperparameter theta[0]
+            mode (str): "ee", "ef" or "ff"
+
+        Returns:
+            ker (array): N1 x N2 energy-energy, N1 x N2 x 3 energy-force or
+                3*N1 x 3*N2 force-force kernel
+
+        """
+
+        if self.engine == 'numba':
+            ker = numbaengine.eam_kernel(q1, dq1, alpha_1, q2, dq2, alpha_2, sig,
+                                         self.type, mode)
+            return ker.astype(self.dtype, copy=False)
+
+        k, delta = eam_rbf(q1, alpha_1, q2, alpha_2, sig, self.type == 'multi')
+        if mode == 'ee':
+            return k
+        if mode == 'ef':
+            return eam_ef(k, delta, dq2, sig)
+        return eam_ff(k, delta, dq1, dq2, sig)
+
+    def eval_pair(self, q1, dq1, alpha_1, conf2, sig, rc, r0, mode):
+        """ Kernel between the descriptor of a first configuration and a second
+        configuration, see ``eam_descriptors``
+        """
+        q2, dq2, alpha_2 = self.descriptors([conf2], rc, r0)
+        ker = self.descriptor_kernel(np.atleast_1d(q1), dq1, np.atleast_1d(alpha_1),
+                                     q2, dq2, alpha_2, sig, mode)
+        if mode == 'ff':
+            return ker
+        return ker[0, 0]
+
+    def numpy_ee(self, conf1, conf2, sig, rc, r0):
+        """ Energy-energy kernel of the numpy engine, same arguments as k2_ee """
+        return self.eval_pair(*self.descriptors([conf1], rc, r0), conf2, sig, rc, r0, 'ee')
+
+    def numpy_ef(self, conf1, conf2, sig, rc, r0):
+        """ Energy-force kernel of the numpy engine, same arguments as k2_ef """
+        return self.eval_pair(*self.descriptors([conf1], rc, r0), conf2, sig, rc, r0, 'ef')
+
+    def numpy_ff(self, conf1, conf2, sig, rc, r0):
+        """ Force-force kernel of the numpy engine, same arguments as k2_ff """
+        return self.eval_pair(*self.descriptors([conf1], rc, r0), conf2, sig, rc, r0, 'ff')
+
+    def numpy_ee_d(self, descr1, conf2, sig, rc, r0, alpha_1_descr=0):
+        """ Energy-energy kernel of the numpy engine from the descriptor of the first
+        configuration, same arguments as k2_ee_d
+        """
+        return self.eval_pair(descr1, None, alpha_1_descr, conf2, sig, rc, r0, 'ee')
+
+    def numpy_ef_d(self, descr1, conf2, sig, rc, r0, alpha_1_descr=0):
+        """ Energy-force kernel of the numpy engine from the descriptor of the first
+        configuration, same arguments as k2_ef_d
+        """
+        return self.eval_pair(descr1, None, alpha_1_descr, conf2, sig, rc, r0, 'ef')
+
+    def descriptor_ff(self, X1, X2):
+        """ Force-force kernel matrix between two sets of configurations, assembled from
+        their descriptors, see ``eam_descriptors``
+        """
+        sig, rc, r0 = self.theta
+        q1, dq1, alpha_1 = self.descriptors(X1, rc, r0)
+        q2, dq2, alpha_2 = self.descriptors(X2, rc, r0)
+
+        return self.descriptor_kernel(q1, dq1, alpha_1, q2, dq2, alpha_2, sig, 'ff')
+
+    def descriptor_ef(self, X_glob, X, mapping=False, alpha_1_descr=0):
+        """ Energy-force kernel matrix assembled from the descriptors of the
+        configurations, same arguments as calc_ef
+        """
+        sig, rc, r0 = self.theta
+        q2, dq2, alpha_2 = self.descriptors(X, rc, r0)
+        if mapping:
+            q1 = np.asarray(X_glob, dtype='float').ravel()
+            ker = self.descriptor_kernel(q1, None, np.full(len(q1), alpha_1_descr),
+                                         q2, dq2, alpha_2, sig, 'ef')
+            return ker.reshape(len(q1), 3 * len(q2))
+
+        q1, _, alpha_1, offsets = global_descriptors(X_glob, rc, r0, self.dtype, self.engine)
+        ker = self.descriptor_kernel(q1, None, alpha_1, q2, dq2, alpha_2, sig, 'ef')
+        ker = 0.5 * segment_sum(ker, offsets)
+
+        return ker.reshape(len(X_glob), 3 * len(q2))
+
+    def descriptor_ee(self, X1, X2, mapping=False, alpha_1_descr=0):
+        """ Energy-energy kernel matrix assembled from the descriptors of the
+        configurations, same arguments as calc_ee
+        """
+        sig, rc, r0 = self.theta
+        q2, _, alpha_2, offsets2 = global_descriptors(X2, rc, r0, self.dtype, self.engine)
+        if mapping:
+            q1 = np.asarray(X1, dtype='float').ravel()
+            k = self.descriptor_kernel(q1, None, np.full(len(q1), alpha_1_descr),
+                                       q2, None, alpha_2, sig, 'ee')
+            return 0.5 * segment_sum(k, offsets2, axis=1)
+
+        q1, _, alpha_1, offsets1 = global_descriptors(X1, rc, r0, self.dtype, self.engine)
+        k = self.descriptor_kernel(q1, None, alpha_1, q2, None, alpha_2, sig, 'ee')
+
+        return 0.25 * segment_sum(segment_sum(k, offsets1), offsets2, axis=1)
+
+    def theano_ee(self, conf1, conf2, sig, rc, r0):
+        """
+        Eam kernel for global energy-energy correlation
+
+        Args:
+            conf1 (array): first configuration.
+            conf2 (array): second configuration.
+            sig (float): lengthscale hyperparameter theta[0]
+            rc (float): cutoff distance hyperparameter theta[1]
+
+        Returns:
+            kernel (float): scalar valued energy-energy Eam kernel
+
+        """
+        return self.theano_function('keam_ee')(np.zeros(3), np.zeros(3), conf1, conf2, sig, rc, r0)
+
+    def theano_ef(self, conf1, conf2, sig, rc, r0):
+        """
+        Eam kernel for global energy-force correlation
+
+        Args:
+            conf1 (array): first configuration.
+            conf2 (array): second configuration.
+            sig (float): lengthscale hyperparameter theta[0]
+            rc (float): cutoff distance hyperparameter theta[1]
+
+        Returns:
+            kernel (array): 3x1 energy-force Eam kernel
+
+        """
+        return -self.theano_function('keam_ef')(np.zeros(3), np.zeros(3), conf1, conf2, sig, rc, r0)
+
+    def theano_ff(self, conf1, conf2, sig, rc, r0):
+        """
+        Eam kernel for force-force correlation
+
+        Args:
+            conf1 (array): first configuration.
+            conf2 (array): second configuration.
+            sig (float): lengthscale hyperparameter theta[0]
+            rc (float): cutoff distance hyperparameter theta[1]
+
+        Returns:
+            kernel (matrix): 3x3 force-force Eam kernel
+
+        """
+        return self.theano_function('keam_ff')(np.zeros(3), np.zeros(3), conf1, conf2, sig, rc, r0)
+
+    def theano_ee_d(self, descr1, conf2, sig, rc, r0, *alpha_1_descr):
+        """
+        Eam kernel for global energy-energy correlation, from the descriptor of the first
+        configuration
+
+        Args:
+            descr1 (float): descriptor calculated for the first configuration.
+            conf2 (array): second configuration.
+            sig (float): lengthscale hyperparameter theta[0]
+            rc (float): cutoff distance hyperparameter theta[1]
+            alpha_1_descr (int): species of the central atom of the first configuration,
+                only taken by the many species kernel
+
+        Returns:
+            kernel (float): scalar valued energy-energy Eam kernel
+
+        """
+        return self.theano_function('keam_eed')(np.zeros(3), descr1, conf2, sig, rc, r0,
+                                                *alpha_1_descr)
+
+    def theano_ef_d(self, descr1, conf2, sig, rc, r0, *alpha_1_descr):
+        """
+        Eam kernel for global energy-force correlation, from the descriptor of the first
+        configuration
+
+        Args:
+            descr1 (float): descriptor calculated for the first configuration.
+            conf2 (array): second configuration.
+            sig (float): lengthscale hyperparameter theta[0]
+            rc (float): cutoff distance hyperparameter theta[1]
+            alpha_1_descr (int): species of the central atom of the first configuration,
+                only taken by the many species kernel
+
+        Returns:
+            kernel (array): 3x1 energy-force Eam kernel
+
+        """
+        return -self.theano_function('keam_efd')(np.zeros(3), descr1, conf2, sig, rc, r0,
+                                                 *alpha_1_descr)
 
+    @cached_blocks('ff', (3, 3))
     def calc(self, X1, X2, ncores=1):
         """
         Calculate the energy-force kernel between two sets of configurations.
@@ -172,39 +503,16 @@ class BaseEam(Kernel, metaclass=ABCMeta):
             K (matrix): N2*3 matrix of the vector-valued kernels 
 
         """
+        if self.engine != 'theano':
+            return self.descriptor_ff(X1, X2)
+
         ker = np.zeros((len(X1) * 3, len(X2) * 3))
 
-        if ncores > 1:
-            confs = []
-            for x1 in X1:
-                for x2 in X2:
-                    confs.append(np.asarray([x1, x2]))
-            n = len(confs)
-            import sys
-            sys.setrecursionlimit(100000)
+        if ncores > 1 and self.engine == 'theano':
             logger.info(
                 'Using %i cores for the eam force-force kernel calculation' % (ncores))
-
-            # Way to split the kernels functions to compute evenly across the nodes
-            splitind = np.zeros(ncores + 1)
-            factor = (n + (ncores - 1)) / ncores
-            splitind[1:-1] = [(i + 1) * factor for i in np.arange(ncores - 1)]
-            splitind[-1] = n
-            splitind = splitind.astype(int)
-            clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                      self.type] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-            import multiprocessing as mp
-            pool = mp.Pool(ncores)
-            result = pool.map(dummy_calc_ff, clist)
-            pool.close()
-            pool.join()
-
-            result = np.concatenate(result).reshape((n, 3, 3))
-            for i in range(len(X1)):
-                for j in range(len(X2)):
-                    ker[i * 3: i * 3 + 3, 3 * j:3 * j +
-                        3] = result[(j + i * len(X2))]
+            ker = self.calc_parallel(dummy_calc_ff, X1, X2, (3, 3), ncores,
+                                     args=(self.theta, self.type, self.dtype))
 
         else:
             for i, conf1 in enumerate(X1):
@@ -214,6 +522,7 @@ class BaseEam(Kernel, metaclass=ABCMeta):
 
         return ker
 
+    @cached_blocks('ef', (1, 3))
     def calc_ef(self, X_glob, X, ncores=1, mapping=False, alpha_1_descr=0):
         """
         Calculate the energy-force kernel between two sets of configurations.
@@ -226,38 +535,18 @@ class BaseEam(Kernel, metaclass=ABCMeta):
             K (matrix): N2*3 matrix of the vector-valued kernels 
 
         """
+        if self.engine != 'theano':
+            return self.descriptor_ef(X_glob, X, mapping, alpha_1_descr)
+
         ker = np.zeros((len(X_glob), len(X) * 3))
 
-        if ncores > 1:
-            confs = []
-            for x1 in X_glob:
-                for x2 in X:
-                    confs.append(np.asarray([x1, x2]))
-            n = len(confs)
-            import sys
-            sys.setrecursionlimit(100000)
+        if ncores > 1 and self.engine == 'theano':
             logger.info(
                 'Using %i cores for the eam energy-force kernel calculation' % (ncores))
-
-            # Way to split the kernels functions to compute evenly across the nodes
-            splitind = np.zeros(ncores + 1)
-            factor = (n + (ncores - 1)) / ncores
-            splitind[1:-1] = [(i + 1) * factor for i in np.arange(ncores - 1)]
-            splitind[-1] = n
-            splitind = splitind.astype(int)
-            clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                      self.type, mapping, alpha_1_descr] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-            import multiprocessing as mp
-            pool = mp.Pool(ncores)
-            result = pool.map(dummy_calc_ef, clist)
-            pool.close()
-            pool.join()
-            result = np.vstack(np.asarray(result))
-
-            for i in range(len(X_glob)):
-                for j in range(len(X)):
-                    ker[i, 3 * j:3 * j + 3] = result[(j + i * len(X))]
+            ker = self.calc_parallel(dummy_calc_ef, X_glob, X, (1, 3), ncores,
+                                     kinds=('local' if mapping else 'global', 'local'),
+                                     args=(self.theta, self.type, mapping, alpha_1_descr,
+                                           self.dtype))
 
         else:
             if not mapping:
@@ -280,6 +569,7 @@ class BaseEam(Kernel, metaclass=ABCMeta):
 
         return ker
 
+    @cached_blocks('ee', (1, 1))
     def calc_ee(self, X1, X2, ncores=1, mapping=False, alpha_1_descr=0):
         """
         Calculate the energy-energy kernel between two global environments.
@@ -292,39 +582,16 @@ class BaseEam(Kernel, metaclass=ABCMeta):
             K (matrix): N1 x N2 matrix of the scalar-valued kernels 
 
        """
-        if ncores > 1:  # Used for multiprocessing
-            confs = []
-
-            # Build a list of all input pairs which matrix needs to be computed
-            for x1 in X1:
-                for x2 in X2:
-                    confs.append(np.asarray([x1, x2]))
-            n = len(confs)
-            import sys
-            sys.setrecursionlimit(100000)
+        if self.engine != 'theano':
+            return self.descriptor_ee(X1, X2, mapping, alpha_1_descr)
+
+        if ncores > 1 and self.engine == 'theano':  # Used for multiprocessing
             logger.info(
                 'Using %i cores for the eam energy-energy kernel calculation' % (ncores))
-
-            # Way to split the kernels functions to compute evenly across the nodes
-            splitind = np.zeros(ncores + 1)
-            factor = (n + (ncores - 1)) / ncores
-            splitind[1:-1] = [(i + 1) * factor for i in np.arange(ncores - 1)]
-            splitind[-1] = n
-            splitind = splitind.astype(int)
-            clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                      self.type, mapping, alpha_1_descr] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-            import multiprocessing as mp
-            pool = mp.Pool(ncores)
-            result = pool.map(dummy_calc_ee, clist)
-            pool.close()
-            pool.join()
-            result = np.concatenate(result).ravel()
-
-            ker = np.zeros((len(X1), len(X2)))
-            for i in range(len(X1)):
-                for j in range(len(X2)):
-                    ker[i, j] = result[j + i*len(X2)]
+            ker = self.calc_parallel(dummy_calc_ee, X1, X2, (1, 1), ncores,
+                                     kinds=('local' if mapping else 'global', 'global'),
+                                     args=(self.theta, self.type, mapping, alpha_1_descr,
+                                           self.dtype))
 
         else:
             if not mapping:
@@ -353,7 +620,45 @@ class BaseEam(Kernel, metaclass=ABCMeta):
 
         return ker
 
-    def calc_gram(self, X, ncores=1, eval_gradient=False):
+    def calc_gram_gradient(self, X, order='C'):
+        """
+        Calculate the force-force gram matrix for a set of configurations X together with
+        its derivatives with respect to the hyperparameters, all assembled from the
+        descriptors of the configurations and their derivatives, see
+        ``descriptor_derivatives``, in double precision whatever the engine.
+
+        Args:
+            X (list): list of N Mx5 arrays containing xyz coordinates and atomic species
+            order (str): memory layout of the gram matrix, 'C' or 'F' (Fortran)
+
+        Returns:
+            gram (matrix): N*3 x N*3 gram matrix of the matrix-valued kernels
+            gradient (array): N*3 x N*3 x 3 derivatives of the gram matrix with respect to
+                theta[0], theta[1] and theta[2]
+
+        """
+        sig, rc, r0 = self.theta
+        q, dq, alpha_1 = eam_descriptors(X, rc, r0)
+        q_rc, dq_rc, q_r0, dq_r0 = descriptor_derivatives(X, rc, r0)
+        k, delta = eam_rbf(q, alpha_1, q, alpha_1, sig, self.type == 'multi')
+
+        # the blocks are h(delta) dq1 dq2, h being the second derivative of the Gaussian
+        h = k * (1 / sig ** 2 - delta ** 2 / sig ** 4)
+        h_sig = k * (delta ** 2 / sig ** 3 * (1 / sig ** 2 - delta ** 2 / sig ** 4) +
+                     4 * delta ** 2 / sig ** 5 - 2 / sig ** 3)
+        h_delta = -k * delta / sig ** 2 * (3 / sig ** 2 - delta ** 2 / sig ** 4)
+
+        gram = np.asarray(outer_blocks(h, dq, dq), order=order)
+        gradient = np.zeros((len(q) * 3, len(q) * 3, 3))
+        gradient[:, :, 0] = outer_blocks(h_sig, dq, dq)
+        for i, (q_t, dq_t) in enumerate(((q_rc, dq_rc), (q_r0, dq_r0)), 1):
+            gradient[:, :, i] = (outer_blocks(h_delta * (q_t[:, None] - q_t[None, :]), dq, dq) +
+                                 outer_blocks(h, dq_t, dq) + outer_blocks(h, dq, dq_t))
+
+        return gram, gradient
+
+    @cached_blocks('gram', (3, 3))
+    def calc_gram(self, X, ncores=1, eval_gradient=False, order='C'):
         """
         Calculate the force-force gram matrix for a set of configurations X.
 
@@ -361,67 +666,34 @@ class BaseEam(Kernel, metaclass=ABCMeta):
             X (list): list of N Mx5 arrays containing xyz coordinates and atomic species
             ncores (int): Number of CPU nodes to use for multiprocessing (default is 1)
             eval_gradient (bool): if True, evaluate the gradient of the gram matrix
+            order (str): memory layout of the gram matrix, 'C' or 'F' (Fortran)
 
         Returns:
             gram (matrix): N*3 x N*3 gram matrix of the matrix-valued kernels 
 
        """
         if eval_gradient:
-            raise NotImplementedError('ERROR: GRADIENT NOT IMPLEMENTED YET')
+            return self.calc_gram_gradient(X, order)
         else:
-            if ncores > 1:  # Used for multiprocessing
-                confs = []
-
-                # Build a list of all input pairs which matrix needs to be computed
-                for i in np.arange(len(X)):
-                    for j in np.arange(i + 1):
-                        thislist = np.asarray([X[i], X[j]])
-                        confs.append(thislist)
-                n = len(confs)
-                import sys
-                sys.setrecursionlimit(100000)
+            if self.engine != 'theano':
+                gram = np.asarray(self.descriptor_ff(X, X), order=order)
+
+            elif ncores > 1:  # Used for multiprocessing
                 logger.info(
                     'Using %i cores for the eam force-force gram matrix calculation' % (ncores))
-
-                # Way to split the kernels functions to compute evenly across the nodes
-                splitind = np.zeros(ncores + 1)
-                factor = (n + (ncores - 1)) / ncores
-                splitind[1:-1] = [(i + 1) *
-                                  factor for i in np.arange(ncores - 1)]
-                splitind[-1] = n
-                splitind = splitind.astype(int)
-                clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                          self.type] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-                import multiprocessing as mp
-                pool = mp.Pool(ncores)
-                result = pool.map(dummy_calc_ff, clist)
-                pool.close()
-                pool.join()
-
-                result = np.concatenate(result).reshape((n, 3, 3))
-                off_diag = np.zeros((len(X) * 3, len(X) * 3))
-                diag = np.zeros((len(X) * 3, len(X) * 3))
-                for i in np.arange(len(X)):
-                    diag[3 * i:3 * i + 3, 3 * i:3 * i +
-                         3] = result[i + i * (i + 1) // 2]
-                    for j in np.arange(i):
-                        off_diag[3 * i:3 * i + 3, 3 * j:3 *
-                                 j + 3] = result[j + i * (i + 1) // 2]
+                gram = self.calc_parallel(dummy_calc_ff, X, X, (3, 3), ncores,
+                                          args=(self.theta, self.type, self.dtype), symmetric=True,
+                                          order=order)
 
             else:
-                diag = np.zeros((X.shape[0] * 3, X.shape[0] * 3))
-                off_diag = np.zeros((X.shape[0] * 3, X.shape[0] * 3))
-                for i in np.arange(X.shape[0]):
-                    diag[3 * i:3 * i + 3, 3 * i:3 * i + 3] = \
-                        self.k2_ff(X[i], X[i], self.theta[0],
-                                   self.theta[1], self.theta[2])
-                    for j in np.arange(i):
-                        off_diag[3 * i:3 * i + 3, 3 * j:3 * j + 3] = \
+                gram = np.zeros((len(X) * 3, len(X) * 3), order=order)
+                for i in range(len(X)):
+                    for j in range(i + 1):
+                        gram[3 * i:3 * i + 3, 3 * j:3 * j + 3] = \
                             self.k2_ff(X[i], X[j], self.theta[0],
                                        self.theta[1], self.theta[2])
+                mirror_lower(gram, 3)  # The gram matrix is symmetric
 
-            gram = diag + off_diag + off_diag.T  # The gram matrix is symmetric
             return gram
 
     def calc_gram_e(self, X, ncores=1, eval_gradient=False):
@@ -440,63 +712,33 @@ class BaseEam(Kernel, metaclass=ABCMeta):
         if eval_gradient:
             raise NotImplementedError('ERROR: GRADIENT NOT IMPLEMENTED YET')
         else:
-            if ncores > 1:  # Used for multiprocessing
-                confs = []
-
-                # Build a list of all input pairs which matrix needs to be computed
-                for i in np.arange(len(X)):
-                    for j in np.arange(i + 1):
-                        thislist = np.array([list(X[i]), list(X[j])])
-                        confs.append(thislist)
-
-                n = len(confs)
-                import sys
-                sys.setrecursionlimit(100000)
+            if self.engine != 'theano':
+                gram = self.descriptor_ee(X, X)
+
+            elif ncores > 1:  # Used for multiprocessing
                 logger.info(
                     'Using %i cores for the eam energy-energy gram matrix calculation' % (ncores))
-
-                # Way to split the kernels functions to compute evenly across the nodes
-                splitind = np.zeros(ncores + 1)
-                factor = (n + (ncores - 1)) / ncores
-                splitind[1:-1] = [(i + 1) *
-                                  factor for i in np.arange(ncores - 1)]
-                splitind[-1] = n
-                splitind = splitind.astype(int)
-                clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                          self.type, False, False] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-                import multiprocessing as mp
-                pool = mp.Pool(ncores)
-                result = pool.map(dummy_calc_ee, clist)
-                pool.close()
-                pool.join()
-
-                result = np.concatenate(result).ravel()
-                off_diag = np.zeros((len(X), len(X)))
-                diag = np.zeros((len(X), len(X)))
-                for i in np.arange(len(X)):
-                    diag[i, i] = result[i + i * (i + 1) // 2]
-                    for j in np.arange(i):
-                        off_diag[i, j] = result[j + i * (i + 1) // 2]
+                gram = self.calc_parallel(dummy_calc_ee, X, X, (1, 1), ncores,
+                                          kinds=('global', 'global'),
+                                          args=(self.theta, self.type, False, 0, self.dtype),
+                                          symmetric=True)
 
             else:
-                diag = np.zeros((X.shape[0], X.shape[0]))
-                off_diag = np.zeros((X.shape[0], X.shape[0]))
-                for i in np.arange(X.shape[0]):
+                gram = np.zeros((len(X), len(X)))
+                for i in range(len(X)):
                     for k, conf1 in enumerate(X[i]):
-                        diag[i, i] += 0.25*self.k2_ee(conf1, conf1, self.theta[0],
+                        gram[i, i] += 0.25*self.k2_ee(conf1, conf1, self.theta[0],
                                                  self.theta[1], self.theta[2])
                         for conf2 in X[i][:k]:
                             # *2 here to speed up the loop
-                            diag[i, i] += 0.25*2.0*self.k2_ee(
+                            gram[i, i] += 0.25*2.0*self.k2_ee(
                                 conf1, conf2, self.theta[0], self.theta[1], self.theta[2])
-                    for j in np.arange(i):
+                    for j in range(i):
                         for conf1 in X[i]:
                             for conf2 in X[j]:
-                                off_diag[i, j] += 0.25*self.k2_ee(
+                                gram[i, j] += 0.25*self.k2_ee(
                                     conf1, conf2, self.theta[0], self.theta[1], self.theta[2])
-
-            gram = diag + off_diag + off_diag.T  # Gram matrix is symmetric
+                mirror_lower(gram, 1)  # Gram matrix is symmetric
 
             return gram
 
@@ -516,47 +758,24 @@ class BaseEam(Kernel, metaclass=ABCMeta):
             gram (matrix): N2 x N1*3 gram matrix of the vector-valued kernels 
 
        """
-        gram = np.zeros((X_glob.shape[0], X.shape[0] * 3))
+        gram = np.zeros((len(X_glob), len(X) * 3))
 
         if eval_gradient:
             raise NotImplementedError('ERROR: GRADIENT NOT IMPLEMENTED YET')
         else:
-            if ncores > 1:  # Multiprocessing
-                confs = []
-                for i in np.arange(len(X_glob)):
-                    for j in np.arange(len(X)):
-                        thislist = np.asarray([X_glob[i], X[j]])
-                        confs.append(thislist)
-                n = len(confs)
-                import sys
-                sys.setrecursionlimit(100000)
+            if self.engine != 'theano':
+                gram = self.descriptor_ef(X_glob, X)
+
+            elif ncores > 1:  # Multiprocessing
                 logger.info(
                     'Using %i cores for the eam energy-force gram matrix calculation' % (ncores))
-
-                # Way to split the kernels functions to compute evenly across the nodes
-                splitind = np.zeros(ncores + 1)
-                factor = (n + (ncores - 1)) / ncores
-                splitind[1:-1] = [(i + 1) *
-                                  factor for i in np.arange(ncores - 1)]
-                splitind[-1] = n
-                splitind = splitind.astype(int)
-                clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                          self.type, False, False] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-                import multiprocessing as mp
-                pool = mp.Pool(ncores)
-                result = pool.map(dummy_calc_ef, clist)
-                pool.close()
-                pool.join()
-                result = np.vstack(np.asarray(result))
-
-                for i in np.arange(X_glob.shape[0]):
-                    for j in np.arange(X.shape[0]):
-                        gram[i, 3 * j:3 * j + 3] = result[(j + i * X.shape[0])]
+                gram = self.calc_parallel(dummy_calc_ef, X_glob, X, (1, 3), ncores,
+                                          kinds=('global', 'local'),
+                                          args=(self.theta, self.type, False, 0, self.dtype))
 
             else:
-                for i in np.arange(X_glob.shape[0]):
-                    for j in np.arange(X.shape[0]):
+                for i in np.arange(len(X_glob)):
+                    for j in np.arange(len(X)):
                         for k in X_glob[i]:
                             gram[i, 3 * j:3 * j + 3] += 0.5*self.k2_ef(
                                 k, X[j], self.theta[0], self.theta[1], self.theta[2])
@@ -567,8 +786,8 @@ class BaseEam(Kernel, metaclass=ABCMeta):
 
     @staticmethod
     @abstractmethod
-    def compile_theano():
-        return None, None, None, None, None
+    def compile_theano(names, dtype='float64'):
+        return {}
 
 
 class EamSingleSpeciesKernel(BaseEam):
@@ -578,215 +797,110 @@ class EamSingleSpeciesKernel(BaseEam):
         theta[0] (float): lengthscale of the kernel
         theta[1] (float): cutoff radius
         theta[2] (float): radius in the descriptor's exponent
+        engine (str): "theano" (default), "numpy" or "numba"
+        dtype (str): "float64" (default) or "float32" for single-precision kernels
     """
 
-    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-1, 1e2), (1e-1, 1e2))):
-        super().__init__(kernel_name='EamSingleSpecies', theta=theta, bounds=bounds)
+    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-1, 1e2), (1e-1, 1e2)),
+                 engine='theano', dtype='float64'):
+        super().__init__(kernel_name='EamSingleSpecies', theta=theta, bounds=bounds,
+                         engine=engine, dtype=dtype)
         self.type = "single"
 
     @staticmethod
-    def compile_theano():
+    def compile_theano(names, dtype='float64'):
         """
         This function generates theano compiled kernels for global energy and force learning
 
         The position of the atoms relative to the central one, and their chemical species
         are defined by a matrix of dimension Mx5 here called r1 and r2.
 
+        Args:
+            names (list): names of the functions to compile, e.g. "keam_ee"
+            dtype (str): "float64" or "float32", precision of the compiled functions
+
         Returns:
-            k2_ee (func): energy-energy kernel
-            k2_ef (func): energy-force kernel
-            k2_ff (func): force-force kernel
-            k2_ee_map (func): energy-energy kernel that takes descriptor as one argument
-            k2_ef_map (func): energy-force kernel that takes descriptor as one argument
+            functions (dict): the compiled theano functions, by name
         """
 
-        if not (os.path.exists(Mffpath / 'keam_ee_s.pickle') and
-                os.path.exists(Mffpath / 'keam_ef_s.pickle') and os.path.exists(
-                    Mffpath / 'keam_ff_s.pickle')
-                and os.path.exists(Mffpath / 'keam_eed_s.pickle') and os.path.exists(Mffpath / 'keam_efd_s.pickle')):
-            print("Building Kernels")
 
-            import theano.tensor as T
-            from theano import function, scan
-            logger.info(
-                "Started compilation of theano eam single species kernels")
-            # --------------------------------------------------
-            # INITIAL DEFINITIONS
-            # --------------------------------------------------
-
-            # positions of central atoms
-            r1, r2 = T.dvectors('r1d', 'r2d')
-            # positions of neighbours
-            rho1, rho2 = T.dmatrices('rho1', 'rho2')
-            # lengthscale hyperparameter
-            sig = T.dscalar('sig')
-            # cutoff hyperparameters
-            rc = T.dscalar('rc')
-            # Descriptor as a given input, used to map
-            q1_descr = T.dscalar('q1_descr')
-            # Radius to use at denominator in the descriptor
-            r0 = T.dscalar('r0')
-
-            # positions of neighbours without chemical species (3D space assumed)
-            rho1s = rho1[:, 0:3]
-            rho2s = rho2[:, 0:3]
-
-            # distances of atoms wrt to the central one and wrt each other in 1 and 2
-            r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
-            r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
-
-            esp_term_1 = (r1j/r0 - 1)
-            esp_term_2 = (r2m/r0 - 1)
-
-            cut_1 = 0.5*(1 + T.cos(np.pi*r1j/rc))*((T.sgn(rc-r1j) + 1) / 2)
-            cut_2 = 0.5*(1 + T.cos(np.pi*r2m/rc))*((T.sgn(rc-r2m) + 1) / 2)
-
-            q1 = T.sum(T.exp(-esp_term_1)*cut_1)
-            q2 = T.sum(T.exp(-esp_term_2)*cut_2)
-
-            k = T.exp(-(q1-q2)**2/(2*sig**2))
-
-            k_descr = T.exp(-(q1_descr-q2)**2/(2*sig**2))
-
-            # energy energy kernel
-            k_ee_fun = function([r1, r2, rho1, rho2, sig, rc, r0], k,
-                                allow_input_downcast=False, on_unused_input='warn')
-
-            # energy force kernel - Used to predict energies from forces
-            k_ef = T.grad(k, r2)
-            k_ef_fun = function([r1, r2, rho1, rho2, sig, rc, r0], k_ef,
-                                allow_input_downcast=False, on_unused_input='warn')
-
-            # force force kernel - it uses only local atom pairs to avoid useless computation
-            k_ff = T.grad(k, r1)
-            k_ff_der, updates = scan(lambda j, k_ff, r2: T.grad(k_ff[j], r2),
-                                     sequences=T.arange(k_ff.shape[0]), non_sequences=[k_ff, r2])
-
-            k_ff_fun = function([r1, r2, rho1, rho2, sig, rc, r0], k_ff_der,
-                                allow_input_downcast=False, on_unused_input='warn')
-
-            # energy energy descriptor kernel
-            k_ee_fun_d = function([r2, q1_descr, rho2, sig, rc, r0], k_descr,
-                                  allow_input_downcast=False, on_unused_input='warn')
-
-            # energy force descriptor kernel
-            k_ef_descr = T.grad(k_descr, r2)
-            k_ef_fun_d = function([r2, q1_descr, rho2, sig, rc, r0], k_ef_descr,
-                                  allow_input_downcast=False, on_unused_input='warn')
-
-            # Save the function that we want to use for multiprocessing
-            # This is necessary because theano is a crybaby and does not want to access the
-            # Automaticallly stored compiled object from different processes
-            with open(Mffpath / 'keam_ee_s.pickle', 'wb') as f:
-                pickle.dump(k_ee_fun, f)
-            with open(Mffpath / 'keam_ef_s.pickle', 'wb') as f:
-                pickle.dump(k_ef_fun, f)
-            with open(Mffpath / 'keam_ff_s.pickle', 'wb') as f:
-                pickle.dump(k_ff_fun, f)
-            with open(Mffpath / 'keam_eed_s.pickle', 'wb') as f:
-                pickle.dump(k_ee_fun_d, f)
-            with open(Mffpath / 'keam_efd_s.pickle', 'wb') as f:
-                pickle.dump(k_ef_fun_d, f)
-
-        else:
-            print("Loading Kernels")
-            with open(Mffpath / "keam_ee_s.pickle", 'rb') as f:
-                k_ee_fun = pickle.load(f)
-            with open(Mffpath / "keam_ef_s.pickle", 'rb') as f:
-                k_ef_fun = pickle.load(f)
-            with open(Mffpath / "keam_ff_s.pickle", 'rb') as f:
-                k_ff_fun = pickle.load(f)
-            with open(Mffpath / 'keam_eed_s.pickle', 'rb') as f:
-                k_ee_fun_d = pickle.load(f)
-            with open(Mffpath / 'keam_efd_s.pickle', 'rb') as f:
-                k_ef_fun_d = pickle.load(f)
+        import theano.tensor as T
+        from theano import function, scan
+        logger.info(
+            "Started compilation of theano eam single species kernels")
         # --------------------------------------------------
-        # WRAPPERS (we don't want to plug the position of the central element every time)
+        # INITIAL DEFINITIONS
         # --------------------------------------------------
 
-        def k2_ee(conf1, conf2, sig, rc, r0):
-            """
-            Eam kernel for global energy-energy correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                rc (float): cutoff distance hyperparameter theta[1]
-
-            Returns:
-                kernel (float): scalar valued energy-energy Eam kernel
-
-            """
-            return k_ee_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, rc, r0)
-
-        def k2_ef(conf1, conf2, sig, rc, r0):
-            """
-            Eam kernel for global energy-force correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                rc (float): cutoff distance hyperparameter theta[1]
-
-            Returns:
-                kernel (array): 3x1 energy-force Eam kernel
-
-            """
-            return -k_ef_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, rc, r0)
-
-        def k2_ff(conf1, conf2, sig, rc, r0):
-            """
-            Eam kernel for force-force correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                rc (float): cutoff distance hyperparameter theta[1]
-
-            Returns:
-                kernel (matrix): 3x3 force-force Eam kernel
-
-            """
-            return k_ff_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, rc, r0)
-
-        def k2_ee_d(descr1, conf2,  sig, rc, r0):
-            """
-            Eam kernel for global energy-force correlation
-
-            Args:
-                descr1 (float): descriptor calculated for the first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                rc (float): cutoff distance hyperparameter theta[1]
-
-            Returns:
-                kernel (array): 3x1 energy-force Eam kernel
-
-            """
-            return k_ee_fun_d(np.zeros(3), descr1, conf2, sig, rc, r0)
-
-        def k2_ef_d(descr1, conf2, sig, rc, r0):
-            """
-            Eam kernel for force-force correlation
-
-            Args:
-                descr1 (float): descriptor calculated for the first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                rc (float): cutoff distance hyperparameter theta[`]
-
-            Returns:
-                kernel (matrix): 3x3 force-force Eam kernel
-
-            """
-            return -k_ef_fun_d(np.zeros(3), descr1, conf2, sig, rc, r0)
+        # positions of central atoms
+        r1, r2 = T.vectors('r1d', 'r2d')
+        # positions of neighbours
+        rho1, rho2 = T.matrices('rho1', 'rho2')
+        # lengthscale hyperparameter
+        sig = T.scalar('sig')
+        # cutoff hyperparameters
+        rc = T.scalar('rc')
+        # Descriptor as a given input, used to map
+        q1_descr = T.scalar('q1_descr')
+        # Radius to use at denominator in the descriptor
+        r0 = T.scalar('r0')
+
+        # positions of neighbours without chemical species (3D space assumed)
+        rho1s = rho1[:, 0:3]
+        rho2s = rho2[:, 0:3]
+
+        # distances of atoms wrt to the central one and wrt each other in 1 and 2
+        r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
+        r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
+
+        esp_term_1 = (r1j/r0 - 1)
+        esp_term_2 = (r2m/r0 - 1)
+
+        cut_1 = 0.5*(1 + T.cos(np.pi*r1j/rc))*((T.sgn(rc-r1j) + 1) / 2)
+        cut_2 = 0.5*(1 + T.cos(np.pi*r2m/rc))*((T.sgn(rc-r2m) + 1) / 2)
+
+        q1 = T.sum(T.exp(-esp_term_1)*cut_1)
+        q2 = T.sum(T.exp(-esp_term_2)*cut_2)
+
+        k = T.exp(-(q1-q2)**2/(2*sig**2))
+
+        k_descr = T.exp(-(q1_descr-q2)**2/(2*sig**2))
+
+        functions = {}
+        # energy energy kernel
+        if 'keam_ee' in names:
+            functions['keam_ee'] = function([r1, r2, rho1, rho2, sig, rc, r0], k,
+                                            allow_input_downcast=True, on_unused_input='warn')
+
+        # energy force kernel - Used to predict energies from forces
+        k_ef = T.grad(k, r2)
+        if 'keam_ef' in names:
+            functions['keam_ef'] = function([r1, r2, rho1, rho2, sig, rc, r0], k_ef,
+                                            allow_input_downcast=True, on_unused_input='warn')
+
+        # force force kernel - it uses only local atom pairs to avoid useless computation
+        k_ff = T.grad(k, r1)
+        k_ff_der, updates = scan(lambda j, k_ff, r2: T.grad(k_ff[j], r2),
+                                 sequences=T.arange(k_ff.shape[0]), non_sequences=[k_ff, r2])
+
+        if 'keam_ff' in names:
+            functions['keam_ff'] = function([r1, r2, rho1, rho2, sig, rc, r0], k_ff_der,
+                                            allow_input_downcast=True, on_unused_input='warn')
+
+        # energy energy descriptor kernel
+        if 'keam_eed' in names:
+            functions['keam_eed'] = function([r2, q1_descr, rho2, sig, rc, r0], k_descr,
+                                             allow_input_downcast=True, on_unused_input='warn')
+
+        # energy force descriptor kernel
+        k_ef_descr = T.grad(k_descr, r2)
+        if 'keam_efd' in names:
+            functions['keam_efd'] = function([r2, q1_descr, rho2, sig, rc, r0], k_ef_descr,
+                                             allow_input_downcast=True, on_unused_input='warn')
 
         logger.info("Ended compilation of theano eam single species kernels")
 
-        return k2_ee, k2_ef, k2_ff, k2_ee_d, k2_ef_d
+        return functions
 
 
 class EamManySpeciesKernel(BaseEam):
@@ -796,227 +910,122 @@ class EamManySpeciesKernel(BaseEam):
         theta[0] (float): lengthscale of the kernel
         theta[1] (float): cutoff radius
         theta[2] (float): radius in the descriptor's exponent
+        engine (str): "theano" (default), "numpy" or "numba"
+        dtype (str): "float64" (default) or "float32" for single-precision kernels
     """
 
-    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-2, 1e2), (1e-2, 1e2))):
-        super().__init__(kernel_name='EamMultiSpecies', theta=theta, bounds=bounds)
+    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-2, 1e2), (1e-2, 1e2)),
+                 engine='theano', dtype='float64'):
+        super().__init__(kernel_name='EamMultiSpecies', theta=theta, bounds=bounds,
+                         engine=engine, dtype=dtype)
         self.type = "multi"
 
     @staticmethod
-    def compile_theano():
+    def compile_theano(names, dtype='float64'):
         """
         This function generates theano compiled kernels for global energy and force learning
 
         The position of the atoms relative to the central one, and their chemical species
         are defined by a matrix of dimension Mx5 here called r1 and r2.
 
+        Args:
+            names (list): names of the functions to compile, e.g. "keam_ee"
+            dtype (str): "float64" or "float32", precision of the compiled functions
+
         Returns:
-            k2_ee (func): energy-energy kernel
-            k2_ef (func): energy-force kernel
-            k2_ff (func): force-force kernel
-            k2_ee_map (func): energy-energy kernel that takes descriptor as one argument
-            k2_ef_map (func): energy-force kernel that takes descriptor as one argument
+            functions (dict): the compiled theano functions, by name
         """
 
-        if not (os.path.exists(Mffpath / 'keam_ee_m.pickle') and
-                os.path.exists(Mffpath / 'keam_ef_m.pickle') and os.path.exists(
-                    Mffpath / 'keam_ff_m.pickle')
-                and os.path.exists(Mffpath / 'keam_eed_m.pickle') and os.path.exists(Mffpath / 'keam_efd_m.pickle')):
-            print("Building Kernels")
-
-            import theano.tensor as T
-            from theano import function, scan
-            logger.info(
-                "Started compilation of theano eam multi species kernels")
-            # --------------------------------------------------
-            # INITIAL DEFINITIONS
-            # --------------------------------------------------
-
-            # positions of central atoms
-            r1, r2 = T.dvectors('r1d', 'r2d')
-            # positions of neighbours
-            rho1, rho2 = T.dmatrices('rho1', 'rho2')
-            # lengthscale hyperparameter
-            sig = T.dscalar('sig')
-            # cutoff hyperparameters
-            rc = T.dscalar('rc')
-            # Descriptor as a given input, used to map
-            q1_descr = T.dscalar('q1_descr')
-            # Element of the central atom if descriptor is Given
-            alpha_1_descr = T.dscalar('alpha_1_descr')
-            # Radius to use at denominator in the descriptor
-            r0 = T.dscalar('r0')
-
-            # positions of neighbours without chemical species (3D space assumed)
-            rho1s = rho1[:, 0:3]
-            rho2s = rho2[:, 0:3]
-            alpha_1 = rho1[0, 3]  # .flatten()
-            alpha_2 = rho2[0, 3]  # .flatten()
-
-            # numerical kronecker
-            def delta_alpha(a1j, a2m):
-                d = T.exp(-(a1j - a2m) ** 2 / (2 * 1e-5 ** 2))
-                return d
-
-            # matrices determining whether couples of atoms have the same atomic number
-            delta_alpha_12 = delta_alpha(alpha_1, alpha_2)
-            delta_alpha_12_descr = delta_alpha(alpha_1_descr, alpha_2)
-
-            # distances of atoms wrt to the central one and wrt each other in 1 and 2
-            r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
-            r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
-
-            esp_term_1 = (r1j/r0 - 1)
-            esp_term_2 = (r2m/r0 - 1)
-
-            cut_1 = 0.5*(1 + T.cos(np.pi*r1j/rc))*((T.sgn(rc-r1j) + 1) / 2)
-            cut_2 = 0.5*(1 + T.cos(np.pi*r2m/rc))*((T.sgn(rc-r2m) + 1) / 2)
-
-            q1 = T.sum(T.exp(-esp_term_1)*cut_1)
-            q2 = T.sum(T.exp(-esp_term_2)*cut_2)
-
-            k = T.exp(-(q1-q2)**2/(2*sig**2))*delta_alpha_12
-
-            k_descr = T.exp(-(q1_descr-q2)**2/(2*sig**2))*delta_alpha_12_descr
-
-            # energy energy kernel
-            k_ee_fun = function([r1, r2, rho1, rho2, sig, rc, r0], k,
-                                allow_input_downcast=False, on_unused_input='warn')
-
-            # energy force kernel - Used to predict energies from forces
-            k_ef = T.grad(k, r2)
-            k_ef_fun = function([r1, r2, rho1, rho2, sig, rc, r0], k_ef,
-                                allow_input_downcast=False, on_unused_input='warn')
-
-            # force force kernel - it uses only local atom pairs to avoid useless computation
-            k_ff = T.grad(k, r1)
-            k_ff_der, updates = scan(lambda j, k_ff, r2: T.grad(k_ff[j], r2),
-                                     sequences=T.arange(k_ff.shape[0]), non_sequences=[k_ff, r2])
-
-            k_ff_fun = function([r1, r2, rho1, rho2, sig, rc, r0], k_ff_der,
-                                allow_input_downcast=False, on_unused_input='warn')
-
-            # energy energy descriptor kernel
-            k_ee_fun_d = function([r2, q1_descr, rho2, sig, rc, r0, alpha_1_descr], k_descr,
-                                  allow_input_downcast=False, on_unused_input='warn')
-
-            # energy force descriptor kernel
-            k_ef_descr = T.grad(k_descr, r2)
-            k_ef_fun_d = function([r2, q1_descr, rho2, sig, rc, r0, alpha_1_descr], k_ef_descr,
-                                  allow_input_downcast=False, on_unused_input='warn')
-
-            # Save the function that we want to use for multiprocessing
-            # This is necessary because theano is a crybaby and does not want to access the
-            # Automaticallly stored compiled object from different processes
-            with open(Mffpath / 'keam_ee_m.pickle', 'wb') as f:
-                pickle.dump(k_ee_fun, f)
-            with open(Mffpath / 'keam_ef_m.pickle', 'wb') as f:
-                pickle.dump(k_ef_fun, f)
-            with open(Mffpath / 'keam_ff_m.pickle', 'wb') as f:
-                pickle.dump(k_ff_fun, f)
-            with open(Mffpath / 'keam_eed_m.pickle', 'wb') as f:
-                pickle.dump(k_ee_fun_d, f)
-            with open(Mffpath / 'keam_efd_m.pickle', 'wb') as f:
-                pickle.dump(k_ef_fun_d, f)
 
-        else:
-            print("Loading Kernels")
-            with open(Mffpath / "keam_ee_m.pickle", 'rb') as f:
-                k_ee_fun = pickle.load(f)
-            with open(Mffpath / "keam_ef_m.pickle", 'rb') as f:
-                k_ef_fun = pickle.load(f)
-            with open(Mffpath / "keam_ff_m.pickle", 'rb') as f:
-                k_ff_fun = pickle.load(f)
-            with open(Mffpath / 'keam_eed_m.pickle', 'rb') as f:
-                k_ee_fun_d = pickle.load(f)
-            with open(Mffpath / 'keam_efd_m.pickle', 'rb') as f:
-                k_ef_fun_d = pickle.load(f)
+        import theano.tensor as T
+        from theano import function, scan
+        logger.info(
+            "Started compilation of theano eam multi species kernels")
         # --------------------------------------------------
-        # WRAPPERS (we don't want to plug the position of the central element every time)
+        # INITIAL DEFINITIONS
         # --------------------------------------------------
 
-        def k2_ee(conf1, conf2, sig, rc, r0):
-            """
-            Eam kernel for global energy-energy correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                rc (float): cutoff distance hyperparameter theta[1]
-
-            Returns:
-                kernel (float): scalar valued energy-energy Eam kernel
-
-            """
-            return k_ee_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, rc, r0)
-
-        def k2_ef(conf1, conf2, sig, rc, r0):
-            """
-            Eam kernel for global energy-force correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                rc (float): cutoff distance hyperparameter theta[1]
-
-            Returns:
-                kernel (array): 3x1 energy-force Eam kernel
-
-            """
-            return -k_ef_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, rc, r0)
-
-        def k2_ff(conf1, conf2, sig, rc, r0):
-            """
-            Eam kernel for force-force correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                rc (float): cutoff distance hyperparameter theta[1]
-
-            Returns:
-                kernel (matrix): 3x3 force-force Eam kernel
-
-            """
-            return k_ff_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, rc, r0)
-
-        def k2_ee_d(descr1, conf2,  sig, rc, r0, alpha_1_descr):
-            """
-            Eam kernel for global energy-force correlation
-
-            Args:
-                descr1 (float): descriptor calculated for the first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                rc (float): cutoff distance hyperparameter theta[2]
-                alpha_1_descr (int): element of the central atom
-
-            Returns:
-                kernel (array): 3x1 energy-force Eam kernel
-
-            """
-            return k_ee_fun_d(np.zeros(3), descr1, conf2, sig, rc, r0, alpha_1_descr)
-
-        def k2_ef_d(descr1, conf2, sig, rc, r0, alpha_1_descr):
-            """
-            Eam kernel for force-force correlation
-
-            Args:
-                descr1 (float): descriptor calculated for the first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                rc (float): cutoff distance hyperparameter theta[1]
-                alpha_1_descr (int): element of the central atom
-
-            Returns:
-                kernel (matrix): 3x3 force-force Eam kernel
-
-            """
-            return -k_ef_fun_d(np.zeros(3), descr1, conf2, sig, rc, r0, alpha_1_descr)
+        # positions of central atoms
+        r1, r2 = T.vectors('r1d', 'r2d')
+        # positions of neighbours
+        rho1, rho2 = T.matrices('rho1', 'rho2')
+        # lengthscale hyperparameter
+        sig = T.scalar('sig')
+        # cutoff hyperparameters
+        rc = T.scalar('rc')
+        # Descriptor as a given input, used to map
+        q1_descr = T.scalar('q1_descr')
+        # Element of the central atom if descriptor is Given
+        alpha_1_descr = T.scalar('alpha_1_descr')
+        # Radius to use at denominator in the descriptor
+        r0 = T.scalar('r0')
+
+        # positions of neighbours without chemical species (3D space assumed)
+        rho1s = rho1[:, 0:3]
+        rho2s = rho2[:, 0:3]
+        alpha_1 = rho1[0, 3]  # .flatten()
+        alpha_2 = rho2[0, 3]  # .flatten()
+
+        # numerical kronecker
+        def delta_alpha(a1j, a2m):
+            d = T.exp(-(a1j - a2m) ** 2 / (2 * 1e-5 ** 2))
+            return d
+
+        # matrices determining whether couples of atoms have the same atomic number
+        delta_alpha_12 = delta_alpha(alpha_1, alpha_2)
+        delta_alpha_12_descr = delta_alpha(alpha_1_descr, alpha_2)
+
+        # distances of atoms wrt to the central one and wrt each other in 1 and 2
+        r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
+        r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
+
+        esp_term_1 = (r1j/r0 - 1)
+        esp_term_2 = (r2m/r0 - 1)
+
+        cut_1 = 0.5*(1 + T.cos(np.pi*r1j/rc))*((T.sgn(rc-r1j) + 1) / 2)
+        cut_2 = 0.5*(1 + T.cos(np.pi*r2m/rc))*((T.sgn(rc-r2m) + 1) / 2)
+
+        q1 = T.sum(T.exp(-esp_term_1)*cut_1)
+        q2 = T.sum(T.exp(-esp_term_2)*cut_2)
+
+        k = T.exp(-(q1-q2)**2/(2*sig**2))*delta_alpha_12
+
+        k_descr = T.exp(-(q1_descr-q2)**2/(2*sig**2))*delta_alpha_12_descr
+
+        functions = {}
+        # energy energy kernel
+        if 'keam_ee' in names:
+            functions['keam_ee'] = function([r1, r2, rho1, rho2, sig, rc, r0], k,
+                                            allow_input_downcast=True, on_unused_input='warn')
+
+        # energy force kernel - Used to predict energies from forces
+        k_ef = T.grad(k, r2)
+        if 'keam_ef' in names:
+            functions['keam_ef'] = function([r1, r2, rho1, rho2, sig, rc, r0], k_ef,
+                                            allow_input_downcast=True, on_unused_input='warn')
+
+        # force force kernel - it uses only local atom pairs to avoid useless computation
+        k_ff = T.grad(k, r1)
+        k_ff_der, updates = scan(lambda j, k_ff, r2: T.grad(k_ff[j], r2),
+                                 sequences=T.arange(k_ff.shape[0]), non_sequences=[k_ff, r2])
+
+        if 'keam_ff' in names:
+            functions['keam_ff'] = function([r1, r2, rho1, rho2, sig, rc, r0], k_ff_der,
+                                            allow_input_downcast=True, on_unused_input='warn')
+
+        # energy energy descriptor kernel
+        if 'keam_eed' in names:
+            functions['keam_eed'] = function([r2, q1_descr, rho2, sig, rc, r0, alpha_1_descr],
+                                             k_descr,
+                                             allow_input_downcast=True, on_unused_input='warn')
+
+        # energy force descriptor kernel
+        k_ef_descr = T.grad(k_descr, r2)
+        if 'keam_efd' in names:
+            functions['keam_efd'] = function([r2, q1_descr, rho2, sig, rc, r0, alpha_1_descr],
+                                             k_ef_descr,
+                                             allow_input_downcast=True, on_unused_input='warn')
 
         logger.info("Ended compilation of theano eam multi species kernels")
 
-        return k2_ee, k2_ef, k2_ff, k2_ee_d, k2_ef_d
+        return functions
@@ -1,94 +1,131 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import os.path
-import pickle
 from abc import ABCMeta, abstractmethod
 
 import numpy as np
 
-from mff.kernels.base import Kernel, Mffpath
+from mff.kernels import numbaengine
+from mff.kernels.base import Kernel, load_function
+from mff.kernels.blockcache import cached_blocks, cached_diag
+from mff.kernels.descriptors import configurations, describe, triplets
+from mff.kernels.parallel import mirror_lower
+from mff.kernels.threebodykernel import cached_triplet_kernel, triplet_kernel
 
 logger = logging.getLogger(__name__)
 
 
-def dummy_calc_ff(data):
-    """ Function used when multiprocessing.
+def engine_function(name, kertype, dtype='float64', options=None):
+    """ Kernel function evaluated by the workers, with the arguments of the compiled
+    function: the compiled function itself, or with the options of the numpy engine
+    the same kernel computed from the 3-body sums of ``triplet_kernel``.
+
     Args:
-        data (list of objects): contains all the information required
-            for the computation of the kernel values
-    
+        name (str): "km_ee", "km_ef" or "km_ff"
+        kertype (str): "single" or "multi" species kernel
+        dtype (str): "float64" or "float32", precision of the kernel
+        options (tuple): numpy engine options, see ``BaseManyBody.engine_options``,
+            None for the compiled function
+
     Returns:
-        result (array): the computed kernel values
+        fun (object): the kernel function
 
     """
 
-    array, theta0, theta1, theta2, kertype = data
-    if kertype == "single":
-        with open(Mffpath / "k3_ff_s.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    elif kertype == "multi":
-        with open(Mffpath / "k3_ff_m.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    result = np.zeros((len(array), 3, 3))
-    for i in np.arange(len(array)):
-        result[i] = fun(np.zeros(3), np.zeros(3), array[i][0],
-                        array[i][1],  theta0, theta1, theta2)
-    return result
+    if options is None:
+        return load_function(name, kertype, dtype)
+
+    steps, max_bytes, species_sorted = options
+    derivatives = ('km_ee', 'km_ef', 'km_ff').index(name)
+    scale = BaseManyBody.exp_scale
+
+    def fun(r1, r2, conf1, conf2, sig, theta, rc):
+        terms = triplet_kernel(triplets(conf1), triplets(conf2), sig, rc, steps, kertype == 'multi',
+                               derivatives, max_bytes, dtype, 'numpy', species_sorted)
+        k = np.exp(terms[0] / scale)
+        if derivatives == 0:
+            return k
+        if derivatives == 1:
+            return k * terms[1] / scale
+        return k * (terms[3] / scale + np.outer(terms[1], terms[2]) / scale ** 2)
+
+    return fun
+
+
+def dummy_calc_ff(conf1, conf2, theta, kertype, dtype='float64', options=None):
+    """ Function used when multiprocessing, evaluates the force-force kernel
+    of a single pair.
+
+    Args:
+        conf1 (array): Mx5 array of the first configuration
+        conf2 (array): Mx5 array of the second configuration
+        theta (list): hyperparameters of the kernel
+        kertype (str): "single" or "multi" species kernel
+        dtype (str): "float64" or "float32", precision of the compiled function
+        options (tuple): numpy engine options, None for the compiled function,
+            see ``engine_function``
+
+    Returns:
+        result (array): the computed kernel value
+
+    """
+
+    fun = engine_function("km_ff", kertype, dtype, options)
+    return fun(np.zeros(3), np.zeros(3), conf1, conf2, theta[0], theta[1], theta[2])
 
 
-def dummy_calc_ee(data):
-    """ Function used when multiprocessing.
+def dummy_calc_ee(x1, x2, theta, kertype, dtype='float64', options=None):
+    """ Function used when multiprocessing, evaluates the energy-energy kernel
+    of a single pair.
+
     Args:
-        data (list of objects): contains all the information required
-            for the computation of the kernel valuesf
-    
+        x1 (list): configurations of the first snapshot
+        x2 (list): configurations of the second snapshot
+        theta (list): hyperparameters of the kernel
+        kertype (str): "single" or "multi" species kernel
+        dtype (str): "float64" or "float32", precision of the compiled function
+        options (tuple): numpy engine options, None for the compiled function,
+            see ``engine_function``
+
     Returns:
-        result (array): the computed kernel values
+        result (float): the computed kernel value
 
     """
 
-    array, theta0, theta1, theta2, kertype = data
-    if kertype == "single":
-        with open(Mffpath / "k3_ee_s.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    elif kertype == "multi":
-        with open(Mffpath / "k3_ee_m.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    result = np.zeros(len(array))
-    for i in np.arange(len(array)):
-        for conf1 in array[i][0]:
-            for conf2 in array[i][1]:
-                result[i] += fun(np.zeros(3), np.zeros(3),
-                                 conf1, conf2, theta0, theta1, theta2)
+    fun = engine_function("km_ee", kertype, dtype, options)
+    result = 0
+    for conf1 in x1:
+        for conf2 in x2:
+            result += fun(np.zeros(3), np.zeros(3),
+                          conf1, conf2, theta[0], theta[1], theta[2])
     return result
 
 
-def dummy_calc_ef(data):
-    """ Function used when multiprocessing.
+def dummy_calc_ef(x1, conf2, theta, kertype, dtype='float64', options=None):
+    """ Function used when multiprocessing, evaluates the energy-force kernel
+    of a single pair.
+
     Args:
-        data (list of objects): contains all the information required
-            for the computation of the kernel values
-    
+        x1 (list): configurations of the first snapshot
+        conf2 (array): Mx5 array of the second configuration
+        theta (list): hyperparameters of the kernel
+        kertype (str): "single" or "multi" species kernel
+        dtype (str): "float64" or "float32", precision of the compiled function
+        options (tuple): numpy engine options, None for the compiled function,
+            see ``engine_function``
+
     Returns:
-        result (array): the computed kernel values
+        result (array): the computed kernel value
 
     """
 
-    array, theta0, theta1, theta2, kertype = data
-    if kertype == "single":
-        with open(Mffpath / "k3_ef_s.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    elif kertype == "multi":
-        with open(Mffpath / "k3_ef_m.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    result = np.zeros((len(array), 3))
-    for i in np.arange(len(array)):
-        conf2 = np.array(array[i][1], dtype='float')
-        for conf1 in array[i][0]:
-            conf1 = np.array(conf1, dtype='float')
-            result[i] += -fun(np.zeros(3), np.zeros(3), conf1,
-                              conf2,  theta0, theta1, theta2)
+    fun = engine_function("km_ef", kertype, dtype, options)
+    conf2 = np.array(conf2, dtype='float')
+    result = np.zeros(3)
+    for conf1 in x1:
+        conf1 = np.array(conf1, dtype='float')
+        result += -fun(np.zeros(3), np.zeros(3), conf1,
+                       conf2, theta[0], theta[1], theta[2])
     return result
 
 
@@ -103,6 +140,20 @@ class BaseManyBody(Kernel, metaclass=ABCMeta):
         theta[1] (float) : decay rate of the cutoff function
         theta[2] (float) : cutoff radius
         bounds (list) : bounds of the kernel function.
+        engine (str): "theano" (default) for the compiled kernels, "numpy" to compute
+            the kernels from triplet descriptors, see ``mff.kernels.descriptors``, or
+            "numba" to compute them from the same descriptors with the compiled loops of
+            ``mff.kernels.numbaengine``, on all the threads
+        max_memory (int): ceiling in bytes of the intermediates of a single kernel call
+            with the numpy engine, larger environments are evaluated in chunks
+        species_sorted (bool): with the numpy engine and many species, evaluate the
+            kernels on the triplets grouped by species, see ``triplet_kernel``
+        sum_cache (BlockCache): with the numpy or numba engine, cache of the 3-body sums
+            between pairs of configurations. Given the same cache, a 3-body kernel with the
+            same hyperparameters and cutoff steps reuses the sums, and the other way around,
+            see ``cached_triplet_kernel``
+        dtype (str): "float64" or "float32", precision in which the kernels are computed,
+            by the compiled functions or by the numpy and numba engines
 
     Attributes:
         km_ee (object): Energy-energy kernel function
@@ -111,13 +162,143 @@ class BaseManyBody(Kernel, metaclass=ABCMeta):
 
     """
 
+    function_names = ('km_ee', 'km_ef', 'km_ff')
+    cost_power = 2
+
+    # Cutoff steps of the theano graphs, see ``Triplets.weights``
+    cutoff_steps = (False, False)
+
+    # The many-body kernel is exp(k3 / exp_scale), k3 being the 3-body sum
+    exp_scale = 1000.
+
     @abstractmethod
-    def __init__(self, kernel_name, theta, bounds):
-        super().__init__(kernel_name)
+    def __init__(self, kernel_name, theta, bounds, engine='theano', max_memory=2**28,
+                 species_sorted=False, sum_cache=None, dtype='float64'):
+        super().__init__(kernel_name, dtype=dtype)
         self.theta = theta
         self.bounds = bounds
-        self.km_ee, self.km_ef, self.km_ff = self.compile_theano()
+        if engine not in ('theano', 'numpy', 'numba'):
+            raise ValueError("Unknown engine %s, use 'theano', 'numpy' or 'numba'" % engine)
+        if engine == 'numba':
+            numbaengine.require_numba()
+        if species_sorted and engine == 'theano':
+            raise ValueError("species_sorted requires the numpy or numba engine")
+        if sum_cache is not None and engine == 'theano':
+            raise ValueError("sum_cache requires the numpy or numba engine")
+        self.engine = engine
+        self.max_memory = max_memory
+        self.species_sorted = species_sorted
+        self.sum_cache = sum_cache
+        if engine != 'theano':
+            self.km_ee, self.km_ef, self.km_ff = self.numpy_ee, self.numpy_ef, self.numpy_ff
+        else:
+            self.km_ee, self.km_ef, self.km_ff = self.theano_ee, self.theano_ef, self.theano_ff
+
+    def describe(self, X, kind='local'):
+        """ Triplet descriptors of the configurations when using the numpy or numba
+        engine, see ``Kernel.describe``
+        """
+        if self.engine != 'theano':
+            return describe(X, kind)
+        return X
+
+    def engine_options(self):
+        """ Options of the numpy engine sent to the workers with the configurations,
+        see ``engine_function``. None with the compiled functions
+        """
+        if self.engine == 'theano':
+            return None
+        return self.cutoff_steps, self.max_memory, self.species_sorted
+
+    def shared(self, X, kind='local'):
+        """ Configurations sent to the workers, which describe them again with the numpy
+        engine, see ``configurations``
+        """
+        if self.engine != 'theano':
+            return configurations(X, kind)
+        return X
+
+    def eval_triplets(self, conf1, conf2, sig, rc, derivatives=0):
+        """ 3-body kernel terms of the numpy or numba engine, see ``triplet_kernel``.
+        Takes configurations or their Triplets.
+        """
+        args = (triplets(conf1), triplets(conf2), sig, rc, self.cutoff_steps, self.type == 'multi',
+                derivatives, self.max_memory, self.dtype, self.engine, self.species_sorted)
+        if self.sum_cache is not None:
+            return cached_triplet_kernel(self.sum_cache, *args)
+        return triplet_kernel(*args)
+
+    def numpy_ee(self, conf1, conf2, sig, theta, rc):
+        """ Energy-energy kernel of the numpy engine, same arguments as km_ee """
+        k, = self.eval_triplets(conf1, conf2, sig, rc)
+        return np.exp(k / self.exp_scale)
+
+    def numpy_ef(self, conf1, conf2, sig, theta, rc):
+        """ Energy-force kernel of the numpy engine, same arguments as km_ef """
+        k, g2 = self.eval_triplets(conf1, conf2, sig, rc, 1)
+        return -np.exp(k / self.exp_scale) * g2 / self.exp_scale
+
+    def numpy_ff(self, conf1, conf2, sig, theta, rc):
+        """ Force-force kernel of the numpy engine, same arguments as km_ff """
+        k, g1, g2, h = self.eval_triplets(conf1, conf2, sig, rc, 2)
+        return np.exp(k / self.exp_scale) * (h / self.exp_scale +
+                                             np.outer(g1, g2) / self.exp_scale ** 2)
+
+    def theano_ee(self, conf1, conf2, sig, theta, rc):
+        """
+        Many body kernel for global energy-energy correlation, evaluated by the compiled function
+
+        Args:
+            conf1 (array): first configuration.
+            conf2 (array): second configuration.
+            sig (float): lengthscale hyperparameter theta[0]
+            theta (float): cutoff decay rate hyperparameter theta[1]
+            rc (float): cutoff distance hyperparameter theta[2]
+
+        Returns:
+            kernel (float): scalar valued energy-energy many-body kernel
+
+        """
+        return self.theano_function('km_ee')(np.zeros(3), np.zeros(3), conf1, conf2,
+                                             sig, theta, rc)
+
+    def theano_ef(self, conf1, conf2, sig, theta, rc):
+        """
+        Many body kernel for global energy-force correlation, evaluated by the compiled function
+
+        Args:
+            conf1 (array): first configuration.
+            conf2 (array): second configuration.
+            sig (float): lengthscale hyperparameter theta[0]
+            theta (float): cutoff decay rate hyperparameter theta[1]
+            rc (float): cutoff distance hyperparameter theta[2]
+
+        Returns:
+            kernel (array): 3x1 energy-force many-body kernel
+
+        """
+        return -self.theano_function('km_ef')(np.zeros(3), np.zeros(3), conf1, conf2,
+                                              sig, theta, rc)
+
+    def theano_ff(self, conf1, conf2, sig, theta, rc):
+        """
+        Many body kernel for force-force correlation, evaluated by the compiled function
+
+        Args:
+            conf1 (array): first configuration.
+            conf2 (array): second configuration.
+            sig (float): lengthscale hyperparameter theta[0]
+            theta (float): cutoff decay rate hyperparameter theta[1]
+            rc (float): cutoff distance hyperparameter theta[2]
+
+        Returns:
+            kernel (matrix): 3x3 force-force many-body kernel
+
+        """
+        return self.theano_function('km_ff')(np.zeros(3), np.zeros(3), conf1, conf2,
+                                             sig, theta, rc)
 
+    @cached_blocks('ff', (3, 3))
     def calc(self, X1, X2, ncores=1):
         """
         Calculate the energy-force kernel between two sets of configurations.
@@ -132,39 +313,15 @@ class BaseManyBody(Kernel, metaclass=ABCMeta):
         """
         ker = np.zeros((len(X1) * 3, len(X2) * 3))
 
-        if ncores > 1:
-            confs = []
-            for x1 in X1:
-                for x2 in X2:
-                    confs.append(np.asarray([x1, x2]))
-            n = len(confs)
-            import sys
-            sys.setrecursionlimit(100000)
+        if ncores > 1 and self.engine != 'numba':
             logger.info(
                 'Using %i cores for the 3-body force-force kernel calculation' % (ncores))
-
-            # Way to split the kernels functions to compute evenly across the nodes
-            splitind = np.zeros(ncores + 1)
-            factor = (n + (ncores - 1)) / ncores
-            splitind[1:-1] = [(i + 1) * factor for i in np.arange(ncores - 1)]
-            splitind[-1] = n
-            splitind = splitind.astype(int)
-            clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                      self.type] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-            import multiprocessing as mp
-            pool = mp.Pool(ncores)
-            result = pool.map(dummy_calc_ff, clist)
-            pool.close()
-            pool.join()
-
-            result = np.concatenate(result).reshape((n, 3, 3))
-            for i in range(len(X1)):
-                for j in range(len(X2)):
-                    ker[i * 3: i * 3 + 3, 3 * j:3 * j +
-                        3] = result[(j + i * len(X2))]
+            ker = self.calc_parallel(dummy_calc_ff, self.shared(X1), self.shared(X2), (3, 3),
+                                     ncores, args=(self.theta, self.type, self.dtype,
+                                                   self.engine_options()))
 
         else:
+            X1, X2 = self.describe(X1), self.describe(X2)
             for i, conf1 in enumerate(X1):
                 for j, conf2 in enumerate(X2):
                     ker[i * 3:i * 3 + 3, 3 * j:3 * j + 3] += self.km_ff(
@@ -172,6 +329,7 @@ class BaseManyBody(Kernel, metaclass=ABCMeta):
 
         return ker
 
+    @cached_blocks('ef', (1, 3))
     def calc_ef(self, X_glob, X, ncores=1, mapping = False):
         """
         Calculate the energy-force kernel between two sets of configurations.
@@ -186,38 +344,16 @@ class BaseManyBody(Kernel, metaclass=ABCMeta):
         """
         ker = np.zeros((len(X_glob), len(X) * 3))
 
-        if ncores > 1:
-            confs = []
-            for x1 in X_glob:
-                for x2 in X:
-                    confs.append(np.asarray([x1, x2]))
-            n = len(confs)
-            import sys
-            sys.setrecursionlimit(100000)
+        if ncores > 1 and self.engine != 'numba':
             logger.info(
                 'Using %i cores for the 3-body energy-force kernel calculation' % (ncores))
-
-            # Way to split the kernels functions to compute evenly across the nodes
-            splitind = np.zeros(ncores + 1)
-            factor = (n + (ncores - 1)) / ncores
-            splitind[1:-1] = [(i + 1) * factor for i in np.arange(ncores - 1)]
-            splitind[-1] = n
-            splitind = splitind.astype(int)
-            clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                      self.type] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-            import multiprocessing as mp
-            pool = mp.Pool(ncores)
-            result = pool.map(dummy_calc_ef, clist)
-            pool.close()
-            pool.join()
-            result = np.vstack(np.asarray(result))
-
-            for i in range(len(X_glob)):
-                for j in range(len(X)):
-                    ker[i, 3 * j:3 * j + 3] = result[(j + i * len(X))]
+            ker = self.calc_parallel(dummy_calc_ef, self.shared(X_glob, 'global'),
+                                     self.shared(X), (1, 3), ncores, kinds=('global', 'local'),
+                                     args=(self.theta, self.type, self.dtype,
+                                           self.engine_options()))
 
         else:
+            X_glob, X = self.describe(X_glob, 'global'), self.describe(X)
             for i, x1 in enumerate(X_glob):
                 for j, conf2 in enumerate(X):
                     for conf1 in x1:
@@ -226,6 +362,7 @@ class BaseManyBody(Kernel, metaclass=ABCMeta):
 
         return ker
 
+    @cached_blocks('ee', (1, 1))
     def calc_ee(self, X1, X2, ncores=1, mapping = False):
         """
         Calculate the energy-energy kernel between two global environments.
@@ -238,41 +375,17 @@ class BaseManyBody(Kernel, metaclass=ABCMeta):
             K (matrix): N1 x N2 matrix of the scalar-valued kernels 
 
        """
-        if ncores > 1:  # Used for multiprocessing
-            confs = []
-
-            # Build a list of all input pairs which matrix needs to be computed
-            for x1 in X1:
-                for x2 in X2:
-                    confs.append(np.asarray([x1, x2]))
-            n = len(confs)
-            import sys
-            sys.setrecursionlimit(100000)
+        if ncores > 1 and self.engine != 'numba':  # Used for multiprocessing
             logger.info(
                 'Using %i cores for the 3-body energy-energy kernel calculation' % (ncores))
-
-            # Way to split the kernels functions to compute evenly across the nodes
-            splitind = np.zeros(ncores + 1)
-            factor = (n + (ncores - 1)) / ncores
-            splitind[1:-1] = [(i + 1) * factor for i in np.arange(ncores - 1)]
-            splitind[-1] = n
-            splitind = splitind.astype(int)
-            clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                      self.type] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-            import multiprocessing as mp
-            pool = mp.Pool(ncores)
-            result = pool.map(dummy_calc_ee, clist)
-            pool.close()
-            pool.join()
-            result = np.concatenate(result).ravel()
-
-            ker = np.zeros((len(X1), len(X2)))
-            for i in range(len(X1)):
-                for j in range(len(X2)):
-                    ker[i, j] = result[j + i*len(X2)]
+            ker = self.calc_parallel(dummy_calc_ee, self.shared(X1, 'global'),
+                                     self.shared(X2, 'global'), (1, 1), ncores,
+                                     kinds=('global', 'global'),
+                                     args=(self.theta, self.type, self.dtype,
+                                           self.engine_options()))
 
         else:
+            X1, X2 = self.describe(X1, 'global'), self.describe(X2, 'global')
             ker = np.zeros((len(X1), len(X2)))
             for i, x1 in enumerate(X1):
                 for j, x2 in enumerate(X2):
@@ -283,7 +396,8 @@ class BaseManyBody(Kernel, metaclass=ABCMeta):
 
         return ker
 
-    def calc_gram(self, X, ncores=1, eval_gradient=False):
+    @cached_blocks('gram', (3, 3))
+    def calc_gram(self, X, ncores=1, eval_gradient=False, order='C'):
         """
         Calculate the force-force gram matrix for a set of configurations X.
 
@@ -291,6 +405,7 @@ class BaseManyBody(Kernel, metaclass=ABCMeta):
             X (list): list of N Mx5 arrays containing xyz coordinates and atomic species
             ncores (int): Number of CPU nodes to use for multiprocessing (default is 1)
             eval_gradient (bool): if True, evaluate the gradient of the gram matrix
+            order (str): memory layout of the gram matrix, 'C' or 'F' (Fortran)
 
         Returns:
             gram (matrix): N*3 x N*3 gram matrix of the matrix-valued kernels 
@@ -299,58 +414,25 @@ class BaseManyBody(Kernel, metaclass=ABCMeta):
         if eval_gradient:
             raise NotImplementedError('ERROR: GRADIENT NOT IMPLEMENTED YET')
         else:
-            if ncores > 1:
-                confs = []
-                for i in np.arange(len(X)):
-                    for j in np.arange(i + 1):
-                        thislist = np.asarray([X[i], X[j]])
-                        confs.append(thislist)
-                n = len(confs)
+            if ncores > 1 and self.engine != 'numba':
                 logger.info(
                     'Using %i cores for the many-body force-force gram matrix calculation' % (ncores))
-
-                import sys
-                sys.setrecursionlimit(100000)
-
-                # Way to split the kernels functions to compute evenly across the nodes
-                splitind = np.zeros(ncores + 1)
-                factor = (n + (ncores - 1)) / ncores
-                splitind[1:-1] = [(i + 1) *
-                                  factor for i in np.arange(ncores - 1)]
-                splitind[-1] = n
-                splitind = splitind.astype(int)
-                clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                          self.type] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-                import multiprocessing as mp
-                pool = mp.Pool(ncores)
-                result = pool.map(dummy_calc_ff, clist)
-                pool.close()
-                pool.join()
-
-                result = np.concatenate(result).reshape((n, 3, 3))
-                off_diag = np.zeros((len(X) * 3, len(X) * 3))
-                diag = np.zeros((len(X) * 3, len(X) * 3))
-                for i in np.arange(len(X)):
-                    diag[3 * i:3 * i + 3, 3 * i:3 * i +
-                         3] = result[i + i * (i + 1) // 2]
-                    for j in np.arange(i):
-                        off_diag[3 * i:3 * i + 3, 3 * j:3 *
-                                 j + 3] = result[j + i * (i + 1) // 2]
+                X = self.shared(X)
+                gram = self.calc_parallel(dummy_calc_ff, X, X, (3, 3), ncores,
+                                          args=(self.theta, self.type, self.dtype,
+                                                self.engine_options()),
+                                          symmetric=True, order=order)
 
             else:
-                diag = np.zeros((X.shape[0] * 3, X.shape[0] * 3))
-                off_diag = np.zeros((X.shape[0] * 3, X.shape[0] * 3))
-                for i in np.arange(X.shape[0]):
-                    diag[3 * i:3 * i + 3, 3 * i:3 * i + 3] = \
-                        self.km_ff(X[i], X[i], self.theta[0],
-                                   self.theta[1], self.theta[2])
-                    for j in np.arange(i):
-                        off_diag[3 * i:3 * i + 3, 3 * j:3 * j + 3] = \
+                X = self.describe(X)
+                gram = np.zeros((len(X) * 3, len(X) * 3), order=order)
+                for i in range(len(X)):
+                    for j in range(i + 1):
+                        gram[3 * i:3 * i + 3, 3 * j:3 * j + 3] = \
                             self.km_ff(X[i], X[j], self.theta[0],
                                        self.theta[1], self.theta[2])
+                mirror_lower(gram, 3)  # The gram matrix is symmetric
 
-            gram = diag + off_diag + off_diag.T
             return gram
 
     def calc_gram_e(self, X, ncores=1, eval_gradient=False):  # Untested
@@ -369,63 +451,34 @@ class BaseManyBody(Kernel, metaclass=ABCMeta):
         if eval_gradient:
             raise NotImplementedError('ERROR: GRADIENT NOT IMPLEMENTED YET')
         else:
-            if ncores > 1:
-                confs = []
-
-                # Build a list of all input pairs which matrix needs to be computed
-                for i in np.arange(len(X)):
-                    for j in np.arange(i + 1):
-                        thislist = np.array([list(X[i]), list(X[j])])
-                        confs.append(thislist)
-
-                n = len(confs)
-                import sys
-                sys.setrecursionlimit(100000)
+            if ncores > 1 and self.engine != 'numba':
                 logger.info(
                     'Using %i cores for the many-body energy-energy gram matrix calculation' % (ncores))
-
-                # Way to split the kernels functions to compute evenly across the nodes
-                splitind = np.zeros(ncores + 1)
-                factor = (n + (ncores - 1)) / ncores
-                splitind[1:-1] = [(i + 1) *
-                                  factor for i in np.arange(ncores - 1)]
-                splitind[-1] = n
-                splitind = splitind.astype(int)
-                clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                          self.type] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-                import multiprocessing as mp
-                pool = mp.Pool(ncores)
-                result = pool.map(dummy_calc_ee, clist)
-                pool.close()
-                pool.join()
-
-                result = np.concatenate(result).ravel()
-                off_diag = np.zeros((len(X), len(X)))
-                diag = np.zeros((len(X), len(X)))
-                for i in np.arange(len(X)):
-                    diag[i, i] = result[i + i * (i + 1) // 2]
-                    for j in np.arange(i):
-                        off_diag[i, j] = result[j + i * (i + 1) // 2]
+                X = self.shared(X, 'global')
+                gram = self.calc_parallel(dummy_calc_ee, X, X, (1, 1), ncores,
+                                          kinds=('global', 'global'),
+                                          args=(self.theta, self.type, self.dtype,
+                                                self.engine_options()),
+                                          symmetric=True)
 
             else:
-                diag = np.zeros((X.shape[0], X.shape[0]))
-                off_diag = np.zeros((X.shape[0], X.shape[0]))
-                for i in np.arange(X.shape[0]):
+                X = self.describe(X, 'global')
+                gram = np.zeros((len(X), len(X)))
+                for i in range(len(X)):
                     for k, conf1 in enumerate(X[i]):
-                        diag[i, i] += self.km_ee(conf1, conf1,
+                        gram[i, i] += self.km_ee(conf1, conf1,
                                                  self.theta[0], self.theta[1], self.theta[2])
                         for conf2 in X[i][:k]:
                             # *2 here to speed up the loop
-                            diag[i, i] += 2.0*self.km_ee(
+                            gram[i, i] += 2.0*self.km_ee(
                                 conf1, conf2, self.theta[0], self.theta[1], self.theta[2])
-                    for j in np.arange(i):
+                    for j in range(i):
                         for conf1 in X[i]:
                             for conf2 in X[j]:
-                                off_diag[i, j] += self.km_ee(
+                                gram[i, j] += self.km_ee(
                                     conf1, conf2, self.theta[0], self.theta[1], self.theta[2])
+                mirror_lower(gram, 1)  # Gram matrix is symmetric
 
-            gram = diag + off_diag + off_diag.T  # Gram matrix is symmetric
             return gram
 
     def calc_gram_ef(self, X, X_glob, ncores=1, eval_gradient=False):
@@ -444,48 +497,24 @@ class BaseManyBody(Kernel, metaclass=ABCMeta):
             gram (matrix): N2 x N1*3 gram matrix of the vector-valued kernels 
 
        """
-        gram = np.zeros((X_glob.shape[0], X.shape[0] * 3))
+        gram = np.zeros((len(X_glob), len(X) * 3))
 
         if eval_gradient:
             raise NotImplementedError('ERROR: GRADIENT NOT IMPLEMENTED YET')
         else:
-            if ncores > 1:  # Multiprocessing
-                confs = []
-                for i in np.arange(len(X_glob)):
-                    for j in np.arange(len(X)):
-                        thislist = np.asarray([X_glob[i], X[j]])
-                        confs.append(thislist)
-                n = len(confs)
-                import sys
-                sys.setrecursionlimit(100000)
+            if ncores > 1 and self.engine != 'numba':  # Multiprocessing
                 logger.info(
                     'Using %i cores for the many-body energy-force gram matrix calculation' % (ncores))
-
-                # Way to split the kernels functions to compute evenly across the nodes
-                splitind = np.zeros(ncores + 1)
-                factor = (n + (ncores - 1)) / ncores
-                splitind[1:-1] = [(i + 1) *
-                                  factor for i in np.arange(ncores - 1)]
-                splitind[-1] = n
-                splitind = splitind.astype(int)
-                clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                          self.type] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-                import multiprocessing as mp
-                pool = mp.Pool(ncores)
-                result = pool.map(dummy_calc_ef, clist)
-                pool.close()
-                pool.join()
-
-                result = np.concatenate(result).ravel()
-                for i in np.arange(X_glob.shape[0]):
-                    for j in np.arange(X.shape[0]):
-                        gram[i, 3 * j:3 * j + 3] = result[3 *
-                                                          (j + i * X.shape[0]):3 + 3*(j + i * X.shape[0])]
+                gram = self.calc_parallel(dummy_calc_ef, self.shared(X_glob, 'global'),
+                                          self.shared(X), (1, 3), ncores,
+                                          kinds=('global', 'local'),
+                                          args=(self.theta, self.type, self.dtype,
+                                                self.engine_options()))
 
             else:
-                for i in np.arange(X_glob.shape[0]):
-                    for j in np.arange(X.shape[0]):
+                X, X_glob = self.describe(X), self.describe(X_glob, 'global')
+                for i in np.arange(len(X_glob)):
+                    for j in np.arange(len(X)):
                         for k in X_glob[i]:
                             gram[i, 3 * j:3 * j + 3] += self.km_ef(
                                 k, X[j], self.theta[0], self.theta[1], self.theta[2])
@@ -494,21 +523,25 @@ class BaseManyBody(Kernel, metaclass=ABCMeta):
 
             return gram
 
+    @cached_diag('ff', 3)
     def calc_diag(self, X):
 
-        diag = np.zeros((X.shape[0] * 3))
+        X = self.describe(X)
+        diag = np.zeros((len(X) * 3))
 
-        for i in np.arange(X.shape[0]):
+        for i in np.arange(len(X)):
             diag[i * 3:(i + 1) * 3] = np.diag(self.km_ff(X[i], X[i],
                                                          self.theta[0], self.theta[1], self.theta[2]))
 
         return diag
 
+    @cached_diag('ee', 1)
     def calc_diag_e(self, X):
 
-        diag = np.zeros((X.shape[0]))
+        X = self.describe(X)
+        diag = np.zeros((len(X)))
 
-        for i in np.arange(X.shape[0]):
+        for i in np.arange(len(X)):
             diag[i] = self.km_ee(X[i], X[i], self.theta[0],
                                  self.theta[1], self.theta[2])
 
@@ -516,8 +549,8 @@ class BaseManyBody(Kernel, metaclass=ABCMeta):
 
     @staticmethod
     @abstractmethod
-    def compile_theano():
-        return None, None, None
+    def compile_theano(names, dtype='float64'):
+        return {}
 
 
 class ManyBodySingleSpeciesKernel(BaseManyBody):
@@ -527,15 +560,22 @@ class ManyBodySingleSpeciesKernel(BaseManyBody):
         theta[0] (float): lengthscale of the kernel
         theta[1] (float): decay rate of the cutoff function
         theta[2] (float): cutoff radius
+        engine (str): "theano" (default), "numpy" or "numba" for the triplet descriptor engines
+        max_memory (int): memory ceiling in bytes of a kernel call with the numpy engine
+        sum_cache (BlockCache): cache of the 3-body sums with the numpy or numba engine,
+            shared with the other kernels it is given to, see ``cached_triplet_kernel``
+        dtype (str): "float64" (default) or "float32" for single-precision kernels
 
     """
 
-    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-2, 1e2), (1e-2, 1e2))):
-        super().__init__(kernel_name='ManyBodySingleSpecies', theta=theta, bounds=bounds)
+    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-2, 1e2), (1e-2, 1e2)),
+                 engine='theano', max_memory=2**28, sum_cache=None, dtype='float64'):
+        super().__init__(kernel_name='ManyBodySingleSpecies', theta=theta, bounds=bounds,
+                         engine=engine, max_memory=max_memory, sum_cache=sum_cache, dtype=dtype)
         self.type = "single"
 
     @staticmethod
-    def compile_theano():
+    def compile_theano(names, dtype='float64'):
         """
         This function generates theano compiled kernels for energy and force learning
         ker_jkmn_withcutoff = ker_jkmn #* cutoff_ikmn
@@ -543,198 +583,132 @@ class ManyBodySingleSpeciesKernel(BaseManyBody):
         The position of the atoms relative to the centrla one, and their chemical species
         are defined by a matrix of dimension Mx5
 
+        Args:
+            names (list): names of the functions to compile, e.g. "km_ee"
+            dtype (str): "float64" or "float32", precision of the compiled functions
+
         Returns:
-            km_ee (func): energy-energy kernel
-            km_ef (func): energy-force kernel
-            km_ff (func): force-force kernel
+            functions (dict): the compiled theano functions, by name
         """
 
-        if not (os.path.exists(Mffpath / 'k3_ee_s.pickle') and
-                os.path.exists(Mffpath / 'k3_ef_s.pickle') and os.path.exists(Mffpath / 'k3_ff_s.pickle')):
-            print("Building Kernels")
-
-            import theano.tensor as T
-            from theano import function, scan
-
-            logger.info("Started compilation of theano three body kernels")
-
-            # --------------------------------------------------
-            # INITIAL DEFINITIONS
-            # --------------------------------------------------
-
-            # positions of central atoms
-            r1, r2 = T.dvectors('r1d', 'r2d')
-            # positions of neighbours
-            rho1, rho2 = T.dmatrices('rho1', 'rho2')
-            # hyperparameter
-            sig = T.dscalar('sig')
-            # cutoff hyperparameters
-            theta = T.dscalar('theta')
-            rc = T.dscalar('rc')
-
-            # positions of neighbours without chemical species
-
-            rho1s = rho1[:, 0:3]
-            rho2s = rho2[:, 0:3]
-
-            # --------------------------------------------------
-            # RELATIVE DISTANCES TO CENTRAL VECTOR AND BETWEEN NEIGHBOURS
-            # --------------------------------------------------
-
-            # first and second configuration
-            r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
-            r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
-            rjk = T.sqrt(
-                T.sum((rho1s[None, :, :] - rho1s[:, None, :]) ** 2, axis=2))
-            rmn = T.sqrt(
-                T.sum((rho2s[None, :, :] - rho2s[:, None, :]) ** 2, axis=2))
-
-            # --------------------------------------------------
-            # BUILD THE KERNEL
-            # --------------------------------------------------
-
-            # Squared exp of differences
-            se_1j2m = T.exp(-(r1j[:, None] - r2m[None, :])
-                            ** 2 / (2 * sig ** 2))
-            se_jkmn = T.exp(-(rjk[:, :, None, None] -
-                              rmn[None, None, :, :]) ** 2 / (2 * sig ** 2))
-            se_jk2m = T.exp(-(rjk[:, :, None] -
-                              r2m[None, None, :]) ** 2 / (2 * sig ** 2))
-            se_1jmn = T.exp(-(r1j[:, None, None] -
-                              rmn[None, :, :]) ** 2 / (2 * sig ** 2))
-
-            # Kernel not summed (cyclic permutations)
-            k1n = (se_1j2m[:, None, :, None] *
-                   se_1j2m[None, :, None, :] * se_jkmn)
-            k2n = (se_1jmn[:, None, :, :] * se_jk2m[:, :,
-                                                    None, :] * se_1j2m[None, :, :, None])
-            k3n = (se_1j2m[:, None, None, :] *
-                   se_jk2m[:, :, :, None] * se_1jmn[None, :, :, :])
-
-            # final shape is M1 M1 M2 M2
-            ker = k1n + k2n + k3n
-
-            cut_j = 0.5*(1+T.cos(np.pi*r1j/rc))
-            cut_m = 0.5*(1+T.cos(np.pi*r2m/rc))
-
-            cut_jk = cut_j[:,None]*cut_j[None,:]*0.5*(1+T.cos(np.pi*rjk/rc))
-            cut_mn = cut_m[:,None]*cut_m[None,:]*0.5*(1+T.cos(np.pi*rmn/rc))
-            
-            # --------------------------------------------------
-            # REMOVE DIAGONAL ELEMENTS AND ADD CUTOFF
-            # --------------------------------------------------
-
-            # remove diagonal elements AND lower triangular ones from first configuration
-            mask_jk = T.triu(T.ones_like(rjk)) - T.identity_like(rjk)
-
-            # remove diagonal elements from second configuration
-            mask_mn = T.ones_like(rmn) - T.identity_like(rmn)
-
-            # Combine masks
-            mask_jkmn = mask_jk[:, :, None, None] * mask_mn[None, None, :, :]
-
-            # Apply mask and then apply cutoff functions
-            ker = ker * mask_jkmn
-            ker = T.sum(ker * cut_jk[:, :, None, None]
-                        * cut_mn[None, None, :, :])
-
-            ker = T.exp(ker / 1000)
-
-            # --------------------------------------------------
-            # FINAL FUNCTIONS
-            # --------------------------------------------------
-
-            # global energy energy kernel
-            k_ee_fun = function(
-                [r1, r2, rho1, rho2, sig, theta, rc], ker, on_unused_input='ignore')
-
-            # global energy force kernel
-            k_ef = T.grad(ker, r2)
-            k_ef_fun = function(
-                [r1, r2, rho1, rho2, sig, theta, rc], k_ef, on_unused_input='ignore')
-
-            # local force force kernel
-            k_ff = T.grad(ker, r1)
-            k_ff_der, updates = scan(lambda j, k_ff, r2: T.grad(k_ff[j], r2),
-                                     sequences=T.arange(k_ff.shape[0]), non_sequences=[k_ff, r2])
-            k_ff_fun = function(
-                [r1, r2, rho1, rho2, sig, theta, rc], k_ff_der, on_unused_input='ignore')
-
-            # Save the function that we want to use for multiprocessing
-            # This is necessary because theano is a crybaby and does not want to access the
-            # Automaticallly stored compiled object from different processes
-            with open(Mffpath / 'k3_ee_s.pickle', 'wb') as f:
-                pickle.dump(k_ee_fun, f)
-            with open(Mffpath / 'k3_ef_s.pickle', 'wb') as f:
-                pickle.dump(k_ef_fun, f)
-            with open(Mffpath / 'k3_ff_s.pickle', 'wb') as f:
-                pickle.dump(k_ff_fun, f)
 
-        else:
-            print("Loading Kernels")
-            with open(Mffpath / "k3_ee_s.pickle", 'rb') as f:
-                k_ee_fun = pickle.load(f)
-            with open(Mffpath / "k3_ef_s.pickle", 'rb') as f:
-                k_ef_fun = pickle.load(f)
-            with open(Mffpath / "k3_ff_s.pickle", 'rb') as f:
-                k_ff_fun = pickle.load(f)
-
-        # WRAPPERS (we don't want to plug the position of the central element every time)
-
-        def km_ee(conf1, conf2, sig, theta, rc):
-            """
-            Many body kernel for global energy-energy correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
-
-            Returns:
-                kernel (float): scalar valued energy-energy many-body kernel
-
-            """
-            return k_ee_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
-
-        def km_ef(conf1, conf2, sig, theta, rc):
-            """
-            Many body kernel for global energy-force correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
-
-            Returns:
-                kernel (array): 3x1 energy-force many-body kernel
-
-            """
-            return -k_ef_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
-
-        def km_ff(conf1, conf2, sig, theta, rc):
-            """
-            Many body kernel for local force-force correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
-
-            Returns:
-                kernel (matrix): 3x3 force-force 3-body kernel
-
-            """
-            return k_ff_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
+        import theano.tensor as T
+        from theano import function, scan
+
+        logger.info("Started compilation of theano three body kernels")
+
+        # --------------------------------------------------
+        # INITIAL DEFINITIONS
+        # --------------------------------------------------
+
+        # positions of central atoms
+        r1, r2 = T.vectors('r1d', 'r2d')
+        # positions of neighbours
+        rho1, rho2 = T.matrices('rho1', 'rho2')
+        # hyperparameter
+        sig = T.scalar('sig')
+        # cutoff hyperparameters
+        theta = T.scalar('theta')
+        rc = T.scalar('rc')
+
+        # positions of neighbours without chemical species
+
+        rho1s = rho1[:, 0:3]
+        rho2s = rho2[:, 0:3]
+
+        # --------------------------------------------------
+        # RELATIVE DISTANCES TO CENTRAL VECTOR AND BETWEEN NEIGHBOURS
+        # --------------------------------------------------
+
+        # first and second configuration
+        r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
+        r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
+        rjk = T.sqrt(
+            T.sum((rho1s[None, :, :] - rho1s[:, None, :]) ** 2, axis=2))
+        rmn = T.sqrt(
+            T.sum((rho2s[None, :, :] - rho2s[:, None, :]) ** 2, axis=2))
+
+        # --------------------------------------------------
+        # BUILD THE KERNEL
+        # --------------------------------------------------
+
+        # Squared exp of differences
+        se_1j2m = T.exp(-(r1j[:, None] - r2m[None, :])
+                        ** 2 / (2 * sig ** 2))
+        se_jkmn = T.exp(-(rjk[:, :, None, None] -
+                          rmn[None, None, :, :]) ** 2 / (2 * sig ** 2))
+        se_jk2m = T.exp(-(rjk[:, :, None] -
+                          r2m[None, None, :]) ** 2 / (2 * sig ** 2))
+        se_1jmn = T.exp(-(r1j[:, None, None] -
+                          rmn[None, :, :]) ** 2 / (2 * sig ** 2))
+
+        # Kernel not summed (cyclic permutations)
+        k1n = (se_1j2m[:, None, :, None] *
+               se_1j2m[None, :, None, :] * se_jkmn)
+        k2n = (se_1jmn[:, None, :, :] * se_jk2m[:, :,
+                                                None, :] * se_1j2m[None, :, :, None])
+        k3n = (se_1j2m[:, None, None, :] *
+               se_jk2m[:, :, :, None] * se_1jmn[None, :, :, :])
+
+        # final shape is M1 M1 M2 M2
+        ker = k1n + k2n + k3n
+
+        cut_j = 0.5*(1+T.cos(np.pi*r1j/rc))
+        cut_m = 0.5*(1+T.cos(np.pi*r2m/rc))
+
+        cut_jk = cut_j[:,None]*cut_j[None,:]*0.5*(1+T.cos(np.pi*rjk/rc))
+        cut_mn = cut_m[:,None]*cut_m[None,:]*0.5*(1+T.cos(np.pi*rmn/rc))
+        
+        # --------------------------------------------------
+        # REMOVE DIAGONAL ELEMENTS AND ADD CUTOFF
+        # --------------------------------------------------
+
+        # remove diagonal elements AND lower triangular ones from first configuration
+        mask_jk = T.triu(T.ones_like(rjk)) - T.identity_like(rjk)
+
+        # remove diagonal elements from second configuration
+        mask_mn = T.ones_like(rmn) - T.identity_like(rmn)
+
+        # Combine masks
+        mask_jkmn = mask_jk[:, :, None, None] * mask_mn[None, None, :, :]
+
+        # Apply mask and then apply cutoff functions
+        ker = ker * mask_jkmn
+        ker = T.sum(ker * cut_jk[:, :, None, None]
+                    * cut_mn[None, None, :, :])
+
+        ker = T.exp(ker / 1000)
+
+        # --------------------------------------------------
+        # FINAL FUNCTIONS
+        # --------------------------------------------------
+
+        functions = {}
+        # global energy energy kernel
+        if 'km_ee' in names:
+            functions['km_ee'] = function(
+                [r1, r2, rho1, rho2, sig, theta, rc], ker, on_unused_input='ignore',
+                allow_input_downcast=True)
+
+        # global energy force kernel
+        k_ef = T.grad(ker, r2)
+        if 'km_ef' in names:
+            functions['km_ef'] = function(
+                [r1, r2, rho1, rho2, sig, theta, rc], k_ef, on_unused_input='ignore',
+                allow_input_downcast=True)
+
+        # local force force kernel
+        k_ff = T.grad(ker, r1)
+        k_ff_der, updates = scan(lambda j, k_ff, r2: T.grad(k_ff[j], r2),
+                                 sequences=T.arange(k_ff.shape[0]), non_sequences=[k_ff, r2])
+        if 'km_ff' in names:
+            functions['km_ff'] = function(
+                [r1, r2, rho1, rho2, sig, theta, rc], k_ff_der, on_unused_input='ignore',
+                allow_input_downcast=True)
 
         logger.info("Ended compilation of theano three body kernels")
 
-        return km_ee, km_ef, km_ff
+        return functions
 
 
 class ManyBodyManySpeciesKernel(BaseManyBody):
@@ -744,15 +718,29 @@ class ManyBodyManySpeciesKernel(BaseManyBody):
         theta[0] (float): lengthscale of the kernel
         theta[1] (float): decay rate of the cutoff function
         theta[2] (float): cutoff radius
+        engine (str): "theano" (default), "numpy" or "numba" for the triplet descriptor engines
+        max_memory (int): memory ceiling in bytes of a kernel call with the numpy engine
+        species_sorted (bool): evaluate only the triplets with matching species, grouped
+            by species once per configuration, with the numpy engine
+        sum_cache (BlockCache): cache of the 3-body sums with the numpy or numba engine,
+            shared with the other kernels it is given to, see ``cached_triplet_kernel``
+        dtype (str): "float64" (default) or "float32" for single-precision kernels
 
     """
 
-    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-2, 1e2), (1e-2, 1e2))):
-        super().__init__(kernel_name='ManyBodyManySpecies', theta=theta, bounds=bounds)
+    cutoff_steps = (False, True)
+    exp_scale = 20.
+
+    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-2, 1e2), (1e-2, 1e2)),
+                 engine='theano', max_memory=2**28, species_sorted=False, sum_cache=None,
+                 dtype='float64'):
+        super().__init__(kernel_name='ManyBodyManySpecies', theta=theta, bounds=bounds,
+                         engine=engine, max_memory=max_memory, species_sorted=species_sorted,
+                         sum_cache=sum_cache, dtype=dtype)
         self.type = "multi"
 
     @staticmethod
-    def compile_theano():
+    def compile_theano(names, dtype='float64'):
         """
         This function generates theano compiled kernels for energy and force learning
         ker_jkmn_withcutoff = ker_jkmn #* cutoff_ikmn
@@ -760,244 +748,178 @@ class ManyBodyManySpeciesKernel(BaseManyBody):
         The position of the atoms relative to the centrla one, and their chemical species
         are defined by a matrix of dimension Mx5
 
+        Args:
+            names (list): names of the functions to compile, e.g. "km_ee"
+            dtype (str): "float64" or "float32", precision of the compiled functions
+
         Returns:
-            km_ee (func): energy-energy kernel
-            km_ef (func): energy-force kernel
-            km_ff (func): force-force kernel
+            functions (dict): the compiled theano functions, by name
         """
 
-        if not (os.path.exists(Mffpath / 'k3_ee_m.pickle') and
-                os.path.exists(Mffpath / 'k3_ef_m.pickle') and os.path.exists(Mffpath / 'k3_ff_m.pickle')):
-            print("Building Kernels")
-
-            import theano.tensor as T
-            from theano import function, scan
-
-            logger.info("Started compilation of theano three body kernels")
-
-            # --------------------------------------------------
-            # INITIAL DEFINITIONS
-            # --------------------------------------------------
-
-            # positions of central atoms
-            r1, r2 = T.dvectors('r1d', 'r2d')
-            # positions of neighbours
-            rho1, rho2 = T.dmatrices('rho1', 'rho2')
-            # hyperparameter
-            sig = T.dscalar('sig')
-            # cutoff hyperparameters
-            theta = T.dscalar('theta')
-            rc = T.dscalar('rc')
-
-            # positions of neighbours without chemical species
-
-            rho1s = rho1[:, 0:3]
-            rho2s = rho2[:, 0:3]
-
-            alpha_1 = rho1[:, 3].flatten()
-            alpha_2 = rho2[:, 3].flatten()
-
-            alpha_j = rho1[:, 4].flatten()
-            alpha_m = rho2[:, 4].flatten()
 
-            alpha_k = rho1[:, 4].flatten()
-            alpha_n = rho2[:, 4].flatten()
-
-            # --------------------------------------------------
-            # RELATIVE DISTANCES TO CENTRAL VECTOR AND BETWEEN NEIGHBOURS
-            # --------------------------------------------------
+        import theano.tensor as T
+        from theano import function, scan
+
+        logger.info("Started compilation of theano three body kernels")
+
+        # --------------------------------------------------
+        # INITIAL DEFINITIONS
+        # --------------------------------------------------
 
-            # first and second configuration
-            r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
-            r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
-            rjk = T.sqrt(
-                T.sum((rho1s[None, :, :] - rho1s[:, None, :]) ** 2, axis=2))
-            rmn = T.sqrt(
-                T.sum((rho2s[None, :, :] - rho2s[:, None, :]) ** 2, axis=2))
+        # positions of central atoms
+        r1, r2 = T.vectors('r1d', 'r2d')
+        # positions of neighbours
+        rho1, rho2 = T.matrices('rho1', 'rho2')
+        # hyperparameter
+        sig = T.scalar('sig')
+        # cutoff hyperparameters
+        theta = T.scalar('theta')
+        rc = T.scalar('rc')
+
+        # positions of neighbours without chemical species
 
-            # --------------------------------------------------
-            # CHEMICAL SPECIES MASK
-            # --------------------------------------------------
+        rho1s = rho1[:, 0:3]
+        rho2s = rho2[:, 0:3]
 
-            # numerical kronecker
-            def delta_alpha2(a1j, a2m):
-                d = np.exp(-(a1j - a2m) ** 2 / (2 * 0.00001 ** 2))
-                return d
-
-            # permutation 1
-
-            delta_alphas12 = delta_alpha2(alpha_1[0], alpha_2[0])
-            delta_alphasjm = delta_alpha2(alpha_j[:, None], alpha_m[None, :])
-            delta_alphas_jmkn = delta_alphasjm[:, None,
-                                               :, None] * delta_alphasjm[None, :, None, :]
-
-            delta_perm1 = delta_alphas12 * delta_alphas_jmkn
-
-            # permutation 3
-            delta_alphas1m = delta_alpha2(
-                alpha_1[0, None], alpha_m[None, :]).flatten()
-            delta_alphasjn = delta_alpha2(alpha_j[:, None], alpha_n[None, :])
-            delta_alphask2 = delta_alpha2(
-                alpha_k[:, None], alpha_2[None, 0]).flatten()
-
-            delta_perm3 = delta_alphas1m[None, None, :, None] * delta_alphasjn[:, None, None, :] * \
-                delta_alphask2[None, :, None, None]
-
-            # permutation 5
-            delta_alphas1n = delta_alpha2(
-                alpha_1[0, None], alpha_n[None, :]).flatten()
-            delta_alphasj2 = delta_alpha2(
-                alpha_j[:, None], alpha_2[None, 0]).flatten()
-            delta_alphaskm = delta_alpha2(alpha_k[:, None], alpha_m[None, :])
-
-            delta_perm5 = delta_alphas1n[None, None, None, :] * delta_alphaskm[None, :, :, None] * \
-                delta_alphasj2[:, None, None, None]
-
-            # --------------------------------------------------
-            # BUILD THE KERNEL
-            # --------------------------------------------------
-
-            # Squared exp of differences
-            se_1j2m = T.exp(-(r1j[:, None] - r2m[None, :])
-                            ** 2 / (2 * sig ** 2))
-            se_jkmn = T.exp(-(rjk[:, :, None, None] -
-                              rmn[None, None, :, :]) ** 2 / (2 * sig ** 2))
-            se_jk2m = T.exp(-(rjk[:, :, None] -
-                              r2m[None, None, :]) ** 2 / (2 * sig ** 2))
-            se_1jmn = T.exp(-(r1j[:, None, None] -
-                              rmn[None, :, :]) ** 2 / (2 * sig ** 2))
-
-            # Kernel not summed (cyclic permutations)
-            k1n = (se_1j2m[:, None, :, None] *
-                   se_1j2m[None, :, None, :] * se_jkmn)
-            k2n = (se_1jmn[:, None, :, :] * se_jk2m[:, :,
-                                                    None, :] * se_1j2m[None, :, :, None])
-            k3n = (se_1j2m[:, None, None, :] *
-                   se_jk2m[:, :, :, None] * se_1jmn[None, :, :, :])
-
-            # final shape is M1 M1 M2 M2
-
-            ker_loc = k1n * delta_perm1 + k2n * delta_perm3 + k3n * delta_perm5
-
-            # Faster version of cutoff (less calculations)
-            cut_j = 0.5*(1+T.cos(np.pi*r1j/rc))
-            cut_m = 0.5*(1+T.cos(np.pi*r2m/rc))
-
-            cut_jk = cut_j[:,None]*cut_j[None,:]*0.5*(1+T.cos(np.pi*rjk/rc))
-            cut_mn = cut_m[:,None]*cut_m[None,:]*0.5*(1+T.cos(np.pi*rmn/rc))
-
-            # --------------------------------------------------
-            # REMOVE DIAGONAL ELEMENTS
-            # --------------------------------------------------
-
-            # remove diagonal elements AND lower triangular ones from first configuration
-            mask_jk = T.triu(T.ones_like(rjk)) - T.identity_like(rjk)
-
-            # remove diagonal elements from second configuration
-            mask_mn = T.ones_like(rmn) - T.identity_like(rmn)
-
-            # Combine masks
-            mask_jkmn = mask_jk[:, :, None, None] * mask_mn[None, None, :, :]
-
-            # Apply mask and then apply cutoff functions
-            ker_loc = ker_loc * mask_jkmn
-            ker_loc = T.sum(
-                ker_loc * cut_jk[:, :, None, None] * cut_mn[None, None, :, :])
-
-            ker_loc = T.exp(ker_loc / 20)
-
-            # --------------------------------------------------
-            # FINAL FUNCTIONS
-            # --------------------------------------------------
-
-            # energy energy kernel
-            k_ee_fun = function(
-                [r1, r2, rho1, rho2, sig, theta, rc], ker_loc, on_unused_input='ignore')
-
-            # energy force kernel
-            k_ef_cut = T.grad(ker_loc, r2)
-            k_ef_fun = function(
-                [r1, r2, rho1, rho2, sig, theta, rc], k_ef_cut, on_unused_input='ignore')
-
-            # force force kernel
-            k_ff_cut = T.grad(ker_loc, r1)
-            k_ff_cut_der, updates = scan(lambda j, k_ff_cut, r2: T.grad(k_ff_cut[j], r2),
-                                         sequences=T.arange(k_ff_cut.shape[0]), non_sequences=[k_ff_cut, r2])
-            k_ff_fun = function(
-                [r1, r2, rho1, rho2, sig, theta, rc], k_ff_cut_der, on_unused_input='ignore')
-
-            # Save the function that we want to use for multiprocessing
-            # This is necessary because theano is a crybaby and does not want to access the
-            # Automaticallly stored compiled object from different processes
-            with open(Mffpath / 'k3_ee_m.pickle', 'wb') as f:
-                pickle.dump(k_ee_fun, f)
-            with open(Mffpath / 'k3_ef_m.pickle', 'wb') as f:
-                pickle.dump(k_ef_fun, f)
-            with open(Mffpath / 'k3_ff_m.pickle', 'wb') as f:
-                pickle.dump(k_ff_fun, f)
+        alpha_1 = rho1[:, 3].flatten()
+        alpha_2 = rho2[:, 3].flatten()
 
-        else:
-            print("Loading Kernels")
-            with open(Mffpath / "k3_ee_m.pickle", 'rb') as f:
-                k_ee_fun = pickle.load(f)
-            with open(Mffpath / "k3_ef_m.pickle", 'rb') as f:
-                k_ef_fun = pickle.load(f)
-            with open(Mffpath / "k3_ff_m.pickle", 'rb') as f:
-                k_ff_fun = pickle.load(f)
-
-        # WRAPPERS (we don't want to plug the position of the central element every time)
-
-        def km_ee(conf1, conf2, sig, theta, rc):
-            """
-            Many body kernel for energy-energy correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
-
-            Returns:
-                kernel (float): scalar valued energy-energy many-body kernel
-
-            """
-            return k_ee_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
-
-        def km_ef(conf1, conf2, sig, theta, rc):
-            """
-            Many body kernel for energy-force correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
-
-            Returns:
-                kernel (array): 3x1 energy-force many-body kernel
-
-            """
-            return -k_ef_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
-
-        def km_ff(conf1, conf2, sig, theta, rc):
-            """
-            Many body kernel for force-force correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
-
-            Returns:
-                kernel (matrix): 3x3 force-force many-body kernel
-
-            """
-            return k_ff_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
+        alpha_j = rho1[:, 4].flatten()
+        alpha_m = rho2[:, 4].flatten()
+
+        alpha_k = rho1[:, 4].flatten()
+        alpha_n = rho2[:, 4].flatten()
+
+        # --------------------------------------------------
+        # RELATIVE DISTANCES TO CENTRAL VECTOR AND BETWEEN NEIGHBOURS
+        # --------------------------------------------------
+
+        # first and second configuration
+        r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
+        r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
+        rjk = T.sqrt(
+            T.sum((rho1s[None, :, :] - rho1s[:, None, :]) ** 2, axis=2))
+        rmn = T.sqrt(
+            T.sum((rho2s[None, :, :] - rho2s[:, None, :]) ** 2, axis=2))
+
+        # --------------------------------------------------
+        # CHEMICAL SPECIES MASK
+        # --------------------------------------------------
+
+        # numerical kronecker
+        def delta_alpha2(a1j, a2m):
+            d = np.exp(-(a1j - a2m) ** 2 / (2 * 0.00001 ** 2))
+            return d
+
+        # permutation 1
+
+        delta_alphas12 = delta_alpha2(alpha_1[0], alpha_2[0])
+        delta_alphasjm = delta_alpha2(alpha_j[:, None], alpha_m[None, :])
+        delta_alphas_jmkn = delta_alphasjm[:, None,
+                                           :, None] * delta_alphasjm[None, :, None, :]
+
+        delta_perm1 = delta_alphas12 * delta_alphas_jmkn
+
+        # permutation 3
+        delta_alphas1m = delta_alpha2(
+            alpha_1[0, None], alpha_m[None, :]).flatten()
+        delta_alphasjn = delta_alpha2(alpha_j[:, None], alpha_n[None, :])
+        delta_alphask2 = delta_alpha2(
+            alpha_k[:, None], alpha_2[None, 0]).flatten()
+
+        delta_perm3 = delta_alphas1m[None, None, :, None] * delta_alphasjn[:, None, None, :] * \
+            delta_alphask2[None, :, None, None]
+
+        # permutation 5
+        delta_alphas1n = delta_alpha2(
+            alpha_1[0, None], alpha_n[None, :]).flatten()
+        delta_alphasj2 = delta_alpha2(
+            alpha_j[:, None], alpha_2[None, 0]).flatten()
+        delta_alphaskm = delta_alpha2(alpha_k[:, None], alpha_m[None, :])
+
+        delta_perm5 = delta_alphas1n[None, None, None, :] * delta_alphaskm[None, :, :, None] * \
+            delta_alphasj2[:, None, None, None]
+
+        # --------------------------------------------------
+        # BUILD THE KERNEL
+        # --------------------------------------------------
+
+        # Squared exp of differences
+        se_1j2m = T.exp(-(r1j[:, None] - r2m[None, :])
+                        ** 2 / (2 * sig ** 2))
+        se_jkmn = T.exp(-(rjk[:, :, None, None] -
+                          rmn[None, None, :, :]) ** 2 / (2 * sig ** 2))
+        se_jk2m = T.exp(-(rjk[:, :, None] -
+                          r2m[None, None, :]) ** 2 / (2 * sig ** 2))
+        se_1jmn = T.exp(-(r1j[:, None, None] -
+                          rmn[None, :, :]) ** 2 / (2 * sig ** 2))
+
+        # Kernel not summed (cyclic permutations)
+        k1n = (se_1j2m[:, None, :, None] *
+               se_1j2m[None, :, None, :] * se_jkmn)
+        k2n = (se_1jmn[:, None, :, :] * se_jk2m[:, :,
+                                                None, :] * se_1j2m[None, :, :, None])
+        k3n = (se_1j2m[:, None, None, :] *
+               se_jk2m[:, :, :, None] * se_1jmn[None, :, :, :])
+
+        # final shape is M1 M1 M2 M2
+
+        ker_loc = k1n * delta_perm1 + k2n * delta_perm3 + k3n * delta_perm5
+
+        # Faster version of cutoff (less calculations)
+        cut_j = 0.5*(1+T.cos(np.pi*r1j/rc))
+        cut_m = 0.5*(1+T.cos(np.pi*r2m/rc))
+
+        cut_jk = cut_j[:,None]*cut_j[None,:]*0.5*(1+T.cos(np.pi*rjk/rc))
+        cut_mn = cut_m[:,None]*cut_m[None,:]*0.5*(1+T.cos(np.pi*rmn/rc))
+
+        # --------------------------------------------------
+        # REMOVE DIAGONAL ELEMENTS
+        # --------------------------------------------------
+
+        # remove diagonal elements AND lower triangular ones from first configuration
+        mask_jk = T.triu(T.ones_like(rjk)) - T.identity_like(rjk)
+
+        # remove diagonal elements from second configuration
+        mask_mn = T.ones_like(rmn) - T.identity_like(rmn)
+
+        # Combine masks
+        mask_jkmn = mask_jk[:, :, None, None] * mask_mn[None, None, :, :]
+
+        # Apply mask and then apply cutoff functions
+        ker_loc = ker_loc * mask_jkmn
+        ker_loc = T.sum(
+            ker_loc * cut_jk[:, :, None, None] * cut_mn[None, None, :, :])
+
+        ker_loc = T.exp(ker_loc / 20)
+
+        # --------------------------------------------------
+        # FINAL FUNCTIONS
+        # --------------------------------------------------
+
+        functions = {}
+        # energy energy kernel
+        if 'km_ee' in names:
+            functions['km_ee'] = function(
+                [r1, r2, rho1, rho2, sig, theta, rc], ker_loc, on_unused_input='ignore',
+                allow_input_downcast=True)
+
+        # energy force kernel
+        k_ef_cut = T.grad(ker_loc, r2)
+        if 'km_ef' in names:
+            functions['km_ef'] = function(
+                [r1, r2, rho1, rho2, sig, theta, rc], k_ef_cut, on_unused_input='ignore',
+                allow_input_downcast=True)
+
+        # force force kernel
+        k_ff_cut = T.grad(ker_loc, r1)
+        k_ff_cut_der, updates = scan(lambda j, k_ff_cut, r2: T.grad(k_ff_cut[j], r2),
+                                     sequences=T.arange(k_ff_cut.shape[0]), non_sequences=[k_ff_cut, r2])
+        if 'km_ff' in names:
+            functions['km_ff'] = function(
+                [r1, r2, rho1, rho2, sig, theta, rc], k_ff_cut_der, on_unused_input='ignore',
+                allow_input_downcast=True)
 
         logger.info("Ended compilation of theano many body kernels")
 
-        return km_ee, km_ef, km_ff
+        return functions
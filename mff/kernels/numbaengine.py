@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+Kernels compiled with numba, used by the kernels created with ``engine='numba'``.
+
+They compute the same closed-form kernels as the numpy engine, from the same
+padded neighbour arrays (2-body and EAM) and triplet lists (3-body and many-body),
+with explicit loops compiled in nopython mode. The outer loops are spread over
+the numba threads, so that a single process uses all the cores without worker pools.
+The number of threads is set by the NUMBA_NUM_THREADS environment variable or by
+``numba.set_num_threads``.
+
+Compilation happens on the first call and is cached on disk by numba.
+
+"""
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:  # The numba engine is optional
+    numba = None
+
+prange = range if numba is None else numba.prange
+
+# Permutations of the vertices of a triplet, and the matching permutations of its distances,
+# same order as in ``threebodykernel``
+VERTEX_PERMUTATIONS = np.array(((0, 1, 2), (0, 2, 1), (1, 2, 0), (1, 0, 2), (2, 0, 1), (2, 1, 0)))
+DISTANCE_PERMUTATIONS = np.array(((0, 1, 2), (1, 0, 2), (2, 0, 1), (0, 2, 1), (1, 2, 0), (2, 1, 0)))
+
+
+def require_numba():
+    """ Raise an ImportError if numba is not installed """
+    if numba is None:
+        raise ImportError("The numba engine requires numba, install it with pip install numba")
+
+
+def jit(parallel=True):
+    """ Compile a function in nopython mode, leaving it as it is when numba is missing
+    so that the module can be imported anyway
+    """
+    if numba is None:
+        return lambda fun: fun
+    return numba.njit(parallel=parallel, cache=True)
+
+
+@jit(parallel=False)
+def species_mask(a1, aj, a2, am):
+    """ Species factor of a pair of neighbours in the many-species 2-body kernel,
+    summed over the two possible permutations as in ``twobodykernel.batch_k2``
+    """
+    return 1. * (a1 == a2 and aj == am) + 1. * (a1 == am and aj == a2)
+
+
+@jit(parallel=False)
+def window_start(r, start, lower):
+    """ First neighbour from start on whose distance is at least lower.
+
+    With a finite window width the neighbours of both blocks are sorted by distance, see
+    ``twobodykernel.sort_neighbours``, so that the window of each neighbour of the first
+    configuration starts at or after the one of the previous neighbour, and the pairs
+    are visited in a single merge-like sweep. With an infinite width all the pairs
+    are visited, in any order.
+    """
+    while start < len(r) and r[start] < lower:
+        start += 1
+    return start
+
+
+@jit()
+def k2_ee_tile(r1, c1, a1, aj, r2, c2, a2, am, sig, multi, width):
+    """ Energy-energy 2-body kernel between two blocks of padded configurations,
+    see ``twobodykernel.batch_k2`` and ``window_start``
+    """
+    n1, m1 = r1.shape
+    n2, m2 = r2.shape
+    ker = np.zeros((n1, n2))
+    for x in prange(n1):
+        for y in range(n2):
+            acc = 0.
+            start = 0
+            for j in range(m1):
+                if c1[x, j] == 0:
+                    continue
+                start = window_start(r2[y], start, r1[x, j] - width)
+                for m in range(start, m2):
+                    if r2[y, m] > r1[x, j] + width:
+                        break
+                    mask = 1.
+                    if multi:
+                        mask = species_mask(a1[x], aj[x, j], a2[y], am[y, m])
+                        if mask == 0:
+                            continue
+                    d = r1[x, j] - r2[y, m]
+                    acc += mask * np.exp(-d ** 2 / (2 * sig ** 2)) * c1[x, j] * c2[y, m]
+            ker[x, y] = acc
+    return ker
+
+
+@jit()
+def k2_ef_tile(r1, c1, a1, aj, r2, u2, c2, dc2, a2, am, sig, multi, width):
+    """ Energy-force 2-body kernel between two blocks of padded configurations,
+    see ``twobodykernel.batch_k2`` and ``window_start``
+    """
+    n1, m1 = r1.shape
+    n2, m2 = r2.shape
+    ker = np.zeros((n1, n2, 3))
+    for x in prange(n1):
+        for y in range(n2):
+            start = 0
+            for j in range(m1):
+                if c1[x, j] == 0:
+                    continue
+                start = window_start(r2[y], start, r1[x, j] - width)
+                for m in range(start, m2):
+                    if r2[y, m] > r1[x, j] + width:
+                        break
+                    mask = 1.
+                    if multi:
+                        mask = species_mask(a1[x], aj[x, j], a2[y], am[y, m])
+                        if mask == 0:
+                            continue
+                    d = r1[x, j] - r2[y, m]
+                    g = mask * np.exp(-d ** 2 / (2 * sig ** 2))
+                    dg = -d / sig ** 2 * g
+                    h = c1[x, j] * (dc2[y, m] * g - c2[y, m] * dg)
+                    for b in range(3):
+                        ker[x, y, b] += h * u2[y, m, b]
+    return ker
+
+
+@jit()
+def k2_ff_tile(r1, u1, c1, dc1, a1, aj, r2, u2, c2, dc2, a2, am, sig, multi, width):
+    """ Force-force 2-body kernel between two blocks of padded configurations,
+    see ``twobodykernel.batch_k2`` and ``window_start``
+    """
+    n1, m1 = r1.shape
+    n2, m2 = r2.shape
+    ker = np.zeros((n1, n2, 3, 3))
+    for x in prange(n1):
+        for y in range(n2):
+            start = 0
+            for j in range(m1):
+                if c1[x, j] == 0 and dc1[x, j] == 0:
+                    continue
+                start = window_start(r2[y], start, r1[x, j] - width)
+                for m in range(start, m2):
+                    if r2[y, m] > r1[x, j] + width:
+                        break
+                    mask = 1.
+                    if multi:
+                        mask = species_mask(a1[x], aj[x, j], a2[y], am[y, m])
+                        if mask == 0:
+                            continue
+                    d = r1[x, j] - r2[y, m]
+                    g = mask * np.exp(-d ** 2 / (2 * sig ** 2))
+                    dg = -d / sig ** 2 * g
+                    ddg = (d ** 2 / sig ** 4 - 1 / sig ** 2) * g
+                    h = (dc1[x, j] * dc2[y, m] * g - dc1[x, j] * c2[y, m] * dg +
+                         c1[x, j] * dc2[y, m] * dg - c1[x, j] * c2[y, m] * ddg)
+                    for a in range(3):
+                        for b in range(3):
+                            ker[x, y, a, b] += h * u1[x, j, a] * u2[y, m, b]
+    return ker
+
+
+def batch_k2(p1, p2, sig, kertype, mode, width=np.inf):
+    """ Evaluate the 2-body kernel between every pair of configurations of two
+    padded blocks, same arguments and results as ``twobodykernel.batch_k2``.
+    With a finite width only the pairs of neighbours within the window of
+    ``twobodykernel.window_k2`` are visited, both blocks being sorted.
+    """
+
+    r1, u1, c1, dc1, a1, aj = p1
+    r2, u2, c2, dc2, a2, am = p2
+    multi = kertype == "multi"
+
+    if mode == "ee":
+        return k2_ee_tile(r1, c1, a1, aj, r2, c2, a2, am, sig, multi, width)
+    if mode == "ef":
+        return k2_ef_tile(r1, c1, a1, aj, r2, u2, c2, dc2, a2, am, sig, multi, width)
+    return k2_ff_tile(r1, u1, c1, dc1, a1, aj, r2, u2, c2, dc2, a2, am, sig, multi, width)
+
+
+@jit()
+def triplet_sums(d1, s1, j1, w1, dw1, d2, s2, j2, w2, dw2, sig, multi, derivatives,
+                 indptr, indices):
+    """ Contributions of two lists of triplets to the 3-body kernel and its derivatives,
+    see ``threebodykernel.triplet_terms``. Each thread accumulates the terms of
+    a subset of the triplets of the first list in double precision. If indptr is not
+    empty, only the triplets indices[indptr[a]:indptr[a + 1]] of the second list are
+    paired with the triplet a of the first list, see ``threebodykernel.triplet_neighbours``.
+
+    Returns:
+        sums (array): 16 values, the kernel followed by the gradients with respect
+            to the first and second central atoms and the flattened 3x3 hessian
+
+    """
+    n1, n2 = len(w1), len(w2)
+    s = sig ** 2
+    windowed = len(indptr) > 0
+    partial = np.zeros((n1, 16))
+    for a in prange(n1):
+        diff = np.zeros(3)
+        av = np.zeros(3)
+        bv = np.zeros(3)
+        lo, hi = (indptr[a], indptr[a + 1]) if windowed else (0, n2)
+        for c in range(lo, hi):
+            b = indices[c] if windowed else c
+            for p in range(6):
+                v = VERTEX_PERMUTATIONS[p]
+                dp = DISTANCE_PERMUTATIONS[p]
+                if multi and not (s1[a, 0] == s2[b, v[0]] and s1[a, 1] == s2[b, v[1]] and
+                                  s1[a, 2] == s2[b, v[2]]):
+                    continue
+                q = 0.
+                for i in range(3):
+                    diff[i] = d1[a, i] - d2[b, dp[i]]
+                    q += diff[i] ** 2
+                e = np.exp(-q / (2 * s))
+                partial[a, 0] += w1[a] * e * w2[b]
+                if derivatives == 0:
+                    continue
+
+                for y in range(3):
+                    t = 0.
+                    for i in range(3):
+                        t += diff[i] * j2[b, dp[i], y]
+                    bv[y] = dw2[b, y] + w2[b] * t / s
+                    partial[a, 4 + y] += w1[a] * e * bv[y]
+                if derivatives == 1:
+                    continue
+
+                for x in range(3):
+                    t = 0.
+                    for i in range(3):
+                        t += diff[i] * j1[a, i, x]
+                    av[x] = dw1[a, x] - w1[a] * t / s
+                    partial[a, 1 + x] += e * av[x] * w2[b]
+                for x in range(3):
+                    for y in range(3):
+                        t = 0.
+                        for i in range(3):
+                            t += j1[a, i, x] * j2[b, dp[i], y]
+                        partial[a, 7 + 3 * x + y] += e * (av[x] * bv[y] + w1[a] * w2[b] * t / s)
+
+    sums = np.zeros(16)
+    for a in range(n1):
+        sums += partial[a]
+    return sums
+
+
+def triplet_terms(l1, l2, sig, multi=False, derivatives=0, indptr=None, indices=None):
+    """ Contributions of two lists of triplets to the 3-body kernel and its derivatives,
+    same arguments and results as ``threebodykernel.triplet_terms``, restricted to
+    the pairs of triplets given by indptr and indices if they are not None
+    """
+
+    if indptr is None:
+        indptr = indices = np.zeros(0, dtype=np.int64)
+    sums = triplet_sums(l1.distances, l1.species, l1.jacobian, l1.w, l1.dw,
+                        l2.distances, l2.species, l2.jacobian, l2.w, l2.dw,
+                        sig, multi, derivatives, indptr, indices)
+
+    return sums[0], sums[1:4], sums[4:7], sums[7:].reshape(3, 3)
+
+
+@jit()
+def eam_sums(r, u, cut, dcut, r0):
+    """ EAM descriptors of a block of padded configurations and their gradients with
+    respect to the central atoms, see ``eamkernel.eam_descriptors``
+    """
+    n, m = r.shape
+    q = np.zeros(n)
+    dq = np.zeros((n, 3))
+    for x in prange(n):
+        for j in range(m):
+            if cut[x, j] == 0 and dcut[x, j] == 0:
+                continue
+            e = np.exp(1 - r[x, j] / r0)
+            q[x] += e * cut[x, j]
+            # the derivative of r with respect to the central atom is -u
+            df = e * (dcut[x, j] - cut[x, j] / r0)
+            for a in range(3):
+                dq[x, a] -= df * u[x, j, a]
+    return q, dq
+
+
+@jit()
+def eam_ee_tile(q1, a1, q2, a2, sig, multi):
+    """ Energy-energy EAM kernel between two sets of descriptors, see ``eamkernel.eam_rbf`` """
+    n1, n2 = len(q1), len(q2)
+    ker = np.zeros((n1, n2))
+    for x in prange(n1):
+        for y in range(n2):
+            if multi and a1[x] != a2[y]:
+                continue
+            ker[x, y] = np.exp(-(q1[x] - q2[y]) ** 2 / (2 * sig ** 2))
+    return ker
+
+
+@jit()
+def eam_ef_tile(q1, a1, q2, dq2, a2, sig, multi):
+    """ Energy-force EAM kernel between two sets of descriptors, see ``eamkernel.eam_ef`` """
+    n1, n2 = len(q1), len(q2)
+    ker = np.zeros((n1, n2, 3))
+    for x in prange(n1):
+        for y in range(n2):
+            if multi and a1[x] != a2[y]:
+                continue
+            delta = q1[x] - q2[y]
+            h = -np.exp(-delta ** 2 / (2 * sig ** 2)) * delta / sig ** 2
+            for b in range(3):
+                ker[x, y, b] = h * dq2[y, b]
+    return ker
+
+
+@jit()
+def eam_ff_tile(q1, dq1, a1, q2, dq2, a2, sig, multi):
+    """ Force-force EAM kernel between two sets of descriptors, as the 3*N1 x 3*N2 matrix
+    of ``eamkernel.eam_ff``
+    """
+    n1, n2 = len(q1), len(q2)
+    ker = np.zeros((3 * n1, 3 * n2))
+    for x in prange(n1):
+        for y in range(n2):
+            if multi and a1[x] != a2[y]:
+                continue
+            delta = q1[x] - q2[y]
+            h = np.exp(-delta ** 2 / (2 * sig ** 2)) * (1 / sig ** 2 - delta ** 2 / sig ** 4)
+            for a in range(3):
+                for b in range(3):
+                    ker[3 * x + a, 3 * y + b] = h * dq1[x, a] * dq2[y, b]
+    return ker
+
+
+def eam_kernel(q1, dq1, alpha_1, q2, dq2, alpha_2, sig, kertype, mode):
+    """ EAM kernel matrix between two sets of descriptors, same results as the numpy
+    functions ``eamkernel.eam_rbf``, ``eam_ef`` and ``eam_ff``
+
+    Args:
+        q1 (array): N1 descriptors, see ``eamkernel.eam_descriptors``
+        dq1 (array): N1x3 gradients of the descriptors, only used by the force-force kernel
+        alpha_1 (array): N1 central atomic numbers
+        q2 (array): N2 descriptors
+        dq2 (array): N2x3 gradients of the descriptors, not used by the energy-energy kernel
+        alpha_2 (array): N2 central atomic numbers
+        sig (float): lengthscale hyperparameter theta[0]
+        kertype (str): "single" or "multi", the latter vanishes between different species
+        mode (str): "ee", "ef" or "ff"
+
+    Returns:
+        ker (array): N1 x N2, N1 x N2 x 3 or 3*N1 x 3*N2 kernel
+
+    """
+
+    multi = kertype == "multi"
+    if mode == "ee":
+        return eam_ee_tile(q1, alpha_1, q2, alpha_2, sig, multi)
+    if mode == "ef":
+        return eam_ef_tile(q1, alpha_1, q2, dq2, alpha_2, sig, multi)
+    return eam_ff_tile(q1, dq1, alpha_1, q2, dq2, alpha_2, sig, multi)
@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory helpers for the parallel evaluation of the kernels.
+
+The configurations are copied once into memory-mapped files, placed in /dev/shm when
+available, and the workers of the pool open them by path. Each task only carries the
+(i-range, j-range) index tiles it has to compute, and the workers write their kernel
+blocks directly into a shared output matrix. The tiles are balanced by a TileScheduler,
+using the number of neighbours of the configurations to estimate their cost.
+
+"""
+
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from mff.configurations import PackedConfs, PackedGlobalConfs
+
+logger = logging.getLogger(__name__)
+
+
+def shared_dir(nbytes=0):
+    """ Folder used for the shared memory-mapped files, /dev/shm if it is available
+    and has room for ``nbytes``, the temporary folder otherwise """
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        stat = os.statvfs('/dev/shm')
+        if stat.f_bavail * stat.f_frsize > nbytes:
+            return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+class SharedArray(object):
+    """ Numpy array backed by a memory-mapped file, that is sent to the workers
+    of a pool by path rather than by value.
+
+    Args:
+        path (str): path of the memory-mapped file, None for empty arrays
+        shape (tuple): shape of the array
+        dtype (str): data type of the array
+        order (str): memory layout of the array, 'C' or 'F'
+
+    """
+
+    def __init__(self, path, shape, dtype, order='C'):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+        self.order = order
+
+    @classmethod
+    def create(cls, shape, dtype='float64', array=None, order='C'):
+        """ Allocate a new shared array, zero-filled or with a copy of ``array``
+
+        Args:
+            shape (tuple): shape of the array
+            dtype (str): data type of the array
+            array (array): optional values to copy into the shared array
+            order (str): memory layout of the array, 'C' or 'F'
+
+        Returns:
+            shared (SharedArray): the shared array
+
+        """
+
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if nbytes == 0:
+            return cls(None, shape, dtype, order)
+
+        fd, path = tempfile.mkstemp(prefix='mff_', suffix='.dat', dir=shared_dir(nbytes))
+        os.close(fd)
+        mm = np.memmap(path, dtype=dtype, mode='w+', shape=tuple(shape), order=order)
+        if array is not None:
+            mm[...] = array
+        del mm
+
+        return cls(path, shape, dtype, order)
+
+    def open(self, mode='r'):
+        """ Map the shared array in the current process
+
+        Args:
+            mode (str): 'r' for read-only access, 'r+' to write into the array
+
+        Returns:
+            array (np.memmap): the shared array
+
+        """
+
+        if self.path is None:
+            return np.zeros(self.shape, dtype=self.dtype, order=self.order)
+        return np.memmap(self.path, dtype=self.dtype, mode=mode, shape=self.shape,
+                         order=self.order)
+
+    def unlink(self):
+        """ Remove the file backing the array, mappings already open stay valid """
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SharedConfs(object):
+    """ Configurations stored in shared arrays.
+
+    Args:
+        kind (str): "local" for a list of Mx5 configurations, "global" for a list
+            of snapshots, "array" for any other numeric input, e.g. descriptor values
+        arrays (dict): the SharedArray objects holding the data
+        weights (array): estimated relative cost of each configuration, only kept
+            in the process that created the shared arrays
+
+    """
+
+    def __init__(self, kind, arrays, weights=None):
+        self.kind = kind
+        self.arrays = arrays
+        self.weights = weights
+
+    def __getstate__(self):
+        # The workers do not need the weights, keep the tasks small
+        return {'kind': self.kind, 'arrays': self.arrays, 'weights': None}
+
+    @classmethod
+    def create(cls, X, kind, power=1):
+        """ Copy a set of configurations into shared arrays
+
+        Args:
+            X (list, PackedConfs or PackedGlobalConfs): the configurations
+            kind (str): "local", "global" or "array"
+            power (int): the cost of a kernel call is estimated as (M1*M2)**power,
+                M1 and M2 being the number of neighbours of the two configurations
+
+        Returns:
+            shared (SharedConfs): the shared configurations
+
+        """
+
+        if kind == 'local' and not isinstance(X, PackedConfs) and len(X) and np.ndim(X[0]) < 2:
+            kind = 'array'
+
+        if kind == 'array':
+            arrays = {'values': np.asarray(X, dtype='float')}
+        elif kind == 'local':
+            confs = PackedConfs.from_confs(X)
+            arrays = {'positions': confs.positions, 'species': confs.species,
+                      'offsets': confs.offsets, 'central': confs.central}
+        elif kind == 'global':
+            glob = PackedGlobalConfs.from_global_confs(X)
+            arrays = {'positions': glob.confs.positions, 'species': glob.confs.species,
+                      'offsets': glob.confs.offsets, 'central': glob.confs.central,
+                      'snapshots': glob.offsets}
+        else:
+            raise ValueError("Unknown kind of configurations %s" % kind)
+
+        weights = conf_weights(kind, arrays, power)
+        arrays = {key: SharedArray.create(a.shape, a.dtype, a) for key, a in arrays.items()}
+
+        return cls(kind, arrays, weights)
+
+    def open(self):
+        """ Map the configurations in the current process
+
+        Returns:
+            X (PackedConfs, PackedGlobalConfs or array): the configurations
+
+        """
+
+        arrays = {key: a.open() for key, a in self.arrays.items()}
+        if self.kind == 'array':
+            return arrays['values']
+
+        confs = PackedConfs(arrays['positions'], arrays['species'],
+                            arrays['offsets'], arrays['central'])
+        if self.kind == 'global':
+            return PackedGlobalConfs(confs, arrays['snapshots'])
+        return confs
+
+    def unlink(self):
+        """ Remove the files backing the configurations """
+        for a in self.arrays.values():
+            a.unlink()
+
+
+def conf_weights(kind, arrays, power):
+    """ Estimate the relative cost of the kernel calls involving each configuration.
+    The cost of a pair is assumed to be the product of the weights of its two elements.
+
+    Args:
+        kind (str): "local", "global" or "array"
+        arrays (dict): packed arrays of the configurations, as built by ``SharedConfs.create``
+        power (int): the weight of a configuration with M neighbours is M**power
+
+    Returns:
+        weights (array): one weight per configuration or snapshot
+
+    """
+
+    if kind == 'array':
+        return np.ones(len(arrays['values']))
+
+    weights = np.maximum(np.diff(arrays['offsets']), 1).astype(float) ** power
+    if kind == 'global':
+        # Every configuration of a snapshot enters the energy kernel
+        cumulative = np.concatenate(([0.], np.cumsum(weights)))
+        weights = cumulative[arrays['snapshots'][1:]] - cumulative[arrays['snapshots'][:-1]]
+        weights = np.maximum(weights, 1.)
+    return weights
+
+
+def split_weighted(weights, parts):
+    """ Split a range into at most ``parts`` contiguous chunks of similar total weight
+
+    Args:
+        weights (array): weight of each element of the range
+        parts (int): number of chunks
+
+    Returns:
+        chunks (list): list of (start, stop) couples
+
+    """
+
+    n = len(weights)
+    if n == 0:
+        return []
+    cumulative = np.cumsum(weights)
+    targets = cumulative[-1] * np.arange(1, min(n, parts)) / min(n, parts)
+    bounds = np.unique(np.concatenate(([0], np.searchsorted(cumulative, targets) + 1, [n])))
+    return [(bounds[k], bounds[k + 1]) for k in range(len(bounds) - 1)]
+
+
+class TileScheduler(object):
+    """ Cost-aware distribution of the index tiles of a kernel matrix over the workers of a pool.
+
+    The cost of each tile is estimated from the number of neighbours of its configurations.
+    With the "static" schedule, tiles are assigned to the workers before the computation
+    (longest processing time first), so that all workers get the same estimated work.
+    With the "dynamic" schedule, smaller tiles are queued from the most to the least
+    expensive, and idle workers take the next one.
+
+    Args:
+        ncores (int): number of workers of the pool
+        mode (str): "static" or "dynamic"
+        tiles_per_core (int): number of tiles per worker, defaults to 4 for the static
+            and 16 for the dynamic schedule
+
+    Attributes:
+        utilization (dict): fraction of the wall time that each worker, identified by
+            its process id, spent computing tiles during the last run
+        imbalance (float): ratio between the largest and the average estimated work
+            assigned to a worker in the last static run
+
+    """
+
+    def __init__(self, ncores, mode='static', tiles_per_core=None):
+        if mode not in ('static', 'dynamic'):
+            raise ValueError("Unknown schedule %s, use 'static' or 'dynamic'" % mode)
+        self.ncores = ncores
+        self.mode = mode
+        if tiles_per_core is None:
+            tiles_per_core = 4 if mode == 'static' else 16
+        self.tiles_per_core = tiles_per_core
+        self.utilization = {}
+        self.imbalance = None
+
+    def tiles(self, w1, w2, symmetric=False):
+        """ Split an N1 x N2 block of configuration pairs into index tiles of similar cost
+
+        Args:
+            w1 (array): N1 weights of the configurations along the first axis
+            w2 (array): N2 weights of the configurations along the second axis
+            symmetric (bool): if True only the tiles of the lower triangle are returned
+
+        Returns:
+            tiles (list): list of ((i_start, i_stop), (j_start, j_stop)) couples
+            costs (array): estimated cost of each tile
+
+        """
+
+        n_tiles = self.tiles_per_core * self.ncores
+
+        if symmetric:
+            # k row chunks give k(k+1)/2 tiles in the lower triangle, the weight of
+            # row i is w_i times the weights of the columns j <= i
+            rows = split_weighted(w1 * np.cumsum(w1),
+                                  int(np.ceil((np.sqrt(8 * n_tiles + 1) - 1) / 2)))
+            tiles = [(rows[a], rows[b]) for a in range(len(rows)) for b in range(a + 1)]
+        else:
+            rows = split_weighted(w1, int(np.ceil(np.sqrt(n_tiles))))
+            cols = split_weighted(w2, int(np.ceil(n_tiles / max(1, len(rows)))))
+            tiles = [(r, c) for r in rows for c in cols]
+
+        cumulative = np.concatenate(([0.], np.cumsum(w2)))
+        costs = np.zeros(len(tiles))
+        for t, (r, c) in enumerate(tiles):
+            i = np.arange(*r)
+            stop = np.minimum(c[1], i + 1) if symmetric else c[1]
+            costs[t] = np.sum(w1[r[0]:r[1]] * np.maximum(cumulative[stop] - cumulative[c[0]], 0))
+
+        return tiles, costs
+
+    def run(self, pool, tasks, costs):
+        """ Evaluate the tasks with the pool and record the utilization of the workers
+
+        Args:
+            pool (multiprocessing.Pool): the worker pool
+            tasks (list): one task per tile, to be passed to ``calc_tiles``
+            costs (array): estimated cost of each task
+
+        """
+
+        order = np.argsort(-np.asarray(costs), kind='stable')
+        start = time.time()
+
+        if self.mode == 'static':
+            # Longest processing time first, each bin becomes the work of one worker
+            bins = [[] for _ in range(min(self.ncores, len(tasks)))]
+            loads = np.zeros(len(bins))
+            for t in order:
+                k = np.argmin(loads)
+                bins[k].append(tasks[t])
+                loads[k] += costs[t]
+            if len(bins):
+                self.imbalance = loads.max() / max(loads.mean(), 1e-300)
+            timings = pool.map(calc_tiles, bins, chunksize=1)
+        else:
+            timings = list(pool.imap_unordered(calc_tiles, [[tasks[t]] for t in order], chunksize=1))
+
+        wall = max(time.time() - start, 1e-12)
+        busy = {}
+        for pid, elapsed in timings:
+            busy[pid] = busy.get(pid, 0.) + elapsed
+        self.utilization = {pid: b / wall for pid, b in busy.items()}
+        if self.utilization:
+            logger.info('Worker utilization: min %.0f%%, mean %.0f%%, over %i workers' % (
+                100 * min(self.utilization.values()),
+                100 * np.mean(list(self.utilization.values())), len(self.utilization)))
+
+
+def calc_tiles(tasks):
+    """ Function used when multiprocessing, computes the kernel blocks of
+    a list of index tiles and writes them into the shared output matrix.
+
+    Args:
+        tasks (list): for each tile, the pair function, the shared inputs and output,
+            the index ranges of the tile, whether only j <= i is needed, and the extra
+            arguments of the pair function
+
+    Returns:
+        pid (int): process id of the worker
+        elapsed (float): time spent computing the tiles, in seconds
+
+    """
+
+    start = time.time()
+    for fun, X1, X2, out, block, rows, cols, symmetric, args in tasks:
+        X1 = X1.open()
+        X2 = X2.open()
+        ker = out.open('r+')
+        b1, b2 = block
+
+        for i in range(*rows):
+            x1 = X1[i]
+            stop = min(cols[1], i + 1) if symmetric else cols[1]
+            for j in range(cols[0], stop):
+                ker[b1 * i:b1 * i + b1, b2 * j:b2 * j + b2] = np.reshape(
+                    fun(x1, X2[j], *args), (b1, b2))
+
+    return os.getpid(), time.time() - start
+
+
+def mirror_lower(gram, b):
+    """ Copy the lower block triangle of a gram matrix into its upper triangle, in place
+
+    Args:
+        gram (array): N*b x N*b matrix, with the blocks j <= i filled in
+        b (int): size of the kernel blocks
+
+    """
+
+    for i in range(1, gram.shape[0] // b):
+        gram[:b * i, b * i:b * i + b] = gram[b * i:b * i + b, :b * i].T
+
+
+def calc_parallel(pool, scheduler, fun, X1, X2, block, kinds=('local', 'local'), args=(),
+                  symmetric=False, power=1, order='C'):
+    """ Evaluate a kernel between two sets of configurations with a pool of workers.
+
+    Args:
+        pool (multiprocessing.Pool): pool whose workers evaluate the tiles
+        scheduler (TileScheduler): splits the work in tiles and distributes them
+        fun (function): module-level function returning the kernel block of one pair
+            of configurations, called as fun(x1, x2, *args)
+        X1 (list): first set of N1 configurations
+        X2 (list): second set of N2 configurations, ignored if symmetric is True
+        block (tuple): shape of the kernel block of a pair, e.g. (3, 3) for force-force
+        kinds (tuple): kind of configurations in X1 and X2, "local", "global" or "array"
+        args (tuple): extra arguments passed to fun
+        symmetric (bool): if True compute the gram matrix of X1 from its lower triangle.
+            With non-square blocks the upper triangle is left for the caller to fill
+        power (int): the cost of a pair is estimated as (M1*M2)**power, with M1 and M2
+            the number of neighbours of the two configurations
+        order (str): memory layout of the kernel matrix, 'C' or 'F'
+
+    Returns:
+        ker (array): N1*block[0] x N2*block[1] kernel matrix
+
+    The kernel matrix is returned in the shared memory the workers wrote into,
+    without any copy. Its file is removed straight away, and the memory is released
+    when the array is garbage collected.
+
+    """
+
+    shared1 = SharedConfs.create(X1, kinds[0], power)
+    shared2 = shared1 if symmetric else SharedConfs.create(X2, kinds[1], power)
+    n1 = len(X1)
+    n2 = n1 if symmetric else len(X2)
+    out = SharedArray.create((n1 * block[0], n2 * block[1]), order=order)
+
+    try:
+        tiles, costs = scheduler.tiles(shared1.weights, shared2.weights, symmetric)
+        tasks = [(fun, shared1, shared2, out, block, rows, cols, symmetric, args)
+                 for rows, cols in tiles]
+        scheduler.run(pool, tasks, costs)
+        ker = out.open('r+').view(np.ndarray)
+    finally:
+        out.unlink()
+        shared1.unlink()
+        shared2.unlink()
+
+    if symmetric and block[0] == block[1]:
+        mirror_lower(ker, block[0])
+
+    return ker
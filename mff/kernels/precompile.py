@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Command line tool compiling the theano kernels into the cache folder, so that
+images and shared installations can ship with a warm cache::
+
+    mff-precompile --dtype float64 --dtype float32 2b 3b
+
+"""
+
+import argparse
+import logging
+import os
+
+from mff import kernels
+from mff.kernels.base import cache_dir
+
+logger = logging.getLogger(__name__)
+
+KERNELS = {
+    '2b': (kernels.TwoBodySingleSpeciesKernel, kernels.TwoBodyManySpeciesKernel),
+    '3b': (kernels.ThreeBodySingleSpeciesKernel, kernels.ThreeBodyManySpeciesKernel),
+    'mb': (kernels.ManyBodySingleSpeciesKernel, kernels.ManyBodyManySpeciesKernel),
+    'eam': (kernels.EamSingleSpeciesKernel, kernels.EamManySpeciesKernel),
+}
+
+
+def precompile(names=tuple(KERNELS), dtypes=('float64',)):
+    """ Compile the theano functions of a set of kernels and store them in the cache.
+    Functions already in the cache are left as they are.
+
+    Args:
+        names (list): kinds of kernels to compile, keys of ``KERNELS``
+        dtypes (list): precisions to compile, "float64" and/or "float32"
+
+    Returns:
+        folder (Path): the cache folder the functions were stored in
+
+    """
+
+    for name in names:
+        for cls in KERNELS[name]:
+            for dtype in dtypes:
+                logger.info('Compiling %s in %s' % (cls.__name__, dtype))
+                cls(dtype=dtype).compile_functions()
+
+    return cache_dir()
+
+
+def main(argv=None):
+    """ Entry point of the mff-precompile command """
+    parser = argparse.ArgumentParser(
+        prog='mff-precompile', description='Compile the mff theano kernels into the cache.')
+    parser.add_argument('kernels', nargs='*', metavar='kernel',
+                        help='kernels to compile among %s, all of them by default'
+                        % ', '.join(KERNELS))
+    parser.add_argument('--dtype', action='append', choices=('float64', 'float32'),
+                        help='precision to compile, can be repeated, float64 by default')
+    parser.add_argument('--cache-dir', help='cache folder, overrides MFF_CACHE_DIR')
+    args = parser.parse_args(argv)
+    for name in args.kernels:
+        if name not in KERNELS:
+            parser.error('unknown kernel %s, choose among %s' % (name, ', '.join(KERNELS)))
+
+    if args.cache_dir:
+        os.environ['MFF_CACHE_DIR'] = args.cache_dir
+
+    logging.basicConfig(level=logging.INFO)
+    folder = precompile(args.kernels or list(KERNELS), args.dtype or ['float64'])
+    print('Compiled kernels stored in %s' % folder)
+
+
+if __name__ == '__main__':
+    main()
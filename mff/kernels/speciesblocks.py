@@ -0,0 +1,191 @@
+"""
+Block-sparse kernel matrices of the many-species kernels.
+
+The 2-body and 3-body many-species kernels only pair neighbours whose species, together
+with the species of their central atom, match. Two configurations that do not share any
+(central, neighbour) species pair therefore have an exactly zero kernel: a matching
+triplet always shares such a pair with the triplet it matches, whatever the permutation.
+
+The species signature of a configuration is the set of its (central, neighbour) species
+pairs. Configurations whose signatures overlap, directly or through other configurations,
+form a species block, and the kernel matrices between different blocks are zero. The
+kernel methods decorated with ``species_blocks`` only evaluate the diagonal blocks.
+
+"""
+
+import functools
+import logging
+
+import numpy as np
+
+from mff.configurations import PackedConfs, PackedGlobalConfs
+
+logger = logging.getLogger(__name__)
+
+
+def species_signature(conf):
+    """ Species pairs of a configuration that the many-species kernels can match
+
+    Args:
+        conf (array or list): a local configuration, its ``Triplets``, or a global
+            configuration given as a list of local configurations
+
+    Returns:
+        signature (frozenset): codes of the unordered (central, neighbour) species pairs,
+            with the same encoding as ``twobodykernel.pair_code``
+
+    """
+
+    conf = getattr(conf, 'conf', conf)  # Descriptors keep their configuration
+    if isinstance(conf, np.ndarray) and conf.dtype != object:
+        a1, aj = conf[:, 3].astype(int), conf[:, 4].astype(int)
+        return frozenset((np.minimum(a1, aj) * 1024 + np.maximum(a1, aj)).tolist())
+
+    return frozenset().union(*(species_signature(x) for x in conf))
+
+
+def species_components(X):
+    """ Label the configurations by species block, joining the configurations whose
+    signatures share a species pair, see ``species_signature``
+
+    Args:
+        X (list): N configurations, or their descriptors
+
+    Returns:
+        labels (array): N block labels, numbered in order of first appearance.
+            Configurations without neighbours are alone in their block
+
+    """
+
+    signatures = [species_signature(x) for x in X]
+
+    # Union-find over the species pairs, all the pairs of a signature are joined
+    parent = {}
+
+    def find(code):
+        parent.setdefault(code, code)
+        while parent[code] != code:
+            parent[code] = parent[parent[code]]
+            code = parent[code]
+        return code
+
+    for signature in signatures:
+        codes = sorted(signature)
+        for code in codes[1:]:
+            parent[find(code)] = find(codes[0])
+
+    labels, roots = np.zeros(len(X), dtype=int), {}
+    for i, signature in enumerate(signatures):
+        root = find(min(signature)) if signature else ('empty', i)
+        labels[i] = roots.setdefault(root, len(roots))
+
+    return labels
+
+
+def species_partition(X):
+    """ Indices of the configurations of each species block, see ``species_components``
+
+    Args:
+        X (list): N configurations, or their descriptors
+
+    Returns:
+        blocks (list): index arrays of the configurations of each block
+
+    """
+
+    labels = species_components(X)
+    return [np.flatnonzero(labels == c) for c in range(labels.max() + 1)] if len(X) else []
+
+
+def block_rows(indices, size):
+    """ Rows of the kernel matrix of a set of configurations, size rows per configuration """
+    return (size * np.asarray(indices)[:, None] + np.arange(size)[None, :]).ravel()
+
+
+def splittable(X):
+    """ Whether the configurations can be split into species blocks: any sequence of
+    configurations, such as a list or an array, but not packed configurations, which the
+    kernels evaluate in one piece """
+    return (not isinstance(X, (PackedConfs, PackedGlobalConfs)) and hasattr(X, '__len__')
+            and hasattr(X, '__getitem__'))
+
+
+def merge_errors(kernel, errors):
+    """ Set the error bound of a kernel that reports one for its last call, such as
+    ``window_error``, to the largest bound of the calls made for the species blocks """
+    errors = [e for e in errors if e is not None]
+    if errors:
+        kernel.window_error = max(errors)
+
+
+def species_blocks(mode, block):
+    """ Decorator skipping the blocks of a kernel method between configurations of
+    different species blocks, whose kernels are zero.
+
+    The decorated method is called once per species block, on the configurations of the
+    block. It is called unchanged when the kernel does not have ``species_zeros`` set,
+    when the configurations are packed, or when all the configurations are in the same
+    block.
+
+    Args:
+        mode (str): "ff" or "gram", the kind of kernel matrix the method computes
+        block (tuple): shape of the kernel block between two configurations
+
+    """
+
+    b1, b2 = block
+
+    def decorator(fun):
+        if mode == 'gram':
+            @functools.wraps(fun)
+            def wrapper(self, X, ncores=1, eval_gradient=False, order='C'):
+                if not getattr(self, 'species_zeros', False) or not splittable(X):
+                    return fun(self, X, ncores, eval_gradient, order)
+                blocks = species_partition(X)
+                if len(blocks) < 2:
+                    return fun(self, X, ncores, eval_gradient, order)
+
+                logger.debug('Computing the gram matrix in %i species blocks' % len(blocks))
+                gram = np.zeros((len(X) * b1, len(X) * b2), order=order)
+                gradient, errors = None, []
+                for indices in blocks:
+                    sub = fun(self, [X[i] for i in indices], ncores, eval_gradient, order)
+                    errors.append(getattr(self, 'window_error', None))
+                    rows = np.ix_(block_rows(indices, b1), block_rows(indices, b2))
+                    if eval_gradient:
+                        sub, sub_gradient = sub
+                        if gradient is None:
+                            gradient = np.zeros(gram.shape + sub_gradient.shape[2:])
+                        gradient[rows] = sub_gradient
+                    gram[rows] = sub
+                merge_errors(self, errors)
+
+                return (gram, gradient) if eval_gradient else gram
+
+            return wrapper
+
+        @functools.wraps(fun)
+        def wrapper(self, X1, X2, ncores=1, *args, **kwargs):
+            if (not getattr(self, 'species_zeros', False) or not splittable(X1) or
+                    not splittable(X2)):
+                return fun(self, X1, X2, ncores, *args, **kwargs)
+            labels = species_components(list(X1) + list(X2))
+            labels1, labels2 = labels[:len(X1)], labels[len(X1):]
+            if len(set(labels)) < 2:
+                return fun(self, X1, X2, ncores, *args, **kwargs)
+
+            ker, errors = np.zeros((len(X1) * b1, len(X2) * b2)), []
+            for c in np.unique(labels1):
+                rows, cols = np.flatnonzero(labels1 == c), np.flatnonzero(labels2 == c)
+                if len(cols):
+                    ker[np.ix_(block_rows(rows, b1), block_rows(cols, b2))] = fun(
+                        self, [X1[i] for i in rows], [X2[j] for j in cols], ncores,
+                        *args, **kwargs)
+                    errors.append(getattr(self, 'window_error', None))
+            merge_errors(self, errors)
+
+            return ker
+
+        return wrapper
+
+    return decorator
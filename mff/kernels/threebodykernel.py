@@ -1,111 +1,708 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import os.path
-import pickle
 from abc import ABCMeta, abstractmethod
 
 import numpy as np
 
-from mff.kernels.base import Kernel, Mffpath
+from mff.kernels import numbaengine
+from mff.kernels.base import Kernel, load_function
+from mff.kernels.blockcache import cached_blocks, conf_hash
+from mff.kernels.descriptors import (TripletList, configurations, cutoff, cutoff_rc, describe,
+                                     triplets)
+from mff.kernels.parallel import mirror_lower
+from mff.kernels.speciesblocks import species_blocks
 
 logger = logging.getLogger(__name__)
 
 
-def dummy_calc_ff(data):
-    """ Function used when multiprocessing.
+def engine_function(name, kertype, dtype='float64', options=None):
+    """ Kernel function evaluated by the workers, with the arguments of the compiled
+    function: the compiled function itself, or with the options of the numpy engine
+    the same kernel computed from the triplets with ``triplet_kernel``.
+
     Args:
-        data (list of objects): contains all the information required
-            for the computation of the kernel values
-    
+        name (str): "k3_ee", "k3_ef" or "k3_ff"
+        kertype (str): "single" or "multi" species kernel
+        dtype (str): "float64" or "float32", precision of the kernel
+        options (tuple): numpy engine options, see ``BaseThreeBody.engine_options``,
+            None for the compiled function
+
     Returns:
-        result (array): the computed kernel values
+        fun (object): the kernel function
 
     """
 
-    array, theta0, theta1, theta2, kertype = data
-    if kertype == "single":
-        with open(Mffpath / "k3_ff_s.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    elif kertype == "multi":
-        with open(Mffpath / "k3_ff_m.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    result = np.zeros((len(array), 3, 3))
-    for i in range(len(array)):
-        result[i] = fun(np.zeros(3), np.zeros(3), array[i][0],
-                        array[i][1],  theta0, theta1, theta2)
-    return result
+    if options is None:
+        return load_function(name, kertype, dtype)
+
+    steps, max_bytes, species_sorted, window_tol = options
+    derivatives = ('k3_ee', 'k3_ef', 'k3_ff').index(name)
 
+    def fun(r1, r2, conf1, conf2, sig, theta, rc):
+        # The last term is the kernel, its gradient or its hessian, as the compiled function
+        return triplet_kernel(triplets(conf1), triplets(conf2), sig, rc, steps, kertype == 'multi',
+                              derivatives, max_bytes, dtype, 'numpy', species_sorted,
+                              window_tol)[-1]
+
+    return fun
+
+
+def dummy_calc_ff(conf1, conf2, theta, kertype, dtype='float64', options=None):
+    """ Function used when multiprocessing, evaluates the force-force kernel
+    of a single pair.
 
-def dummy_calc_ee(data):
-    """ Function used when multiprocessing.
     Args:
-        data (list of objects): contains all the information required
-            for the computation of the kernel values
-    
+        conf1 (array): Mx5 array of the first configuration
+        conf2 (array): Mx5 array of the second configuration
+        theta (list): hyperparameters of the kernel
+        kertype (str): "single" or "multi" species kernel
+        dtype (str): "float64" or "float32", precision of the compiled function
+        options (tuple): numpy engine options, None for the compiled function,
+            see ``engine_function``
+
     Returns:
-        result (array): the computed kernel values
+        result (array): the computed kernel value
 
     """
 
-    array, theta0, theta1, theta2, kertype, mapping = data
-    if kertype == "single":
-        with open(Mffpath / "k3_ee_s.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    elif kertype == "multi":
-        with open(Mffpath / "k3_ee_m.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    result = np.zeros(len(array))
+    fun = engine_function("k3_ff", kertype, dtype, options)
+    return fun(np.zeros(3), np.zeros(3), conf1, conf2, theta[0], theta[1], theta[2])
 
+
+def dummy_calc_ff_gradient(conf1, conf2, theta, kertype, steps, max_bytes):
+    """ Function used when multiprocessing, evaluates the force-force kernel of a single
+    pair together with its derivatives with respect to the hyperparameters,
+    see ``triplet_gradient``.
+
+    Args:
+        conf1 (array): Mx5 array of the first configuration
+        conf2 (array): Mx5 array of the second configuration
+        theta (list): hyperparameters of the kernel
+        kertype (str): "single" or "multi" species kernel
+        steps (tuple): cutoff steps of the kernel, see ``Triplets.weights``
+        max_bytes (int): memory ceiling of the intermediates, None for no limit
+
+    Returns:
+        result (array): 3x3x4 kernel, followed along the last axis by its derivatives
+            with respect to theta[0], theta[1] and theta[2]
+
+    """
+
+    h, h_sig, h_rc = triplet_gradient(triplets(conf1), triplets(conf2), theta[0], theta[2],
+                                      steps, kertype == 'multi', max_bytes)
+    return np.stack((h, h_sig, np.zeros((3, 3)), h_rc), axis=-1)
+
+
+def dummy_calc_ee(x1, x2, theta, kertype, mapping, dtype='float64', options=None):
+    """ Function used when multiprocessing, evaluates the energy-energy kernel
+    of a single pair.
+
+    Args:
+        x1 (list): configurations of the first snapshot
+        x2 (list): configurations of the second snapshot
+        theta (list): hyperparameters of the kernel
+        kertype (str): "single" or "multi" species kernel
+        mapping (bool): if True the first argument is a local configuration
+        dtype (str): "float64" or "float32", precision of the compiled function
+        options (tuple): numpy engine options, None for the compiled function,
+            see ``engine_function``
+
+    Returns:
+        result (float): the computed kernel value
+
+    """
+
+    fun = engine_function("k3_ee", kertype, dtype, options)
+    result = 0
     if not mapping:
-        for i in range(len(array)):
-            for conf1 in array[i][0]:
-                for conf2 in array[i][1]:
-                    result[i] += 1/9.0*fun(np.zeros(3), np.zeros(3),
-                                     conf1, conf2, theta0, theta1, theta2)
+        for conf1 in x1:
+            for conf2 in x2:
+                result += 1/9.0*fun(np.zeros(3), np.zeros(3),
+                                  conf1, conf2, theta[0], theta[1], theta[2])
     else:
-        for i in range(len(array)):
-            for conf2 in array[i][1]:
-                result[i] += 1/3.0*fun(np.zeros(3), np.zeros(3),
-                                 array[i][0], conf2, theta0, theta1, theta2)
-
+        for conf2 in x2:
+            result += 1/3.0*fun(np.zeros(3), np.zeros(3),
+                              x1, conf2, theta[0], theta[1], theta[2])
     return result
 
 
-def dummy_calc_ef(data):
-    """ Function used when multiprocessing.
+def dummy_calc_ef(x1, conf2, theta, kertype, mapping, dtype='float64', options=None):
+    """ Function used when multiprocessing, evaluates the energy-force kernel
+    of a single pair.
+
     Args:
-        data (list of objects): contains all the information required
-            for the computation of the kernel values
-    
+        x1 (list): configurations of the first snapshot
+        conf2 (array): Mx5 array of the second configuration
+        theta (list): hyperparameters of the kernel
+        kertype (str): "single" or "multi" species kernel
+        mapping (bool): if True the first argument is a local configuration
+        dtype (str): "float64" or "float32", precision of the compiled function
+        options (tuple): numpy engine options, None for the compiled function,
+            see ``engine_function``
+
     Returns:
-        result (array): the computed kernel values
+        result (array): the computed kernel value
 
     """
-    
-    array, theta0, theta1, theta2, kertype, mapping = data
-    if kertype == "single":
-        with open(Mffpath / "k3_ef_s.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    elif kertype == "multi":
-        with open(Mffpath / "k3_ef_m.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    result = np.zeros((len(array), 3))
+
+    fun = engine_function("k3_ef", kertype, dtype, options)
+    conf2 = np.array(conf2, dtype='float')
+    result = np.zeros(3)
     if not mapping:
-        for i in range(len(array)):
-            conf2 = np.array(array[i][1], dtype='float')
-            for conf1 in array[i][0]:
-                conf1 = np.array(conf1, dtype='float')
-                result[i] += -1/3.0*fun(np.zeros(3), np.zeros(3),
-                                  conf1, conf2,  theta0, theta1, theta2)
+        for conf1 in x1:
+            conf1 = np.array(conf1, dtype='float')
+            result += -1/3.0*fun(np.zeros(3), np.zeros(3), conf1,
+                               conf2, theta[0], theta[1], theta[2])
     else:
-        for i in range(len(array)):
-            conf2 = np.array(array[i][1], dtype='float')
-            conf1 = np.array(array[i][0], dtype='float')
-            result[i] += -fun(np.zeros(3), np.zeros(3), conf1,
-                              conf2,  theta0, theta1, theta2)
+        conf1 = np.array(x1, dtype='float')
+        result += -fun(np.zeros(3), np.zeros(3), conf1,
+                       conf2, theta[0], theta[1], theta[2])
     return result
 
+# Permutations of the vertices of a triplet, and the matching permutations of its distances
+VERTEX_PERMUTATIONS = ((0, 1, 2), (0, 2, 1), (1, 2, 0), (1, 0, 2), (2, 0, 1), (2, 1, 0))
+DISTANCE_PERMUTATIONS = ((0, 1, 2), (1, 0, 2), (2, 0, 1), (0, 2, 1), (1, 2, 0), (2, 1, 0))
+
+# Upper bound of the number of arrays of the size of the triplet pairs that are alive
+# at the same time in triplet_terms, for each order of derivatives
+TRIPLET_PAIR_ARRAYS = (4, 10, 16)
+
+
+def species_codes(species):
+    """ Encode the ordered species of each triplet in a single number """
+    return (species[:, 0] * 1024 + species[:, 1]) * 1024 + species[:, 2]
+
+
+def triplet_terms(l1, l2, sig, multi=False, derivatives=0, permutations=None):
+    """ Contributions of two lists of triplets to the 3-body kernel and its derivatives.
+    Every pair of triplets contributes the sum over the permutations of the second
+    triplet of the Gaussians of the distance differences, weighted by the cutoff
+    functions, as in the theano kernels.
+
+    The Gaussians of all the triplet pairs are obtained from one matrix product per
+    permutation, exp(-(|d1|^2 + |d2|^2 - 2 d1.d2) / (2 sig^2)), and permutations
+    without any matching species are skipped.
+
+    Args:
+        l1 (TripletList): valid triplets of the first configuration
+        l2 (TripletList): valid triplets of the second configuration
+        sig (float): lengthscale hyperparameter theta[0]
+        multi (bool): if True only permutations with matching species contribute
+        derivatives (int): 0, 1 or 2, see ``triplet_kernel``
+        permutations (tuple): indices in ``VERTEX_PERMUTATIONS`` of the permutations
+            to evaluate, None for all of them
+
+    Returns:
+        k (float): kernel value
+        g1 (array): gradient with respect to the first central atom
+        g2 (array): gradient with respect to the second central atom
+        h (array): 3x3 mixed hessian
+
+    """
+
+    d1, s1, j1, w1, dw1 = l1
+    d2, s2, j2, w2, dw2 = l2
+    s = sig ** 2
+    k, g1, g2, h = 0., np.zeros(3), np.zeros(3), np.zeros((3, 3))
+    if len(w1) == 0 or len(w2) == 0:
+        return k, g1, g2, h
+
+    # Squared norms do not change with the permutations
+    n12 = (np.sum(d1 ** 2, axis=1)[:, None] + np.sum(d2 ** 2, axis=1)[None, :]) / (2 * s)
+    if multi:
+        c1 = species_codes(s1)
+
+    for p, (v, d) in enumerate(zip(VERTEX_PERMUTATIONS, DISTANCE_PERMUTATIONS)):
+        if permutations is not None and p not in permutations:
+            continue
+        if multi:
+            match = c1[:, None] == species_codes(s2[:, v])[None, :]
+            if not match.any():
+                continue
+        d2p = d2[:, d]
+        e = np.exp(d1.dot(d2p.T) / s - n12)
+        if multi:
+            e *= match
+        k += w1.dot(e).dot(w2)
+        if derivatives == 0:
+            continue
+
+        diff = d1[:, None, :] - d2p[None, :, :]
+        j2p = j2[:, d]
+        b = dw2[None, :, :] + w2[None, :, None] * np.einsum('abi,biy->aby', diff, j2p) / s
+        g2 += np.einsum('a,ab,aby->y', w1, e, b)
+        if derivatives == 1:
+            continue
+
+        a = dw1[:, None, :] - w1[:, None, None] * np.einsum('abi,aix->abx', diff, j1) / s
+        g1 += np.einsum('ab,abx,b->x', e, a, w2)
+        h += np.einsum('ab,abx,aby->xy', e, a, b)
+        h += np.einsum('aix,aiy->xy', j1,
+                       np.einsum('ab,biy->aiy', e * w1[:, None] * w2[None, :], j2p)) / s
+
+    return k, g1, g2, h
+
+
+def triplet_hessians(l1, l2, r1, r2, sig, multi=False):
+    """ Mixed hessian of the 3-body kernel between two lists of triplets, see
+    ``triplet_terms``, together with its derivatives with respect to sig and rc.
+    The Gaussians of each permutation and the terms they multiply are evaluated once
+    and shared by the three.
+
+    The Gaussians depend on sig through their exponent, and the other terms through
+    their 1 / sig^2 factors. The hessian is bilinear in the cutoff weights of the two
+    lists, so that its derivative with respect to rc is the sum of the hessians with
+    the weights of either list replaced by their derivatives, see ``rc_derivatives``.
+
+    Args:
+        l1 (TripletList): valid triplets of the first configuration
+        l2 (TripletList): valid triplets of the second configuration
+        r1 (TripletList): l1 with the derivatives of its weights with respect to rc
+        r2 (TripletList): l2 with the derivatives of its weights with respect to rc
+        sig (float): lengthscale hyperparameter theta[0]
+        multi (bool): if True only permutations with matching species contribute
+
+    Returns:
+        h (array): 3x3 mixed hessian
+        h_sig (array): its derivative with respect to sig
+        h_rc (array): its derivative with respect to rc
+
+    """
+
+    d1, s1, j1, w1, dw1 = l1
+    d2, s2, j2, w2, dw2 = l2
+    s = sig ** 2
+    h = np.zeros((3, 3, 3))
+    if len(w1) == 0 or len(w2) == 0:
+        return tuple(h)
+
+    n12 = (np.sum(d1 ** 2, axis=1)[:, None] + np.sum(d2 ** 2, axis=1)[None, :]) / (2 * s)
+    w12 = w1[:, None] * w2[None, :]
+    w12_rc = r1.w[:, None] * w2[None, :] + w1[:, None] * r2.w[None, :]
+    if multi:
+        c1 = species_codes(s1)
+
+    for v, d in zip(VERTEX_PERMUTATIONS, DISTANCE_PERMUTATIONS):
+        if multi:
+            match = c1[:, None] == species_codes(s2[:, v])[None, :]
+            if not match.any():
+                continue
+        d2p = d2[:, d]
+        arg = d1.dot(d2p.T) / s - n12
+        e = np.exp(arg)
+        if multi:
+            e *= match
+        de = -2 * e * arg / sig
+
+        diff = d1[:, None, :] - d2p[None, :, :]
+        j2p = j2[:, d]
+        p1 = np.einsum('abi,aix->abx', diff, j1) / s
+        p2 = np.einsum('abi,biy->aby', diff, j2p) / s
+        a = dw1[:, None, :] - w1[:, None, None] * p1
+        b = dw2[None, :, :] + w2[None, :, None] * p2
+        a_rc = r1.dw[:, None, :] - r1.w[:, None, None] * p1
+        b_rc = r2.dw[None, :, :] + r2.w[None, :, None] * p2
+
+        # The parts of a and b in 1 / s contribute -2 / sig times themselves to h_sig
+        h[0] += np.einsum('ab,abx,aby->xy', e, a, b)
+        h[1] += np.einsum('ab,abx,aby->xy', de, a, b)
+        h[1] -= 2 / sig * (np.einsum('ab,abx,aby->xy', e, a - dw1[:, None, :], b) +
+                           np.einsum('ab,abx,aby->xy', e, a, b - dw2[None, :, :]))
+        h[2] += np.einsum('ab,abx,aby->xy', e, a_rc, b) + np.einsum('ab,abx,aby->xy', e, a, b_rc)
+
+        # Jacobian terms of the three, in one contraction
+        coefficients = np.stack((e * w12, (de - 2 / sig * e) * w12, e * w12_rc))
+        h += np.einsum('aix,kaiy->kxy', j1, np.einsum('kab,biy->kaiy', coefficients, j2p)) / s
+
+    return tuple(h)
+
+
+def window_bound(sig, rc, tol, derivatives=0):
+    """ Upper bound on the contribution of a pair of triplets outside the window of
+    ``triplet_kernel`` to each entry of the kernel or of its derivatives, all the
+    permutations included.
+
+    With x = |d1 - d2| / sig > sqrt(2 log(1 / tol)) for every permutation, the Gaussian
+    is below tol, but the gradients multiply it by up to x / sig and the hessian by up to
+    x^2 / sig^2, through the jacobian of the distances. The cutoff weights are at most 1,
+    their gradients at most pi / rc, and the jacobian holds two unit vectors.
+
+    Args:
+        sig (float): lengthscale hyperparameter theta[0]
+        rc (float): cutoff radius theta[2]
+        tol (float): tolerance, between 0 and 1
+        derivatives (int): 0 for the kernel, 1 for its gradient, 2 for the hessian
+
+    Returns:
+        bound (float): the bound, to be multiplied by the number of skipped pairs
+
+    """
+
+    k = np.sqrt(2 * np.log(1 / tol))
+    # Largest x exp(-x^2 / 2) and x^2 exp(-x^2 / 2) beyond k
+    f1 = k * tol if k >= 1 else np.exp(-0.5)
+    f2 = k ** 2 * tol if k >= np.sqrt(2) else 2 * np.exp(-1)
+    a = np.pi / rc
+    bound = (tol, a * tol + np.sqrt(2) * f1 / sig,
+             a ** 2 * tol + 2 * np.sqrt(2) * a * f1 / sig + 2 * (f2 + tol) / sig ** 2)
+
+    return len(VERTEX_PERMUTATIONS) * bound[derivatives]
+
+
+def triplet_neighbours(t1, t2, rc, steps, radius):
+    """ Pairs of valid triplets of two configurations whose sorted distances are within
+    radius of each other, found with the KD-trees of ``Triplets.tree``. For the other
+    pairs every permutation of the distances differs by more than radius.
+
+    Args:
+        t1 (Triplets): descriptors of the first configuration
+        t2 (Triplets): descriptors of the second configuration
+        rc (float): cutoff radius
+        steps (tuple): cutoff steps, see ``Triplets.weights``
+        radius (float): largest distance between the sorted distances
+
+    Returns:
+        indptr (array): T1 + 1 offsets in indices of the neighbours of each triplet of t1
+        indices (array): indices in ``Triplets.valid`` of the triplets of t2
+
+    """
+
+    tree1, tree2 = t1.tree(rc, steps), t2.tree(rc, steps)
+    if tree1.n == 0 or tree2.n == 0:
+        return np.zeros(tree1.n + 1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    pairs = tree1.sparse_distance_matrix(tree2, radius, output_type='ndarray')
+    indptr = np.zeros(tree1.n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pairs['i'], minlength=tree1.n), out=indptr[1:])
+    indices = pairs['j'][np.argsort(pairs['i'], kind='stable')].astype(np.int64)
+
+    return indptr, indices
+
+
+def pair_terms(l1, l2, i1, i2, sig, multi=False, derivatives=0):
+    """ Contributions of a list of pairs of triplets to the 3-body kernel and its
+    derivatives, same terms as ``triplet_terms`` restricted to the pairs (i1[p], i2[p])
+
+    Args:
+        l1 (TripletList): valid triplets of the first configuration
+        l2 (TripletList): valid triplets of the second configuration
+        i1 (array): indices of the triplets of the pairs in l1
+        i2 (array): indices of the triplets of the pairs in l2
+        sig (float): lengthscale hyperparameter theta[0]
+        multi (bool): if True only permutations with matching species contribute
+        derivatives (int): 0, 1 or 2, see ``triplet_kernel``
+
+    Returns:
+        k (float): kernel value
+        g1 (array): gradient with respect to the first central atom
+        g2 (array): gradient with respect to the second central atom
+        h (array): 3x3 mixed hessian
+
+    """
+
+    d1, s1, j1, w1, dw1 = (x[i1] for x in l1)
+    d2, s2, j2, w2, dw2 = (x[i2] for x in l2)
+    s = sig ** 2
+    k, g1, g2, h = 0., np.zeros(3), np.zeros(3), np.zeros((3, 3))
+    if multi:
+        c1 = species_codes(s1)
+
+    for v, d in zip(VERTEX_PERMUTATIONS, DISTANCE_PERMUTATIONS):
+        if multi:
+            match = c1 == species_codes(s2[:, v])
+            if not match.any():
+                continue
+        diff = d1 - d2[:, d]
+        e = np.exp(-np.sum(diff ** 2, axis=1) / (2 * s))
+        if multi:
+            e *= match
+        k += np.sum(w1 * e * w2)
+        if derivatives == 0:
+            continue
+
+        j2p = j2[:, d]
+        b = dw2 + w2[:, None] * np.einsum('pi,piy->py', diff, j2p) / s
+        g2 += np.einsum('p,py->y', w1 * e, b)
+        if derivatives == 1:
+            continue
+
+        a = dw1 - w1[:, None] * np.einsum('pi,pix->px', diff, j1) / s
+        g1 += np.einsum('p,px->x', e * w2, a)
+        h += np.einsum('p,px,py->xy', e, a, b)
+        h += np.einsum('pix,piy->xy', j1 * (e * w1 * w2)[:, None, None], j2p) / s
+
+    return k, g1, g2, h
+
+
+def cast_triplets(l, dtype):
+    """ Copy of a TripletList with distances, jacobian and weights in the given precision.
+    The species are left as they are, so that their codes stay exact.
+    """
+    return l._replace(distances=l.distances.astype(dtype), jacobian=l.jacobian.astype(dtype),
+                      w=l.w.astype(dtype), dw=l.dw.astype(dtype))
+
+
+def triplet_chunks(n1, n2, derivatives, max_bytes, itemsize=8):
+    """ Split the n1 x n2 pairs of triplets in chunks whose intermediates fit in max_bytes
+
+    Args:
+        n1 (int): number of triplets of the first configuration
+        n2 (int): number of triplets of the second configuration
+        derivatives (int): 0, 1 or 2, see ``triplet_kernel``
+        max_bytes (int): memory ceiling of the intermediates, None for no limit
+        itemsize (int): size in bytes of the floats of the intermediates
+
+    Returns:
+        chunks (list): list of (slice, slice) couples
+
+    """
+
+    if max_bytes is None:
+        return [(slice(0, n1), slice(0, n2))]
+
+    # Intermediates allocated for each pair of triplets
+    per_pair = itemsize * TRIPLET_PAIR_ARRAYS[derivatives]
+    c2 = max(1, min(n2, max_bytes // (per_pair * max(1, n1))))
+    if c2 < n2:
+        c1 = max(1, min(n1, max_bytes // (per_pair * c2)))
+    else:
+        c1 = n1
+
+    return [(slice(i, i + c1), slice(j, j + c2))
+            for i in range(0, n1, c1) for j in range(0, n2, c2)]
+
+
+def species_pairs(groups1, groups2):
+    """ Couples of species groups of two configurations that contribute to the
+    many-species kernel, see ``Triplets.species_groups``
+
+    Args:
+        groups1 (dict): triplets of the first configuration, by species
+        groups2 (dict): triplets of the second configuration, by species
+
+    Returns:
+        pairs (list): (TripletList, TripletList, permutations) tuples, permutations being
+            the indices of the permutations of the second triplets whose species
+            match the first ones
+
+    """
+
+    pairs = []
+    for s1, l1 in groups1.items():
+        for s2, l2 in groups2.items():
+            permutations = tuple(p for p, v in enumerate(VERTEX_PERMUTATIONS)
+                                 if tuple(s2[i] for i in v) == s1)
+            if permutations:
+                pairs.append((l1, l2, permutations))
+
+    return pairs
+
+
+def triplet_kernel(t1, t2, sig, rc, steps=(True, True), multi=False, derivatives=0,
+                   max_bytes=None, dtype='float64', engine='numpy', species_sorted=False,
+                   window_tol=None):
+    """ Three-body kernel between two configurations, computed from the compact lists
+    of their valid triplets with NumPy, see ``triplet_terms``.
+
+    The pairs of triplets are processed in chunks, so that the intermediates of a call
+    never exceed max_bytes. The partial sums of the chunks give the same result
+    as a single evaluation. In single precision the intermediates are computed in float32,
+    while the partial sums are accumulated in double precision. The numba engine loops
+    over the pairs of triplets without intermediates, see ``numbaengine.triplet_terms``.
+
+    With species_sorted and many species, the triplets of each configuration are grouped
+    by species once, and only the couples of groups and the permutations with matching
+    species are evaluated, instead of masking every permutation of every pair.
+
+    With window_tol, only the pairs of triplets whose sorted distances are within
+    sig * sqrt(2 log(1 / window_tol)) of each other are evaluated, see
+    ``triplet_neighbours``, so that the Gaussians of all the permutations of the
+    skipped pairs are below window_tol. Each skipped pair changes the kernel by at most
+    6 window_tol, and its gradients and hessian by at most ``window_bound``, which grows
+    as 1 / sig^2 for the hessian. The triplets are then not grouped by species.
+
+    Args:
+        t1 (Triplets): descriptors of the first configuration
+        t2 (Triplets): descriptors of the second configuration
+        sig (float): lengthscale hyperparameter theta[0]
+        rc (float): cutoff distance hyperparameter theta[2]
+        steps (tuple): cutoff steps of the kernel, see ``Triplets.weights``
+        multi (bool): if True only permutations with matching species contribute
+        derivatives (int): 0 for the kernel only, 1 to add its gradient with respect
+            to the central atom of the second configuration, 2 to add the gradient
+            with respect to the first central atom and the mixed hessian
+        max_bytes (int): memory ceiling of the intermediates, None for no limit
+        dtype (str): "float64" or "float32", precision of the intermediates
+        engine (str): "numpy" or "numba"
+        species_sorted (bool): if True and multi, evaluate the triplets by species group
+        window_tol (float): tolerance below which the pairs of triplets are skipped,
+            None to evaluate all of them
+
+    Returns:
+        terms (tuple): kernel value, followed by the gradient for derivatives=1, or by
+            the two gradients and the 3x3 hessian for derivatives=2
+
+    """
+
+    if window_tol is not None:
+        l1, l2 = t1.valid(rc, steps), t2.valid(rc, steps)
+        indptr, indices = triplet_neighbours(t1, t2, rc, steps,
+                                             sig * np.sqrt(2 * np.log(1 / window_tol)))
+        if dtype != 'float64':
+            l1, l2 = cast_triplets(l1, dtype), cast_triplets(l2, dtype)
+        if engine == 'numba':
+            k, g1, g2, h = numbaengine.triplet_terms(l1, l2, sig, multi, derivatives,
+                                                     indptr, indices)
+        else:
+            i1 = np.repeat(np.arange(len(l1.w)), np.diff(indptr))
+            # Intermediates allocated for each pair of triplets, about 48 floats
+            size = len(i1) if max_bytes is None else max(
+                1, max_bytes // (48 * np.dtype(dtype).itemsize))
+            k, g1, g2, h = 0., np.zeros(3), np.zeros(3), np.zeros((3, 3))
+            for c in range(0, len(i1), size):
+                terms = pair_terms(l1, l2, i1[c:c + size], indices[c:c + size], sig, multi,
+                                   derivatives)
+                k, g1, g2, h = (x + y for x, y in zip((k, g1, g2, h), terms))
+        return ((k,), (k, g2), (k, g1, g2, h))[derivatives]
+
+    if engine == 'numba':
+        l1, l2 = t1.valid(rc, steps), t2.valid(rc, steps)
+        if dtype != 'float64':
+            l1, l2 = cast_triplets(l1, dtype), cast_triplets(l2, dtype)
+        k, g1, g2, h = numbaengine.triplet_terms(l1, l2, sig, multi, derivatives)
+        return ((k,), (k, g2), (k, g1, g2, h))[derivatives]
+
+    if multi and species_sorted:
+        # the species of the groups match, no need to compare them again
+        pairs = species_pairs(t1.species_groups(rc, steps), t2.species_groups(rc, steps))
+        multi = False
+    else:
+        pairs = [(t1.valid(rc, steps), t2.valid(rc, steps), None)]
+
+    k, g1, g2, h = 0., np.zeros(3), np.zeros(3), np.zeros((3, 3))
+    for l1, l2, permutations in pairs:
+        if dtype != 'float64':
+            l1, l2 = cast_triplets(l1, dtype), cast_triplets(l2, dtype)
+        chunks = triplet_chunks(len(l1.w), len(l2.w), derivatives, max_bytes,
+                                np.dtype(dtype).itemsize)
+        for c1, c2 in chunks:
+            terms = triplet_terms(TripletList(*(x[c1] for x in l1)),
+                                  TripletList(*(x[c2] for x in l2)), sig, multi, derivatives,
+                                  permutations)
+            k, g1, g2, h = (x + y for x, y in zip((k, g1, g2, h), terms))
+
+    return ((k,), (k, g2), (k, g1, g2, h))[derivatives]
+
+
+def rc_derivatives(l, rc, steps=(True, True)):
+    """ TripletList whose cutoff weights and their gradients are replaced by their
+    derivatives with respect to the cutoff radius, see ``Triplets.weights``. The terms of
+    ``triplet_terms`` are bilinear in the weights of the two lists, so that their
+    derivatives with respect to rc are the sums of the terms with either list replaced.
+
+    Args:
+        l (TripletList): valid triplets of a configuration
+        rc (float): cutoff radius
+        steps (tuple): cutoff steps, see ``Triplets.weights``
+
+    Returns:
+        l_rc (TripletList): the same triplets with the derivatives of the weights
+
+    """
+
+    f1j, d1j = cutoff(l.distances[:, 0], rc, steps[0])
+    f1k, d1k = cutoff(l.distances[:, 1], rc, steps[0])
+    fjk, _ = cutoff(l.distances[:, 2], rc, steps[1])
+    f1j_rc, d1j_rc = cutoff_rc(l.distances[:, 0], rc, steps[0])
+    f1k_rc, d1k_rc = cutoff_rc(l.distances[:, 1], rc, steps[0])
+    fjk_rc, _ = cutoff_rc(l.distances[:, 2], rc, steps[1])
+
+    w = f1j_rc * f1k * fjk + f1j * f1k_rc * fjk + f1j * f1k * fjk_rc
+    dw = (fjk_rc[:, None] * ((d1j * f1k)[:, None] * l.jacobian[:, 0] +
+                             (f1j * d1k)[:, None] * l.jacobian[:, 1]) +
+          fjk[:, None] * ((d1j_rc * f1k + d1j * f1k_rc)[:, None] * l.jacobian[:, 0] +
+                          (f1j_rc * d1k + f1j * d1k_rc)[:, None] * l.jacobian[:, 1]))
+
+    return l._replace(w=w, dw=dw)
+
+
+def triplet_gradient(t1, t2, sig, rc, steps=(True, True), multi=False, max_bytes=None):
+    """ Mixed hessian of the three-body kernel between two configurations together with
+    its derivatives with respect to sig and rc, computed in double precision with NumPy
+    in a single pass over the pairs of triplets, see ``triplet_hessians``
+
+    Args:
+        t1 (Triplets): descriptors of the first configuration
+        t2 (Triplets): descriptors of the second configuration
+        sig (float): lengthscale hyperparameter theta[0]
+        rc (float): cutoff distance hyperparameter theta[2]
+        steps (tuple): cutoff steps of the kernel, see ``Triplets.weights``
+        multi (bool): if True only permutations with matching species contribute
+        max_bytes (int): memory ceiling of the intermediates, None for no limit
+
+    Returns:
+        h (array): 3x3 mixed hessian, the force-force kernel
+        h_sig (array): its derivative with respect to sig
+        h_rc (array): its derivative with respect to rc
+
+    """
+
+    l1, l2 = t1.valid(rc, steps), t2.valid(rc, steps)
+    r1, r2 = rc_derivatives(l1, rc, steps), rc_derivatives(l2, rc, steps)
+
+    h = np.zeros((3, 3, 3))
+    # The intermediates are about twice those of triplet_terms with derivatives=2
+    for c1, c2 in triplet_chunks(len(l1.w), len(l2.w), 2, max_bytes, 16):
+        h += triplet_hessians(*(TripletList(*(x[c] for x in l))
+                                for l, c in ((l1, c1), (l2, c2), (r1, c1), (r2, c2))),
+                              sig, multi)
+
+    return tuple(h)
+
+
+def pack_terms(terms):
+    """ Flatten the terms of ``triplet_kernel`` into an array of 17 values, the missing
+    gradients and hessian being zero, followed by the order of the derivatives
+    """
+    packed = np.zeros(17)
+    packed[0], packed[16] = terms[0], {1: 0, 2: 1, 4: 2}[len(terms)]
+    if len(terms) == 2:
+        packed[4:7] = terms[1]
+    elif len(terms) == 4:
+        packed[1:4], packed[4:7], packed[7:16] = terms[1], terms[2], np.ravel(terms[3])
+    return packed
+
+
+def cached_triplet_kernel(cache, t1, t2, sig, rc, steps=(True, True), multi=False,
+                          derivatives=0, max_bytes=None, dtype='float64', engine='numpy',
+                          species_sorted=False, window_tol=None):
+    """ Three-body kernel between two configurations, read from a cache of the 3-body sums
+    when available, same arguments and results as ``triplet_kernel``.
+
+    The terms are stored under the content of the two configurations and the
+    hyperparameters, cutoff steps, species treatment and precision that determine them,
+    so that the kernels sharing the cache, e.g. a 3-body and a many-body kernel fitted
+    on the same data, compute the sums of each pair of configurations once. Terms computed
+    with derivatives also serve the calls that need fewer of them.
+
+    Args:
+        cache (BlockCache): cache of the terms, see ``mff.kernels.blockcache``
+
+    """
+
+    key = (conf_hash(t1), conf_hash(t2), float(sig), float(rc), tuple(steps), bool(multi),
+           dtype, window_tol)
+    packed = cache.get(key)
+    if packed is None or packed[16] < derivatives:
+        packed = pack_terms(triplet_kernel(t1, t2, sig, rc, steps, multi, derivatives,
+                                           max_bytes, dtype, engine, species_sorted,
+                                           window_tol))
+        cache.put(key, packed)
+
+    k, g1, g2, h = packed[0], packed[1:4], packed[4:7], packed[7:16].reshape(3, 3)
+    return ((k,), (k, g2), (k, g1, g2, h))[derivatives]
+
 
 class BaseThreeBody(Kernel, metaclass=ABCMeta):
     """ Three body kernel class
@@ -118,6 +715,24 @@ class BaseThreeBody(Kernel, metaclass=ABCMeta):
         theta[1] (float) : decay rate of the cutoff function
         theta[2] (float) : cutoff radius
         bounds (list) : bounds of the kernel function.
+        engine (str): "theano" (default) for the compiled kernels, "numpy" to compute
+            the kernels from triplet descriptors, see ``mff.kernels.descriptors``, or
+            "numba" to compute them from the same descriptors with the compiled loops of
+            ``mff.kernels.numbaengine``, on all the threads
+        max_memory (int): ceiling in bytes of the intermediates of a single kernel call
+            with the numpy engine, larger environments are evaluated in chunks
+        species_sorted (bool): with the numpy engine and many species, evaluate the
+            kernels on the triplets grouped by species, see ``triplet_kernel``
+        sum_cache (BlockCache): with the numpy or numba engine, cache of the 3-body sums
+            between pairs of configurations, which can be shared with a many-body kernel
+            on the same data, see ``cached_triplet_kernel``
+        dtype (str): "float64" or "float32", precision in which the kernels are computed,
+            by the compiled functions or by the numpy and numba engines
+        window_tol (float): with the numpy or numba engine, only sum over the pairs of
+            triplets whose sorted distances are close enough for their squared exponential
+            to be above this tolerance, found with a KD-tree of each configuration, see
+            ``triplet_neighbours``. None sums over all the pairs. The error of each
+            skipped pair is bounded by ``window_bound``
 
     Attributes:
         k3_ee (object): Energy-energy kernel function
@@ -127,13 +742,144 @@ class BaseThreeBody(Kernel, metaclass=ABCMeta):
 
     """
 
+    function_names = ('k3_ee', 'k3_ef', 'k3_ff')
+    cost_power = 2
+
+    # Whether the cutoff functions vanish beyond rc for the distances from the central
+    # atom and between neighbours, as in the theano graphs, see ``Triplets.weights``
+    cutoff_steps = (True, True)
+
     @abstractmethod
-    def __init__(self, kernel_name, theta, bounds):
-        super().__init__(kernel_name)
+    def __init__(self, kernel_name, theta, bounds, engine='theano', max_memory=2**28,
+                 species_sorted=False, sum_cache=None, dtype='float64', window_tol=None):
+        super().__init__(kernel_name, dtype=dtype)
         self.theta = theta
         self.bounds = bounds
-        self.k3_ee, self.k3_ef, self.k3_ff = self.compile_theano()
+        if engine not in ('theano', 'numpy', 'numba'):
+            raise ValueError("Unknown engine %s, use 'theano', 'numpy' or 'numba'" % engine)
+        if engine == 'numba':
+            numbaengine.require_numba()
+        if species_sorted and engine == 'theano':
+            raise ValueError("species_sorted requires the numpy or numba engine")
+        if sum_cache is not None and engine == 'theano':
+            raise ValueError("sum_cache requires the numpy or numba engine")
+        if window_tol is not None and engine == 'theano':
+            raise ValueError("window_tol requires the numpy or numba engine")
+        if window_tol is not None and not 0 < window_tol < 1:
+            raise ValueError("window_tol must be between 0 and 1")
+        self.engine = engine
+        self.max_memory = max_memory
+        self.species_sorted = species_sorted
+        self.sum_cache = sum_cache
+        self.window_tol = window_tol
+        if engine != 'theano':
+            self.k3_ee, self.k3_ef, self.k3_ff = self.numpy_ee, self.numpy_ef, self.numpy_ff
+        else:
+            self.k3_ee, self.k3_ef, self.k3_ff = self.theano_ee, self.theano_ef, self.theano_ff
+
+    def describe(self, X, kind='local'):
+        """ Triplet descriptors of the configurations when using the numpy or numba
+        engine, see ``Kernel.describe``
+        """
+        if self.engine != 'theano':
+            return describe(X, kind)
+        return X
+
+    def engine_options(self):
+        """ Options of the numpy engine sent to the workers with the configurations,
+        see ``engine_function``. None with the compiled functions
+        """
+        if self.engine == 'theano':
+            return None
+        return self.cutoff_steps, self.max_memory, self.species_sorted, self.window_tol
+
+    def shared(self, X, kind='local'):
+        """ Configurations sent to the workers, which describe them again with the numpy
+        engine, see ``configurations``
+        """
+        if self.engine != 'theano':
+            return configurations(X, kind)
+        return X
+
+    def eval_triplets(self, conf1, conf2, sig, rc, derivatives=0):
+        """ 3-body kernel terms of the numpy or numba engine, see ``triplet_kernel``.
+        Takes configurations or their Triplets.
+        """
+        args = (triplets(conf1), triplets(conf2), sig, rc, self.cutoff_steps, self.type == 'multi',
+                derivatives, self.max_memory, self.dtype, self.engine, self.species_sorted,
+                self.window_tol)
+        if self.sum_cache is not None:
+            return cached_triplet_kernel(self.sum_cache, *args)
+        return triplet_kernel(*args)
+
+    def numpy_ee(self, conf1, conf2, sig, theta, rc):
+        """ Energy-energy kernel of the numpy engine, same arguments as k3_ee """
+        return self.eval_triplets(conf1, conf2, sig, rc)[0]
+
+    def numpy_ef(self, conf1, conf2, sig, theta, rc):
+        """ Energy-force kernel of the numpy engine, same arguments as k3_ef """
+        return -self.eval_triplets(conf1, conf2, sig, rc, 1)[1]
+
+    def numpy_ff(self, conf1, conf2, sig, theta, rc):
+        """ Force-force kernel of the numpy engine, same arguments as k3_ff """
+        return self.eval_triplets(conf1, conf2, sig, rc, 2)[3]
+
+    def theano_ee(self, conf1, conf2, sig, theta, rc):
+        """
+        Three body kernel for global energy-energy correlation, evaluated by the compiled function
+
+        Args:
+            conf1 (array): first configuration.
+            conf2 (array): second configuration.
+            sig (float): lengthscale hyperparameter theta[0]
+            theta (float): cutoff decay rate hyperparameter theta[1]
+            rc (float): cutoff distance hyperparameter theta[2]
+
+        Returns:
+            kernel (float): scalar valued energy-energy 3-body kernel
+
+        """
+        return self.theano_function('k3_ee')(np.zeros(3), np.zeros(3), conf1, conf2,
+                                             sig, theta, rc)
+
+    def theano_ef(self, conf1, conf2, sig, theta, rc):
+        """
+        Three body kernel for global energy-force correlation, evaluated by the compiled function
+
+        Args:
+            conf1 (array): first configuration.
+            conf2 (array): second configuration.
+            sig (float): lengthscale hyperparameter theta[0]
+            theta (float): cutoff decay rate hyperparameter theta[1]
+            rc (float): cutoff distance hyperparameter theta[2]
+
+        Returns:
+            kernel (array): 3x1 energy-force 3-body kernel
+
+        """
+        return -self.theano_function('k3_ef')(np.zeros(3), np.zeros(3), conf1, conf2,
+                                              sig, theta, rc)
+
+    def theano_ff(self, conf1, conf2, sig, theta, rc):
+        """
+        Three body kernel for force-force correlation, evaluated by the compiled function
+
+        Args:
+            conf1 (array): first configuration.
+            conf2 (array): second configuration.
+            sig (float): lengthscale hyperparameter theta[0]
+            theta (float): cutoff decay rate hyperparameter theta[1]
+            rc (float): cutoff distance hyperparameter theta[2]
 
+        Returns:
+            kernel (matrix): 3x3 force-force 3-body kernel
+
+        """
+        return self.theano_function('k3_ff')(np.zeros(3), np.zeros(3), conf1, conf2,
+                                             sig, theta, rc)
+
+    @cached_blocks('ff', (3, 3))
+    @species_blocks('ff', (3, 3))
     def calc(self, X1, X2, ncores=1):
         """
         Calculate the energy-force kernel between two sets of configurations.
@@ -148,39 +894,15 @@ class BaseThreeBody(Kernel, metaclass=ABCMeta):
         """
         ker = np.zeros((len(X1) * 3, len(X2) * 3))
 
-        if ncores > 1:
-
-            confs = [[x1, x2] for x1 in X1 for x2 in X2]
-            n = len(confs)
-            import sys
-            sys.setrecursionlimit(100000)
+        if ncores > 1 and self.engine != 'numba':
             logger.info(
                 'Using %i cores for the 3-body force-force kernel calculation' % (ncores))
-
-            # Way to split the kernels functions to compute evenly across the nodes
-            splitind = np.zeros(ncores + 1)
-            factor = (n + (ncores - 1)) / ncores
-            splitind[1:-1] = [(i + 1) * factor for i in range(ncores - 1)]
-            splitind[-1] = n
-            splitind = splitind.astype(int)
-            clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                      self.type] for i in range(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-            del confs
-            import multiprocessing as mp
-            pool = mp.Pool(ncores)
-            result = pool.map(dummy_calc_ff, clist)
-            del clist
-            pool.close()
-            pool.join()
-
-            result = np.concatenate(result).reshape((n, 3, 3))
-            for i in range(len(X1)):
-                for j in range(len(X2)):
-                    ker[i * 3: i * 3 + 3, 3 * j:3 * j +
-                        3] = result[(j + i * len(X2))]
-            del result
+            ker = self.calc_parallel(dummy_calc_ff, self.shared(X1), self.shared(X2), (3, 3),
+                                     ncores, args=(self.theta, self.type, self.dtype,
+                                                   self.engine_options()))
 
         else:
+            X1, X2 = self.describe(X1), self.describe(X2)
             for i, conf1 in enumerate(X1):
                 for j, conf2 in enumerate(X2):
                     ker[i * 3:i * 3 + 3, 3 * j:3 * j + 3] += self.k3_ff(
@@ -188,6 +910,7 @@ class BaseThreeBody(Kernel, metaclass=ABCMeta):
 
         return ker
 
+    @cached_blocks('ef', (1, 3))
     def calc_ef(self, X_glob, X, ncores=1, mapping=False):
         """
         Calculate the energy-force kernel between two sets of configurations.
@@ -202,36 +925,17 @@ class BaseThreeBody(Kernel, metaclass=ABCMeta):
         """
         ker = np.zeros((len(X_glob), len(X) * 3))
 
-        if ncores > 1:
-            confs = [[x1, x2] for x1 in X_glob for x2 in X]
-            n = len(confs)
-            import sys
-            sys.setrecursionlimit(100000)
+        if ncores > 1 and self.engine != 'numba':
             logger.info(
                 'Using %i cores for the 3-body energy-force kernel calculation' % (ncores))
-
-            # Way to split the kernels functions to compute evenly across the nodes
-            splitind = np.zeros(ncores + 1)
-            factor = (n + (ncores - 1)) / ncores
-            splitind[1:-1] = [(i + 1) * factor for i in range(ncores - 1)]
-            splitind[-1] = n
-            splitind = splitind.astype(int)
-            clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                      self.type, mapping] for i in range(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-            del confs
-            import multiprocessing as mp
-            pool = mp.Pool(ncores)
-            result = pool.map(dummy_calc_ef, clist)
-            del clist
-            pool.close()
-            pool.join()
-            result = np.vstack(np.asarray(result))
-
-            for i in range(len(X_glob)):
-                for j in range(len(X)):
-                    ker[i, 3 * j:3 * j + 3] = result[(j + i * len(X))]
+            kind = 'local' if mapping else 'global'
+            ker = self.calc_parallel(dummy_calc_ef, self.shared(X_glob, kind), self.shared(X),
+                                     (1, 3), ncores, kinds=(kind, 'local'),
+                                     args=(self.theta, self.type, mapping, self.dtype,
+                                           self.engine_options()))
 
         else:
+            X_glob, X = self.describe(X_glob, 'local' if mapping else 'global'), self.describe(X)
             if not mapping:
                 for i, x1 in enumerate(X_glob):
                     for j, conf2 in enumerate(X):
@@ -246,6 +950,7 @@ class BaseThreeBody(Kernel, metaclass=ABCMeta):
 
         return ker
 
+    @cached_blocks('ee', (1, 1))
     def calc_ee(self, X1, X2, ncores=1, mapping=False):
         """
         Calculate the energy-energy kernel between two global environments.
@@ -258,45 +963,19 @@ class BaseThreeBody(Kernel, metaclass=ABCMeta):
             K (matrix): N1 x N2 matrix of the scalar-valued kernels 
 
        """
-        if ncores > 1:  # Used for multiprocessing
-
-            # Build a list of all input pairs which matrix needs to be computed
-            confs = [[x1, x2] for x1 in X1 for x2 in X2]
-
-            n = len(confs)
-            import sys
-            sys.setrecursionlimit(100000)
+        if ncores > 1 and self.engine != 'numba':  # Used for multiprocessing
             logger.info(
                 'Using %i cores for the 3-body energy-energy kernel calculation' % (ncores))
+            kind = 'local' if mapping else 'global'
+            ker = self.calc_parallel(dummy_calc_ee, self.shared(X1, kind),
+                                     self.shared(X2, 'global'), (1, 1), ncores,
+                                     kinds=(kind, 'global'),
+                                     args=(self.theta, self.type, mapping, self.dtype,
+                                           self.engine_options()))
 
-            # Way to split the kernels functions to compute evenly across the nodes
-            splitind = np.zeros(ncores + 1)
-            factor = (n + (ncores - 1)) / ncores
-            splitind[1:-1] = [(i + 1) * factor for i in range(ncores - 1)]
-            splitind[-1] = n
-            splitind = splitind.astype(int)
-            clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                      self.type, mapping] for i in range(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-            del confs
-
-            import multiprocessing as mp
-            pool = mp.Pool(ncores)
-            result = pool.map(dummy_calc_ee, clist)
-
-            del clist
-            pool.close()
-            pool.join()
-            result = np.concatenate(result).ravel()
-
-            ker = np.zeros((len(X1), len(X2)))
-            for i in range(len(X1)):
-                for j in range(len(X2)):
-                    ker[i, j] = result[j + i*len(X2)]
-
-            del result 
-            
         else:
+            X1 = self.describe(X1, 'local' if mapping else 'global')
+            X2 = self.describe(X2, 'global')
             if not mapping:
                 ker = np.zeros((len(X1), len(X2)))
                 for i, x1 in enumerate(X1):
@@ -315,7 +994,9 @@ class BaseThreeBody(Kernel, metaclass=ABCMeta):
 
         return ker
 
-    def calc_gram(self, X, ncores=1, eval_gradient=False):
+    @cached_blocks('gram', (3, 3))
+    @species_blocks('gram', (3, 3))
+    def calc_gram(self, X, ncores=1, eval_gradient=False, order='C'):
         """
         Calculate the force-force gram matrix for a set of configurations X.
 
@@ -323,68 +1004,78 @@ class BaseThreeBody(Kernel, metaclass=ABCMeta):
             X (list): list of N Mx5 arrays containing xyz coordinates and atomic species
             ncores (int): Number of CPU nodes to use for multiprocessing (default is 1)
             eval_gradient (bool): if True, evaluate the gradient of the gram matrix
+            order (str): memory layout of the gram matrix, 'C' or 'F' (Fortran)
 
         Returns:
             gram (matrix): N*3 x N*3 gram matrix of the matrix-valued kernels 
 
         """
         if eval_gradient:
-            raise NotImplementedError('ERROR: GRADIENT NOT IMPLEMENTED YET')
+            return self.calc_gram_gradient(X, order, ncores)
         else:
-            if ncores > 1:
-                confs = [[X[i], X[j]] for i in range(len(X)) for j in range(i + 1)]
-
-                n = len(confs)
+            if ncores > 1 and self.engine != 'numba':
                 logger.info(
                     'Using %i cores for the 3-body force-force gram matrix calculation' % (ncores))
-
-                import sys
-                sys.setrecursionlimit(100000)
-
-                # Way to split the kernels functions to compute evenly across the nodes
-                splitind = np.zeros(ncores + 1)
-                factor = (n + (ncores - 1)) / ncores
-                splitind[1:-1] = [(i + 1) *
-                                  factor for i in range(ncores - 1)]
-                splitind[-1] = n
-                splitind = splitind.astype(int)
-                clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                          self.type] for i in range(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-                del confs
-                import multiprocessing as mp
-                pool = mp.Pool(ncores)
-                result = pool.map(dummy_calc_ff, clist)
-                del clist
-                pool.close()
-                pool.join()
-
-                result = np.concatenate(result).reshape((n, 3, 3))
-                off_diag = np.zeros((len(X) * 3, len(X) * 3))
-                diag = np.zeros((len(X) * 3, len(X) * 3))
-                for i in range(len(X)):
-                    diag[3 * i:3 * i + 3, 3 * i:3 * i +
-                         3] = result[i + i * (i + 1) // 2]
-                    for j in range(i):
-                        off_diag[3 * i:3 * i + 3, 3 * j:3 *
-                                 j + 3] = result[j + i * (i + 1) // 2]
-                del result
+                X = self.shared(X)
+                gram = self.calc_parallel(dummy_calc_ff, X, X, (3, 3), ncores,
+                                          args=(self.theta, self.type, self.dtype,
+                                                self.engine_options()),
+                                          symmetric=True, order=order)
 
             else:
-                diag = np.zeros((X.shape[0] * 3, X.shape[0] * 3))
-                off_diag = np.zeros((X.shape[0] * 3, X.shape[0] * 3))
-                for i in range(X.shape[0]):
-                    diag[3 * i:3 * i + 3, 3 * i:3 * i + 3] = \
-                        self.k3_ff(X[i], X[i], self.theta[0],
-                                   self.theta[1], self.theta[2])
-                    for j in range(i):
-                        off_diag[3 * i:3 * i + 3, 3 * j:3 * j + 3] = \
+                X = self.describe(X)
+                gram = np.zeros((len(X) * 3, len(X) * 3), order=order)
+                for i in range(len(X)):
+                    for j in range(i + 1):
+                        gram[3 * i:3 * i + 3, 3 * j:3 * j + 3] = \
                             self.k3_ff(X[i], X[j], self.theta[0],
                                        self.theta[1], self.theta[2])
+                mirror_lower(gram, 3)  # The gram matrix is symmetric
 
-            gram = diag + off_diag + off_diag.T
-            del diag, off_diag
             return gram
 
+    def calc_gram_gradient(self, X, order='C', ncores=1):
+        """
+        Calculate the force-force gram matrix for a set of configurations X together with
+        its derivatives with respect to the hyperparameters, the three being computed in
+        a single pass over the triplets of each pair of configurations with
+        ``triplet_gradient``, in double precision whatever the engine. Only the lower
+        triangle is computed, by the worker pool when ncores > 1. The kernel does not
+        depend on theta[1], whose derivative is zero.
+
+        Args:
+            X (list): list of N Mx5 arrays containing xyz coordinates and atomic species
+            order (str): memory layout of the gram matrix, 'C' or 'F' (Fortran)
+            ncores (int): Number of CPU nodes to use for multiprocessing (default is 1)
+
+        Returns:
+            gram (matrix): N*3 x N*3 gram matrix of the matrix-valued kernels
+            gradient (array): N*3 x N*3 x 3 derivatives of the gram matrix with respect to
+                theta[0], theta[1] and theta[2]
+
+        """
+        n = len(X)
+        args = (self.theta, self.type, self.cutoff_steps, self.max_memory)
+        if ncores > 1:
+            logger.info('Using %i cores for the 3-body gram matrix gradient calculation'
+                        % ncores)
+            # The 3x12 blocks hold the kernel and its three derivatives side by side
+            ker = self.calc_parallel(dummy_calc_ff_gradient, configurations(X), None, (3, 12),
+                                     ncores, args=args, symmetric=True)
+        else:
+            X = describe(X)
+            ker = np.zeros((n * 3, n * 12))
+            for i in range(n):
+                for j in range(i + 1):
+                    ker[3 * i:3 * i + 3, 12 * j:12 * j + 12] = np.reshape(
+                        dummy_calc_ff_gradient(X[i], X[j], *args), (3, 12))
+
+        ker = ker.reshape(n * 3, n * 3, 4)
+        for k in (0, 1, 3):
+            mirror_lower(ker[:, :, k], 3)
+
+        return np.array(ker[:, :, 0], order=order), np.array(ker[:, :, 1:])
+
     def calc_gram_e(self, X, ncores=1, eval_gradient=False):  # Untested
         """
         Calculate the energy-energy gram matrix for a set of configurations X.
@@ -401,61 +1092,34 @@ class BaseThreeBody(Kernel, metaclass=ABCMeta):
         if eval_gradient:
             raise NotImplementedError('ERROR: GRADIENT NOT IMPLEMENTED YET')
         else:
-            if ncores > 1:
-                # Build a list of all input pairs which matrix needs to be computed
-                confs = [[X[i], X[j]] for i in range(len(X)) for j in range(i + 1)]
-
-                n = len(confs)
-                import sys
-                sys.setrecursionlimit(100000)
+            if ncores > 1 and self.engine != 'numba':
                 logger.info(
                     'Using %i cores for the 3-body energy-energy gram matrix calculation' % (ncores))
-
-                # Way to split the kernels functions to compute evenly across the nodes
-                splitind = np.zeros(ncores + 1)
-                factor = (n + (ncores - 1)) / ncores
-                splitind[1:-1] = [(i + 1) *
-                                  factor for i in range(ncores - 1)]
-                splitind[-1] = n
-                splitind = splitind.astype(int)
-                clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                          self.type, False] for i in range(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-                del confs
-                import multiprocessing as mp
-                pool = mp.Pool(ncores)
-                result = pool.map(dummy_calc_ee, clist)
-                del clist
-                pool.close()
-                pool.join()
-
-                result = np.concatenate(result).ravel()
-                off_diag = np.zeros((len(X), len(X)))
-                diag = np.zeros((len(X), len(X)))
-                for i in range(len(X)):
-                    diag[i, i] = result[i + i * (i + 1) // 2]
-                    for j in range(i):
-                        off_diag[i, j] = result[j + i * (i + 1) // 2]
-                del result
+                X = self.shared(X, 'global')
+                gram = self.calc_parallel(dummy_calc_ee, X, X, (1, 1), ncores,
+                                          kinds=('global', 'global'),
+                                          args=(self.theta, self.type, False, self.dtype,
+                                                self.engine_options()),
+                                          symmetric=True)
 
             else:
-                diag = np.zeros((X.shape[0], X.shape[0]))
-                off_diag = np.zeros((X.shape[0], X.shape[0]))
-                for i in range(X.shape[0]):
+                X = self.describe(X, 'global')
+                gram = np.zeros((len(X), len(X)))
+                for i in range(len(X)):
                     for k, conf1 in enumerate(X[i]):
-                        diag[i, i] += 1/9.0*self.k3_ee(conf1, conf1,
+                        gram[i, i] += 1/9.0*self.k3_ee(conf1, conf1,
                                                  self.theta[0], self.theta[1], self.theta[2])
                         for conf2 in X[i][:k]:
                             # *2 here to speed up the loop
-                            diag[i, i] += 1/9.0*2.0*self.k3_ee(
+                            gram[i, i] += 1/9.0*2.0*self.k3_ee(
                                 conf1, conf2, self.theta[0], self.theta[1], self.theta[2])
                     for j in range(i):
                         for conf1 in X[i]:
                             for conf2 in X[j]:
-                                off_diag[i, j] += 1/9.0*self.k3_ee(
+                                gram[i, j] += 1/9.0*self.k3_ee(
                                     conf1, conf2, self.theta[0], self.theta[1], self.theta[2])
+                mirror_lower(gram, 1)  # Gram matrix is symmetric
 
-            gram = diag + off_diag + off_diag.T
-            del diag, off_diag            
             return gram
 
     def calc_gram_ef(self, X, X_glob, ncores=1, eval_gradient=False):
@@ -474,46 +1138,24 @@ class BaseThreeBody(Kernel, metaclass=ABCMeta):
             gram (matrix): N2 x N1*3 gram matrix of the vector-valued kernels 
 
        """
-        gram = np.zeros((X_glob.shape[0], X.shape[0] * 3))
+        gram = np.zeros((len(X_glob), len(X) * 3))
 
         if eval_gradient:
             raise NotImplementedError('ERROR: GRADIENT NOT IMPLEMENTED YET')
         else:
-            if ncores > 1:  # Multiprocessing
-                confs = [[x1, x2] for x1 in X_glob for x2 in X]
-                n = len(confs)
-                import sys
-                sys.setrecursionlimit(100000)
+            if ncores > 1 and self.engine != 'numba':  # Multiprocessing
                 logger.info(
                     'Using %i cores for the 3-body energy-force gram matrix calculation' % (ncores))
+                gram = self.calc_parallel(dummy_calc_ef, self.shared(X_glob, 'global'),
+                                          self.shared(X), (1, 3), ncores,
+                                          kinds=('global', 'local'),
+                                          args=(self.theta, self.type, False, self.dtype,
+                                                self.engine_options()))
 
-                # Way to split the kernels functions to compute evenly across the nodes
-                splitind = np.zeros(ncores + 1)
-                factor = (n + (ncores - 1)) / ncores
-                splitind[1:-1] = [(i + 1) *
-                                  factor for i in range(ncores - 1)]
-                splitind[-1] = n
-                splitind = splitind.astype(int)
-                clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                          self.type, False] for i in range(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-                del confs
-                import multiprocessing as mp
-                pool = mp.Pool(ncores)
-                result = pool.map(dummy_calc_ef, clist)
-                del clist
-                pool.close()
-                pool.join()
-
-                result = np.concatenate(result).ravel()
-                for i in range(X_glob.shape[0]):
-                    for j in range(X.shape[0]):
-                        gram[i, 3 * j:3 * j + 3] = result[3 *
-                                                          (j + i * X.shape[0]):3 + 3*(j + i * X.shape[0])]
-                del result
             else:
-                for i in range(X_glob.shape[0]):
-                    for j in range(X.shape[0]):
+                X, X_glob = self.describe(X), self.describe(X_glob, 'global')
+                for i in range(len(X_glob)):
+                    for j in range(len(X)):
                         for k in X_glob[i]:
                             gram[i, 3 * j:3 * j + 3] += 1/3.0*self.k3_ef(
                                 k, X[j], self.theta[0], self.theta[1], self.theta[2])
@@ -522,8 +1164,8 @@ class BaseThreeBody(Kernel, metaclass=ABCMeta):
 
     @staticmethod
     @abstractmethod
-    def compile_theano():
-        return None, None, None
+    def compile_theano(names, dtype='float64'):
+        return {}
 
 
 class ThreeBodySingleSpeciesKernel(BaseThreeBody):
@@ -533,15 +1175,26 @@ class ThreeBodySingleSpeciesKernel(BaseThreeBody):
         theta[0] (float): lengthscale of the kernel
         theta[1] (float): decay rate of the cutoff function
         theta[2] (float): cutoff radius
+        engine (str): "theano" (default), "numpy" or "numba" for the triplet descriptor engines
+        max_memory (int): memory ceiling in bytes of a kernel call with the numpy engine
+        sum_cache (BlockCache): cache of the 3-body sums with the numpy or numba engine,
+            shared with the other kernels it is given to, see ``cached_triplet_kernel``
+        dtype (str): "float64" (default) or "float32" for single-precision kernels
+        window_tol (float): tolerance below which the pairs of triplets are skipped,
+            with the numpy or numba engine, see ``triplet_kernel``
 
     """
 
-    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-2, 1e2), (1e-2, 1e2))):
-        super().__init__(kernel_name='ThreeBodySingleSpecies', theta=theta, bounds=bounds)
+    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-2, 1e2), (1e-2, 1e2)),
+                 engine='theano', max_memory=2**28, sum_cache=None, dtype='float64',
+                 window_tol=None):
+        super().__init__(kernel_name='ThreeBodySingleSpecies', theta=theta, bounds=bounds,
+                         engine=engine, max_memory=max_memory, sum_cache=sum_cache, dtype=dtype,
+                         window_tol=window_tol)
         self.type = "single"
 
     @staticmethod
-    def compile_theano():
+    def compile_theano(names, dtype='float64'):
         """
         This function generates theano compiled kernels for energy and force learning
         ker_jkmn_withcutoff = ker_jkmn #* cutoff_ikmn
@@ -549,193 +1202,128 @@ class ThreeBodySingleSpeciesKernel(BaseThreeBody):
         The position of the atoms relative to the centrla one, and their chemical species
         are defined by a matrix of dimension Mx5
 
+        Args:
+            names (list): names of the functions to compile, e.g. "k3_ee"
+            dtype (str): "float64" or "float32", precision of the compiled functions
+
         Returns:
-            k3_ee (func): energy-energy kernel
-            k3_ef (func): energy-force kernel
-            k3_ff (func): force-force kernel
+            functions (dict): the compiled theano functions, by name
         """
-        if not (os.path.exists(Mffpath / 'k3_ee_s.pickle') and
-                os.path.exists(Mffpath / 'k3_ef_s.pickle') and os.path.exists(Mffpath / 'k3_ff_s.pickle')):
-            print("Building Kernels")
-
-            import theano.tensor as T
-            from theano import function, scan
-            logger.info("Started compilation of theano three body kernels")
-
-            # --------------------------------------------------
-            # INITIAL DEFINITIONS
-            # --------------------------------------------------
-
-            # positions of central atoms
-            r1, r2 = T.dvectors('r1d', 'r2d')
-            # positions of neighbours
-            rho1, rho2 = T.dmatrices('rho1', 'rho2')
-            # hyperparameter
-            sig = T.dscalar('sig')
-            # cutoff hyperparameters
-            theta = T.dscalar('theta')
-            rc = T.dscalar('rc')
-
-            # positions of neighbours without chemical species
-
-            rho1s = rho1[:, 0:3]
-            rho2s = rho2[:, 0:3]
-
-            # --------------------------------------------------
-            # RELATIVE DISTANCES TO CENTRAL VECTOR AND BETWEEN NEIGHBOURS
-            # --------------------------------------------------
-
-            # first and second configuration
-            r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
-            r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
-            rjk = T.sqrt(
-                T.sum((rho1s[None, :, :] - rho1s[:, None, :]) ** 2, axis=2))
-            rmn = T.sqrt(
-                T.sum((rho2s[None, :, :] - rho2s[:, None, :]) ** 2, axis=2))
-
-            # --------------------------------------------------
-            # BUILD THE KERNEL
-            # --------------------------------------------------
-
-            # Squared exp of differences
-            se_1j2m = T.exp(-(r1j[:, None] - r2m[None, :])
-                            ** 2 / (2 * sig ** 2))
-            se_jkmn = T.exp(-(rjk[:, :, None, None] -
-                              rmn[None, None, :, :]) ** 2 / (2 * sig ** 2))
-            se_jk2m = T.exp(-(rjk[:, :, None] -
-                              r2m[None, None, :]) ** 2 / (2 * sig ** 2))
-            se_1jmn = T.exp(-(r1j[:, None, None] -
-                              rmn[None, :, :]) ** 2 / (2 * sig ** 2))
-
-            # Kernel not summed (cyclic permutations)
-            k1n = (se_1j2m[:, None, :, None] *
-                   se_1j2m[None, :, None, :] * se_jkmn)
-            k2n = (se_1jmn[:, None, :, :] * se_jk2m[:, :,
-                                                    None, :] * se_1j2m[None, :, :, None])
-            k3n = (se_1j2m[:, None, None, :] *
-                   se_jk2m[:, :, :, None] * se_1jmn[None, :, :, :])
-
-            # final shape is M1 M1 M2 M2
-            ker = k1n + k2n + k3n
-
-            cut_j = 0.5*(1+T.cos(np.pi*r1j/rc))*((T.sgn(rc-r1j) + 1) / 2)
-            cut_m = 0.5*(1+T.cos(np.pi*r2m/rc))*((T.sgn(rc-r2m) + 1) / 2)
-
-            cut_jk = cut_j[:,None]*cut_j[None,:]*0.5*(1+T.cos(np.pi*rjk/rc))*((T.sgn(rc-rjk) + 1) / 2)
-            cut_mn = cut_m[:,None]*cut_m[None,:]*0.5*(1+T.cos(np.pi*rmn/rc))*((T.sgn(rc-rmn) + 1) / 2)
-            
-            # --------------------------------------------------
-            # REMOVE DIAGONAL ELEMENTS AND ADD CUTOFF
-            # --------------------------------------------------
-
-            # remove diagonal elements AND lower triangular ones from first configuration
-            mask_jk = T.triu(T.ones_like(rjk)) - T.identity_like(rjk)
-
-            # remove diagonal elements from second configuration
-            mask_mn = T.ones_like(rmn) - T.identity_like(rmn)
-
-            # Combine masks
-            mask_jkmn = mask_jk[:, :, None, None] * mask_mn[None, None, :, :]
-
-            # Apply mask and then apply cutoff functions
-            ker = ker * mask_jkmn
-            ker = T.sum(ker * cut_jk[:, :, None, None]
-                        * cut_mn[None, None, :, :])
-
-            # --------------------------------------------------
-            # FINAL FUNCTIONS
-            # --------------------------------------------------
-
-            # global energy energy kernel
-            k_ee_fun = function(
-                [r1, r2, rho1, rho2, sig, theta, rc], ker, on_unused_input='ignore')
-
-            # global energy force kernel
-            k_ef = T.grad(ker, r2)
-            k_ef_fun = function(
-                [r1, r2, rho1, rho2, sig, theta, rc], k_ef, on_unused_input='ignore')
-
-            # local force force kernel
-            k_ff = T.grad(ker, r1)
-            k_ff_der, updates = scan(lambda j, k_ff, r2: T.grad(k_ff[j], r2),
-                                     sequences=T.arange(k_ff.shape[0]), non_sequences=[k_ff, r2])
-            k_ff_fun = function(
-                [r1, r2, rho1, rho2, sig, theta, rc], k_ff_der, on_unused_input='ignore')
-
-            # Save the function that we want to use for multiprocessing
-            # This is necessary because theano is a crybaby and does not want to access the
-            # Automaticallly stored compiled object from different processes
-            with open(Mffpath / 'k3_ee_s.pickle', 'wb') as f:
-                pickle.dump(k_ee_fun, f)
-            with open(Mffpath / 'k3_ef_s.pickle', 'wb') as f:
-                pickle.dump(k_ef_fun, f)
-            with open(Mffpath / 'k3_ff_s.pickle', 'wb') as f:
-                pickle.dump(k_ff_fun, f)
 
-        else:
-            print("Loading Kernels")
-            with open(Mffpath / "k3_ee_s.pickle", 'rb') as f:
-                k_ee_fun = pickle.load(f)
-            with open(Mffpath / "k3_ef_s.pickle", 'rb') as f:
-                k_ef_fun = pickle.load(f)
-            with open(Mffpath / "k3_ff_s.pickle", 'rb') as f:
-                k_ff_fun = pickle.load(f)
-
-        # WRAPPERS (we don't want to plug the position of the central element every time)
-        def k3_ee(conf1, conf2, sig, theta, rc):
-            """
-            Three body kernel for global energy-energy correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
-
-            Returns:
-                kernel (float): scalar valued energy-energy 3-body kernel
-
-            """
-            return k_ee_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
-
-        def k3_ef(conf1, conf2, sig, theta, rc):
-            """
-            Three body kernel for global energy-force correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
-
-            Returns:
-                kernel (array): 3x1 energy-force 3-body kernel
-
-            """
-            return -k_ef_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
-
-        def k3_ff(conf1, conf2, sig, theta, rc):
-            """
-            Three body kernel for local force-force correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
-
-            Returns:
-                kernel (matrix): 3x3 force-force 3-body kernel
-
-            """
-            return k_ff_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
+        import theano.tensor as T
+        from theano import function, scan
+        logger.info("Started compilation of theano three body kernels")
+
+        # --------------------------------------------------
+        # INITIAL DEFINITIONS
+        # --------------------------------------------------
+
+        # positions of central atoms
+        r1, r2 = T.vectors('r1d', 'r2d')
+        # positions of neighbours
+        rho1, rho2 = T.matrices('rho1', 'rho2')
+        # hyperparameter
+        sig = T.scalar('sig')
+        # cutoff hyperparameters
+        theta = T.scalar('theta')
+        rc = T.scalar('rc')
+
+        # positions of neighbours without chemical species
+
+        rho1s = rho1[:, 0:3]
+        rho2s = rho2[:, 0:3]
+
+        # --------------------------------------------------
+        # RELATIVE DISTANCES TO CENTRAL VECTOR AND BETWEEN NEIGHBOURS
+        # --------------------------------------------------
+
+        # first and second configuration
+        r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
+        r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
+        rjk = T.sqrt(
+            T.sum((rho1s[None, :, :] - rho1s[:, None, :]) ** 2, axis=2))
+        rmn = T.sqrt(
+            T.sum((rho2s[None, :, :] - rho2s[:, None, :]) ** 2, axis=2))
+
+        # --------------------------------------------------
+        # BUILD THE KERNEL
+        # --------------------------------------------------
+
+        # Squared exp of differences
+        se_1j2m = T.exp(-(r1j[:, None] - r2m[None, :])
+                        ** 2 / (2 * sig ** 2))
+        se_jkmn = T.exp(-(rjk[:, :, None, None] -
+                          rmn[None, None, :, :]) ** 2 / (2 * sig ** 2))
+        se_jk2m = T.exp(-(rjk[:, :, None] -
+                          r2m[None, None, :]) ** 2 / (2 * sig ** 2))
+        se_1jmn = T.exp(-(r1j[:, None, None] -
+                          rmn[None, :, :]) ** 2 / (2 * sig ** 2))
+
+        # Kernel not summed (cyclic permutations)
+        k1n = (se_1j2m[:, None, :, None] *
+               se_1j2m[None, :, None, :] * se_jkmn)
+        k2n = (se_1jmn[:, None, :, :] * se_jk2m[:, :,
+                                                None, :] * se_1j2m[None, :, :, None])
+        k3n = (se_1j2m[:, None, None, :] *
+               se_jk2m[:, :, :, None] * se_1jmn[None, :, :, :])
+
+        # final shape is M1 M1 M2 M2
+        ker = k1n + k2n + k3n
+
+        cut_j = 0.5*(1+T.cos(np.pi*r1j/rc))*((T.sgn(rc-r1j) + 1) / 2)
+        cut_m = 0.5*(1+T.cos(np.pi*r2m/rc))*((T.sgn(rc-r2m) + 1) / 2)
+
+        cut_jk = cut_j[:,None]*cut_j[None,:]*0.5*(1+T.cos(np.pi*rjk/rc))*((T.sgn(rc-rjk) + 1) / 2)
+        cut_mn = cut_m[:,None]*cut_m[None,:]*0.5*(1+T.cos(np.pi*rmn/rc))*((T.sgn(rc-rmn) + 1) / 2)
+        
+        # --------------------------------------------------
+        # REMOVE DIAGONAL ELEMENTS AND ADD CUTOFF
+        # --------------------------------------------------
+
+        # remove diagonal elements AND lower triangular ones from first configuration
+        mask_jk = T.triu(T.ones_like(rjk)) - T.identity_like(rjk)
+
+        # remove diagonal elements from second configuration
+        mask_mn = T.ones_like(rmn) - T.identity_like(rmn)
+
+        # Combine masks
+        mask_jkmn = mask_jk[:, :, None, None] * mask_mn[None, None, :, :]
+
+        # Apply mask and then apply cutoff functions
+        ker = ker * mask_jkmn
+        ker = T.sum(ker * cut_jk[:, :, None, None]
+                    * cut_mn[None, None, :, :])
+
+        # --------------------------------------------------
+        # FINAL FUNCTIONS
+        # --------------------------------------------------
+
+        functions = {}
+        # global energy energy kernel
+        if 'k3_ee' in names:
+            functions['k3_ee'] = function(
+                [r1, r2, rho1, rho2, sig, theta, rc], ker, on_unused_input='ignore',
+                allow_input_downcast=True)
+
+        # global energy force kernel
+        k_ef = T.grad(ker, r2)
+        if 'k3_ef' in names:
+            functions['k3_ef'] = function(
+                [r1, r2, rho1, rho2, sig, theta, rc], k_ef, on_unused_input='ignore',
+                allow_input_downcast=True)
+
+        # local force force kernel
+        k_ff = T.grad(ker, r1)
+        k_ff_der, updates = scan(lambda j, k_ff, r2: T.grad(k_ff[j], r2),
+                                 sequences=T.arange(k_ff.shape[0]), non_sequences=[k_ff, r2])
+        if 'k3_ff' in names:
+            functions['k3_ff'] = function(
+                [r1, r2, rho1, rho2, sig, theta, rc], k_ff_der, on_unused_input='ignore',
+                allow_input_downcast=True)
 
         logger.info("Ended compilation of theano three body kernels")
 
-        return k3_ee, k3_ef, k3_ff
+        return functions
 
 
 class ThreeBodyManySpeciesKernel(BaseThreeBody):
@@ -745,15 +1333,31 @@ class ThreeBodyManySpeciesKernel(BaseThreeBody):
         theta[0] (float): lengthscale of the kernel
         theta[1] (float): decay rate of the cutoff function
         theta[2] (float): cutoff radius
+        engine (str): "theano" (default), "numpy" or "numba" for the triplet descriptor engines
+        max_memory (int): memory ceiling in bytes of a kernel call with the numpy engine
+        species_sorted (bool): evaluate only the triplets with matching species, grouped
+            by species once per configuration, with the numpy engine
+        sum_cache (BlockCache): cache of the 3-body sums with the numpy or numba engine,
+            shared with the other kernels it is given to, see ``cached_triplet_kernel``
+        dtype (str): "float64" (default) or "float32" for single-precision kernels
+        window_tol (float): tolerance below which the pairs of triplets are skipped,
+            with the numpy or numba engine, see ``triplet_kernel``
 
     """
 
-    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-2, 1e2), (1e-2, 1e2))):
-        super().__init__(kernel_name='ThreeBodyManySpecies', theta=theta, bounds=bounds)
+    cutoff_steps = (False, True)
+    species_zeros = True
+
+    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-2, 1e2), (1e-2, 1e2)),
+                 engine='theano', max_memory=2**28, species_sorted=False, sum_cache=None,
+                 dtype='float64', window_tol=None):
+        super().__init__(kernel_name='ThreeBodyManySpecies', theta=theta, bounds=bounds,
+                         engine=engine, max_memory=max_memory, species_sorted=species_sorted,
+                         sum_cache=sum_cache, dtype=dtype, window_tol=window_tol)
         self.type = "multi"
 
     @staticmethod
-    def compile_theano():
+    def compile_theano(names, dtype='float64'):
         """
         This function generates theano compiled kernels for energy and force learning
         ker_jkmn_withcutoff = ker_jkmn #* cutoff_ikmn
@@ -761,242 +1365,175 @@ class ThreeBodyManySpeciesKernel(BaseThreeBody):
         The position of the atoms relative to the centrla one, and their chemical species
         are defined by a matrix of dimension Mx5
 
+        Args:
+            names (list): names of the functions to compile, e.g. "k3_ee"
+            dtype (str): "float64" or "float32", precision of the compiled functions
+
         Returns:
-            k3_ee (func): energy-energy kernel
-            k3_ef (func): energy-force kernel
-            k3_ff (func): force-force kernel
+            functions (dict): the compiled theano functions, by name
         """
 
         logger.info("Started compilation of theano three body kernels")
 
-        if not (os.path.exists(Mffpath / 'k3_ee_m.pickle') and
-                os.path.exists(Mffpath / 'k3_ef_m.pickle') and os.path.exists(Mffpath / 'k3_ff_m.pickle')):
-            print("Building Kernels")
-
-            import theano.tensor as T
-            from theano import function, scan
-
-            # --------------------------------------------------
-            # INITIAL DEFINITIONS
-            # --------------------------------------------------
-
-            # positions of central atoms
-            r1, r2 = T.dvectors('r1d', 'r2d')
-            # positions of neighbours
-            rho1, rho2 = T.dmatrices('rho1', 'rho2')
-            # hyperparameter
-            sig = T.dscalar('sig')
-            # cutoff hyperparameters
-            theta = T.dscalar('theta')
-            rc = T.dscalar('rc')
-
-            # positions of neighbours without chemical species
-
-            rho1s = rho1[:, 0:3]
-            rho2s = rho2[:, 0:3]
-
-            alpha_1 = rho1[:, 3].flatten()
-            alpha_2 = rho2[:, 3].flatten()
-
-            alpha_j = rho1[:, 4].flatten()
-            alpha_m = rho2[:, 4].flatten()
-
-            alpha_k = rho1[:, 4].flatten()
-            alpha_n = rho2[:, 4].flatten()
-
-            # --------------------------------------------------
-            # RELATIVE DISTANCES TO CENTRAL VECTOR AND BETWEEN NEIGHBOURS
-            # --------------------------------------------------
-
-            # first and second configuration
-            r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
-            r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
-            rjk = T.sqrt(
-                T.sum((rho1s[None, :, :] - rho1s[:, None, :]) ** 2, axis=2))
-            rmn = T.sqrt(
-                T.sum((rho2s[None, :, :] - rho2s[:, None, :]) ** 2, axis=2))
-
-            # --------------------------------------------------
-            # CHEMICAL SPECIES MASK
-            # --------------------------------------------------
-
-            # numerical kronecker
-            def delta_alpha2(a1j, a2m):
-                d = np.exp(-(a1j - a2m) ** 2 / (2 * 0.00001 ** 2))
-                return d
-
-            # permutation 1
-
-            delta_alphas12 = delta_alpha2(alpha_1[0], alpha_2[0])
-            delta_alphasjm = delta_alpha2(alpha_j[:, None], alpha_m[None, :])
-            delta_alphas_jmkn = delta_alphasjm[:, None,
-                                               :, None] * delta_alphasjm[None, :, None, :]
-
-            delta_perm1 = delta_alphas12 * delta_alphas_jmkn
-
-            # permutation 3
-            delta_alphas1m = delta_alpha2(
-                alpha_1[0, None], alpha_m[None, :]).flatten()
-            delta_alphasjn = delta_alpha2(alpha_j[:, None], alpha_n[None, :])
-            delta_alphask2 = delta_alpha2(
-                alpha_k[:, None], alpha_2[None, 0]).flatten()
-
-            delta_perm3 = delta_alphas1m[None, None, :, None] * delta_alphasjn[:, None, None, :] * \
-                delta_alphask2[None, :, None, None]
-
-            # permutation 5
-            delta_alphas1n = delta_alpha2(
-                alpha_1[0, None], alpha_n[None, :]).flatten()
-            delta_alphasj2 = delta_alpha2(
-                alpha_j[:, None], alpha_2[None, 0]).flatten()
-            delta_alphaskm = delta_alpha2(alpha_k[:, None], alpha_m[None, :])
-
-            delta_perm5 = delta_alphas1n[None, None, None, :] * delta_alphaskm[None, :, :, None] * \
-                delta_alphasj2[:, None, None, None]
-
-            # --------------------------------------------------
-            # BUILD THE KERNEL
-            # --------------------------------------------------
-
-            # Squared exp of differences
-            se_1j2m = T.exp(-(r1j[:, None] - r2m[None, :])
-                            ** 2 / (2 * sig ** 2))
-            se_jkmn = T.exp(-(rjk[:, :, None, None] -
-                              rmn[None, None, :, :]) ** 2 / (2 * sig ** 2))
-            se_jk2m = T.exp(-(rjk[:, :, None] -
-                              r2m[None, None, :]) ** 2 / (2 * sig ** 2))
-            se_1jmn = T.exp(-(r1j[:, None, None] -
-                              rmn[None, :, :]) ** 2 / (2 * sig ** 2))
-
-            # Kernel not summed (cyclic permutations)
-            k1n = (se_1j2m[:, None, :, None] *
-                   se_1j2m[None, :, None, :] * se_jkmn)
-            k2n = (se_1jmn[:, None, :, :] * se_jk2m[:, :,
-                                                    None, :] * se_1j2m[None, :, :, None])
-            k3n = (se_1j2m[:, None, None, :] *
-                   se_jk2m[:, :, :, None] * se_1jmn[None, :, :, :])
-
-            # final shape is M1 M1 M2 M2
-
-            ker_loc = k1n * delta_perm1 + k2n * delta_perm3 + k3n * delta_perm5
-
-            # Faster version of cutoff (less calculations)
-            cut_j = 0.5*(1+T.cos(np.pi*r1j/rc))#*((T.sgn(rc-r1j) + 1) / 2)
-            cut_m = 0.5*(1+T.cos(np.pi*r2m/rc))#*((T.sgn(rc-r2m) + 1) / 2)
-
-            cut_jk = cut_j[:,None]*cut_j[None,:]*0.5*(1+T.cos(np.pi*rjk/rc))*((T.sgn(rc-rjk) + 1) / 2)
-            cut_mn = cut_m[:,None]*cut_m[None,:]*0.5*(1+T.cos(np.pi*rmn/rc))*((T.sgn(rc-rmn) + 1) / 2)
-
-
-            # --------------------------------------------------
-            # REMOVE DIAGONAL ELEMENTS
-            # --------------------------------------------------
-
-            # remove diagonal elements AND lower triangular ones from first configuration
-            mask_jk = T.triu(T.ones_like(rjk)) - T.identity_like(rjk)
-
-            # remove diagonal elements from second configuration
-            mask_mn = T.ones_like(rmn) - T.identity_like(rmn)
-
-            # Combine masks
-            mask_jkmn = mask_jk[:, :, None, None] * mask_mn[None, None, :, :]
-
-            # Apply mask and then apply cutoff functions
-            ker_loc = ker_loc * mask_jkmn
-            ker_loc = T.sum(
-                ker_loc * cut_jk[:, :, None, None] * cut_mn[None, None, :, :])
-
-            # --------------------------------------------------
-            # FINAL FUNCTIONS
-            # --------------------------------------------------
-
-            # energy energy kernel
-            k_ee_fun = function(
-                [r1, r2, rho1, rho2, sig, theta, rc], ker_loc, on_unused_input='ignore')
-
-            # energy force kernel
-            k_ef_cut = T.grad(ker_loc, r2)
-            k_ef_fun = function(
-                [r1, r2, rho1, rho2, sig, theta, rc], k_ef_cut, on_unused_input='ignore')
-
-            # force force kernel
-            k_ff_cut = T.grad(ker_loc, r1)
-            k_ff_cut_der, updates = scan(lambda j, k_ff_cut, r2: T.grad(k_ff_cut[j], r2),
-                                         sequences=T.arange(k_ff_cut.shape[0]), non_sequences=[k_ff_cut, r2])
-            k_ff_fun = function(
-                [r1, r2, rho1, rho2, sig, theta, rc], k_ff_cut_der, on_unused_input='ignore')
-
-            # Save the function that we want to use for multiprocessing
-            # This is necessary because theano is a crybaby and does not want to access the
-            # Automaticallly stored compiled object from different processes
-            with open(Mffpath / 'k3_ee_m.pickle', 'wb') as f:
-                pickle.dump(k_ee_fun, f)
-            with open(Mffpath / 'k3_ef_m.pickle', 'wb') as f:
-                pickle.dump(k_ef_fun, f)
-            with open(Mffpath / 'k3_ff_m.pickle', 'wb') as f:
-                pickle.dump(k_ff_fun, f)
-
-        else:
-            print("Loading Kernels")
-            with open(Mffpath / "k3_ee_m.pickle", 'rb') as f:
-                k_ee_fun = pickle.load(f)
-            with open(Mffpath / "k3_ef_m.pickle", 'rb') as f:
-                k_ef_fun = pickle.load(f)
-            with open(Mffpath / "k3_ff_m.pickle", 'rb') as f:
-                k_ff_fun = pickle.load(f)
-
-        # WRAPPERS (we don't want to plug the position of the central element every time)
-        def k3_ee(conf1, conf2, sig, theta, rc):
-            """
-            Three body kernel for energy-energy correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
-
-            Returns:
-                kernel (float): scalar valued energy-energy 3-body kernel
-
-            """
-            return k_ee_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
-
-        def k3_ef(conf1, conf2, sig, theta, rc):
-            """
-            Three body kernel for energy-force correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
-
-            Returns:
-                kernel (array): 3x1 energy-force 3-body kernel
-
-            """
-            return -k_ef_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
-
-        def k3_ff(conf1, conf2, sig, theta, rc):
-            """
-            Three body kernel for force-force correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
-
-            Returns:
-                kernel (matrix): 3x3 force-force 3-body kernel
-
-            """
-            return k_ff_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
+        import theano.tensor as T
+        from theano import function, scan
+
+        # --------------------------------------------------
+        # INITIAL DEFINITIONS
+        # --------------------------------------------------
+
+        # positions of central atoms
+        r1, r2 = T.vectors('r1d', 'r2d')
+        # positions of neighbours
+        rho1, rho2 = T.matrices('rho1', 'rho2')
+        # hyperparameter
+        sig = T.scalar('sig')
+        # cutoff hyperparameters
+        theta = T.scalar('theta')
+        rc = T.scalar('rc')
+
+        # positions of neighbours without chemical species
+
+        rho1s = rho1[:, 0:3]
+        rho2s = rho2[:, 0:3]
+
+        alpha_1 = rho1[:, 3].flatten()
+        alpha_2 = rho2[:, 3].flatten()
+
+        alpha_j = rho1[:, 4].flatten()
+        alpha_m = rho2[:, 4].flatten()
+
+        alpha_k = rho1[:, 4].flatten()
+        alpha_n = rho2[:, 4].flatten()
+
+        # --------------------------------------------------
+        # RELATIVE DISTANCES TO CENTRAL VECTOR AND BETWEEN NEIGHBOURS
+        # --------------------------------------------------
+
+        # first and second configuration
+        r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
+        r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
+        rjk = T.sqrt(
+            T.sum((rho1s[None, :, :] - rho1s[:, None, :]) ** 2, axis=2))
+        rmn = T.sqrt(
+            T.sum((rho2s[None, :, :] - rho2s[:, None, :]) ** 2, axis=2))
+
+        # --------------------------------------------------
+        # CHEMICAL SPECIES MASK
+        # --------------------------------------------------
+
+        # numerical kronecker
+        def delta_alpha2(a1j, a2m):
+            d = np.exp(-(a1j - a2m) ** 2 / (2 * 0.00001 ** 2))
+            return d
+
+        # permutation 1
+
+        delta_alphas12 = delta_alpha2(alpha_1[0], alpha_2[0])
+        delta_alphasjm = delta_alpha2(alpha_j[:, None], alpha_m[None, :])
+        delta_alphas_jmkn = delta_alphasjm[:, None,
+                                           :, None] * delta_alphasjm[None, :, None, :]
+
+        delta_perm1 = delta_alphas12 * delta_alphas_jmkn
+
+        # permutation 3
+        delta_alphas1m = delta_alpha2(
+            alpha_1[0, None], alpha_m[None, :]).flatten()
+        delta_alphasjn = delta_alpha2(alpha_j[:, None], alpha_n[None, :])
+        delta_alphask2 = delta_alpha2(
+            alpha_k[:, None], alpha_2[None, 0]).flatten()
+
+        delta_perm3 = delta_alphas1m[None, None, :, None] * delta_alphasjn[:, None, None, :] * \
+            delta_alphask2[None, :, None, None]
+
+        # permutation 5
+        delta_alphas1n = delta_alpha2(
+            alpha_1[0, None], alpha_n[None, :]).flatten()
+        delta_alphasj2 = delta_alpha2(
+            alpha_j[:, None], alpha_2[None, 0]).flatten()
+        delta_alphaskm = delta_alpha2(alpha_k[:, None], alpha_m[None, :])
+
+        delta_perm5 = delta_alphas1n[None, None, None, :] * delta_alphaskm[None, :, :, None] * \
+            delta_alphasj2[:, None, None, None]
+
+        # --------------------------------------------------
+        # BUILD THE KERNEL
+        # --------------------------------------------------
+
+        # Squared exp of differences
+        se_1j2m = T.exp(-(r1j[:, None] - r2m[None, :])
+                        ** 2 / (2 * sig ** 2))
+        se_jkmn = T.exp(-(rjk[:, :, None, None] -
+                          rmn[None, None, :, :]) ** 2 / (2 * sig ** 2))
+        se_jk2m = T.exp(-(rjk[:, :, None] -
+                          r2m[None, None, :]) ** 2 / (2 * sig ** 2))
+        se_1jmn = T.exp(-(r1j[:, None, None] -
+                          rmn[None, :, :]) ** 2 / (2 * sig ** 2))
+
+        # Kernel not summed (cyclic permutations)
+        k1n = (se_1j2m[:, None, :, None] *
+               se_1j2m[None, :, None, :] * se_jkmn)
+        k2n = (se_1jmn[:, None, :, :] * se_jk2m[:, :,
+                                                None, :] * se_1j2m[None, :, :, None])
+        k3n = (se_1j2m[:, None, None, :] *
+               se_jk2m[:, :, :, None] * se_1jmn[None, :, :, :])
+
+        # final shape is M1 M1 M2 M2
+
+        ker_loc = k1n * delta_perm1 + k2n * delta_perm3 + k3n * delta_perm5
+
+        # Faster version of cutoff (less calculations)
+        cut_j = 0.5*(1+T.cos(np.pi*r1j/rc))#*((T.sgn(rc-r1j) + 1) / 2)
+        cut_m = 0.5*(1+T.cos(np.pi*r2m/rc))#*((T.sgn(rc-r2m) + 1) / 2)
+
+        cut_jk = cut_j[:,None]*cut_j[None,:]*0.5*(1+T.cos(np.pi*rjk/rc))*((T.sgn(rc-rjk) + 1) / 2)
+        cut_mn = cut_m[:,None]*cut_m[None,:]*0.5*(1+T.cos(np.pi*rmn/rc))*((T.sgn(rc-rmn) + 1) / 2)
+
+        # --------------------------------------------------
+        # REMOVE DIAGONAL ELEMENTS
+        # --------------------------------------------------
+
+        # remove diagonal elements AND lower triangular ones from first configuration
+        mask_jk = T.triu(T.ones_like(rjk)) - T.identity_like(rjk)
+
+        # remove diagonal elements from second configuration
+        mask_mn = T.ones_like(rmn) - T.identity_like(rmn)
+
+        # Combine masks
+        mask_jkmn = mask_jk[:, :, None, None] * mask_mn[None, None, :, :]
+
+        # Apply mask and then apply cutoff functions
+        ker_loc = ker_loc * mask_jkmn
+        ker_loc = T.sum(
+            ker_loc * cut_jk[:, :, None, None] * cut_mn[None, None, :, :])
+
+        # --------------------------------------------------
+        # FINAL FUNCTIONS
+        # --------------------------------------------------
+
+        functions = {}
+        # energy energy kernel
+        if 'k3_ee' in names:
+            functions['k3_ee'] = function(
+                [r1, r2, rho1, rho2, sig, theta, rc], ker_loc, on_unused_input='ignore',
+                allow_input_downcast=True)
+
+        # energy force kernel
+        k_ef_cut = T.grad(ker_loc, r2)
+        if 'k3_ef' in names:
+            functions['k3_ef'] = function(
+                [r1, r2, rho1, rho2, sig, theta, rc], k_ef_cut, on_unused_input='ignore',
+                allow_input_downcast=True)
+
+        # force force kernel
+        k_ff_cut = T.grad(ker_loc, r1)
+        k_ff_cut_der, updates = scan(lambda j, k_ff_cut, r2: T.grad(k_ff_cut[j], r2),
+                                     sequences=T.arange(k_ff_cut.shape[0]), non_sequences=[k_ff_cut, r2])
+        if 'k3_ff' in names:
+            functions['k3_ff'] = function(
+                [r1, r2, rho1, rho2, sig, theta, rc], k_ff_cut_der, on_unused_input='ignore',
+                allow_input_downcast=True)
 
         logger.info("Ended compilation of theano three body kernels")
 
-        return k3_ee, k3_ef, k3_ff
+        return functions
@@ -1,112 +1,663 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import os.path
-import pickle
 from abc import ABCMeta, abstractmethod
 
 import numpy as np
 
-from mff.kernels.base import Kernel, Mffpath
+from mff.configurations import PackedConfs
+from mff.kernels import numbaengine
+from mff.kernels.base import Kernel, flatten_segments, load_function, segment_sum
+from mff.kernels.blockcache import cached_blocks
+from mff.kernels.descriptors import cutoff_rc
+from mff.kernels.parallel import mirror_lower
+from mff.kernels.speciesblocks import species_blocks
 
 logger = logging.getLogger(__name__)
 
 
-def dummy_calc_ff(data):
-    """ Function used when multiprocessing.
+def dummy_calc_ff(conf1, conf2, theta, kertype, dtype='float64'):
+    """ Function used when multiprocessing, evaluates the force-force kernel
+    of a single pair.
+
     Args:
-        data (list of objects): contains all the information required
-            for the computation of the kernel values
-    
+        conf1 (array): Mx5 array of the first configuration
+        conf2 (array): Mx5 array of the second configuration
+        theta (list): hyperparameters of the kernel
+        kertype (str): "single" or "multi" species kernel
+        dtype (str): "float64" or "float32", precision of the compiled function
+
     Returns:
-        result (array): the computed kernel values
+        result (array): the computed kernel value
 
     """
 
-    array, theta0, theta1, theta2, kertype = data
-    if kertype == "single":
-        with open(Mffpath / "k2_ff_s.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    elif kertype == "multi":
-        with open(Mffpath / "k2_ff_m.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    result = np.zeros((len(array), 3, 3))
-    for i in np.arange(len(array)):
-        result[i] = fun(np.zeros(3), np.zeros(3), array[i][0],
-                        array[i][1],  theta0, theta1, theta2)
-    return result
+    fun = load_function("k2_ff", kertype, dtype)
+    return fun(np.zeros(3), np.zeros(3), conf1, conf2, theta[0], theta[1], theta[2])
 
 
-def dummy_calc_ee(data):
-    """ Function used when multiprocessing.
+def dummy_calc_ee(x1, x2, theta, kertype, mapping, dtype='float64'):
+    """ Function used when multiprocessing, evaluates the energy-energy kernel
+    of a single pair.
+
     Args:
-        data (list of objects): contains all the information required
-            for the computation of the kernel values
-    
+        x1 (list): configurations of the first snapshot
+        x2 (list): configurations of the second snapshot
+        theta (list): hyperparameters of the kernel
+        kertype (str): "single" or "multi" species kernel
+        mapping (bool): if True the first argument is a local configuration
+        dtype (str): "float64" or "float32", precision of the compiled function
+
     Returns:
-        result (array): the computed kernel values
+        result (float): the computed kernel value
 
     """
 
-    array, theta0, theta1, theta2, kertype, mapping = data
-    if kertype == "single":
-        with open(Mffpath / "k2_ee_s.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    elif kertype == "multi":
-        with open(Mffpath / "k2_ee_m.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    result = np.zeros(len(array))
-
+    fun = load_function("k2_ee", kertype, dtype)
+    result = 0
     if not mapping:
-        for i in np.arange(len(array)):
-            for conf1 in array[i][0]:
-                for conf2 in array[i][1]:
-                    result[i] += 0.25*fun(np.zeros(3), np.zeros(3),
-                                     conf1, conf2, theta0, theta1, theta2)
+        for conf1 in x1:
+            for conf2 in x2:
+                result += 0.25*fun(np.zeros(3), np.zeros(3),
+                                  conf1, conf2, theta[0], theta[1], theta[2])
     else:
-        for i in np.arange(len(array)):
-            for conf2 in array[i][1]:
-                result[i] += 0.5*fun(np.zeros(3), np.zeros(3),
-                                 array[i][0], conf2, theta0, theta1, theta2)
-
+        for conf2 in x2:
+            result += 0.5*fun(np.zeros(3), np.zeros(3),
+                              x1, conf2, theta[0], theta[1], theta[2])
     return result
 
 
-def dummy_calc_ef(data):
-    """ Function used when multiprocessing.
+def dummy_calc_ef(x1, conf2, theta, kertype, mapping, dtype='float64'):
+    """ Function used when multiprocessing, evaluates the energy-force kernel
+    of a single pair.
+
     Args:
-        data (list of objects): contains all the information required
-            for the computation of the kernel values
-    
+        x1 (list): configurations of the first snapshot
+        conf2 (array): Mx5 array of the second configuration
+        theta (list): hyperparameters of the kernel
+        kertype (str): "single" or "multi" species kernel
+        mapping (bool): if True the first argument is a local configuration
+        dtype (str): "float64" or "float32", precision of the compiled function
+
     Returns:
-        result (array): the computed kernel values
+        result (array): the computed kernel value
 
     """
-    
-    array, theta0, theta1, theta2, kertype, mapping = data
-    if kertype == "single":
-        with open(Mffpath / "k2_ef_s.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    elif kertype == "multi":
-        with open(Mffpath / "k2_ef_m.pickle", 'rb') as f:
-            fun = pickle.load(f)
-    result = np.zeros((len(array), 3))
+
+    fun = load_function("k2_ef", kertype, dtype)
+    conf2 = np.array(conf2, dtype='float')
+    result = np.zeros(3)
     if not mapping:
-        for i in np.arange(len(array)):
-            conf2 = np.array(array[i][1], dtype='float')
-            for conf1 in array[i][0]:
-                conf1 = np.array(conf1, dtype='float')
-                result[i] += -0.5*fun(np.zeros(3), np.zeros(3),
-                                  conf1, conf2,  theta0, theta1, theta2)
+        for conf1 in x1:
+            conf1 = np.array(conf1, dtype='float')
+            result += -0.5*fun(np.zeros(3), np.zeros(3), conf1,
+                               conf2, theta[0], theta[1], theta[2])
     else:
-        for i in np.arange(len(array)):
-            conf2 = np.array(array[i][1], dtype='float')
-            conf1 = np.array(array[i][0], dtype='float')
-            result[i] += -fun(np.zeros(3), np.zeros(3), conf1,
-                              conf2,  theta0, theta1, theta2)
+        conf1 = np.array(x1, dtype='float')
+        result += -fun(np.zeros(3), np.zeros(3), conf1,
+                       conf2, theta[0], theta[1], theta[2])
     return result
 
 
+# Maximum number of elements of a single (B1, B2, M1, M2) intermediate used
+# by the batched engine, about 2 MB in double precision so that the tiles stay in cache
+BATCH_MAX_ELEMENTS = 2 ** 18
+
+
+def pad_confs(X, rc, dtype='float64'):
+    """ Pad a list of configurations into dense neighbour arrays
+    that can be used by the batched NumPy engine.
+
+    Args:
+        X (list or PackedConfs): N Mx5 arrays containing xyz coordinates and atomic species
+        rc (float): cutoff radius
+        dtype (str): "float64" or "float32", precision of the padded arrays, and so of
+            the kernels computed from them by ``batch_k2``
+
+    Returns:
+        r (array): N x M_max distances of the neighbours from the central atom
+        u (array): N x M_max x 3 unit vectors pointing from the central atom to the neighbours
+        cut (array): N x M_max values of the cutoff function
+        dcut (array): N x M_max derivatives of the cutoff function
+        alpha_1 (array): N atomic numbers of the central atoms
+        alpha_j (array): N x M_max atomic numbers of the neighbours
+
+    Padded entries have zero cutoff and zero derivative, so that they
+    never contribute to the kernel.
+
+    """
+
+    if isinstance(X, PackedConfs):
+        xyz, alpha_j, mask = X.padded()
+        if xyz.shape[1] == 0:
+            xyz = np.zeros((len(X), 1, 3))
+            alpha_j = np.zeros((len(X), 1))
+            mask = np.zeros((len(X), 1), dtype=bool)
+        r = np.sqrt(np.sum(xyz ** 2, axis=2))
+        u = xyz / np.where(mask, r, 1.)[:, :, None]
+        alpha_1 = X.central.astype('float')
+        alpha_j = alpha_j.astype('float')
+    else:
+        n = len(X)
+        m_max = max([len(x) for x in X] + [1])
+        r = np.zeros((n, m_max))
+        u = np.zeros((n, m_max, 3))
+        alpha_1 = np.zeros(n)
+        alpha_j = np.zeros((n, m_max))
+        mask = np.zeros((n, m_max), dtype=bool)
+
+        for i, x in enumerate(X):
+            x = np.asarray(x, dtype='float')
+            m = len(x)
+            if m == 0:
+                continue
+            r[i, :m] = np.sqrt(np.sum(x[:, 0:3] ** 2, axis=1))
+            u[i, :m] = x[:, 0:3] / r[i, :m, None]
+            alpha_1[i] = x[0, 3]
+            alpha_j[i, :m] = x[:, 4]
+            mask[i, :m] = True
+
+    # Same step function as the theano kernels, (sgn(rc - r) + 1) / 2
+    step = mask * (np.sign(rc - r) + 1) / 2
+    cut = 0.5 * (1 + np.cos(np.pi * r / rc)) * step
+    dcut = -0.5 * np.pi / rc * np.sin(np.pi * r / rc) * step
+
+    return tuple(x.astype(dtype, copy=False) for x in (r, u, cut, dcut, alpha_1, alpha_j))
+
+
+def rc_derivatives(p, rc):
+    """ Block of padded configurations whose cutoff function and derivative are replaced by
+    their derivatives with respect to the cutoff radius, see ``cutoff_rc``. The kernels are
+    bilinear in the cutoffs of the two blocks, so that the derivative of a kernel with
+    respect to rc is the sum of the kernels with either block replaced.
+
+    Args:
+        p (tuple): block of configurations, as returned by ``pad_confs``
+        rc (float): cutoff radius
+
+    Returns:
+        p_rc (tuple): block with the same layout as p
+
+    """
+
+    r, u, cut, dcut, alpha_1, alpha_j = p
+    # padded entries are the only ones at zero distance
+    step = (r > 0) * (np.sign(rc - r) + 1) / 2
+    cut_rc, dcut_rc = cutoff_rc(r, rc, step=False)
+    return r, u, cut_rc * step, dcut_rc * step, alpha_1, alpha_j
+
+
+def batch_k2(p1, p2, sig, kertype, mode):
+    """ Evaluate the 2-body kernel between every pair of configurations
+    of two padded blocks in a single vectorized call.
+
+    Args:
+        p1 (tuple): first block of configurations, as returned by ``pad_confs``
+        p2 (tuple): second block of configurations, as returned by ``pad_confs``
+        sig (float): lengthscale hyperparameter theta[0]
+        kertype (str): "single" or "multi" species kernel
+        mode (str): "ee", "ef" or "ff"
+
+    Returns:
+        ker (array): N1 x N2 energy-energy, N1 x N2 x 3 energy-force or
+            N1 x N2 x 3 x 3 force-force kernel tile
+
+    """
+
+    r1, u1, c1, dc1, a1, aj = p1
+    r2, u2, c2, dc2, a2, am = p2
+
+    d = r1[:, None, :, None] - r2[None, :, None, :]
+    g = np.exp(-d ** 2 / (2 * sig ** 2))
+
+    if kertype == "multi":
+        # chemical species mask, summed over the two possible permutations
+        g = g * (1.0 * (a1[:, None, None, None] == a2[None, :, None, None]) *
+                 (aj[:, None, :, None] == am[None, :, None, :]) +
+                 1.0 * (a1[:, None, None, None] == am[None, :, None, :]) *
+                 (aj[:, None, :, None] == a2[None, :, None, None]))
+
+    c1 = c1[:, None, :, None]
+    c2 = c2[None, :, None, :]
+
+    if mode == "ee":
+        return np.einsum('xyjm,xyjm->xy', g, c1 * c2)
+
+    # derivative of the squared exponential with respect to r1j
+    dg = -d / sig ** 2 * g
+    dc2 = dc2[None, :, None, :]
+
+    if mode == "ef":
+        # minus the derivative with respect to the second central atom
+        h = c1 * (dc2 * g - c2 * dg)
+        return np.einsum('xyjm,ymb->xyb', h, u2)
+
+    dc1 = dc1[:, None, :, None]
+    ddg = (d ** 2 / sig ** 4 - 1 / sig ** 2) * g
+    h = dc1 * dc2 * g - dc1 * c2 * dg + c1 * dc2 * dg - c1 * c2 * ddg
+    return np.einsum('xyjm,xja,ymb->xyab', h, u1, u2)
+
+
+def batch_k2_gradient(p1, p2, sig, rc, kertype):
+    """ Force-force 2-body kernel between every pair of configurations of two padded
+    blocks, together with its derivatives with respect to sig and rc. The squared
+    exponentials and their derivatives are evaluated once and shared by the three.
+
+    The kernel is bilinear in the cutoffs of the two blocks, so that its derivative
+    with respect to rc is the sum of the kernels with the cutoffs of either block
+    replaced by their derivatives, see ``rc_derivatives``.
+
+    Args:
+        p1 (tuple): first block of configurations, as returned by ``pad_confs``
+        p2 (tuple): second block of configurations, as returned by ``pad_confs``
+        sig (float): lengthscale hyperparameter theta[0]
+        rc (float): cutoff distance hyperparameter theta[2]
+        kertype (str): "single" or "multi" species kernel
+
+    Returns:
+        ker (array): 3 x N1 x N2 x 3 x 3 force-force tiles of the kernel and of its
+            derivatives with respect to sig and rc
+
+    """
+
+    r1, u1, c1, dc1, a1, aj = p1
+    r2, u2, c2, dc2, a2, am = p2
+    c1_rc, dc1_rc = rc_derivatives(p1, rc)[2:4]
+    c2_rc, dc2_rc = rc_derivatives(p2, rc)[2:4]
+
+    d = r1[:, None, :, None] - r2[None, :, None, :]
+    g = np.exp(-d ** 2 / (2 * sig ** 2))
+    if kertype == "multi":
+        # chemical species mask, summed over the two possible permutations
+        g = g * (1.0 * (a1[:, None, None, None] == a2[None, :, None, None]) *
+                 (aj[:, None, :, None] == am[None, :, None, :]) +
+                 1.0 * (a1[:, None, None, None] == am[None, :, None, :]) *
+                 (aj[:, None, :, None] == a2[None, :, None, None]))
+
+    # squared exponential and its first two derivatives with respect to r1j,
+    # followed by their derivatives with respect to sig
+    dg = -d / sig ** 2 * g
+    ddg = (d ** 2 / sig ** 4 - 1 / sig ** 2) * g
+    g_sig = g * d ** 2 / sig ** 3
+    dg_sig = -d / sig ** 2 * g_sig + 2 * d / sig ** 3 * g
+    ddg_sig = ((d ** 2 / sig ** 4 - 1 / sig ** 2) * g_sig
+               + (2 / sig ** 3 - 4 * d ** 2 / sig ** 5) * g)
+
+    def hessian(g, dg, ddg, c1, dc1, c2, dc2):
+        c1, dc1 = c1[:, None, :, None], dc1[:, None, :, None]
+        c2, dc2 = c2[None, :, None, :], dc2[None, :, None, :]
+        return dc1 * dc2 * g - dc1 * c2 * dg + c1 * dc2 * dg - c1 * c2 * ddg
+
+    h = np.stack((hessian(g, dg, ddg, c1, dc1, c2, dc2),
+                  hessian(g_sig, dg_sig, ddg_sig, c1, dc1, c2, dc2),
+                  hessian(g, dg, ddg, c1_rc, dc1_rc, c2, dc2) +
+                  hessian(g, dg, ddg, c1, dc1, c2_rc, dc2_rc)))
+    return np.einsum('kxyjm,xja,ymb->kxyab', h, u1, u2, optimize=True)
+
+
+def pair_k2(conf1, conf2, sig, rc, kertype, mode, dtype='float64', engine='numpy'):
+    """ Closed-form 2-body kernel between two configurations, vectorized over
+    the pairs of neighbours. The gradient and hessian with respect to the central
+    atoms are written out analytically, instead of being obtained by automatic
+    differentiation and scan as in the theano graphs.
+
+    Args:
+        conf1 (array): first configuration
+        conf2 (array): second configuration
+        sig (float): lengthscale hyperparameter theta[0]
+        rc (float): cutoff distance hyperparameter theta[2]
+        kertype (str): "single" or "multi" species kernel
+        mode (str): "ee", "ef" or "ff"
+        dtype (str): "float64" or "float32", precision of the computation
+        engine (str): "numpy" or "numba", see ``mff.kernels.numbaengine``
+
+    Returns:
+        ker (float or array): energy-energy value, 3 energy-force or
+            3x3 force-force kernel
+
+    """
+
+    batch = numbaengine.batch_k2 if engine == 'numba' else batch_k2
+    return batch(pad_confs([conf1], rc, dtype), pad_confs([conf2], rc, dtype),
+                 sig, kertype, mode)[0, 0]
+
+
+def species_split(p):
+    """ Sort the neighbours of a block of padded configurations by species, splitting
+    the block in one padded block per species. Neighbours whose cutoff function and
+    derivative vanish are dropped, as they never contribute to the kernel.
+
+    Args:
+        p (tuple): block of configurations, as returned by ``pad_confs``
+
+    Returns:
+        blocks (dict): padded blocks with the same layout as p, by neighbour species
+
+    """
+
+    r, u, cut, dcut, alpha_1, alpha_j = p
+    keep = (cut != 0) | (dcut != 0)
+    blocks = {}
+    for s in np.unique(alpha_j[keep]):
+        sel = keep & (alpha_j == s)
+        # stable sort moving the selected neighbours first, then trimmed to the longest row
+        order = np.argsort(~sel, axis=1, kind='stable')[:, :sel.sum(axis=1).max()]
+        valid = np.take_along_axis(sel, order, axis=1)
+        blocks[s] = (np.take_along_axis(r, order, axis=1),
+                     np.take_along_axis(u, order[:, :, None], axis=1),
+                     np.take_along_axis(cut, order, axis=1) * valid,
+                     np.take_along_axis(dcut, order, axis=1) * valid,
+                     alpha_1, np.take_along_axis(alpha_j, order, axis=1))
+
+    return blocks
+
+
+def sorted_k2(p1, p2, sig, kertype='multi', mode='ee', width=None):
+    """ Many-species 2-body kernel between two blocks of padded configurations,
+    evaluated on the neighbours sorted by species, see ``species_split``.
+
+    Two neighbours j and m contribute when the species of the pairs (1, j) and (2, m)
+    match, in either order, so that only the blocks of neighbour species s and t with
+    s == t and equal central species, or with s and t equal to the swapped central
+    species, are computed. Within each block the species factors are the same for all
+    the neighbours, and the single-species kernel of ``batch_k2`` is used.
+
+    Args:
+        p1 (tuple): first block of configurations, as returned by ``pad_confs``
+        p2 (tuple): second block of configurations, as returned by ``pad_confs``
+        sig (float): lengthscale hyperparameter theta[0]
+        kertype (str): only "multi" is meaningful, kept for the signature of ``batch_k2``
+        mode (str): "ee", "ef" or "ff"
+        width (float): if given, the blocks are evaluated by ``window_k2`` with this width,
+            p2 being sorted by ``sort_neighbours``
+
+    Returns:
+        ker (array): same kernel tile as ``batch_k2``
+
+    """
+
+    a1, a2 = p1[4], p2[4]
+    n1, n2 = len(a1), len(a2)
+    ker = np.zeros({'ee': (n1, n2), 'ef': (n1, n2, 3), 'ff': (n1, n2, 3, 3)}[mode])
+    same = a1[:, None] == a2[None, :]
+    blocks2 = species_split(p2)
+
+    for s, b1 in species_split(p1).items():
+        for t, b2 in blocks2.items():
+            # species factor of the two permutations, one value per couple of configurations
+            w = 1.0 * same * (s == t) + 1.0 * (a1[:, None] == t) * (a2[None, :] == s)
+            rows, cols = np.nonzero(w.any(axis=1))[0], np.nonzero(w.any(axis=0))[0]
+            if len(rows) == 0:
+                continue
+            q1, q2 = tuple(x[rows] for x in b1), tuple(x[cols] for x in b2)
+            if width is None:
+                tile = batch_k2(q1, q2, sig, 'single', mode)
+            else:
+                tile = window_k2(q1, q2, sig, 'single', mode, width)
+            w = w[np.ix_(rows, cols)]
+            ker[np.ix_(rows, cols)] += w.reshape(w.shape + (1,) * (tile.ndim - 2)) * tile
+
+    return ker
+
+
+def window_width(sig, tol):
+    """ Half-width of the window of distances outside which the squared exponential
+    exp(-(r1j - r2m)^2 / (2 sig^2)) is below tol
+
+    Args:
+        sig (float): lengthscale hyperparameter theta[0]
+        tol (float): tolerance, between 0 and 1
+
+    Returns:
+        width (float): the half-width, sig * sqrt(2 log(1 / tol))
+
+    """
+
+    return sig * np.sqrt(2 * np.log(1 / tol))
+
+
+def window_bound(sig, rc, tol, mode, kertype='single'):
+    """ Upper bound on the contribution of a pair of neighbours outside the window of
+    ``window_width`` to a kernel value. The cutoff functions and the unit vectors are
+    at most 1, the derivatives of the cutoff functions at most pi / (2 rc), and the
+    derivatives of the squared exponential are decreasing beyond the window.
+
+    Args:
+        sig (float): lengthscale hyperparameter theta[0]
+        rc (float): cutoff radius theta[2]
+        tol (float): tolerance, between 0 and 1
+        mode (str): "ee", "ef" or "ff"
+        kertype (str): "single" or "multi", the species factor of the latter is at most 2
+
+    Returns:
+        bound (float): the bound, to be multiplied by the number of pairs of neighbours
+
+    """
+
+    k = np.sqrt(2 * np.log(1 / tol))
+    a = np.pi / (2 * rc)
+    bound = {'ee': 1., 'ef': a + k / sig,
+             'ff': a ** 2 + 2 * a * k / sig + (k ** 2 + 1) / sig ** 2}[mode] * tol
+
+    return 2 * bound if kertype == 'multi' else bound
+
+
+def sort_neighbours(p, sentinel):
+    """ Sort the neighbours of each configuration of a block of padded configurations by
+    distance, the neighbours that never contribute to the kernel being moved last with
+    their distance set to sentinel. See ``window_k2``.
+
+    Args:
+        p (tuple): block of configurations, as returned by ``pad_confs``
+        sentinel (float): distance of the padded neighbours, farther than the window
+            from any neighbour within the cutoff
+
+    Returns:
+        p_sorted (tuple): block with the same layout as p
+
+    """
+
+    r, u, cut, dcut, alpha_1, alpha_j = p
+    keep = (cut != 0) | (dcut != 0)
+    r = np.where(keep, r, sentinel)
+    order = np.argsort(r, axis=1, kind='stable')
+
+    return (np.take_along_axis(r, order, axis=1), np.take_along_axis(u, order[:, :, None], axis=1),
+            np.take_along_axis(cut, order, axis=1), np.take_along_axis(dcut, order, axis=1),
+            alpha_1, np.take_along_axis(alpha_j, order, axis=1))
+
+
+def window_k2(p1, p2, sig, kertype, mode, width):
+    """ 2-body kernel between two blocks of padded configurations, restricted to the pairs
+    of neighbours whose distances from the central atoms differ by at most width.
+
+    The neighbours of each configuration of p2 must be sorted by distance, with the
+    ones that never contribute last, see ``sort_neighbours``. The window of each neighbour
+    of p1 is then found with a binary search, and only the neighbours of p2 within it are
+    gathered, so that the dense M1 x M2 sum of ``batch_k2`` becomes M1 x W, W being the
+    largest number of neighbours within a window. Tiles whose windows hold more than
+    half of the neighbours are evaluated by ``batch_k2``.
+
+    Args:
+        p1 (tuple): first block of configurations, as returned by ``pad_confs``
+        p2 (tuple): second block of configurations, sorted by ``sort_neighbours``
+        sig (float): lengthscale hyperparameter theta[0]
+        kertype (str): "single" or "multi" species kernel
+        mode (str): "ee", "ef" or "ff"
+        width (float): half-width of the window, see ``window_width``
+
+    Returns:
+        ker (array): same kernel tile as ``batch_k2``, up to the pairs outside the window
+
+    """
+
+    r1, u1, c1, dc1, a1, aj = p1
+    r2, u2, c2, dc2, a2, am = p2
+    n1, n2, m2 = len(r1), len(r2), r2.shape[1]
+    ker = np.zeros((n1, n2) + {'ee': (), 'ef': (3,), 'ff': (3, 3)}[mode])
+
+    # The rows of p2 are shifted apart, so that one search finds the windows in all of them
+    valid2 = (c2 != 0) | (dc2 != 0)
+    far = max(np.max(r1, initial=0.), np.max(r2, initial=0.)) + width + 1
+    stride = far + 2 * width + 1
+    shift = stride * np.arange(n2)
+    keys = (np.where(valid2, r2, far).astype('float64') + shift[:, None]).ravel()
+    queries = r1[:, None, :] + shift[None, :, None]
+    lo = np.searchsorted(keys, queries - width)
+    count = np.searchsorted(keys, queries + width, side='right') - lo
+    count *= ((c1 != 0) | (dc1 != 0))[:, None, :]
+    w = count.max(initial=0)
+    if w == 0:
+        return ker
+    if 2 * w > m2:
+        # Gathering the windows costs more than the dense sum
+        return batch_k2(p1, p2, sig, kertype, mode)
+
+    inside = np.arange(w) < count[..., None]
+    idx = np.minimum(lo[..., None] + np.arange(w), n2 * m2 - 1)
+    r2, c2, dc2, am = (x.ravel()[idx] for x in (r2, c2, dc2, am))
+
+    d = r1[:, None, :, None] - r2
+    g = np.exp(-d ** 2 / (2 * sig ** 2)) * inside
+
+    if kertype == "multi":
+        # chemical species mask, summed over the two possible permutations
+        g = g * (1.0 * (a1[:, None, None, None] == a2[None, :, None, None]) *
+                 (aj[:, None, :, None] == am) +
+                 1.0 * (a1[:, None, None, None] == am) *
+                 (aj[:, None, :, None] == a2[None, :, None, None]))
+
+    c1 = c1[:, None, :, None]
+    if mode == "ee":
+        return np.einsum('xyjw,xyjw->xy', g, c1 * c2)
+
+    u2 = u2.reshape(-1, 3)[idx]
+    dg = -d / sig ** 2 * g
+    if mode == "ef":
+        h = c1 * (dc2 * g - c2 * dg)
+        return np.einsum('xyjw,xyjwb->xyb', h, u2)
+
+    dc1 = dc1[:, None, :, None]
+    ddg = (d ** 2 / sig ** 4 - 1 / sig ** 2) * g
+    h = dc1 * dc2 * g - dc1 * c2 * dg + c1 * dc2 * dg - c1 * c2 * ddg
+    return np.einsum('xyjw,xja,xyjwb->xyab', h, u1, u2)
+
+
+def pair_codes(*blocks):
+    """ Species pairs (central atom, neighbour) of blocks of padded configurations,
+    completed with the swapped pairs
+
+    Args:
+        blocks (tuple): blocks of configurations, as returned by ``pad_confs``
+
+    Returns:
+        codes (array): sorted codes of the species pairs, see ``pair_code``
+        swap (array): index in codes of the swapped pair of each pair
+
+    """
+
+    pairs = [np.stack(np.broadcast_arrays(p[4][:, None], p[5]), axis=-1)[p[2] != 0]
+             for p in blocks]
+    pairs = np.concatenate(pairs + [np.zeros((0, 2))])
+    codes = np.unique(np.concatenate((pair_code(pairs[:, 0], pairs[:, 1]),
+                                      pair_code(pairs[:, 1], pairs[:, 0]))))
+    swap = np.searchsorted(codes, pair_code(*np.divmod(codes, 1024)[::-1]))
+
+    return codes, swap
+
+
+def pair_code(alpha_1, alpha_j):
+    """ Integer code of the species pairs (alpha_1, alpha_j), for atomic numbers below 1024 """
+    return np.asarray(alpha_1, dtype=int) * 1024 + np.asarray(alpha_j, dtype=int)
+
+
+def pair_histograms(p, offsets, rc, width, codes=None):
+    """ Histograms of the distances of the neighbours of the global configurations,
+    weighted by the cutoff function and resolved by species pair.
+
+    Each distance is shared between the two closest grid points of spacing width, in
+    proportion to its distance from the other one, so that the kernels computed from
+    the histograms interpolate the squared exponential linearly between the grid points.
+
+    Args:
+        p (tuple): local configurations, as returned by ``pad_confs``
+        offsets (array): offsets of the global configurations in p, see
+            ``flatten_segments``, or None to keep the local configurations
+        rc (float): cutoff radius
+        width (float): spacing of the grid
+        codes (array): species pairs of the histograms, see ``pair_codes``, or None for
+            a single histogram per configuration
+
+    Returns:
+        h (array): N x S x B histograms, S being the number of species pairs and B the
+            number of grid points, ceil(rc / width) + 2
+
+    """
+
+    r, u, cut, dcut, alpha_1, alpha_j = p
+    if offsets is None:
+        offsets = np.arange(len(r) + 1)
+    n = len(offsets) - 1
+    n_pairs = 1 if codes is None else len(codes)
+    n_bins = int(np.ceil(rc / width)) + 2
+
+    owner = np.repeat(np.arange(n), np.diff(offsets))[:, None]
+    sel = np.nonzero(cut != 0)
+    x = r[sel] / width
+    b = np.floor(x).astype(int)
+    f = x - b
+    if codes is None:
+        s = np.zeros(len(b), dtype=int)
+    else:
+        s = np.searchsorted(codes, pair_code(alpha_1[sel[0]], alpha_j[sel]))
+    index = (np.broadcast_to(owner, r.shape)[sel] * n_pairs + s) * n_bins + b
+    w = cut[sel].astype('float64')
+    h = (np.bincount(index, w * (1 - f), minlength=n * n_pairs * n_bins) +
+         np.bincount(index + 1, w * f, minlength=n * n_pairs * n_bins))
+
+    return h.reshape(n, n_pairs, n_bins)
+
+
+def smoothing_matrix(n_bins, width, sig):
+    """ Squared exponential kernel between the points of a grid
+
+    Args:
+        n_bins (int): number of grid points
+        width (float): spacing of the grid
+        sig (float): lengthscale hyperparameter theta[0]
+
+    Returns:
+        G (array): n_bins x n_bins matrix
+
+    """
+
+    x = width * np.arange(n_bins)
+    return np.exp(-(x[:, None] - x[None, :]) ** 2 / (2 * sig ** 2))
+
+
+def batch_tiles(n1, n2, m1, m2, batch_size):
+    """ Split an n1 x n2 block of configuration pairs into tiles small enough
+    for the batched engine.
+
+    Args:
+        n1 (int): number of configurations along the first axis
+        n2 (int): number of configurations along the second axis
+        m1 (int): maximum number of neighbours along the first axis
+        m2 (int): maximum number of neighbours along the second axis
+        batch_size (int): maximum number of configurations per tile side
+
+    Returns:
+        tiles (list): list of (slice, slice) couples
+
+    """
+
+    b2 = max(1, min(batch_size, n2, BATCH_MAX_ELEMENTS // max(1, m1 * m2)))
+    b1 = max(1, min(batch_size, n1, BATCH_MAX_ELEMENTS // max(1, b2 * m1 * m2)))
+
+    return [(slice(i, min(i + b1, n1)), slice(j, min(j + b2, n2)))
+            for i in range(0, n1, b1) for j in range(0, n2, b2)]
+
+
 class BaseTwoBody(Kernel, metaclass=ABCMeta):
     """ Two body kernel class
     Handles the functions common to the single-species and
@@ -118,21 +669,381 @@ class BaseTwoBody(Kernel, metaclass=ABCMeta):
         theta[1] (float) : decay rate of the cutoff function
         theta[2] (float) : cutoff radius
         bounds (list) : bounds of the kernel function.
+        engine (str): "theano" to evaluate the kernels one pair of configurations
+            at a time, "numpy" to use the batched NumPy engine and the closed-form
+            kernels of ``pair_k2``, without theano, "numba" to evaluate the same batches
+            with the compiled loops of ``mff.kernels.numbaengine``, on all the threads
+        batch_size (int): maximum number of configurations per side of the
+            tiles evaluated by the batched engine
+        species_sorted (bool): with the numpy engine and many species, evaluate the
+            kernels on the neighbours sorted by species, see ``sorted_k2``
+        dtype (str): "float64" or "float32", precision in which the kernels are computed,
+            by the compiled functions or by the numpy and numba engines
+        window_tol (float): with the numpy or numba engine, only sum over the pairs of
+            neighbours whose squared exponential is above this tolerance, sorting the
+            neighbours by distance, see ``window_k2``. None sums over all the pairs
+        histogram_width (float): if given, the energy-energy kernels between global
+            configurations are approximated from histograms of their pair distances with
+            this bin width, see ``calc_histogram_ee`` and ``histogram_error``
 
     Attributes:
         k2_ee (object): Energy-energy kernel function
         k2_ef (object): Energy-force kernel function
         k2_ff (object): Force-force kernel function
+        window_error (float): with window_tol, bound on the absolute error of each local
+            kernel value of the last call to ``calc_batch``, or of all the species blocks
+            of the last call to calc or calc_gram, see ``window_bound``
 
     """
 
+    function_names = ('k2_ee', 'k2_ef', 'k2_ff')
+
     @abstractmethod
-    def __init__(self, kernel_name, theta, bounds):
-        super().__init__(kernel_name)
+    def __init__(self, kernel_name, theta, bounds, engine='theano', batch_size=256,
+                 species_sorted=False, dtype='float64', window_tol=None, histogram_width=None):
+        super().__init__(kernel_name, dtype=dtype)
         self.theta = theta
         self.bounds = bounds
-        self.k2_ee, self.k2_ef, self.k2_ff = self.compile_theano()
+        if engine not in ('theano', 'numpy', 'numba'):
+            raise ValueError("Unknown engine %s, use 'theano', 'numpy' or 'numba'" % engine)
+        if engine == 'numba':
+            numbaengine.require_numba()
+        if species_sorted and engine == 'theano':
+            raise ValueError("species_sorted requires the numpy or numba engine")
+        if window_tol is not None and engine == 'theano':
+            raise ValueError("window_tol requires the numpy or numba engine")
+        if window_tol is not None and not 0 < window_tol < 1:
+            raise ValueError("window_tol must be between 0 and 1")
+        if histogram_width is not None and not histogram_width > 0:
+            raise ValueError("histogram_width must be positive")
+        self.engine = engine
+        self.batch_size = batch_size
+        self.species_sorted = species_sorted
+        self.window_tol = window_tol
+        self.window_error = 0.
+        self.histogram_width = histogram_width
+        if engine != 'theano':
+            self.k2_ee, self.k2_ef, self.k2_ff = self.numpy_ee, self.numpy_ef, self.numpy_ff
+        else:
+            self.k2_ee, self.k2_ef, self.k2_ff = self.theano_ee, self.theano_ef, self.theano_ff
+
+    def eval_batch(self, p1, p2, sig, mode):
+        """ Kernel tile between two blocks of padded configurations, computed by
+        ``batch_k2``, ``sorted_k2``, ``window_k2`` or the numba engine depending on
+        the options. With window_tol the blocks must be sorted by ``sort_block``.
+        """
+        width = None if self.window_tol is None else window_width(sig, self.window_tol)
+        if self.engine == 'numba':
+            return numbaengine.batch_k2(p1, p2, sig, self.type, mode,
+                                        np.inf if width is None else width)
+        if self.species_sorted and self.type == 'multi':
+            return sorted_k2(p1, p2, sig, self.type, mode, width)
+        if width is not None:
+            return window_k2(p1, p2, sig, self.type, mode, width)
+        return batch_k2(p1, p2, sig, self.type, mode)
+
+    def sort_block(self, p):
+        """ Block of padded configurations with the neighbours sorted by distance when
+        the kernel uses window_tol, see ``sort_neighbours``, p itself otherwise """
+        if self.window_tol is None:
+            return p
+        return sort_neighbours(p, self.theta[2] + window_width(self.theta[0], self.window_tol) + 1)
+
+    def numpy_ee(self, conf1, conf2, sig, theta, rc):
+        """ Closed-form energy-energy kernel, same arguments as k2_ee """
+        p1, p2 = (self.sort_block(pad_confs([conf], rc, self.dtype)) for conf in (conf1, conf2))
+        return self.eval_batch(p1, p2, sig, 'ee')[0, 0]
+
+    def numpy_ef(self, conf1, conf2, sig, theta, rc):
+        """ Closed-form energy-force kernel, same arguments as k2_ef """
+        p1, p2 = (self.sort_block(pad_confs([conf], rc, self.dtype)) for conf in (conf1, conf2))
+        return self.eval_batch(p1, p2, sig, 'ef')[0, 0]
+
+    def numpy_ff(self, conf1, conf2, sig, theta, rc):
+        """ Closed-form force-force kernel, same arguments as k2_ff """
+        p1, p2 = (self.sort_block(pad_confs([conf], rc, self.dtype)) for conf in (conf1, conf2))
+        return self.eval_batch(p1, p2, sig, 'ff')[0, 0]
+
+    def theano_ee(self, conf1, conf2, sig, theta, rc):
+        """
+        Two body kernel for global energy-energy correlation, evaluated by the compiled function
+
+        Args:
+            conf1 (array): first configuration.
+            conf2 (array): second configuration.
+            sig (float): lengthscale hyperparameter theta[0]
+            theta (float): cutoff decay rate hyperparameter theta[1]
+            rc (float): cutoff distance hyperparameter theta[2]
+
+        Returns:
+            kernel (float): scalar valued energy-energy 2-body kernel
+
+        """
+        return self.theano_function('k2_ee')(np.zeros(3), np.zeros(3), conf1, conf2,
+                                             sig, theta, rc)
+
+    def theano_ef(self, conf1, conf2, sig, theta, rc):
+        """
+        Two body kernel for global energy-force correlation, evaluated by the compiled function
+
+        Args:
+            conf1 (array): first configuration.
+            conf2 (array): second configuration.
+            sig (float): lengthscale hyperparameter theta[0]
+            theta (float): cutoff decay rate hyperparameter theta[1]
+            rc (float): cutoff distance hyperparameter theta[2]
+
+        Returns:
+            kernel (array): 3x1 energy-force 2-body kernel
+
+        """
+        return -self.theano_function('k2_ef')(np.zeros(3), np.zeros(3), conf1, conf2,
+                                              sig, theta, rc)
+
+    def theano_ff(self, conf1, conf2, sig, theta, rc):
+        """
+        Two body kernel for force-force correlation, evaluated by the compiled function
+
+        Args:
+            conf1 (array): first configuration.
+            conf2 (array): second configuration.
+            sig (float): lengthscale hyperparameter theta[0]
+            theta (float): cutoff decay rate hyperparameter theta[1]
+            rc (float): cutoff distance hyperparameter theta[2]
+
+        Returns:
+            kernel (matrix): 3x3 force-force 2-body kernel
+
+        """
+        return self.theano_function('k2_ff')(np.zeros(3), np.zeros(3), conf1, conf2,
+                                             sig, theta, rc)
+
+    def calc_batch(self, p1, p2, mode, symmetric=False, out=None):
+        """
+        Calculate the kernel between two blocks of padded configurations
+        using the batched NumPy or numba engine, one tile at a time.
+
+        Args:
+            p1 (tuple): first block of configurations, as returned by ``pad_confs``
+            p2 (tuple): second block of configurations, as returned by ``pad_confs``
+            mode (str): "ee", "ef" or "ff"
+            symmetric (bool): if True p1 and p2 are the same block, only the
+                lower triangular tiles are computed and then mirrored
+            out (array): optional array the kernel values are written into,
+                with the same shape as the returned one
+
+        Returns:
+            K (array): N1 x N2, N1 x N2 x 3 or N1 x 3 x N2 x 3 kernel values.
+                The force-force values are laid out so that reshaping them
+                to a 3*N1 x 3*N2 matrix does not need a copy.
+
+        """
+        n1, m1 = p1[0].shape
+        n2, m2 = p2[0].shape
+        if out is None:
+            out = np.zeros({'ee': (n1, n2), 'ef': (n1, n2, 3), 'ff': (n1, 3, n2, 3)}[mode])
+        ker = out
+
+        if self.window_tol is not None:
+            # The neighbours of each configuration are sorted once, for all the tiles
+            p1, p2 = self.sort_block(p1), self.sort_block(p2)
+            m = [np.sum((p[2] != 0) | (p[3] != 0), axis=1).max(initial=0) for p in (p1, p2)]
+            self.window_error = m[0] * m[1] * window_bound(self.theta[0], self.theta[2],
+                                                           self.window_tol, mode, self.type)
+
+        if symmetric:
+            # Square tiles on the diagonal, so that s1 == s2 there
+            b = int(np.sqrt(BATCH_MAX_ELEMENTS // max(1, m1 * m2)))
+            b = max(1, min(self.batch_size, n1, b))
+            tiles = [(slice(i, min(i + b, n1)), slice(j, min(j + b, n1)))
+                     for i in range(0, n1, b) for j in range(0, i + 1, b)]
+        else:
+            tiles = batch_tiles(n1, n2, m1, m2, self.batch_size)
+
+        for s1, s2 in tiles:
+            tile = self.eval_batch(tuple(p[s1] for p in p1), tuple(p[s2] for p in p2),
+                                   self.theta[0], mode)
+            if mode == 'ff':
+                ker[s1, :, s2, :] = tile.transpose(0, 2, 1, 3)
+                if symmetric and s1.start != s2.start:
+                    ker[s2, :, s1, :] = tile.transpose(1, 3, 0, 2)
+            else:
+                ker[s1, s2] = tile
+                if symmetric and s1.start != s2.start:
+                    ker[s2, s1] = np.swapaxes(tile, 0, 1)
+
+        return ker
+
+    def calc_gram_gradient(self, X, order='C'):
+        """
+        Calculate the force-force gram matrix for a set of configurations X together with
+        its derivatives with respect to the hyperparameters, in a single pass over the
+        lower triangular tiles, each evaluated once by ``batch_k2_gradient``. The closed-form
+        kernels are used in double precision whatever the engine. The kernel does not
+        depend on theta[1], whose derivative is zero.
+
+        Args:
+            X (list): list of N Mx5 arrays containing xyz coordinates and atomic species
+            order (str): memory layout of the gram matrix, 'C' or 'F' (Fortran)
+
+        Returns:
+            gram (matrix): N*3 x N*3 gram matrix of the matrix-valued kernels
+            gradient (array): N*3 x N*3 x 3 derivatives of the gram matrix with respect to
+                theta[0], theta[1] and theta[2]
+
+        """
+        sig, rc = self.theta[0], self.theta[2]
+        p = pad_confs(X, rc)
+        n, m = p[0].shape
+        gram = np.zeros((n, 3, n, 3))
+        gradient = np.zeros((n, 3, n, 3, 3))
+
+        # Square tiles on the diagonal as in calc_batch, sized for the three tiles at once
+        b = int(np.sqrt(BATCH_MAX_ELEMENTS // max(1, 3 * m * m)))
+        b = max(1, min(self.batch_size, n, b))
+        for i in range(0, n, b):
+            for j in range(0, i + 1, b):
+                s1, s2 = slice(i, min(i + b, n)), slice(j, min(j + b, n))
+                tiles = batch_k2_gradient(tuple(x[s1] for x in p), tuple(x[s2] for x in p),
+                                          sig, rc, self.type).transpose(0, 1, 3, 2, 4)
+                gram[s1, :, s2] = tiles[0]
+                gradient[s1, :, s2, :, 0] = tiles[1]
+                gradient[s1, :, s2, :, 2] = tiles[2]
+
+        gram = np.asarray(gram.reshape(3 * n, 3 * n), order=order)
+        gradient = gradient.reshape(3 * n, 3 * n, 3)
+        mirror_lower(gram, 3)
+        for k in (0, 2):
+            mirror_lower(gradient[:, :, k], 3)
+
+        return gram, gradient
+
+    def calc_histogram_ee(self, X1, offsets1, X2=None, offsets2=None):
+        """
+        Approximate energy-energy kernel sums between two sets of global configurations,
+        each reduced once to histograms of its pair distances by ``pair_histograms``.
+        The kernel between two configurations is then h1 . G . h2, G being the
+        squared exponential between the bins, see ``smoothing_matrix``, and its cost
+        no longer depends on the number of atoms of the configurations.
+
+        Args:
+            X1 (list): local configurations of the first set
+            offsets1 (array): offsets of the global configurations in X1, see
+                ``flatten_segments``, or None to keep the local configurations
+            X2 (list): local configurations of the second set, None for the gram matrix
+                of the first one
+            offsets2 (array): offsets of the global configurations in X2, or None
+
+        Returns:
+            K (array): N1 x N2 kernel sums, as in ``calc_segments`` in "ee" mode
+
+        """
+        sig, rc, width = self.theta[0], self.theta[2], self.histogram_width
+        p1 = pad_confs(X1, rc)
+        p2 = p1 if X2 is None else pad_confs(X2, rc)
+        codes, swap = pair_codes(p1, p2) if self.type == 'multi' else (None, None)
+
+        h1 = pair_histograms(p1, offsets1, rc, width, codes)
+        h2 = h1 if X2 is None else pair_histograms(p2, offsets2, rc, width, codes)
+        if swap is not None:
+            # same species factor as batch_k2, summed over the two permutations
+            h2 = h2 + h2[:, swap]
+        h2 = np.einsum('ysc,bc->ysb', h2, smoothing_matrix(h2.shape[2], width, sig))
 
+        return h1.reshape(len(h1), -1).dot(h2.reshape(len(h2), -1).T)
+
+    def histogram_error(self, X, size=10):
+        """ Accuracy check of the energy-energy kernels computed from histograms, see
+        ``calc_histogram_ee``, on the gram matrix of the first global configurations.
+
+        Args:
+            X (list): global configurations, lists of local configurations
+            size (int): number of global configurations used for the check
+
+        Returns:
+            error (float): largest absolute difference from the exact gram matrix, computed
+                in double precision without histograms or window, relative to its largest
+                value
+
+        """
+        # A kernel of its own, without the window or the caches of this one
+        exact = type(self)(theta=self.theta, bounds=self.bounds, engine=self.engine,
+                           batch_size=self.batch_size)
+        ref = exact.calc_gram_e(X[:size])
+        gram = self.calc_gram_e(X[:size])
+
+        return np.abs(gram - ref).max() / max(np.abs(ref).max(), 1e-300)
+
+    def calc_segments(self, p1, offsets1, p2, offsets2, mode, symmetric=False):
+        """
+        Calculate the kernel between two blocks of padded local configurations with
+        ``calc_batch``, summed over the local configurations of each global one with
+        ``segment_sum``. The local kernels are computed for row blocks of whole global
+        configurations, about batch_size local ones, and reduced as they come, so that
+        the kernel matrix of all the local configurations is never stored.
+
+        Args:
+            p1 (tuple): first block of local configurations, as returned by ``pad_confs``
+            offsets1 (array): offsets of the global configurations in p1, see
+                ``flatten_segments``, or None to keep the local configurations
+            p2 (tuple): second block of local configurations
+            offsets2 (array): offsets of the global configurations in p2, or None
+            mode (str): "ee" or "ef"
+            symmetric (bool): if True p1 and p2 are the same block, only the lower
+                triangle is computed and then mirrored
+
+        Returns:
+            K (array): N1 x N2 or N1 x N2 x 3 kernel sums, N being the number of global
+                configurations, or of local ones when the offsets are None
+
+        """
+        if offsets1 is None:
+            offsets1 = np.arange(len(p1[0]) + 1)
+        if offsets2 is None:
+            offsets2 = np.arange(len(p2[0]) + 1)
+        n1, n2 = len(offsets1) - 1, len(offsets2) - 1
+        ker = np.zeros((n1, n2) + ((3,) if mode == 'ef' else ()))
+
+        edges = [0]
+        for i in range(1, n1):
+            if offsets1[i] - offsets1[edges[-1]] >= self.batch_size:
+                edges.append(i)
+        edges.append(n1)
+
+        for g0, g1 in zip(edges[:-1], edges[1:]):
+            if g0 == g1:
+                continue
+            cols = g1 if symmetric else n2
+            local = self.calc_batch(tuple(x[offsets1[g0]:offsets1[g1]] for x in p1),
+                                    tuple(x[:offsets2[cols]] for x in p2), mode)
+            ker[g0:g1, :cols] = segment_sum(segment_sum(local, offsets1[g0:g1 + 1] - offsets1[g0]),
+                                            offsets2[:cols + 1], axis=1)
+
+        if symmetric:
+            mirror_lower(ker, 1)
+
+        return ker
+
+    @staticmethod
+    def block_view(gram, n1, n2):
+        """ View of a 3*N1 x 3*N2 matrix as an N1 x 3 x N2 x 3 array, without copies
+
+        Args:
+            gram (array): C or Fortran ordered 3*N1 x 3*N2 matrix
+            n1 (int): number of configurations along the first axis
+            n2 (int): number of configurations along the second axis
+
+        Returns:
+            view (array): N1 x 3 x N2 x 3 view of gram
+
+        """
+
+        if gram.flags.c_contiguous:
+            return gram.reshape(n1, 3, n2, 3)
+        return gram.reshape((3, n1, 3, n2), order='F').transpose(1, 0, 3, 2)
+
+    @cached_blocks('ff', (3, 3))
+    @species_blocks('ff', (3, 3))
     def calc(self, X1, X2, ncores=1):
         """
         Calculate the force-force kernel between two sets of configurations.
@@ -147,37 +1058,17 @@ class BaseTwoBody(Kernel, metaclass=ABCMeta):
         """
         ker = np.zeros((len(X1) * 3, len(X2) * 3))
 
+        if self.engine != 'theano':
+            self.calc_batch(pad_confs(X1, self.theta[2], self.dtype),
+                            pad_confs(X2, self.theta[2], self.dtype), 'ff',
+                            out=self.block_view(ker, len(X1), len(X2)))
+            return ker
+
         if ncores > 1:
-            confs = []
-            for x1 in X1:
-                for x2 in X2:
-                    confs.append(np.asarray([x1, x2]))
-            n = len(confs)
-            import sys
-            sys.setrecursionlimit(100000)
             logger.info(
                 'Using %i cores for the 2-body force-force kernel calculation' % (ncores))
-
-            # Way to split the kernels functions to compute evenly across the nodes
-            splitind = np.zeros(ncores + 1)
-            factor = (n + (ncores - 1)) / ncores
-            splitind[1:-1] = [(i + 1) * factor for i in np.arange(ncores - 1)]
-            splitind[-1] = n
-            splitind = splitind.astype(int)
-            clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                      self.type] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-            import multiprocessing as mp
-            pool = mp.Pool(ncores)
-            result = pool.map(dummy_calc_ff, clist)
-            pool.close()
-            pool.join()
-
-            result = np.concatenate(result).reshape((n, 3, 3))
-            for i in range(len(X1)):
-                for j in range(len(X2)):
-                    ker[i * 3: i * 3 + 3, 3 * j:3 * j +
-                        3] = result[(j + i * len(X2))]
+            ker = self.calc_parallel(dummy_calc_ff, X1, X2, (3, 3), ncores,
+                                     args=(self.theta, self.type, self.dtype))
 
         else:
             for i, conf1 in enumerate(X1):
@@ -187,6 +1078,7 @@ class BaseTwoBody(Kernel, metaclass=ABCMeta):
 
         return ker
 
+    @cached_blocks('ef', (1, 3))
     def calc_ef(self, X_glob, X, ncores=1, mapping=False):
         """
         Calculate the energy-force kernel between two sets of configurations.
@@ -201,36 +1093,22 @@ class BaseTwoBody(Kernel, metaclass=ABCMeta):
         """
         ker = np.zeros((len(X_glob), len(X) * 3))
 
+        if self.engine != 'theano':
+            p2 = pad_confs(X, self.theta[2], self.dtype)
+            if not mapping:
+                confs, offsets = flatten_segments(X_glob)
+                ker = 0.5*self.calc_segments(pad_confs(confs, self.theta[2], self.dtype),
+                                             offsets, p2, None, 'ef')
+            else:
+                ker = self.calc_batch(pad_confs(X_glob, self.theta[2], self.dtype), p2, 'ef')
+            return ker.reshape(len(X_glob), len(X) * 3)
+
         if ncores > 1:
-            confs = []
-            for x1 in X_glob:
-                for x2 in X:
-                    confs.append(np.asarray([x1, x2]))
-            n = len(confs)
-            import sys
-            sys.setrecursionlimit(100000)
             logger.info(
                 'Using %i cores for the 2-body energy-force kernel calculation' % (ncores))
-
-            # Way to split the kernels functions to compute evenly across the nodes
-            splitind = np.zeros(ncores + 1)
-            factor = (n + (ncores - 1)) / ncores
-            splitind[1:-1] = [(i + 1) * factor for i in np.arange(ncores - 1)]
-            splitind[-1] = n
-            splitind = splitind.astype(int)
-            clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                      self.type, mapping] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-            import multiprocessing as mp
-            pool = mp.Pool(ncores)
-            result = pool.map(dummy_calc_ef, clist)
-            pool.close()
-            pool.join()
-            result = np.vstack(np.asarray(result))
-
-            for i in range(len(X_glob)):
-                for j in range(len(X)):
-                    ker[i, 3 * j:3 * j + 3] = result[(j + i * len(X))]
+            ker = self.calc_parallel(dummy_calc_ef, X_glob, X, (1, 3), ncores,
+                                     kinds=('local' if mapping else 'global', 'local'),
+                                     args=(self.theta, self.type, mapping, self.dtype))
 
         else:
             if not mapping:
@@ -247,6 +1125,7 @@ class BaseTwoBody(Kernel, metaclass=ABCMeta):
 
         return ker
 
+    @cached_blocks('ee', (1, 1))
     def calc_ee(self, X1, X2, ncores=1, mapping=False):
         """
         Calculate the energy-energy kernel between two global environments.
@@ -259,39 +1138,29 @@ class BaseTwoBody(Kernel, metaclass=ABCMeta):
             K (matrix): N1 x N2 matrix of the scalar-valued kernels 
 
        """
+        if self.histogram_width is not None:
+            confs2, offsets2 = flatten_segments(X2)
+            if not mapping:
+                confs1, offsets1 = flatten_segments(X1)
+                return 0.25*self.calc_histogram_ee(confs1, offsets1, confs2, offsets2)
+            return 0.5*self.calc_histogram_ee(X1, None, confs2, offsets2)
+
+        if self.engine != 'theano':
+            confs2, offsets2 = flatten_segments(X2)
+            p2 = pad_confs(confs2, self.theta[2], self.dtype)
+            if not mapping:
+                confs1, offsets1 = flatten_segments(X1)
+                return 0.25*self.calc_segments(pad_confs(confs1, self.theta[2], self.dtype),
+                                               offsets1, p2, offsets2, 'ee')
+            return 0.5*self.calc_segments(pad_confs(X1, self.theta[2], self.dtype), None,
+                                          p2, offsets2, 'ee')
+
         if ncores > 1:  # Used for multiprocessing
-            confs = []
-
-            # Build a list of all input pairs which matrix needs to be computed
-            for x1 in X1:
-                for x2 in X2:
-                    confs.append(np.asarray([x1, x2]))
-            n = len(confs)
-            import sys
-            sys.setrecursionlimit(100000)
             logger.info(
                 'Using %i cores for the 2-body energy-energy kernel calculation' % (ncores))
-
-            # Way to split the kernels functions to compute evenly across the nodes
-            splitind = np.zeros(ncores + 1)
-            factor = (n + (ncores - 1)) / ncores
-            splitind[1:-1] = [(i + 1) * factor for i in np.arange(ncores - 1)]
-            splitind[-1] = n
-            splitind = splitind.astype(int)
-            clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                      self.type, mapping] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-            import multiprocessing as mp
-            pool = mp.Pool(ncores)
-            result = pool.map(dummy_calc_ee, clist)
-            pool.close()
-            pool.join()
-            result = np.concatenate(result).ravel()
-
-            ker = np.zeros((len(X1), len(X2)))
-            for i in range(len(X1)):
-                for j in range(len(X2)):
-                    ker[i, j] = result[j + i*len(X2)]
+            ker = self.calc_parallel(dummy_calc_ee, X1, X2, (1, 1), ncores,
+                                     kinds=('local' if mapping else 'global', 'global'),
+                                     args=(self.theta, self.type, mapping, self.dtype))
 
         else:
             if not mapping:
@@ -312,7 +1181,9 @@ class BaseTwoBody(Kernel, metaclass=ABCMeta):
 
         return ker
 
-    def calc_gram(self, X, ncores=1, eval_gradient=False):
+    @cached_blocks('gram', (3, 3))
+    @species_blocks('gram', (3, 3))
+    def calc_gram(self, X, ncores=1, eval_gradient=False, order='C'):
         """
         Calculate the force-force gram matrix for a set of configurations X.
 
@@ -320,67 +1191,36 @@ class BaseTwoBody(Kernel, metaclass=ABCMeta):
             X (list): list of N Mx5 arrays containing xyz coordinates and atomic species
             ncores (int): Number of CPU nodes to use for multiprocessing (default is 1)
             eval_gradient (bool): if True, evaluate the gradient of the gram matrix
+            order (str): memory layout of the gram matrix, 'C' or 'F' (Fortran)
 
         Returns:
             gram (matrix): N*3 x N*3 gram matrix of the matrix-valued kernels 
 
        """
         if eval_gradient:
-            raise NotImplementedError('ERROR: GRADIENT NOT IMPLEMENTED YET')
+            return self.calc_gram_gradient(X, order)
+        elif self.engine != 'theano':
+            p = pad_confs(X, self.theta[2], self.dtype)
+            gram = np.zeros((len(X) * 3, len(X) * 3), order=order)
+            self.calc_batch(p, p, 'ff', symmetric=True, out=self.block_view(gram, len(X), len(X)))
+            return gram
         else:
             if ncores > 1:  # Used for multiprocessing
-                confs = []
-
-                # Build a list of all input pairs which matrix needs to be computed
-                for i in np.arange(len(X)):
-                    for j in np.arange(i + 1):
-                        thislist = np.asarray([X[i], X[j]])
-                        confs.append(thislist)
-                n = len(confs)
-                import sys
-                sys.setrecursionlimit(100000)
                 logger.info(
                     'Using %i cores for the 2-body force-force gram matrix calculation' % (ncores))
-
-                # Way to split the kernels functions to compute evenly across the nodes
-                splitind = np.zeros(ncores + 1)
-                factor = (n + (ncores - 1)) / ncores
-                splitind[1:-1] = [(i + 1) *
-                                  factor for i in np.arange(ncores - 1)]
-                splitind[-1] = n
-                splitind = splitind.astype(int)
-                clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                          self.type] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-                import multiprocessing as mp
-                pool = mp.Pool(ncores)
-                result = pool.map(dummy_calc_ff, clist)
-                pool.close()
-                pool.join()
-
-                result = np.concatenate(result).reshape((n, 3, 3))
-                off_diag = np.zeros((len(X) * 3, len(X) * 3))
-                diag = np.zeros((len(X) * 3, len(X) * 3))
-                for i in np.arange(len(X)):
-                    diag[3 * i:3 * i + 3, 3 * i:3 * i +
-                         3] = result[i + i * (i + 1) // 2]
-                    for j in np.arange(i):
-                        off_diag[3 * i:3 * i + 3, 3 * j:3 *
-                                 j + 3] = result[j + i * (i + 1) // 2]
+                gram = self.calc_parallel(dummy_calc_ff, X, X, (3, 3), ncores,
+                                          args=(self.theta, self.type, self.dtype), symmetric=True,
+                                          order=order)
 
             else:
-                diag = np.zeros((X.shape[0] * 3, X.shape[0] * 3))
-                off_diag = np.zeros((X.shape[0] * 3, X.shape[0] * 3))
-                for i in np.arange(X.shape[0]):
-                    diag[3 * i:3 * i + 3, 3 * i:3 * i + 3] = \
-                        self.k2_ff(X[i], X[i], self.theta[0],
-                                   self.theta[1], self.theta[2])
-                    for j in np.arange(i):
-                        off_diag[3 * i:3 * i + 3, 3 * j:3 * j + 3] = \
+                gram = np.zeros((len(X) * 3, len(X) * 3), order=order)
+                for i in range(len(X)):
+                    for j in range(i + 1):
+                        gram[3 * i:3 * i + 3, 3 * j:3 * j + 3] = \
                             self.k2_ff(X[i], X[j], self.theta[0],
                                        self.theta[1], self.theta[2])
+                mirror_lower(gram, 3)  # The gram matrix is symmetric
 
-            gram = diag + off_diag + off_diag.T  # The gram matrix is symmetric
             return gram
 
     def calc_gram_e(self, X, ncores=1, eval_gradient=False):
@@ -398,64 +1238,37 @@ class BaseTwoBody(Kernel, metaclass=ABCMeta):
        """
         if eval_gradient:
             raise NotImplementedError('ERROR: GRADIENT NOT IMPLEMENTED YET')
+        elif self.histogram_width is not None:
+            return 0.25*self.calc_histogram_ee(*flatten_segments(X))
+        elif self.engine != 'theano':
+            confs, offsets = flatten_segments(X)
+            p = pad_confs(confs, self.theta[2], self.dtype)
+            return 0.25*self.calc_segments(p, offsets, p, offsets, 'ee', symmetric=True)
         else:
             if ncores > 1:  # Used for multiprocessing
-                confs = []
-
-                # Build a list of all input pairs which matrix needs to be computed
-                for i in np.arange(len(X)):
-                    for j in np.arange(i + 1):
-                        thislist = np.array([list(X[i]), list(X[j])])
-                        confs.append(thislist)
-
-                n = len(confs)
-                import sys
-                sys.setrecursionlimit(100000)
                 logger.info(
                     'Using %i cores for the 2-body energy-energy gram matrix calculation' % (ncores))
-
-                # Way to split the kernels functions to compute evenly across the nodes
-                splitind = np.zeros(ncores + 1)
-                factor = (n + (ncores - 1)) / ncores
-                splitind[1:-1] = [(i + 1) *
-                                  factor for i in np.arange(ncores - 1)]
-                splitind[-1] = n
-                splitind = splitind.astype(int)
-                clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                          self.type, False] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-                import multiprocessing as mp
-                pool = mp.Pool(ncores)
-                result = pool.map(dummy_calc_ee, clist)
-                pool.close()
-                pool.join()
-
-                result = np.concatenate(result).ravel()
-                off_diag = np.zeros((len(X), len(X)))
-                diag = np.zeros((len(X), len(X)))
-                for i in np.arange(len(X)):
-                    diag[i, i] = result[i + i * (i + 1) // 2]
-                    for j in np.arange(i):
-                        off_diag[i, j] = result[j + i * (i + 1) // 2]
+                gram = self.calc_parallel(dummy_calc_ee, X, X, (1, 1), ncores,
+                                          kinds=('global', 'global'),
+                                          args=(self.theta, self.type, False, self.dtype),
+                                          symmetric=True)
 
             else:
-                diag = np.zeros((X.shape[0], X.shape[0]))
-                off_diag = np.zeros((X.shape[0], X.shape[0]))
-                for i in np.arange(X.shape[0]):
+                gram = np.zeros((len(X), len(X)))
+                for i in range(len(X)):
                     for k, conf1 in enumerate(X[i]):
-                        diag[i, i] += 0.25*self.k2_ee(conf1, conf1,
+                        gram[i, i] += 0.25*self.k2_ee(conf1, conf1,
                                                  self.theta[0], self.theta[1], self.theta[2])
                         for conf2 in X[i][:k]:
                             # *2 here to speed up the loop
-                            diag[i, i] += 0.25*2.0*self.k2_ee(
+                            gram[i, i] += 0.25*2.0*self.k2_ee(
                                 conf1, conf2, self.theta[0], self.theta[1], self.theta[2])
-                    for j in np.arange(i):
+                    for j in range(i):
                         for conf1 in X[i]:
                             for conf2 in X[j]:
-                                off_diag[i, j] += 0.25*self.k2_ee(
+                                gram[i, j] += 0.25*self.k2_ee(
                                     conf1, conf2, self.theta[0], self.theta[1], self.theta[2])
-
-            gram = diag + off_diag + off_diag.T  # Gram matrix is symmetric
+                mirror_lower(gram, 1)  # Gram matrix is symmetric
 
             return gram
 
@@ -475,47 +1288,25 @@ class BaseTwoBody(Kernel, metaclass=ABCMeta):
             gram (matrix): N2 x N1*3 gram matrix of the vector-valued kernels 
 
        """
-        gram = np.zeros((X_glob.shape[0], X.shape[0] * 3))
+        gram = np.zeros((len(X_glob), len(X) * 3))
 
         if eval_gradient:
             raise NotImplementedError('ERROR: GRADIENT NOT IMPLEMENTED YET')
+        elif self.engine != 'theano':
+            gram = self.calc_ef(X_glob, X)
+            self.gram_ef = gram
+            return gram
         else:
             if ncores > 1:  # Multiprocessing
-                confs = []
-                for i in np.arange(len(X_glob)):
-                    for j in np.arange(len(X)):
-                        thislist = np.asarray([X_glob[i], X[j]])
-                        confs.append(thislist)
-                n = len(confs)
-                import sys
-                sys.setrecursionlimit(100000)
                 logger.info(
                     'Using %i cores for the 2-body energy-force gram matrix calculation' % (ncores))
-
-                # Way to split the kernels functions to compute evenly across the nodes
-                splitind = np.zeros(ncores + 1)
-                factor = (n + (ncores - 1)) / ncores
-                splitind[1:-1] = [(i + 1) *
-                                  factor for i in np.arange(ncores - 1)]
-                splitind[-1] = n
-                splitind = splitind.astype(int)
-                clist = [[confs[splitind[i]:splitind[i + 1]], self.theta[0], self.theta[1], self.theta[2],
-                          self.type, False] for i in np.arange(ncores)]  # Shape is ncores * (ntrain*(ntrain+1)/2)/ncores
-
-                import multiprocessing as mp
-                pool = mp.Pool(ncores)
-                result = pool.map(dummy_calc_ef, clist)
-                pool.close()
-                pool.join()
-                result = np.vstack(np.asarray(result))
-
-                for i in np.arange(X_glob.shape[0]):
-                    for j in np.arange(X.shape[0]):
-                        gram[i, 3 * j:3 * j + 3] = result[(j + i * X.shape[0])]
+                gram = self.calc_parallel(dummy_calc_ef, X_glob, X, (1, 3), ncores,
+                                          kinds=('global', 'local'),
+                                          args=(self.theta, self.type, False, self.dtype))
 
             else:
-                for i in np.arange(X_glob.shape[0]):
-                    for j in np.arange(X.shape[0]):
+                for i in np.arange(len(X_glob)):
+                    for j in np.arange(len(X)):
                         for k in X_glob[i]:
                             gram[i, 3 * j:3 * j + 3] += 0.5*self.k2_ef(
                                 k, X[j], self.theta[0], self.theta[1], self.theta[2])
@@ -526,8 +1317,8 @@ class BaseTwoBody(Kernel, metaclass=ABCMeta):
 
     @staticmethod
     @abstractmethod
-    def compile_theano():
-        return None, None, None
+    def compile_theano(names, dtype='float64'):
+        return {}
 
 
 class TwoBodySingleSpeciesKernel(BaseTwoBody):
@@ -537,165 +1328,107 @@ class TwoBodySingleSpeciesKernel(BaseTwoBody):
         theta[0] (float): lengthscale of the kernel
         theta[1] (float): decay rate of the cutoff function
         theta[2] (float): cutoff radius
+        engine (str): "theano" (default), "numpy" or "numba" for the batched engines
+        batch_size (int): maximum tile side used by the batched engine
+        dtype (str): "float64" (default) or "float32" for single-precision kernels
+        window_tol (float): tolerance below which the pairs of neighbours are pruned,
+            with the numpy or numba engine
+        histogram_width (float): bin width of the approximate energy-energy kernels
+            between global configurations, None for the exact ones
 
     """
 
-    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-2, 1e2), (1e-2, 1e2))):
-        super().__init__(kernel_name='TwoBodySingleSpecies', theta=theta, bounds=bounds)
+    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-2, 1e2), (1e-2, 1e2)),
+                 engine='theano', batch_size=256, dtype='float64', window_tol=None,
+                 histogram_width=None):
+        super().__init__(kernel_name='TwoBodySingleSpecies', theta=theta, bounds=bounds,
+                         engine=engine, batch_size=batch_size, dtype=dtype,
+                         window_tol=window_tol, histogram_width=histogram_width)
         self.type = "single"
 
     @staticmethod
-    def compile_theano():
+    def compile_theano(names, dtype='float64'):
         """
         This function generates theano compiled kernels for global energy and force learning
 
         The position of the atoms relative to the central one, and their chemical species
         are defined by a matrix of dimension Mx5 here called r1 and r2.
 
+        Args:
+            names (list): names of the functions to compile, e.g. "k2_ee"
+            dtype (str): "float64" or "float32", precision of the compiled functions
+
         Returns:
-            k2_ee (func): energy-energy kernel
-            k2_ef (func): energy-force kernel
-            k2_ff (func): force-force kernel
+            functions (dict): the compiled theano functions, by name
         """
 
-        if not (os.path.exists(Mffpath / 'k2_ee_s.pickle') and
-                os.path.exists(Mffpath / 'k2_ef_s.pickle') and os.path.exists(Mffpath / 'k2_ff_s.pickle')):
-            print("Building Kernels")
-
-            import theano.tensor as T
-            from theano import function, scan
-            logger.info(
-                "Started compilation of theano two body single species kernels")
-            # --------------------------------------------------
-            # INITIAL DEFINITIONS
-            # --------------------------------------------------
-
-            # positions of central atoms
-            r1, r2 = T.dvectors('r1d', 'r2d')
-            # positions of neighbours
-            rho1, rho2 = T.dmatrices('rho1', 'rho2')
-            # lengthscale hyperparameter
-            sig = T.dscalar('sig')
-            # cutoff hyperparameters
-            theta = T.dscalar('theta')
-            rc = T.dscalar('rc')
-
-            # positions of neighbours without chemical species (3D space assumed)
-            rho1s = rho1[:, 0:3]
-            rho2s = rho2[:, 0:3]
-
-            # distances of atoms wrt to the central one and wrt each other in 1 and 2
-            r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
-            r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
-
-            # squared exponential of the above distance matrices
-            se_jm = T.exp(-(r1j[:, None] - r2m[None, :]) ** 2 / (2 * sig ** 2))
-
-            cut_jm = 0.5*(1+T.cos(np.pi*r1j[:, None]/rc))*0.5*(1+T.cos(np.pi*r2m[None, :]/rc))*(
-                (T.sgn(rc-r1j[:, None]) + 1) / 2)*((T.sgn(rc-r2m[None, :]) + 1) / 2)
-
-            # apply the cutoff function to the squared exponential partial kernels
-            se_jm = se_jm*cut_jm
-
-            k = T.sum(se_jm)
-
-            # --------------------------------------------------
-            # FINAL FUNCTIONS
-            # --------------------------------------------------
-
-            # energy energy kernel
-            k_ee_fun = function([r1, r2, rho1, rho2, sig, theta, rc], k,
-                                allow_input_downcast=False, on_unused_input='warn')
-
-            # energy force kernel - Used to predict energies from forces
-            k_ef = T.grad(k, r2)
-            k_ef_fun = function([r1, r2, rho1, rho2, sig, theta, rc], k_ef,
-                                allow_input_downcast=False, on_unused_input='warn')
-
-            # force force kernel - it uses only local atom pairs to avoid useless computation
-            k_ff = T.grad(k, r1)
-            k_ff_der, updates = scan(lambda j, k_ff, r2: T.grad(k_ff[j], r2),
-                                     sequences=T.arange(k_ff.shape[0]), non_sequences=[k_ff, r2])
-
-            k_ff_fun = function([r1, r2, rho1, rho2, sig, theta, rc], k_ff_der,
-                                allow_input_downcast=False, on_unused_input='warn')
-            # Save the function that we want to use for multiprocessing
-            # This is necessary because theano is a crybaby and does not want to access the
-            # Automaticallly stored compiled object from different processes
-            with open(Mffpath / 'k2_ee_s.pickle', 'wb') as f:
-                pickle.dump(k_ee_fun, f)
-            with open(Mffpath / 'k2_ef_s.pickle', 'wb') as f:
-                pickle.dump(k_ef_fun, f)
-            with open(Mffpath / 'k2_ff_s.pickle', 'wb') as f:
-                pickle.dump(k_ff_fun, f)
 
-        else:
-            print("Loading Kernels")
-            with open(Mffpath / "k2_ee_s.pickle", 'rb') as f:
-                k_ee_fun = pickle.load(f)
-            with open(Mffpath / "k2_ef_s.pickle", 'rb') as f:
-                k_ef_fun = pickle.load(f)
-            with open(Mffpath / "k2_ff_s.pickle", 'rb') as f:
-                k_ff_fun = pickle.load(f)
+        import theano.tensor as T
+        from theano import function, scan
+        logger.info(
+            "Started compilation of theano two body single species kernels")
         # --------------------------------------------------
-        # WRAPPERS (we don't want to plug the position of the central element every time)
+        # INITIAL DEFINITIONS
         # --------------------------------------------------
 
-        def k2_ee(conf1, conf2, sig, theta, rc):
-            """
-            Two body kernel for global energy-energy correlation
+        # positions of central atoms
+        r1, r2 = T.vectors('r1d', 'r2d')
+        # positions of neighbours
+        rho1, rho2 = T.matrices('rho1', 'rho2')
+        # lengthscale hyperparameter
+        sig = T.scalar('sig')
+        # cutoff hyperparameters
+        theta = T.scalar('theta')
+        rc = T.scalar('rc')
 
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
+        # positions of neighbours without chemical species (3D space assumed)
+        rho1s = rho1[:, 0:3]
+        rho2s = rho2[:, 0:3]
 
-            Returns:
-                kernel (float): scalar valued energy-energy 2-body kernel
+        # distances of atoms wrt to the central one and wrt each other in 1 and 2
+        r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
+        r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
 
-            """
-            return k_ee_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
+        # squared exponential of the above distance matrices
+        se_jm = T.exp(-(r1j[:, None] - r2m[None, :]) ** 2 / (2 * sig ** 2))
 
-        def k2_ef(conf1, conf2, sig, theta, rc):
-            """
-            Two body kernel for global energy-force correlation
+        cut_jm = 0.5*(1+T.cos(np.pi*r1j[:, None]/rc))*0.5*(1+T.cos(np.pi*r2m[None, :]/rc))*(
+            (T.sgn(rc-r1j[:, None]) + 1) / 2)*((T.sgn(rc-r2m[None, :]) + 1) / 2)
 
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
+        # apply the cutoff function to the squared exponential partial kernels
+        se_jm = se_jm*cut_jm
 
-            Returns:
-                kernel (array): 3x1 energy-force 2-body kernel
+        k = T.sum(se_jm)
 
-            """
-            return -k_ef_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
+        # --------------------------------------------------
+        # FINAL FUNCTIONS
+        # --------------------------------------------------
 
-        def k2_ff(conf1, conf2, sig, theta, rc):
-            """
-            Two body kernel for force-force correlation
+        functions = {}
+        # energy energy kernel
+        if 'k2_ee' in names:
+            functions['k2_ee'] = function([r1, r2, rho1, rho2, sig, theta, rc], k,
+                                          allow_input_downcast=True, on_unused_input='warn')
 
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
+        # energy force kernel - Used to predict energies from forces
+        k_ef = T.grad(k, r2)
+        if 'k2_ef' in names:
+            functions['k2_ef'] = function([r1, r2, rho1, rho2, sig, theta, rc], k_ef,
+                                          allow_input_downcast=True, on_unused_input='warn')
 
-            Returns:
-                kernel (matrix): 3x3 force-force 2-body kernel
+        # force force kernel - it uses only local atom pairs to avoid useless computation
+        k_ff = T.grad(k, r1)
+        k_ff_der, updates = scan(lambda j, k_ff, r2: T.grad(k_ff[j], r2),
+                                 sequences=T.arange(k_ff.shape[0]), non_sequences=[k_ff, r2])
 
-            """
-            return k_ff_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
+        if 'k2_ff' in names:
+            functions['k2_ff'] = function([r1, r2, rho1, rho2, sig, theta, rc], k_ff_der,
+                                          allow_input_downcast=True, on_unused_input='warn')
 
         logger.info(
             "Ended compilation of theano two body single species kernels")
 
-        return k2_ee, k2_ef, k2_ff
+        return functions
 
 
 class TwoBodyManySpeciesKernel(BaseTwoBody):
@@ -705,179 +1438,123 @@ class TwoBodyManySpeciesKernel(BaseTwoBody):
         theta[0] (float): lengthscale of the kernel
         theta[1] (float): decay rate of the cutoff function
         theta[2] (float): cutoff radius
+        engine (str): "theano" (default), "numpy" or "numba" for the batched engines
+        batch_size (int): maximum tile side used by the batched engine
+        species_sorted (bool): evaluate only the blocks of neighbours with matching
+            species, with the numpy engine
+        dtype (str): "float64" (default) or "float32" for single-precision kernels
+        window_tol (float): tolerance below which the pairs of neighbours are pruned,
+            with the numpy or numba engine
+        histogram_width (float): bin width of the approximate energy-energy kernels
+            between global configurations, None for the exact ones
 
     """
 
-    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-2, 1e2), (1e-2, 1e2))):
-        super().__init__(kernel_name='TwoBodyManySpecies', theta=theta, bounds=bounds)
+    species_zeros = True
+
+    def __init__(self, theta=(1., 1., 1.), bounds=((1e-2, 1e2), (1e-2, 1e2), (1e-2, 1e2)),
+                 engine='theano', batch_size=256, species_sorted=False, dtype='float64',
+                 window_tol=None, histogram_width=None):
+        super().__init__(kernel_name='TwoBodyManySpecies', theta=theta, bounds=bounds,
+                         engine=engine, batch_size=batch_size, species_sorted=species_sorted,
+                         dtype=dtype, window_tol=window_tol, histogram_width=histogram_width)
         self.type = "multi"
 
     @staticmethod
-    def compile_theano():
+    def compile_theano(names, dtype='float64'):
         """
         This function generates theano compiled kernels for global energy and force learning
 
         The position of the atoms relative to the central one, and their chemical species
         are defined by a matrix of dimension Mx5 here called r1 and r2.
 
+        Args:
+            names (list): names of the functions to compile, e.g. "k2_ee"
+            dtype (str): "float64" or "float32", precision of the compiled functions
+
         Returns:
-            k2_ee (func): energy-energy kernel
-            k2_ef (func): energy-force kernel
-            k2_ff (func): force-force kernel
+            functions (dict): the compiled theano functions, by name
         """
 
-        if not (os.path.exists(Mffpath / 'k2_ee_m.pickle') and
-                os.path.exists(Mffpath / 'k2_ef_m.pickle') and os.path.exists(Mffpath / 'k2_ff_m.pickle')):
-            print("Building Kernels")
-
-            import theano.tensor as T
-            from theano import function, scan
-            logger.info("Started compilation of theano two body kernels")
-            # --------------------------------------------------
-            # INITIAL DEFINITIONS
-            # --------------------------------------------------
-
-            # positions of central atoms
-            r1, r2 = T.dvectors('r1d', 'r2d')
-            # positions of neighbours
-            rho1, rho2 = T.dmatrices('rho1', 'rho2')
-            # lengthscale hyperparameter
-            sig = T.dscalar('sig')
-            # cutoff hyperparameters
-            theta = T.dscalar('theta')
-            rc = T.dscalar('rc')
-
-            # positions of neighbours without chemical species (3D space assumed)
-            rho1s = rho1[:, 0:3]
-            rho2s = rho2[:, 0:3]
-            alpha_1 = rho1[:, 3]  # .flatten()
-            alpha_2 = rho2[:, 3]  # .flatten()
-            alpha_j = rho1[:, 4]  # .flatten()
-            alpha_m = rho2[:, 4]  # .flatten()
-
-            # numerical kronecker
-            def delta_alpha2(a1j, a2m):
-                d = T.exp(-(a1j - a2m) ** 2 / (2 * 1e-5 ** 2))
-                return d
-
-            # matrices determining whether couples of atoms have the same atomic number
-            delta_alphas12 = delta_alpha2(alpha_1[:, None], alpha_2[None, :])
-            delta_alphasjm = delta_alpha2(alpha_j[:, None], alpha_m[None, :])
-            delta_alphas1m = delta_alpha2(alpha_1[:, None], alpha_m[None, :])
-            delta_alphasj2 = delta_alpha2(alpha_j[:, None], alpha_2[None, :])
-
-            # distances of atoms wrt to the central one and wrt each other in 1 and 2
-            r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
-            r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
-
-            # Get the squared exponential kernels
-            se_jm = T.exp(-(r1j[:, None] - r2m[None, :]) ** 2 / (2 * sig ** 2))
-
-            # Define cutoff function
-            cut_jm = 0.5*(1+T.cos(np.pi*r1j[:, None]/rc))*0.5*(1+T.cos(np.pi*r2m[None, :]/rc))*(
-                (T.sgn(rc-r1j) + 1) / 2)*((T.sgn(rc-r2m) + 1) / 2)
-
-            # Apply cutoffs and chemical species masks
-            se_jm = se_jm*cut_jm * \
-                (delta_alphas12 * delta_alphasjm + delta_alphas1m * delta_alphasj2)
-
-            ker = T.sum(se_jm)
-
-            # --------------------------------------------------
-            # FINAL FUNCTIONS
-            # --------------------------------------------------
-
-            # global energy energy kernel
-            k_ee_fun = function([r1, r2, rho1, rho2, sig, theta, rc], ker,
-                                allow_input_downcast=False, on_unused_input='warn')
-
-            # energy force kernel - Used to predict energies from forces
-            k_ef = T.grad(ker, r2)
-            k_ef_fun = function([r1, r2, rho1, rho2, sig, theta, rc], k_ef,
-                                allow_input_downcast=False, on_unused_input='warn')
-
-            # force force kernel - it uses only local atom pairs to avoid useless computation
-            k_ff = T.grad(ker, r1)
-            k_ff_der, updates = scan(lambda j, k_ff, r2: T.grad(k_ff[j], r2),
-                                     sequences=T.arange(k_ff.shape[0]), non_sequences=[k_ff, r2])
-
-            k_ff_fun = function([r1, r2, rho1, rho2, sig, theta, rc], k_ff_der,
-                                allow_input_downcast=False, on_unused_input='warn')
-
-            # Save the function that we want to use for multiprocessing
-            # This is necessary because theano is a crybaby and does not want to access the
-            # Automaticallly stored compiled object from different processes
-            with open(Mffpath / 'k2_ee_m.pickle', 'wb') as f:
-                pickle.dump(k_ee_fun, f)
-            with open(Mffpath / 'k2_ef_m.pickle', 'wb') as f:
-                pickle.dump(k_ef_fun, f)
-            with open(Mffpath / 'k2_ff_m.pickle', 'wb') as f:
-                pickle.dump(k_ff_fun, f)
 
-        else:
-            print("Loading Kernels")
-            with open(Mffpath / "k2_ee_m.pickle", 'rb') as f:
-                k_ee_fun = pickle.load(f)
-            with open(Mffpath / "k2_ef_m.pickle", 'rb') as f:
-                k_ef_fun = pickle.load(f)
-            with open(Mffpath / "k2_ff_m.pickle", 'rb') as f:
-                k_ff_fun = pickle.load(f)
-
-#         # --------------------------------------------------
-#         # WRAPPERS (we don't want to plug the position of the central element every time)
-#         # --------------------------------------------------
-
-        def k2_ee(conf1, conf2, sig, theta, rc):
-            """
-            Two body kernel for global energy-energy correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
-
-            Returns:
-                kernel (float): scalar valued energy-energy 2-body kernel
-
-            """
-            return k_ee_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
-
-        def k2_ef(conf1, conf2, sig, theta, rc):
-            """
-            Two body kernel for global energy-force correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
-
-            Returns:
-                kernel (array): 3x1 energy-force 2-body kernel
-
-            """
-            return -k_ef_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
-
-        def k2_ff(conf1, conf2, sig, theta, rc):
-            """
-            Two body kernel for energy-energy correlation
-
-            Args:
-                conf1 (array): first configuration.
-                conf2 (array): second configuration.
-                sig (float): lengthscale hyperparameter theta[0]
-                theta (float): cutoff decay rate hyperparameter theta[1]
-                rc (float): cutoff distance hyperparameter theta[2]
-
-            Returns:
-                kernel (matrix): 3x3 force-force 2-body kernel
-
-            """
-            return k_ff_fun(np.zeros(3), np.zeros(3), conf1, conf2, sig, theta, rc)
+        import theano.tensor as T
+        from theano import function, scan
+        logger.info("Started compilation of theano two body kernels")
+        # --------------------------------------------------
+        # INITIAL DEFINITIONS
+        # --------------------------------------------------
+
+        # positions of central atoms
+        r1, r2 = T.vectors('r1d', 'r2d')
+        # positions of neighbours
+        rho1, rho2 = T.matrices('rho1', 'rho2')
+        # lengthscale hyperparameter
+        sig = T.scalar('sig')
+        # cutoff hyperparameters
+        theta = T.scalar('theta')
+        rc = T.scalar('rc')
+
+        # positions of neighbours without chemical species (3D space assumed)
+        rho1s = rho1[:, 0:3]
+        rho2s = rho2[:, 0:3]
+        alpha_1 = rho1[:, 3]  # .flatten()
+        alpha_2 = rho2[:, 3]  # .flatten()
+        alpha_j = rho1[:, 4]  # .flatten()
+        alpha_m = rho2[:, 4]  # .flatten()
+
+        # numerical kronecker
+        def delta_alpha2(a1j, a2m):
+            d = T.exp(-(a1j - a2m) ** 2 / (2 * 1e-5 ** 2))
+            return d
+
+        # matrices determining whether couples of atoms have the same atomic number
+        delta_alphas12 = delta_alpha2(alpha_1[:, None], alpha_2[None, :])
+        delta_alphasjm = delta_alpha2(alpha_j[:, None], alpha_m[None, :])
+        delta_alphas1m = delta_alpha2(alpha_1[:, None], alpha_m[None, :])
+        delta_alphasj2 = delta_alpha2(alpha_j[:, None], alpha_2[None, :])
+
+        # distances of atoms wrt to the central one and wrt each other in 1 and 2
+        r1j = T.sqrt(T.sum((rho1s[:, :] - r1[None, :]) ** 2, axis=1))
+        r2m = T.sqrt(T.sum((rho2s[:, :] - r2[None, :]) ** 2, axis=1))
+
+        # Get the squared exponential kernels
+        se_jm = T.exp(-(r1j[:, None] - r2m[None, :]) ** 2 / (2 * sig ** 2))
+
+        # Define cutoff function
+        cut_jm = 0.5*(1+T.cos(np.pi*r1j[:, None]/rc))*0.5*(1+T.cos(np.pi*r2m[None, :]/rc))*(
+            (T.sgn(rc-r1j[:, None]) + 1) / 2)*((T.sgn(rc-r2m[None, :]) + 1) / 2)
+
+        # Apply cutoffs and chemical species masks
+        se_jm = se_jm*cut_jm * \
+            (delta_alphas12 * delta_alphasjm + delta_alphas1m * delta_alphasj2)
+
+        ker = T.sum(se_jm)
+
+        # --------------------------------------------------
+        # FINAL FUNCTIONS
+        # --------------------------------------------------
+
+        functions = {}
+        # global energy energy kernel
+        if 'k2_ee' in names:
+            functions['k2_ee'] = function([r1, r2, rho1, rho2, sig, theta, rc], ker,
+                                          allow_input_downcast=True, on_unused_input='warn')
+
+        # energy force kernel - Used to predict energies from forces
+        k_ef = T.grad(ker, r2)
+        if 'k2_ef' in names:
+            functions['k2_ef'] = function([r1, r2, rho1, rho2, sig, theta, rc], k_ef,
+                                          allow_input_downcast=True, on_unused_input='warn')
+
+        # force force kernel - it uses only local atom pairs to avoid useless computation
+        k_ff = T.grad(ker, r1)
+        k_ff_der, updates = scan(lambda j, k_ff, r2: T.grad(k_ff[j], r2),
+                                 sequences=T.arange(k_ff.shape[0]), non_sequences=[k_ff, r2])
+
+        if 'k2_ff' in names:
+            functions['k2_ff'] = function([r1, r2, rho1, rho2, sig, theta, rc], k_ff_der,
+                                          allow_input_downcast=True, on_unused_input='warn')
 
         logger.info("Ended compilation of theano two body kernels")
 
-        return k2_ee, k2_ef, k2_ff
+        return functions
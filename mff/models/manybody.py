@@ -50,6 +50,8 @@ class ManyBodySingleSpeciesModel(Model):
 
         kernel = kernels.ManyBodySingleSpeciesKernel(
             theta=[sigma, theta, r_cut])
+        # The self-kernels used by predict with return_std are kept for each configuration
+        kernel.use_diag_cache()
         self.gp = gp.GaussianProcess(kernel=kernel, noise=noise, **kwargs)
 
         self.grid, self.grid_start, self.grid_num = None, None, None
@@ -254,6 +256,8 @@ class ManyBodyManySpeciesModel(Model):
         self.r_cut = r_cut
 
         kernel = kernels.ManyBodyManySpeciesKernel(theta=[sigma, theta, r_cut])
+        # The self-kernels used by predict with return_std are kept for each configuration
+        kernel.use_diag_cache()
         self.gp = gp.GaussianProcess(kernel=kernel, noise=noise, **kwargs)
 
         self.grid, self.grid_start, self.grid_num = {}, None, None
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Out-of-core force-force gram matrices, for training sets whose gram matrix does not fit in memory.
+
+The gram matrix is written tile by tile into a memory-mapped file. Every finished tile is
+recorded in a ledger next to the file, so that a calculation that was interrupted resumes
+from the tiles it already wrote. The Cholesky factor is then computed in place, one panel of
+columns at a time, and its progress is recorded in the same ledger.
+
+The ledger is a text file whose first line describes the gram matrix, the kernel and its
+training configurations, and whose other lines each record a finished tile or panel.
+A ledger describing a different calculation is discarded together with the matrix.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+from scipy.linalg import cholesky, solve_triangular
+
+from mff.kernels.blockcache import conf_hash
+
+logger = logging.getLogger(__name__)
+
+
+def gram_key(kernel, X):
+    """ Key of the gram matrix of a kernel on a set of configurations
+
+    Args:
+        kernel (Kernel): the kernel
+        X (list): the configurations, or their descriptors
+
+    Returns:
+        key (str): hexadecimal key, that only depends on the kernel, its hyperparameters,
+            its precision and the values of the configurations
+
+    """
+
+    h = hashlib.sha1()
+    h.update(repr((type(kernel).__name__, kernel.kernel_name, kernel.dtype,
+                   tuple(float(t) for t in kernel.theta))).encode())
+    h.update(conf_hash(X))
+
+    return h.hexdigest()
+
+
+class GramFile(object):
+    """ Force-force gram matrix stored in a memory-mapped file.
+
+    The 3N x 3N matrix is split in tiles of ``tile_size`` x ``tile_size`` configurations.
+    The tiles of the lower triangle are computed with ``kernel.calc_gram`` on the diagonal
+    and ``kernel.calc`` elsewhere, and written together with their transpose.
+
+    After ``cholesky`` the lower triangle of the file holds the Cholesky factor, while its
+    strictly upper triangle still holds the gram matrix, whose diagonal is kept in a separate
+    file. The factorization can thus be resumed, or undone by ``compute``.
+
+    Args:
+        path (str): path of the file of the gram matrix. The ledger and the diagonal are
+            stored next to it, with the .ledger and .diag.npy extensions
+        kernel (Kernel): the kernel
+        X (list): N training configurations, or their descriptors
+        tile_size (int): number of configurations per side of a tile, the Cholesky panels
+            are 3 * tile_size columns wide
+
+    Attributes:
+        size (int): size of the matrix, 3N
+        tiles (set): (i, j) indices of the finished tiles, with j <= i
+        panels (dict): noise level of the finished Cholesky panels, by panel index
+
+    """
+
+    def __init__(self, path, kernel, X, tile_size=256):
+        self.path = str(path)
+        self.ledger_path = self.path + '.ledger'
+        self.diag_path = self.path + '.diag.npy'
+        self.kernel = kernel
+        self.X = X
+        self.tile_size = tile_size
+        self.size = 3 * len(X)
+        self.header = json.dumps({'size': self.size, 'tile_size': tile_size,
+                                  'key': gram_key(kernel, X)}, sort_keys=True)
+        self.tiles = set()
+        self.panels = {}
+
+        if os.path.exists(self.path) and self.read_ledger():
+            logger.info('Resuming the gram matrix %s from %i tiles and %i panels'
+                        % (self.path, len(self.tiles), len(self.panels)))
+        else:
+            self.open('w+')
+            if os.path.exists(self.diag_path):
+                os.remove(self.diag_path)
+            self.write_ledger()
+
+    @property
+    def n_tiles(self):
+        """ Number of tiles per side of the matrix """
+        return -(-self.size // (3 * self.tile_size))
+
+    def open(self, mode='r+'):
+        """ Map the matrix in memory
+
+        Args:
+            mode (str): 'r' for read-only access, 'r+' to write into the matrix,
+                'w+' to create a new zero-filled matrix
+
+        Returns:
+            matrix (np.memmap): the 3N x 3N matrix
+
+        """
+
+        return np.memmap(self.path, dtype='float64', mode=mode, shape=(self.size, self.size))
+
+    def read_ledger(self):
+        """ Read the finished tiles and panels from the ledger
+
+        Returns:
+            valid (bool): False if there is no ledger or it describes another calculation
+
+        """
+
+        if not os.path.exists(self.ledger_path):
+            return False
+        with open(self.ledger_path) as f:
+            lines = f.read().split('\n')
+        if lines[0] != self.header:
+            return False
+
+        # The last line is empty, or was left incomplete by an interrupted run
+        for line in lines[1:-1]:
+            fields = line.split()
+            if fields[0] == 'tile':
+                self.tiles.add((int(fields[1]), int(fields[2])))
+            elif fields[0] == 'panel':
+                self.panels[int(fields[1])] = float(fields[2])
+
+        return True
+
+    def write_ledger(self):
+        """ Replace the ledger with the current tiles and panels, atomically """
+        lines = [self.header] + ['tile %i %i' % t for t in sorted(self.tiles)]
+        lines += ['panel %i %r' % (k, self.panels[k]) for k in sorted(self.panels)]
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.ledger_path)
+
+    def record(self, line):
+        """ Append a finished tile or panel to the ledger. The matrix must be flushed first """
+        with open(self.ledger_path, 'a') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def compute(self, ncores=1):
+        """ Compute the missing tiles of the gram matrix, and undo the Cholesky
+        factorization if the file holds one
+
+        Args:
+            ncores (int): number of CPU workers used by the kernel for each tile
+
+        Returns:
+            gram (np.memmap): the 3N x 3N gram matrix
+
+        """
+
+        gram = self.open('r+')
+        if self.panels:
+            self.restore(gram)
+
+        t = self.tile_size
+        X = self.X
+        for i in range(self.n_tiles):
+            for j in range(i + 1):
+                if (i, j) in self.tiles:
+                    continue
+                if i == j:
+                    block = self.kernel.calc_gram(X[t * i:t * i + t], ncores)
+                else:
+                    block = self.kernel.calc(X[t * i:t * i + t], X[t * j:t * j + t], ncores)
+                rows = slice(3 * t * i, 3 * t * i + block.shape[0])
+                cols = slice(3 * t * j, 3 * t * j + block.shape[1])
+                gram[rows, cols] = block
+                gram[cols, rows] = block.T
+                gram.flush()
+                self.record('tile %i %i' % (i, j))
+                self.tiles.add((i, j))
+                logger.info('Gram matrix tile %i, %i of %i computed' % (i, j, self.n_tiles))
+
+        return gram
+
+    def panel_slices(self):
+        """ Column ranges of the Cholesky panels """
+        w = 3 * self.tile_size
+        return [slice(c, min(c + w, self.size)) for c in range(0, self.size, w)]
+
+    def restore(self, gram):
+        """ Copy the gram matrix back into the lower triangle of the file, from its upper
+        triangle and the saved diagonal, discarding the Cholesky factor """
+
+        diag = np.load(self.diag_path)
+        for p in self.panel_slices():
+            gram[p.stop:, p] = gram[p, p.stop:].T
+            block = np.array(gram[p, p])
+            lower = np.tril_indices(len(block), -1)
+            block[lower] = block.T[lower]
+            block[np.diag_indices_from(block)] = diag[p]
+            gram[p, p] = block
+        gram.flush()
+        self.panels = {}
+        self.write_ledger()
+
+    def cholesky(self, noise=0.):
+        """ Cholesky factorization of the gram matrix plus noise on its diagonal, in place.
+        The columns are factorized one panel at a time, each panel being read from the
+        upper triangle of the file and updated with the panels already factorized, so that
+        an interrupted factorization resumes from the last finished panel.
+
+        Args:
+            noise (float): noise added to the diagonal of the gram matrix
+
+        Returns:
+            L (np.memmap): the 3N x 3N matrix, whose lower triangle is the Cholesky factor
+
+        """
+
+        if len(self.tiles) < self.n_tiles * (self.n_tiles + 1) // 2:
+            raise ValueError("The gram matrix %s is not complete, call compute first" % self.path)
+
+        gram = self.open('r+')
+        if any(n != noise for n in self.panels.values()):
+            self.restore(gram)
+        if not self.panels:
+            diag = np.array(np.diagonal(gram))
+            folder = os.path.dirname(os.path.abspath(self.diag_path))
+            fd, tmp = tempfile.mkstemp(suffix='.npy', dir=folder)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, diag)
+            os.replace(tmp, self.diag_path)
+        diag = np.load(self.diag_path)
+
+        panels = self.panel_slices()
+        for k, p in enumerate(panels):
+            if k in self.panels:
+                continue
+            w = p.stop - p.start
+            panel = np.array(gram[p, p.start:].T)
+            panel[np.diag_indices(w)] = diag[p] + noise
+            for q in panels[:k]:
+                factor = np.array(gram[p.start:, q])
+                panel -= factor.dot(factor[:w].T)
+            # Only the lower triangle of the diagonal block was read from the gram matrix
+            block = np.tril(panel[:w])
+            block += np.tril(block, -1).T
+            factor = cholesky(block, lower=True)
+            panel[w:] = solve_triangular(factor, panel[w:].T, lower=True).T
+
+            gram[p.stop:, p] = panel[w:]
+            block = np.array(gram[p, p])
+            lower = np.tril_indices(w)
+            block[lower] = factor[lower]
+            gram[p, p] = block
+            gram.flush()
+            self.record('panel %i %r' % (k, noise))
+            self.panels[k] = noise
+            logger.info('Cholesky panel %i of %i factorized' % (k, len(panels)))
+
+        return gram
+
+    def cho_solve(self, y):
+        """ Solve the linear system of the factorized gram matrix, one panel at a time
+
+        Args:
+            y (array): 3N x K right-hand sides
+
+        Returns:
+            x (array): 3N x K solutions
+
+        """
+
+        if len(self.panels) < len(self.panel_slices()):
+            raise ValueError("The gram matrix %s is not factorized, call cholesky first"
+                             % self.path)
+
+        L = self.open('r')
+        z = np.array(y, dtype='float64')
+        panels = self.panel_slices()
+        for p in panels:
+            z[p] -= np.dot(L[p, :p.start], z[:p.start])
+            z[p] = solve_triangular(L[p, p], z[p], lower=True)
+        for p in panels[::-1]:
+            z[p] -= np.dot(L[p.stop:, p].T, z[p.stop:])
+            z[p] = solve_triangular(L[p, p], z[p], lower=True, trans='T')
+
+        return z
@@ -24,6 +24,11 @@ def find_repulstion_sigma(confs):
     The distance r is the smallest bond distance found in the training set.
     """
 
+    if isinstance(confs, configurations.PackedGlobalConfs):
+        confs = confs.confs
+    if isinstance(confs, configurations.PackedConfs):
+        return np.min(np.sum(confs.positions**2, axis=1)**0.5)*0.02**(1/12)
+
     dists = []
     for c in confs:
         if len(c.shape) == 2:
@@ -44,6 +49,13 @@ def get_repulsive_forces(confs, sig):
     """ Function used to get repulsive forces for a configuration
     given a sigma value. The repuslion is a LJ repulsion.
     """
+    if isinstance(confs, configurations.PackedConfs):
+        d_ = np.sum(confs.positions**2, axis=1)**0.5
+        f = 12*(sig/d_)**12/d_**2
+        rows = confs.conf_index
+        return np.stack([np.bincount(rows, f*confs.positions[:, k], minlength=len(confs))
+                         for k in range(3)], axis=1)
+
     forces = np.zeros((len(confs), 3))
     for i, c in enumerate(confs):
         d_ = np.sum(c[:, :3]**2, axis=1)**0.5
@@ -57,6 +69,15 @@ def get_repulsive_energies(confs, sig, mapping=False):
     """ Function used to get repulsive energy for a configuration
     given a sigma value. The repuslion is a LJ repulsion.
     """
+    if isinstance(confs, (configurations.PackedConfs, configurations.PackedGlobalConfs)):
+        packed = confs.confs if isinstance(confs, configurations.PackedGlobalConfs) else confs
+        e = np.bincount(packed.conf_index, (sig/np.sum(packed.positions**2, axis=1)**0.5)**12,
+                        minlength=len(packed))
+        if isinstance(confs, configurations.PackedGlobalConfs) and not mapping:
+            e = np.add.reduceat(np.append(e, 0), confs.offsets[:-1])
+            e[confs.sizes == 0] = 0
+        return e
+
     energies = np.zeros(len(confs))
     if not mapping:
         for i, c in enumerate(confs):
@@ -21,6 +21,9 @@ setup(
     url="https://github.com/kcl-tscm/mff",
     packages=find_packages(),
     ext_modules=[tricube_cpp_module],
+    entry_points={
+        'console_scripts': ['mff-precompile = mff.kernels.precompile:main'],
+    },
     package_data={
         # If any package contains source code files, include them:
         '': ['*.h', '*.c', '*.pyf']
@@ -33,6 +36,9 @@ setup(
         'theano >= 1.0.4',
         'scipy'
     ],
+    extras_require={
+        'numba': ['numba >= 0.49'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
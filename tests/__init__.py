@@ -1 +1,6 @@
 from tests.test_mff import TestMFFModels
+from tests.test_kernels import (TestTwoBodyEngine, TestParallel, TestFunctionCache,
+                                TestBlockCache, TestTriplets, TestNumbaEngine,
+                                TestEamDescriptors, TestGramGradient, TestGramFile,
+                                TestSpeciesBlocks)
+from tests.test_configurations import TestPackedConfs
@@ -0,0 +1,36 @@
+import unittest
+
+import numpy as np
+
+from mff.configurations import PackedConfs, PackedGlobalConfs
+
+
+class TestPackedConfs(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.confs = []
+        for m in (3, 5, 0, 4):
+            conf = np.zeros((m, 5))
+            conf[:, :3] = rng.uniform(-3., 3., (m, 3))
+            conf[:, 3] = 1
+            conf[:, 4] = rng.choice((1, 2), m)
+            self.confs.append(conf)
+
+    def test_roundtrip(self):
+        packed = PackedConfs.from_confs(self.confs)
+        self.assertEqual(len(packed), 4)
+        for a, b in zip(packed, self.confs):
+            np.testing.assert_array_equal(a, b)
+        for a, b in zip(packed[[3, 0]], [self.confs[3], self.confs[0]]):
+            np.testing.assert_array_equal(a, b)
+
+    def test_global_confs(self):
+        packed = PackedGlobalConfs.from_global_confs([self.confs[:1], self.confs[1:]])
+        self.assertEqual(len(packed), 2)
+        self.assertEqual(len(packed[1]), 3)
+        np.testing.assert_array_equal(packed[1][0], self.confs[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
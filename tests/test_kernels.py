@@ -0,0 +1,953 @@
+import contextlib
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import multiprocessing as mp
+
+from mff import gp, outofcore
+from mff.kernels import (base, blockcache, eamkernel, manybodykernel, numbaengine, parallel,
+                         speciesblocks, threebodykernel, twobodykernel)
+from mff.kernels.descriptors import Triplets
+
+
+def random_conf(rng, m, species=(1,)):
+    conf = np.zeros((m, 5))
+    conf[:, :3] = rng.uniform(-3., 3., (m, 3))
+    conf[:, 3] = rng.choice(species)
+    conf[:, 4] = rng.choice(species, m)
+    return conf
+
+
+def fake_k2_ee(r1, r2, rho1, rho2, sig, theta, rc):
+    """ Stand-in for a compiled theano function, picklable by the function cache """
+    return float(len(rho1) * len(rho2))
+
+
+class TestTwoBodyEngine(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.confs = [random_conf(rng, m, (1, 2)) for m in (3, 5, 4, 6)]
+
+    def test_batch_k2_matches_pairwise(self):
+        X = self.confs
+        p = twobodykernel.pad_confs(X, 3.5)
+        ff = twobodykernel.batch_k2(p, p, 0.7, 'multi', 'ff')
+        for i in range(len(X)):
+            for j in range(len(X)):
+                pi = twobodykernel.pad_confs(X[i:i + 1], 3.5)
+                pj = twobodykernel.pad_confs(X[j:j + 1], 3.5)
+                np.testing.assert_allclose(
+                    ff[i, j], twobodykernel.batch_k2(pi, pj, 0.7, 'multi', 'ff')[0, 0],
+                    atol=1e-12)
+
+    def test_ff_symmetry(self):
+        p = twobodykernel.pad_confs(self.confs, 3.5)
+        ff = twobodykernel.batch_k2(p, p, 0.7, 'multi', 'ff')
+        np.testing.assert_allclose(ff, ff.transpose(1, 0, 3, 2), atol=1e-12)
+
+    def test_closed_form_derivatives(self):
+        kernel = twobodykernel.TwoBodyManySpeciesKernel(engine='numpy')
+        c1, c2 = self.confs[0], self.confs[1]
+        shift = np.eye(3) * 1e-4
+
+        # Moving the central atom by d moves the neighbours by -d
+        def ee(d1, d2):
+            return kernel.k2_ee(c1 - np.r_[d1, 0, 0], c2 - np.r_[d2, 0, 0], 0.7, 1., 3.5)
+
+        z = np.zeros(3)
+        np.testing.assert_allclose(kernel.k2_ef(c1, c2, 0.7, 1., 3.5),
+                                   [-(ee(z, s) - ee(z, -s)) / 2e-4 for s in shift], atol=1e-7)
+        np.testing.assert_allclose(
+            kernel.k2_ff(c1, c2, 0.7, 1., 3.5),
+            [[(ee(a, b) - ee(a, -b) - ee(-a, b) + ee(-a, -b)) / 4e-8 for b in shift]
+             for a in shift], atol=1e-5)
+
+    def test_closed_form_matches_theano(self):
+        try:
+            import theano  # noqa: F401
+        except ImportError:
+            self.skipTest('theano is not installed')
+        for cls in (twobodykernel.TwoBodySingleSpeciesKernel,
+                    twobodykernel.TwoBodyManySpeciesKernel):
+            ref, kernel = cls(), cls(engine='numpy')
+            for name in ('k2_ee', 'k2_ef', 'k2_ff'):
+                for c1 in self.confs:
+                    for c2 in self.confs:
+                        np.testing.assert_allclose(
+                            getattr(kernel, name)(c1, c2, 0.7, 1., 3.5),
+                            getattr(ref, name)(c1, c2, 0.7, 1., 3.5), atol=1e-10)
+
+    def test_block_view(self):
+        p = twobodykernel.pad_confs(self.confs, 3.5)
+        ff = twobodykernel.batch_k2(p, p, 0.7, 'multi', 'ff')
+        ref = ff.transpose(0, 2, 1, 3).reshape(12, 12)
+        for order in ('C', 'F'):
+            gram = np.zeros((12, 12), order=order)
+            view = twobodykernel.BaseTwoBody.block_view(gram, 4, 4)
+            view[...] = ff.transpose(0, 2, 1, 3)
+            self.assertTrue(np.shares_memory(view, gram))
+            np.testing.assert_allclose(gram, ref)
+
+    def test_single_precision(self):
+        self.assertEqual(base.function_name('k2_ff', 'multi', 'float32'), 'k2_ff_m_f32')
+        self.assertEqual(base.function_name('k2_ff', 'multi'), 'k2_ff_m')
+        with self.assertRaises(ValueError):
+            twobodykernel.TwoBodyManySpeciesKernel(engine='numpy', dtype='float16')
+
+        ref = twobodykernel.TwoBodyManySpeciesKernel(theta=(0.7, 1., 3.5), engine='numpy')
+        kernel = twobodykernel.TwoBodyManySpeciesKernel(theta=(0.7, 1., 3.5), engine='numpy',
+                                                        dtype='float32')
+        self.assertEqual(twobodykernel.pad_confs(self.confs, 3.5, 'float32')[0].dtype, np.float32)
+        gram = kernel.calc_gram(self.confs)
+        self.assertEqual(gram.dtype, np.float64)
+        np.testing.assert_allclose(gram, ref.calc_gram(self.confs), rtol=1e-4, atol=1e-6)
+        np.testing.assert_allclose(kernel.calc_ee([self.confs], [self.confs]),
+                                   ref.calc_ee([self.confs], [self.confs]), rtol=1e-5)
+
+    def test_segment_sums(self):
+        X_glob = [self.confs[:2], [], self.confs[1:]]
+        kernel = twobodykernel.TwoBodyManySpeciesKernel(theta=(0.7, 1., 3.5), engine='numpy',
+                                                        batch_size=2)
+
+        def ee(x1, x2):
+            return sum(kernel.k2_ee(c1, c2, 0.7, 1., 3.5) for c1 in x1 for c2 in x2)
+
+        def ef(x1, conf2):
+            return sum((kernel.k2_ef(c1, conf2, 0.7, 1., 3.5) for c1 in x1), np.zeros(3))
+
+        np.testing.assert_allclose(kernel.calc_gram_e(X_glob),
+                                   [[0.25 * ee(x1, x2) for x2 in X_glob] for x1 in X_glob],
+                                   atol=1e-12)
+        np.testing.assert_allclose(kernel.calc_ee(self.confs, X_glob, mapping=True),
+                                   [[0.5 * ee([c1], x2) for x2 in X_glob] for c1 in self.confs],
+                                   atol=1e-12)
+        np.testing.assert_allclose(kernel.calc_ef(X_glob, self.confs),
+                                   [np.concatenate([0.5 * ef(x1, c2) for c2 in self.confs])
+                                    for x1 in X_glob], atol=1e-12)
+        np.testing.assert_array_equal(
+            base.segment_sum(np.arange(6.).reshape(3, 2), np.array([0, 2, 2, 3]), axis=0),
+            [[2., 4.], [0., 0.], [4., 5.]])
+
+    def test_species_sorted(self):
+        rng = np.random.RandomState(1)
+        X = [random_conf(rng, m, (1, 2, 3)) for m in (3, 7, 5, 6)]
+        p = twobodykernel.pad_confs(X, 3.5)
+        for mode in ('ee', 'ef', 'ff'):
+            np.testing.assert_allclose(twobodykernel.sorted_k2(p, p, 0.7, 'multi', mode),
+                                       twobodykernel.batch_k2(p, p, 0.7, 'multi', mode),
+                                       atol=1e-12)
+
+        ref = twobodykernel.TwoBodyManySpeciesKernel(theta=(0.7, 1., 3.5), engine='numpy')
+        kernel = twobodykernel.TwoBodyManySpeciesKernel(theta=(0.7, 1., 3.5), engine='numpy',
+                                                        species_sorted=True)
+        np.testing.assert_allclose(kernel.calc_gram(X), ref.calc_gram(X), atol=1e-12)
+        np.testing.assert_allclose(kernel.k2_ef(X[0], X[1], 0.7, 1., 3.5),
+                                   ref.k2_ef(X[0], X[1], 0.7, 1., 3.5), atol=1e-12)
+        with self.assertRaises(ValueError):
+            twobodykernel.TwoBodyManySpeciesKernel(species_sorted=True)
+
+    def test_distance_window(self):
+        rng = np.random.RandomState(2)
+        X = [random_conf(rng, m, (1, 2)) for m in (12, 20, 0, 16)]
+        p = twobodykernel.pad_confs(X, 3.5)
+        q = twobodykernel.sort_neighbours(p, 10.)
+        width = twobodykernel.window_width(0.02, 1e-15)
+        for mode in ('ee', 'ef', 'ff'):
+            dense = twobodykernel.batch_k2(p, p, 0.02, 'multi', mode)
+            with mock.patch.object(twobodykernel, 'batch_k2') as m:
+                np.testing.assert_allclose(
+                    twobodykernel.window_k2(p, q, 0.02, 'multi', mode, width), dense, atol=1e-12)
+            m.assert_not_called()
+
+        ref = twobodykernel.TwoBodyManySpeciesKernel(theta=(0.1, 1., 3.5), engine='numpy')
+        for species_sorted in (False, True):
+            kernel = twobodykernel.TwoBodyManySpeciesKernel(
+                theta=(0.1, 1., 3.5), engine='numpy', species_sorted=species_sorted,
+                window_tol=1e-4)
+            error = np.abs(kernel.calc_gram(X) - ref.calc_gram(X)).max()
+            self.assertGreater(error, 0)
+            self.assertLessEqual(error, kernel.window_error)
+            self.assertLessEqual(
+                abs(kernel.k2_ee(X[0], X[1], 0.1, 1., 3.5) - ref.k2_ee(X[0], X[1], 0.1, 1., 3.5)),
+                twobodykernel.window_bound(0.1, 3.5, 1e-4, 'ee', 'multi') * 12 * 20)
+        with self.assertRaises(ValueError):
+            twobodykernel.TwoBodyManySpeciesKernel(window_tol=1e-12)
+
+    def test_pair_histograms(self):
+        rng = np.random.RandomState(3)
+        X_glob = [[random_conf(rng, 8, (1, 2)) for _ in range(n)] for n in (4, 0, 6, 2)]
+        ref = twobodykernel.TwoBodyManySpeciesKernel(theta=(0.5, 1., 3.5), engine='numpy')
+        errors = []
+        for width in (0.1, 0.02):
+            kernel = twobodykernel.TwoBodyManySpeciesKernel(theta=(0.5, 1., 3.5), engine='numpy',
+                                                            histogram_width=width)
+            scale = np.abs(ref.calc_gram_e(X_glob)).max()
+            errors.append(kernel.histogram_error(X_glob))
+            np.testing.assert_allclose(kernel.calc_gram_e(X_glob), ref.calc_gram_e(X_glob),
+                                       atol=errors[-1] * scale * (1 + 1e-9))
+            np.testing.assert_allclose(kernel.calc_ee(X_glob[2], X_glob, mapping=True),
+                                       ref.calc_ee(X_glob[2], X_glob, mapping=True),
+                                       atol=errors[-1] * scale)
+        self.assertLess(errors[1], 1e-3)
+
+        # The reference skips neither the histograms nor the window of the kernel
+        kernel = twobodykernel.TwoBodyManySpeciesKernel(theta=(0.5, 1., 3.5), engine='numpy',
+                                                        histogram_width=0.02, window_tol=1e-2)
+        cache = kernel.use_block_cache()
+        error = kernel.histogram_error(X_glob)
+        gram, exact = kernel.calc_gram_e(X_glob), ref.calc_gram_e(X_glob)
+        self.assertAlmostEqual(error, np.abs(gram - exact).max() / np.abs(exact).max())
+        self.assertIs(kernel.block_cache, cache)
+        self.assertLess(errors[1], errors[0] / 10)
+        for width in (0., -0.1):
+            with self.assertRaises(ValueError):
+                twobodykernel.TwoBodyManySpeciesKernel(engine='numpy', histogram_width=width)
+
+        # Single species, one histogram per configuration with all the neighbours
+        codes, swap = twobodykernel.pair_codes(twobodykernel.pad_confs(X_glob[0], 3.5))
+        np.testing.assert_array_equal(codes[swap], twobodykernel.pair_code(
+            codes % 1024, codes // 1024))
+        h = twobodykernel.pair_histograms(twobodykernel.pad_confs(X_glob[0], 3.5), None, 3.5, 0.1)
+        self.assertEqual(h.shape, (4, 1, 37))
+        np.testing.assert_allclose(h.sum(axis=(1, 2)),
+                                   twobodykernel.pad_confs(X_glob[0], 3.5)[2].sum(axis=1))
+
+
+def outer_sum(conf1, conf2, scale):
+    return scale * np.outer(conf1[:, :3].sum(axis=0), conf2[:, :3].sum(axis=0))
+
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.confs = [random_conf(rng, m) for m in (3, 5, 1, 4, 6, 2, 3)]
+
+    def test_tiles_cover_pairs(self):
+        rng = np.random.RandomState(1)
+        scheduler = parallel.TileScheduler(3)
+        for symmetric in (False, True):
+            seen = np.zeros((7, 5 if not symmetric else 7), dtype=int)
+            w1 = rng.randint(1, 60, seen.shape[0]).astype(float)
+            w2 = w1 if symmetric else rng.randint(1, 60, seen.shape[1]).astype(float)
+            expected = np.tri(7, dtype=int) if symmetric else np.ones_like(seen)
+            tiles, costs = scheduler.tiles(w1, w2, symmetric)
+            self.assertAlmostEqual(costs.sum(), np.sum(np.outer(w1, w2) * expected))
+            for rows, cols in tiles:
+                for i in range(*rows):
+                    stop = min(cols[1], i + 1) if symmetric else cols[1]
+                    seen[i, cols[0]:stop] += 1
+            np.testing.assert_array_equal(seen, expected)
+
+    def test_calc_parallel(self):
+        X = self.confs
+        ref = np.block([[outer_sum(a, b, 2.) for b in X] for a in X])
+        with mp.Pool(2) as pool:
+            for mode in ('static', 'dynamic'):
+                scheduler = parallel.TileScheduler(2, mode)
+                ker = parallel.calc_parallel(pool, scheduler, outer_sum, X, X[:3], (3, 3),
+                                             args=(2.,))
+                gram = parallel.calc_parallel(pool, scheduler, outer_sum, X, X, (3, 3),
+                                              args=(2.,), symmetric=True, power=2)
+                np.testing.assert_allclose(ker, ref[:, :9])
+                np.testing.assert_allclose(gram, ref)
+                self.assertTrue(0 < len(scheduler.utilization) <= 2)
+
+    def test_numpy_engine(self):
+        rng = np.random.RandomState(3)
+        X = [random_conf(rng, m, (1, 2)) for m in (3, 5, 4, 6)]
+        for conf in X:
+            conf[:, :3] *= 0.6
+        X_glob = [X[:2], X[1:]]
+        for kernel in (threebodykernel.ThreeBodySingleSpeciesKernel(theta=(0.8, 1., 3.2),
+                                                                    engine='numpy'),
+                       threebodykernel.ThreeBodyManySpeciesKernel(theta=(0.8, 1., 3.2),
+                                                                  engine='numpy', window_tol=1e-6),
+                       manybodykernel.ManyBodySingleSpeciesKernel(theta=(0.8, 1., 3.2),
+                                                                  engine='numpy')):
+            calls = ((kernel.calc, (X[:3], X)), (kernel.calc_gram, (X,)),
+                     (kernel.calc_ee, (X_glob, X_glob)), (kernel.calc_ef, (X_glob, X)),
+                     (kernel.calc_gram_e, (X_glob,)), (kernel.calc_gram_ef, (X, X_glob)))
+            serial = [fun(*args) for fun, args in calls]
+            for (fun, args), ref in zip(calls, serial):
+                np.testing.assert_allclose(fun(*args, ncores=2), ref, atol=1e-12)
+            kernel.close_pool()
+
+    def test_mirror_lower(self):
+        rng = np.random.RandomState(2)
+        ref = rng.rand(12, 12)
+        ref = ref + ref.T
+        for order in ('C', 'F'):
+            gram = np.array(np.tril(ref), order=order)
+            for i in range(4):
+                gram[3 * i:3 * i + 3, 3 * i:3 * i + 3] = ref[3 * i:3 * i + 3, 3 * i:3 * i + 3]
+            parallel.mirror_lower(gram, 3)
+            np.testing.assert_allclose(gram, ref)
+
+
+class TestFunctionCache(unittest.TestCase):
+
+    def test_cache_root(self):
+        with mock.patch.dict(os.environ, {'MFF_CACHE_DIR': '/tmp/a', 'XDG_CACHE_HOME': '/tmp/b'}):
+            self.assertEqual(str(base.cache_root()), '/tmp/a')
+            del os.environ['MFF_CACHE_DIR']
+            self.assertEqual(str(base.cache_root()), '/tmp/b/mff')
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as root, \
+                mock.patch.dict(os.environ, {'MFF_CACHE_DIR': root}):
+            folder = base.cache_dir()
+            self.assertEqual(folder.parent, base.cache_root())
+            with base.cache_lock('TwoBodySingleSpecies', 'float32'):
+                base.save_function(np.arange(3.), 'k2_ee', 'single', 'float32')
+            self.assertEqual([p.name for p in folder.glob('*.pickle')], ['k2_ee_s_f32.pickle'])
+            self.assertFalse(list(folder.glob('*.tmp')))
+
+            base._functions.clear()
+            np.testing.assert_array_equal(base.load_function('k2_ee', 'single', 'float32'),
+                                          np.arange(3.))
+            with self.assertRaises(FileNotFoundError):
+                base.load_function('k2_ee', 'single')
+        base._functions.clear()
+
+    def test_save_deep_function(self):
+        deep = []
+        for _ in range(5000):
+            deep = [deep]
+        limit = sys.getrecursionlimit()
+        try:
+            sys.setrecursionlimit(2000)
+            with tempfile.TemporaryDirectory() as root, \
+                    mock.patch.dict(os.environ, {'MFF_CACHE_DIR': root}):
+                base.save_function(deep, 'k2_ee', 'single')
+                base._functions.clear()
+                self.assertEqual(len(base.load_function('k2_ee', 'single')), 1)
+            self.assertGreaterEqual(sys.getrecursionlimit(), base.RECURSION_LIMIT)
+        finally:
+            sys.setrecursionlimit(limit)
+            base._functions.clear()
+
+    def test_lazy_compilation(self):
+        functions = {'k2_ee': fake_k2_ee}
+        with tempfile.TemporaryDirectory() as root, \
+                mock.patch.dict(os.environ, {'MFF_CACHE_DIR': root}), \
+                mock.patch.object(base, 'theano_precision', contextlib.nullcontext), \
+                mock.patch.object(twobodykernel.TwoBodySingleSpeciesKernel, 'compile_theano',
+                                  return_value=functions) as compile_theano:
+            kernel = twobodykernel.TwoBodySingleSpeciesKernel()
+            self.assertFalse(list(base.cache_dir().glob('*.pickle')))
+
+            conf = np.ones((4, 5))
+            self.assertEqual(kernel.k2_ee(conf, conf[:3], 1., 1., 1.), 12.)
+            self.assertEqual(kernel.k2_ee(conf, conf, 1., 1., 1.), 16.)
+            compile_theano.assert_called_once_with(('k2_ee',), 'float64')
+
+            base._functions.clear()
+            self.assertEqual(twobodykernel.TwoBodySingleSpeciesKernel().k2_ee(
+                conf, conf, 1., 1., 1.), 16.)
+            compile_theano.assert_called_once_with(('k2_ee',), 'float64')
+        base._functions.clear()
+
+
+class TestBlockCache(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.confs = [random_conf(rng, m) for m in (3, 5, 4, 6)]
+        self.kernel = twobodykernel.TwoBodySingleSpeciesKernel(theta=(0.7, 1., 3.5), engine='numpy')
+
+    def test_cached_blocks(self):
+        X = self.confs
+        ref = self.kernel.calc_gram(X)
+        cache = self.kernel.use_block_cache()
+        np.testing.assert_allclose(self.kernel.calc_gram(X), ref)
+        self.assertEqual((cache.hits, cache.misses), (0, 10))
+        np.testing.assert_allclose(self.kernel.calc(X, X), ref)
+        self.assertEqual((cache.hits, cache.misses), (16, 10))
+        np.testing.assert_allclose(self.kernel.calc_gram(X, order='F'), ref)
+        self.assertEqual(cache.hits, 26)
+
+        Y = [X[1], np.array(X[2]), X[0] + 0.1]
+        np.testing.assert_allclose(self.kernel.calc(Y, X[:2]), twobodykernel.TwoBodySingleSpeciesKernel(
+            theta=(0.7, 1., 3.5), engine='numpy').calc(Y, X[:2]))
+        self.assertEqual(cache.misses, 12)
+
+        self.kernel.theta = (0.8, 1., 3.5)
+        self.kernel.calc(X[:1], X[:1])
+        self.assertEqual(cache.misses, 13)
+
+        # The approximation options change the kernel, and are part of the keys
+        self.kernel.window_tol = 1e-2
+        self.kernel.calc(X[:1], X[:1])
+        self.assertEqual(cache.misses, 14)
+        self.kernel.histogram_width = 0.1
+        self.kernel.calc(X[:1], X[:1])
+        self.assertEqual(cache.misses, 15)
+
+    def test_diag_cache(self):
+        kernel = manybodykernel.ManyBodySingleSpeciesKernel(theta=(0.9, 1., 3.2), engine='numpy')
+        ref = kernel.calc_diag(self.confs), kernel.calc_diag_e(self.confs)
+        cache = kernel.use_diag_cache()
+        np.testing.assert_allclose(kernel.calc_diag(self.confs[:2]), ref[0][:6])
+        np.testing.assert_allclose(kernel.calc_diag(self.confs), ref[0])
+        np.testing.assert_allclose(kernel.calc_diag_e(self.confs), ref[1])
+        self.assertEqual((cache.hits, cache.misses), (2, 8))
+        kernel.theta = (0.8, 1., 3.2)
+        kernel.calc_diag(self.confs[:1])
+        self.assertEqual(cache.misses, 9)
+
+    def test_eviction(self):
+        cache = blockcache.BlockCache(max_bytes=1000)
+        for i in range(20):
+            cache.put((i,), np.full((3, 3), i, dtype=float))
+        self.assertLessEqual(cache.nbytes, 1000)
+        self.assertGreater(cache.evictions, 0)
+        self.assertIsNone(cache.get((0,)))
+        np.testing.assert_array_equal(cache.get((19,)), 19.)
+        self.assertNotEqual(blockcache.conf_hash(self.confs[0]),
+                            blockcache.conf_hash(self.confs[0][:2]))
+        self.assertEqual(blockcache.conf_hash(self.confs),
+                         blockcache.conf_hash([np.array(x) for x in self.confs]))
+
+
+def dense_k3_ee(conf1, conf2, sig, rc, steps):
+    """ NumPy transcription of the single-species theano graph of the 3-body kernel """
+    r1j, r2m = np.linalg.norm(conf1[:, :3], axis=1), np.linalg.norm(conf2[:, :3], axis=1)
+    rjk = np.linalg.norm(conf1[None, :, :3] - conf1[:, None, :3], axis=2)
+    rmn = np.linalg.norm(conf2[None, :, :3] - conf2[:, None, :3], axis=2)
+    se = lambda a, b: np.exp(-(a - b) ** 2 / (2 * sig ** 2))
+    se_1j2m, se_jkmn = se(r1j[:, None], r2m[None]), se(rjk[:, :, None, None], rmn[None, None])
+    se_jk2m, se_1jmn = se(rjk[:, :, None], r2m[None, None]), se(r1j[:, None, None], rmn[None])
+    ker = (se_1j2m[:, None, :, None] * se_1j2m[None, :, None, :] * se_jkmn +
+           se_1jmn[:, None, :, :] * se_jk2m[:, :, None, :] * se_1j2m[None, :, :, None] +
+           se_1j2m[:, None, None, :] * se_jk2m[:, :, :, None] * se_1jmn[None, :, :, :])
+
+    def cut(r, step):
+        return 0.5 * (1 + np.cos(np.pi * r / rc)) * ((np.sign(rc - r) + 1) / 2 if step else 1)
+
+    cj, cm = cut(r1j, steps[0]), cut(r2m, steps[0])
+    cjk = cj[:, None] * cj[None] * cut(rjk, steps[1]) * (np.triu(np.ones_like(rjk), 1))
+    cmn = cm[:, None] * cm[None] * cut(rmn, steps[1]) * (1 - np.eye(len(rmn)))
+    return np.sum(ker * cjk[:, :, None, None] * cmn[None, None])
+
+
+class TestTriplets(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.confs = [random_conf(rng, m, (1, 2)) for m in (5, 6, 4)]
+        for conf in self.confs:
+            conf[:, :3] *= 0.7
+
+    def test_matches_theano_graph(self):
+        c1, c2 = self.confs[0].copy(), self.confs[1].copy()
+        c1[:, 3:], c2[:, 3:] = 1, 1
+        for steps in ((True, True), (False, True), (False, False)):
+            k, = threebodykernel.triplet_kernel(Triplets(c1), Triplets(c2), 0.9, 3.2, steps)
+            self.assertAlmostEqual(k, dense_k3_ee(c1, c2, 0.9, 3.2, steps))
+
+    def test_valid_triplets(self):
+        conf = self.confs[1].copy()
+        conf[:, 3:] = 1
+        conf[0, :3], conf[1, :3] = [1.5, 0, 0], [-1.5, 0, 0]
+        t = Triplets(conf)
+        self.assertLess(len(t.valid(2.5).w), len(t))
+        k, = threebodykernel.triplet_kernel(t, t, 0.9, 2.5)
+        self.assertAlmostEqual(k, dense_k3_ee(conf, conf, 0.9, 2.5, (True, True)))
+
+    def test_chunks(self):
+        t1, t2 = Triplets(self.confs[0]), Triplets(self.confs[1])
+        for multi in (False, True):
+            for derivatives in (0, 1, 2):
+                full = threebodykernel.triplet_kernel(t1, t2, 0.9, 3.2, multi=multi,
+                                                      derivatives=derivatives)
+                chunked = threebodykernel.triplet_kernel(t1, t2, 0.9, 3.2, multi=multi,
+                                                         derivatives=derivatives, max_bytes=2000)
+                for a, b in zip(full, chunked):
+                    np.testing.assert_allclose(a, b, atol=1e-12)
+
+    def test_derivatives(self):
+        eps, shift = 1e-4, np.eye(3) * 1e-4
+        three_body = threebodykernel.ThreeBodyManySpeciesKernel(engine='numpy')
+        many_body = manybodykernel.ManyBodySingleSpeciesKernel(engine='numpy')
+        for k_ee, k_ef, k_ff in ((three_body.k3_ee, three_body.k3_ef, three_body.k3_ff),
+                                 (many_body.km_ee, many_body.km_ef, many_body.km_ff)):
+
+            # Moving the central atom by d moves the neighbours by -d
+            def ee(d1, d2):
+                return k_ee(self.confs[0] - np.r_[d1, 0, 0], self.confs[1] - np.r_[d2, 0, 0],
+                            0.9, 1., 3.2)
+
+            z = np.zeros(3)
+            np.testing.assert_allclose(
+                k_ef(self.confs[0], self.confs[1], 0.9, 1., 3.2),
+                [-(ee(z, s) - ee(z, -s)) / (2 * eps) for s in shift], atol=1e-6)
+            np.testing.assert_allclose(
+                k_ff(self.confs[0], self.confs[1], 0.9, 1., 3.2),
+                [[(ee(a, b) - ee(a, -b) - ee(-a, b) + ee(-a, -b)) / (4 * eps ** 2)
+                  for b in shift] for a in shift], atol=1e-5)
+
+    def test_single_precision(self):
+        t1, t2 = Triplets(self.confs[0]), Triplets(self.confs[1])
+        for multi in (False, True):
+            ref = threebodykernel.triplet_kernel(t1, t2, 0.9, 3.2, multi=multi, derivatives=2)
+            terms = threebodykernel.triplet_kernel(t1, t2, 0.9, 3.2, multi=multi, derivatives=2,
+                                                   max_bytes=2000, dtype='float32')
+            for a, b in zip(ref, terms):
+                np.testing.assert_allclose(a, b, rtol=1e-4, atol=1e-5)
+
+    def test_species_sorted(self):
+        rng = np.random.RandomState(1)
+        X = [random_conf(rng, m, (1, 2, 3)) for m in (5, 6, 4)]
+        t1, t2 = Triplets(X[0]), Triplets(X[1])
+        self.assertEqual(sum(len(l.w) for l in t1.species_groups(3.2).values()),
+                         len(t1.valid(3.2).w))
+        for derivatives in (0, 1, 2):
+            ref = threebodykernel.triplet_kernel(t1, t2, 0.9, 3.2, multi=True,
+                                                 derivatives=derivatives)
+            terms = threebodykernel.triplet_kernel(t1, t2, 0.9, 3.2, multi=True,
+                                                   derivatives=derivatives, max_bytes=2000,
+                                                   species_sorted=True)
+            for a, b in zip(ref, terms):
+                np.testing.assert_allclose(a, b, atol=1e-12)
+
+        for cls in (threebodykernel.ThreeBodyManySpeciesKernel,
+                    manybodykernel.ManyBodyManySpeciesKernel):
+            ref = cls(theta=(0.9, 1., 3.2), engine='numpy')
+            kernel = cls(theta=(0.9, 1., 3.2), engine='numpy', species_sorted=True)
+            np.testing.assert_allclose(kernel.calc_gram(X), ref.calc_gram(X), atol=1e-12)
+
+    def test_sum_cache(self):
+        t1, t2 = Triplets(self.confs[0]), Triplets(self.confs[1])
+        cache = blockcache.BlockCache()
+        for derivatives in (2, 0, 1):
+            ref = threebodykernel.triplet_kernel(t1, t2, 0.9, 3.2, derivatives=derivatives)
+            terms = threebodykernel.cached_triplet_kernel(cache, t1, t2, 0.9, 3.2,
+                                                          derivatives=derivatives)
+            for a, b in zip(ref, terms):
+                np.testing.assert_allclose(a, b, atol=1e-12)
+        self.assertEqual(len(cache), 1)
+
+        ref = manybodykernel.ManyBodyManySpeciesKernel(theta=(0.9, 1., 3.2), engine='numpy')
+        kernel = manybodykernel.ManyBodyManySpeciesKernel(theta=(0.9, 1., 3.2), engine='numpy',
+                                                          sum_cache=blockcache.BlockCache())
+        np.testing.assert_allclose(kernel.calc_gram(self.confs), ref.calc_gram(self.confs))
+        misses = kernel.sum_cache.misses
+        np.testing.assert_allclose(kernel.calc_diag_e(self.confs), ref.calc_diag_e(self.confs))
+        self.assertEqual(kernel.sum_cache.misses, misses)
+
+        # The many-species 3-body kernel has the same cutoff steps and shares the sums
+        ref = threebodykernel.ThreeBodyManySpeciesKernel(theta=(0.9, 1., 3.2), engine='numpy')
+        three = threebodykernel.ThreeBodyManySpeciesKernel(theta=(0.9, 1., 3.2), engine='numpy',
+                                                           sum_cache=kernel.sum_cache)
+        hits = kernel.sum_cache.hits
+        np.testing.assert_allclose(three.calc_gram(self.confs), ref.calc_gram(self.confs))
+        self.assertEqual(kernel.sum_cache.misses, misses)
+        self.assertGreater(kernel.sum_cache.hits, hits)
+        with self.assertRaises(ValueError):
+            threebodykernel.ThreeBodyManySpeciesKernel(sum_cache=blockcache.BlockCache())
+
+    def test_triplet_window(self):
+        rng = np.random.RandomState(2)
+        X = [random_conf(rng, m, (1, 2)) for m in (8, 9, 7)]
+        t1, t2 = Triplets(X[0]), Triplets(X[1])
+        sig, tol = 0.2, 1e-6
+        indptr, indices = threebodykernel.triplet_neighbours(
+            t1, t2, 3.2, (True, True), sig * np.sqrt(2 * np.log(1 / tol)))
+        skipped = len(t1.valid(3.2).w) * len(t2.valid(3.2).w) - len(indices)
+        self.assertGreater(skipped, 0)
+        for multi in (False, True):
+            for derivatives in (0, 1, 2):
+                ref = threebodykernel.triplet_kernel(t1, t2, sig, 3.2, multi=multi,
+                                                     derivatives=derivatives)
+                terms = threebodykernel.triplet_kernel(t1, t2, sig, 3.2, multi=multi,
+                                                       derivatives=derivatives, max_bytes=2000,
+                                                       window_tol=tol)
+                orders = ((0,), (0, 1), (0, 1, 1, 2))[derivatives]
+                for a, b, order in zip(ref, terms, orders):
+                    np.testing.assert_allclose(a, b, atol=1e-3)
+                    bound = threebodykernel.window_bound(sig, 3.2, tol, order) * skipped
+                    self.assertLessEqual(np.abs(a - b).max(), bound)
+
+        # The bound of the hessian grows as 1 / sig^2, well above the tolerance
+        tol = 1e-4
+        indptr, indices = threebodykernel.triplet_neighbours(
+            t1, t2, 3.2, (True, True), sig * np.sqrt(2 * np.log(1 / tol)))
+        skipped = len(t1.valid(3.2).w) * len(t2.valid(3.2).w) - len(indices)
+        ref = threebodykernel.triplet_kernel(t1, t2, sig, 3.2, derivatives=2)
+        terms = threebodykernel.triplet_kernel(t1, t2, sig, 3.2, derivatives=2, window_tol=tol)
+        for a, b, order in zip(ref, terms, (0, 1, 1, 2)):
+            bound = threebodykernel.window_bound(sig, 3.2, tol, order) * skipped
+            self.assertLessEqual(np.abs(a - b).max(), bound)
+
+        for cls in (threebodykernel.ThreeBodySingleSpeciesKernel,
+                    threebodykernel.ThreeBodyManySpeciesKernel):
+            ref = cls(theta=(sig, 1., 3.2), engine='numpy')
+            kernel = cls(theta=(sig, 1., 3.2), engine='numpy', window_tol=tol)
+            np.testing.assert_allclose(kernel.calc_gram(X), ref.calc_gram(X), atol=1e-3)
+            with self.assertRaises(ValueError):
+                cls(window_tol=tol)
+
+    def test_gp_keeps_descriptors(self):
+        kernel = threebodykernel.ThreeBodyManySpeciesKernel(theta=(0.9, 1., 3.2), engine='numpy')
+        model = gp.GaussianProcess(kernel=kernel, noise=1e-8)
+        forces = np.random.RandomState(1).rand(len(self.confs), 3)
+        model.fit(self.confs, forces)
+        self.assertTrue(all(isinstance(d, Triplets) for d in model.D_train_))
+        self.assertEqual(model.dtype_, 'float64')
+        np.testing.assert_allclose(model.predict(self.confs), forces, atol=1e-3)
+
+
+class TestNumbaEngine(unittest.TestCase):
+
+    def setUp(self):
+        if numbaengine.numba is None:
+            self.skipTest('numba is not installed')
+        rng = np.random.RandomState(0)
+        self.confs = [random_conf(rng, m, (1, 2)) for m in (5, 6, 4)]
+
+    def test_matches_numpy_engine(self):
+        for cls, prefix in ((twobodykernel.TwoBodySingleSpeciesKernel, 'k2'),
+                            (twobodykernel.TwoBodyManySpeciesKernel, 'k2'),
+                            (threebodykernel.ThreeBodySingleSpeciesKernel, 'k3'),
+                            (threebodykernel.ThreeBodyManySpeciesKernel, 'k3'),
+                            (manybodykernel.ManyBodySingleSpeciesKernel, 'km'),
+                            (manybodykernel.ManyBodyManySpeciesKernel, 'km')):
+            ref = cls(theta=(0.9, 1., 3.2), engine='numpy')
+            kernel = cls(theta=(0.9, 1., 3.2), engine='numba')
+            for mode in ('ee', 'ef', 'ff'):
+                name = prefix + '_' + mode
+                np.testing.assert_allclose(
+                    getattr(kernel, name)(self.confs[0], self.confs[1], 0.9, 1., 3.2),
+                    getattr(ref, name)(self.confs[0], self.confs[1], 0.9, 1., 3.2), atol=1e-10)
+            np.testing.assert_allclose(kernel.calc_gram(self.confs), ref.calc_gram(self.confs),
+                                       atol=1e-10)
+
+    def test_eam_matches_numpy_engine(self):
+        glob = [self.confs[:2], self.confs[1:]]
+        for cls in (eamkernel.EamSingleSpeciesKernel, eamkernel.EamManySpeciesKernel):
+            ref = cls(theta=(0.9, 3.2, 1.1), engine='numpy')
+            kernel = cls(theta=(0.9, 3.2, 1.1), engine='numba')
+            for mode in ('ee', 'ef', 'ff'):
+                name = 'k2_' + mode
+                np.testing.assert_allclose(
+                    getattr(kernel, name)(self.confs[0], self.confs[1], 0.9, 3.2, 1.1),
+                    getattr(ref, name)(self.confs[0], self.confs[1], 0.9, 3.2, 1.1), atol=1e-10)
+            for method, args in (('calc', (self.confs, self.confs[1:])),
+                                 ('calc_ef', (glob, self.confs)),
+                                 ('calc_ee', (glob, glob)),
+                                 ('calc_gram', (self.confs,))):
+                np.testing.assert_allclose(getattr(kernel, method)(*args),
+                                           getattr(ref, method)(*args), atol=1e-10)
+
+    def test_eam_derivatives(self):
+        eps, shift = 1e-4, np.eye(3) * 1e-4
+        kernel = eamkernel.EamManySpeciesKernel(theta=(0.7, 3.2, 1.1), engine='numba')
+        c1, c2 = self.confs[0], self.confs[1].copy()
+        c2[:, 3] = c1[0, 3]
+
+        def ee(d1, d2):
+            return kernel.k2_ee(c1 - np.r_[d1, 0, 0], c2 - np.r_[d2, 0, 0], 0.7, 3.2, 1.1)
+
+        z = np.zeros(3)
+        np.testing.assert_allclose(kernel.k2_ef(c1, c2, 0.7, 3.2, 1.1),
+                                   [-(ee(z, s) - ee(z, -s)) / (2 * eps) for s in shift], atol=1e-7)
+        np.testing.assert_allclose(
+            kernel.k2_ff(c1, c2, 0.7, 3.2, 1.1),
+            [[(ee(a, b) - ee(a, -b) - ee(-a, b) + ee(-a, -b)) / (4 * eps ** 2) for b in shift]
+             for a in shift], atol=1e-5)
+        q1 = eamkernel.eam_descriptors([c1], 3.2, 1.1, engine='numba')[0][0]
+        self.assertAlmostEqual(kernel.k2_ee_d(q1, c2, 0.7, 3.2, 1.1, c1[0, 3]),
+                               kernel.k2_ee(c1, c2, 0.7, 3.2, 1.1))
+        c2[:, 3] = 3
+        self.assertEqual(kernel.k2_ee(c1, c2, 0.7, 3.2, 1.1), 0)
+
+    def test_matches_theano(self):
+        try:
+            import theano  # noqa: F401
+        except ImportError:
+            self.skipTest('theano is not installed')
+        for cls, theta in ((twobodykernel.TwoBodyManySpeciesKernel, (0.9, 1., 3.2)),
+                           (threebodykernel.ThreeBodyManySpeciesKernel, (0.9, 1., 3.2)),
+                           (manybodykernel.ManyBodyManySpeciesKernel, (0.9, 1., 3.2)),
+                           (eamkernel.EamManySpeciesKernel, (0.9, 3.2, 1.1))):
+            ref, kernel = cls(theta=theta), cls(theta=theta, engine='numba')
+            for method in ('calc_gram', 'calc_gram_e'):
+                X = self.confs if method == 'calc_gram' else [self.confs]
+                np.testing.assert_allclose(getattr(kernel, method)(X), getattr(ref, method)(X),
+                                           rtol=1e-8, atol=1e-10)
+
+
+class TestEamDescriptors(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.confs = [random_conf(rng, m, (1, 2)) for m in (5, 6, 4, 7)]
+        self.glob = [self.confs[:2], self.confs[2:]]
+
+    def test_matches_pair_kernels(self):
+        for cls in (eamkernel.EamSingleSpeciesKernel, eamkernel.EamManySpeciesKernel):
+            kernel = cls(theta=(0.7, 3.2, 1.1), engine='numpy')
+            np.testing.assert_allclose(
+                kernel.calc_gram(self.confs),
+                np.block([[kernel.k2_ff(c1, c2, 0.7, 3.2, 1.1) for c2 in self.confs]
+                          for c1 in self.confs]), atol=1e-12)
+            np.testing.assert_allclose(
+                kernel.calc_gram_e(self.glob),
+                [[0.25 * sum(kernel.k2_ee(c1, c2, 0.7, 3.2, 1.1) for c1 in x1 for c2 in x2)
+                  for x2 in self.glob] for x1 in self.glob], atol=1e-12)
+            np.testing.assert_allclose(
+                kernel.calc_gram_ef(self.confs, self.glob),
+                [np.concatenate([0.5 * sum(kernel.k2_ef(c1, c2, 0.7, 3.2, 1.1) for c1 in x1)
+                                 for c2 in self.confs]) for x1 in self.glob], atol=1e-12)
+
+    def test_mapping(self):
+        kernel = eamkernel.EamManySpeciesKernel(theta=(0.7, 3.2, 1.1), engine='numpy')
+        conf = self.confs[0]
+        q, _, _ = eamkernel.eam_descriptors([conf], 3.2, 1.1)
+        np.testing.assert_allclose(
+            kernel.calc_ee(q, self.glob, mapping=True, alpha_1_descr=conf[0, 3]),
+            2 * kernel.calc_ee([[conf]], self.glob), atol=1e-12)
+        np.testing.assert_allclose(
+            kernel.calc_ef(q, self.confs, mapping=True, alpha_1_descr=conf[0, 3]),
+            2 * kernel.calc_ef([[conf]], self.confs), atol=1e-12)
+
+    def test_derivatives(self):
+        eps, shift = 1e-4, np.eye(3) * 1e-4
+        kernel = eamkernel.EamManySpeciesKernel(theta=(0.7, 3.2, 1.1), engine='numpy')
+        c1, c2 = self.confs[0], self.confs[1].copy()
+        c2[:, 3] = c1[0, 3]
+
+        def ee(d1, d2):
+            return kernel.k2_ee(c1 - np.r_[d1, 0, 0], c2 - np.r_[d2, 0, 0], 0.7, 3.2, 1.1)
+
+        z = np.zeros(3)
+        np.testing.assert_allclose(kernel.k2_ef(c1, c2, 0.7, 3.2, 1.1),
+                                   [-(ee(z, s) - ee(z, -s)) / (2 * eps) for s in shift], atol=1e-7)
+        np.testing.assert_allclose(
+            kernel.k2_ff(c1, c2, 0.7, 3.2, 1.1),
+            [[(ee(a, b) - ee(a, -b) - ee(-a, b) + ee(-a, -b)) / (4 * eps ** 2) for b in shift]
+             for a in shift], atol=1e-5)
+
+
+class TestGramGradient(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.confs = [random_conf(rng, m, (1, 2)) for m in (4, 5, 6)]
+        for conf in self.confs:
+            conf[:, :3] *= 0.7
+
+    def test_finite_differences(self):
+        for cls, theta in ((twobodykernel.TwoBodyManySpeciesKernel, (0.8, 1., 3.2)),
+                           (threebodykernel.ThreeBodySingleSpeciesKernel, (0.8, 1., 3.2)),
+                           (threebodykernel.ThreeBodyManySpeciesKernel, (0.8, 1., 3.2)),
+                           (eamkernel.EamManySpeciesKernel, (0.7, 3.2, 1.1))):
+            kernel = cls(theta=np.array(theta), engine='numpy')
+            gram, gradient = kernel.calc_gram(self.confs, eval_gradient=True)
+            np.testing.assert_allclose(gram, kernel.calc_gram(self.confs), atol=1e-12)
+            for i, eps in enumerate(np.eye(3) * 1e-6):
+                kernel.theta = np.array(theta) + eps
+                plus = kernel.calc_gram(self.confs)
+                kernel.theta = np.array(theta) - eps
+                minus = kernel.calc_gram(self.confs)
+                np.testing.assert_allclose(gradient[:, :, i], (plus - minus) / 2e-6, atol=1e-7)
+
+    def test_parallel(self):
+        kernel = threebodykernel.ThreeBodySingleSpeciesKernel(theta=[0.8, 1., 3.2], engine='numpy')
+        gram, gradient = kernel.calc_gram(self.confs, eval_gradient=True)
+        gram_2, gradient_2 = kernel.calc_gram(self.confs, ncores=2, eval_gradient=True)
+        kernel.close_pool()
+        np.testing.assert_allclose(gram_2, gram, atol=1e-12)
+        np.testing.assert_allclose(gradient_2, gradient, atol=1e-12)
+
+    def test_optimizer(self):
+        kernel = twobodykernel.TwoBodySingleSpeciesKernel(theta=[2., 1., 3.2],
+                                                          bounds=((0.1, 10.), (1., 1.), (3.2, 3.2)),
+                                                          engine='numpy')
+        model = gp.GaussianProcess(kernel=kernel, noise=1e-4, optimizer='fmin_l_bfgs_b')
+        forces = np.random.RandomState(1).rand(len(self.confs), 3)
+        model.D_train_, model.y_train_ = self.confs, forces.reshape(-1, 1)
+        lml, grad = model.log_marginal_likelihood(np.array([2., 1., 3.2]), eval_gradient=True)
+        plus = model.log_marginal_likelihood(np.array([2. + 1e-6, 1., 3.2]))
+        minus = model.log_marginal_likelihood(np.array([2. - 1e-6, 1., 3.2]))
+        np.testing.assert_allclose(grad[0], (plus - minus) / 2e-6, rtol=1e-6)
+
+        kernel.theta = [2., 1., 3.2]
+        model.fit(self.confs, forces)
+        self.assertGreaterEqual(model.log_marginal_likelihood_value_, lml)
+        self.assertNotEqual(model.kernel_.theta[0], 2.)
+
+    def test_restarts(self):
+        forces = np.random.RandomState(1).rand(len(self.confs), 3)
+        starts = []
+        for _ in range(2):
+            kernel = twobodykernel.TwoBodySingleSpeciesKernel(
+                theta=[2., 1., 3.2], bounds=((0.1, 10.), (1., 1.), (3.2, 3.2)), engine='numpy')
+            model = gp.GaussianProcess(kernel=kernel, noise=1e-4, optimizer='fmin_l_bfgs_b',
+                                       n_restarts_optimizer=2, random_state=3)
+            with mock.patch.object(model, '_constrained_optimization',
+                                   side_effect=lambda f, theta, bounds: (theta, f(theta, False))
+                                   ) as optimization:
+                model.fit(self.confs, forces)
+            starts.append([call[0][1] for call in optimization.call_args_list])
+        self.assertEqual(len(starts[0]), 3)
+        self.assertNotEqual(starts[0][1][0], starts[0][2][0])
+        np.testing.assert_array_equal(starts[0], starts[1])
+
+
+class TestGramFile(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.confs = [random_conf(rng, 6, (1,)) for _ in range(11)]
+        self.kernel = twobodykernel.TwoBodySingleSpeciesKernel(theta=[0.8, 1., 3.2], engine='numpy')
+        self.gram = self.kernel.calc_gram(self.confs)
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'gram.dat')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_resume(self):
+        calc = self.kernel.calc
+        with mock.patch.object(self.kernel, 'calc',
+                               side_effect=[calc(self.confs[4:8], self.confs[:4]), RuntimeError]):
+            with self.assertRaises(RuntimeError):
+                outofcore.GramFile(self.path, self.kernel, self.confs, tile_size=4).compute()
+
+        gram = outofcore.GramFile(self.path, self.kernel, self.confs, tile_size=4)
+        self.assertEqual(gram.tiles, {(0, 0), (1, 0), (1, 1)})
+        with mock.patch.object(self.kernel, 'calc', wraps=calc) as m:
+            np.testing.assert_allclose(gram.compute(), self.gram, atol=1e-14)
+        self.assertEqual(m.call_count, 2)
+
+        # Another kernel starts from scratch
+        self.kernel.theta = [0.9, 1., 3.2]
+        self.assertEqual(outofcore.GramFile(self.path, self.kernel, self.confs, 4).tiles, set())
+
+    def test_cholesky(self):
+        gram = outofcore.GramFile(self.path, self.kernel, self.confs, tile_size=4)
+        gram.compute()
+        ref = np.linalg.cholesky(self.gram + 1e-3 * np.eye(len(self.gram)))
+        np.testing.assert_allclose(np.tril(gram.cholesky(1e-3)), ref, atol=1e-12)
+
+        # An interrupted factorization resumes from its finished panels
+        with open(gram.ledger_path) as f:
+            lines = f.read().split('\n')
+        with open(gram.ledger_path, 'w') as f:
+            f.write('\n'.join(lines[:-3]) + '\npan')
+        gram = outofcore.GramFile(self.path, self.kernel, self.confs, tile_size=4)
+        self.assertEqual(sorted(gram.panels), [0])
+        np.testing.assert_allclose(np.tril(gram.cholesky(1e-3)), ref, atol=1e-12)
+        np.testing.assert_allclose(gram.compute(), self.gram, atol=1e-14)
+
+        forces = np.random.RandomState(1).rand(len(self.confs), 3)
+        model = gp.GaussianProcess(kernel=self.kernel, noise=1e-3).fit(self.confs, forces)
+        alpha, predicted = model.alpha_, model.predict(self.confs[:2])
+        model.fit(self.confs, forces, gram_file=self.path)
+        self.assertIsNone(model.K)
+        np.testing.assert_allclose(model.alpha_, alpha, rtol=1e-8)
+        np.testing.assert_allclose(model.predict(self.confs[:2]), predicted, rtol=1e-8)
+
+
+class TestSpeciesBlocks(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.confs = [random_conf(rng, 5, species) for species in ((1, 2), (3, 4)) * 4]
+        for conf in self.confs:
+            conf[:, :3] *= 0.7
+
+    def test_components(self):
+        labels = speciesblocks.species_components(self.confs)
+        self.assertTrue(set(labels[::2]).isdisjoint(labels[1::2]))
+        self.assertEqual(sum(len(b) for b in speciesblocks.species_partition(self.confs)),
+                         len(self.confs))
+        self.assertEqual(speciesblocks.species_signature(self.confs[:2]),
+                         speciesblocks.species_signature(self.confs[0]) |
+                         speciesblocks.species_signature(Triplets(self.confs[1])))
+
+    def test_skipped_blocks(self):
+        for cls in (twobodykernel.TwoBodyManySpeciesKernel,
+                    threebodykernel.ThreeBodyManySpeciesKernel):
+            kernel = cls(theta=(0.9, 1., 3.2), engine='numpy')
+            ref = cls(theta=(0.9, 1., 3.2), engine='numpy')
+            ref.species_zeros = False
+            gram = ref.calc_gram(self.confs)
+            self.assertFalse(gram.reshape(8, 3, 8, 3)[::2, :, 1::2].any())
+            np.testing.assert_allclose(kernel.calc_gram(self.confs), gram, atol=1e-12)
+            np.testing.assert_allclose(kernel.calc(self.confs[:3], self.confs[2:]),
+                                       ref.calc(self.confs[:3], self.confs[2:]), atol=1e-12)
+            if cls is threebodykernel.ThreeBodyManySpeciesKernel:
+                grams = kernel.calc_gram(self.confs, eval_gradient=True)
+                for a, b in zip(grams, ref.calc_gram(self.confs, eval_gradient=True)):
+                    np.testing.assert_allclose(a, b, atol=1e-12)
+
+    def test_array_input(self):
+        kernel = twobodykernel.TwoBodyManySpeciesKernel(theta=(0.9, 1., 3.2), engine='numpy')
+        gram = kernel.calc_gram(self.confs)
+        X = np.array(self.confs)
+        ragged = np.empty(len(self.confs), dtype=object)
+        ragged[:] = [conf[:4 + i % 2] for i, conf in enumerate(self.confs)]
+        for X, ref in ((X, gram), (ragged, kernel.calc_gram(list(ragged)))):
+            with mock.patch.object(speciesblocks, 'species_partition',
+                                   wraps=speciesblocks.species_partition) as partition:
+                np.testing.assert_allclose(kernel.calc_gram(X), ref, atol=1e-12)
+            partition.assert_called_once()
+            with mock.patch.object(speciesblocks, 'species_components',
+                                   wraps=speciesblocks.species_components) as components:
+                np.testing.assert_allclose(kernel.calc(X[:3], X[2:]),
+                                           ref[:9, 6:], atol=1e-12)
+            components.assert_called_once()
+
+    def test_gp_blocks(self):
+        kernel = twobodykernel.TwoBodyManySpeciesKernel(theta=(0.9, 1., 3.2), engine='numpy')
+        forces = np.random.RandomState(1).rand(len(self.confs), 3)
+        model = gp.GaussianProcess(kernel=kernel, noise=1e-4).fit(self.confs, forces)
+        self.assertGreater(len(model.L_blocks_), 1)
+        self.assertIsNone(model.L_)
+
+        kernel = twobodykernel.TwoBodyManySpeciesKernel(theta=(0.9, 1., 3.2), engine='numpy')
+        kernel.species_zeros = False
+        ref = gp.GaussianProcess(kernel=kernel, noise=1e-4).fit(self.confs, forces)
+        np.testing.assert_allclose(model.alpha_, ref.alpha_, atol=1e-8)
+        np.testing.assert_allclose(model.predict(self.confs[:3]), ref.predict(self.confs[:3]),
+                                   atol=1e-8)
+        np.testing.assert_allclose(model.gram_inverse(), ref.gram_inverse(), atol=1e-6)
+
+        K_trans = ref.kernel_.calc(self.confs[:3], ref.D_train_)
+        with mock.patch.object(model, 'gram_inverse', side_effect=AssertionError):
+            fit = model._variance_fit(K_trans)
+        np.testing.assert_allclose(fit, ref._variance_fit(K_trans), atol=1e-6)
+
+    def test_save_and_load(self):
+        kernel = twobodykernel.TwoBodyManySpeciesKernel(theta=(0.9, 1., 3.2), engine='numpy',
+                                                        dtype='float32')
+        forces = np.random.RandomState(1).rand(len(self.confs), 3)
+        model = gp.GaussianProcess(kernel=kernel, noise=1e-4).fit(self.confs, forces)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'gp.npy')
+            model.save(path)
+            kernel = twobodykernel.TwoBodyManySpeciesKernel(theta=(0.9, 1., 3.2), engine='numpy',
+                                                            dtype='float32')
+            loaded = gp.GaussianProcess(kernel=kernel)
+            loaded.load(path)
+        self.assertEqual(loaded.dtype_, 'float32')
+        self.assertIsNone(loaded.L_)
+        self.assertEqual(len(loaded.L_blocks_), len(model.L_blocks_))
+        for (rows, L), (rows_ref, L_ref) in zip(loaded.L_blocks_, model.L_blocks_):
+            np.testing.assert_array_equal(rows, rows_ref)
+            np.testing.assert_array_equal(L, L_ref)
+        np.testing.assert_allclose(loaded.predict(self.confs[:3]), model.predict(self.confs[:3]),
+                                   atol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()